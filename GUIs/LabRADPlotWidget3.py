@@ -1,3 +1,4 @@
+import os
 import sys
 
 from PyQt4 import Qt, QtCore
@@ -8,8 +9,10 @@ from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 
-UPDATE_PERIOD = 1.0          # (in seconds)
-DR_LOGGER_CHECK_SKIP = 1     # check the DR Logger every X updates
+from plot_buffer import DataBuffer, decimate
+
+UPDATE_PERIOD = 1.0          # (in seconds) redraw at most this often
+DR_LOGGER_CHECK_SKIP = 5     # check the DR Logger every X updates
 TIME_DELAY_WARNING = 10      # display in bold red if last data point older than X seconds
 COLORS = ['red', 'green', 'blue', 'magenta', 'black', 'darkgoldenrod',
           'Brown', 'darkslategrey', 'orangered', 'OliveDrab']
@@ -17,6 +20,9 @@ plt.rcParams['axes.color_cycle'] = COLORS
 PLOT_BACKGROUND = '#E5E5E5'  # HTML colors are allowed
 NEW_DATASET_SIGNAL = 99901
 NEW_DATA_SIGNAL = 99902
+FETCH_ROWS = 5000            # rows to get from the data vault at a time
+MAX_ROWS = 500000            # keep (at least) the latest X rows
+MAX_DRAWN_POINTS = 4000      # draw at most about X points per line
 
 HISTORY_TOOLTIP = """For example:
 60 - last 60 data points
@@ -27,6 +33,9 @@ HISTORY_TOOLTIP = """For example:
 FILTER_TOOLTIP = """Filter out excess points to make graph more responsive.
 This means not all data will be displayed for long histories or small numbers of points."""
 
+REFRESH_TOOLTIP = """CPU time taken to redraw the plots (moving average),
+and the number of rows in memory."""
+
 NO_SERVER_STYLE = 'QLabel {color: red; font-weight: bold; font-size: 15pt;}'
 NO_SERVER_TEXT = 'Not Running!'
 NOT_LOGGING_STYLE = NO_SERVER_STYLE
@@ -39,6 +48,14 @@ TIME_DELAY_STYLE = 'QLabel {color: darkorange; font-weight: bold; font-size: 15p
 TIME_UNKNOWN_STYLE = 'QLabel {color: purple; font-weight: bold; font-size: 15pt;}'
 TIME_NORMAL_STYLE = 'QLabel {color: black; font-size: 12pt;}'
 ERROR_TITLE_STYLE = 'QLabel {color: red; font-weight: bold; font-size: 15pt;}'
+REFRESH_TEXT = """Plot refresh: {time} ms CPU
+{rows} rows"""
+
+
+def cpuTime():
+    """ User + system CPU time of this process, in seconds. """
+    t = os.times()
+    return t[0] + t[1]
 
 # noinspection PyAttributeOutsideInit
 class LabRADPlotWidget3(Qt.QWidget):
@@ -60,6 +77,7 @@ class LabRADPlotWidget3(Qt.QWidget):
         # create the qt basics
         self.drLoggerName = drLoggerName
         self.drLoggerCounter = 0
+        self.refreshTime = None
         self.layout = Qt.QHBoxLayout(self)
         self.optionsLayout = Qt.QVBoxLayout()
         self.layout.addLayout(self.optionsLayout)
@@ -67,10 +85,20 @@ class LabRADPlotWidget3(Qt.QWidget):
         # the plots will be in a tabbed window thing
         self.tab = Qt.QTabWidget(self)
         self.layout.addWidget(self.tab)
+        self.lines = []
+        self.staleCanvases = set()
+        self.tab.currentChanged.connect(self.drawCurrentTab)
+        # the rows of the dataset, with the x-axis converted and zeroed
+        self.buffer = DataBuffer(maxRows=MAX_ROWS)
+        self.rebuildPlot = False
+        self.dirtyPlots = False
         # labrad variables
         self.path = path if path is not None else []
         self.dataset = dataset
         self.waitingOnLabrad = False
+        self.dataPending = False
+        self.fetchFailed = False
+        self.listening = False
         # start the labrad connection
         if cxn is None:
             self.ownCxn = True
@@ -98,6 +126,11 @@ class LabRADPlotWidget3(Qt.QWidget):
     def closeEvent(self, event):
         self.destroyPlot()
         self.updateTimer.stop()
+        if self.listening:
+            dv = self.cxn.data_vault
+            dv.removeListener(listener=self.switchDataset, context=self.ctx, ID=NEW_DATASET_SIGNAL)
+            dv.removeListener(listener=self.dataAvailable, context=self.ctx, ID=NEW_DATA_SIGNAL)
+            self.listening = False
         if self.ownCxn:
             self.cxn.disconnect()
 
@@ -120,6 +153,8 @@ class LabRADPlotWidget3(Qt.QWidget):
         self.zeroXAxisCB = Qt.QCheckBox("Zero X-Axis", self)
         self.xAxisZero = None
         self.optionsLayout.addWidget(self.zeroXAxisCB)
+        for checkBox in [self.rescaleYCB, self.rescaleXCB]:
+            checkBox.stateChanged.connect(self.setDirty)
         # history widgets
         self.historyLE = Qt.QLineEdit(self)
         self.historyLE.setFixedWidth(120)
@@ -129,6 +164,7 @@ class LabRADPlotWidget3(Qt.QWidget):
         self.optionsLayout.addWidget(self._makeLine())
         self.optionsLayout.addWidget(label)
         self.optionsLayout.addWidget(self.historyLE)
+        self.historyLE.editingFinished.connect(self.setDirty)
         # units widgets
         tooltip = 'Any LabRAD unit. (Use min for minute.)'
         label = Qt.QLabel("X-Axis unit conversion:", self)
@@ -148,6 +184,13 @@ class LabRADPlotWidget3(Qt.QWidget):
         self.optionsLayout.addWidget(self.filterCB)
         self.optionsLayout.addWidget(label)
         self.optionsLayout.addWidget(self.maxPointsLE)
+        self.filterCB.stateChanged.connect(self.setDirty)
+        self.maxPointsLE.editingFinished.connect(self.setDirty)
+        # plot refresh time
+        self.refreshLabel = Qt.QLabel(REFRESH_TEXT.format(time='-', rows=0), self)
+        self.refreshLabel.setToolTip(REFRESH_TOOLTIP)
+        self.optionsLayout.addWidget(self._makeLine())
+        self.optionsLayout.addWidget(self.refreshLabel)
         # DR Logger server monitoring
         if self.drLoggerName:
             self.optionsLayout.addWidget(self._makeLine())
@@ -180,9 +223,10 @@ class LabRADPlotWidget3(Qt.QWidget):
 
     def setCxn(self, cxn):
         self.cxn = cxn
+        # our own context, so that widgets sharing a connection each get all the data
+        self.ctx = cxn.context()
         if self.dataset:
             self.loadDataset()
-        self.waitingOnLabrad = False
 
     def setDataset(self, path=None, dataset=None):
         if path:
@@ -195,7 +239,7 @@ class LabRADPlotWidget3(Qt.QWidget):
         return self.dataset
 
     def loadDataset(self):
-        p = self.cxn.data_vault.packet()
+        p = self.cxn.data_vault.packet(context=self.ctx)
         p.cd(self.path)
         p.dir()
         d = p.send()
@@ -212,34 +256,74 @@ class LabRADPlotWidget3(Qt.QWidget):
             else:
                 self.dataset = None
                 print "Dataset %s not found!" % self.dataset
-        p = self.cxn.data_vault.packet()
-        p.open(self.dataset)
-        p.send()
-        self.rebuildPlot = True
-        # automatically switch datasets when new one created in our current directory
-        dv = self.cxn.data_vault
-        dv.signal__new_dataset(NEW_DATASET_SIGNAL)
-        dv.addListener(listener=self.switchDataset, source=None, ID=NEW_DATASET_SIGNAL)
+        if not self.listening:
+            # automatically switch datasets when new one created in our current directory,
+            # and get new data when the data vault tells us there is some, instead of polling
+            dv = self.cxn.data_vault
+            p = dv.packet(context=self.ctx)
+            p.signal__new_dataset(NEW_DATASET_SIGNAL)
+            p.signal__data_available(NEW_DATA_SIGNAL)
+            p.send()
+            dv.addListener(listener=self.switchDataset, context=self.ctx, ID=NEW_DATASET_SIGNAL)
+            dv.addListener(listener=self.dataAvailable, context=self.ctx, ID=NEW_DATA_SIGNAL)
+            self.listening = True
+        if self.dataset:
+            self.openDataset()
 
     def switchDataset(self, msgContext, newDataset):
         # we've received a signal for a new dataset. switch to it.
         print "Switching dataset to: %s" % newDataset
         self.dataset = newDataset
-        p = self.cxn.data_vault.packet()
+        self.openDataset()
+
+    def openDataset(self):
+        """ Open self.dataset, and get its data from the start. """
+        self.rebuildPlot = True
+        self.xAxisZero = None
+        p = self.cxn.data_vault.packet(context=self.ctx)
         p.open(self.dataset)
-        p.send()
+        d = p.send()
+        d.addCallback(lambda response: self.fetchData())
 
-    def timerFunc(self):
+    def dataAvailable(self, msgContext, data):
+        # the data vault sends this once, after we have read all the data, when
+        # there are new rows, or right away if there are more rows to read.
+        self.fetchData()
+
+    def fetchData(self):
+        """ Get the rows we don't have yet. """
         if self.waitingOnLabrad:
+            # get them when the current request is done
+            self.dataPending = True
             return
-        if not self.dataset:
-            return
-        p = self.cxn.data_vault.packet()
+        self.waitingOnLabrad = True
+        self.dataPending = False
+        self.fetchFailed = False
+        p = self.cxn.data_vault.packet(context=self.ctx)
         if self.rebuildPlot:
             p.variables()
-        p.get(5000)         # don't grab the whole DS at once, just in case
+        p.get(FETCH_ROWS)         # don't grab the whole DS at once, just in case
         d = p.send()
         d.addCallback(self.datavaultCallback)
+        d.addErrback(self.fetchErrback)
+        d.addBoth(self.fetchDone)
+
+    def fetchErrback(self, failure):
+        # we won't be notified of new data until we read again, so try on the next update
+        print "Error getting data: %s" % failure.getErrorMessage()
+        self.fetchFailed = True
+
+    def fetchDone(self, result):
+        self.waitingOnLabrad = False
+        if self.dataPending:
+            self.fetchData()
+
+    def timerFunc(self):
+        if not self.dataset or self.cxn is None:
+            return
+        if self.fetchFailed:
+            self.fetchData()
+        self.refresh()
         # now check on the DR logger
         if self.drLoggerName and self.drLoggerCounter == 0:
             if self.drLoggerName not in self.cxn.servers:
@@ -261,6 +345,27 @@ class LabRADPlotWidget3(Qt.QWidget):
         self.drLoggerCounter += 1
         self.drLoggerCounter %= DR_LOGGER_CHECK_SKIP
 
+    def refresh(self):
+        """ Apply changes of the x-axis options, and redraw the plots if anything changed. """
+        if self.rebuildPlot or not self.lines:
+            return
+        start = cpuTime()
+        self.handleUnitConversion()
+        self.handleZeroing()
+        if not self.dirtyPlots:
+            return
+        self.plotNewData()
+        elapsed = cpuTime() - start
+        if self.refreshTime is None:
+            self.refreshTime = elapsed
+        else:
+            self.refreshTime += 0.2 * (elapsed - self.refreshTime)
+        self.refreshLabel.setText(REFRESH_TEXT.format(time='%.1f' % (self.refreshTime * 1e3),
+                                                      rows=len(self.buffer)))
+
+    def setDirty(self, *args):
+        self.dirtyPlots = True
+
     def drLoggerCallback(self, response, err=None):
         """ update the DR Logger monitoring stuff.
         if response is None, then there was no DR Logger server """
@@ -332,22 +437,30 @@ class LabRADPlotWidget3(Qt.QWidget):
                 self.drLoggerErrorsLayout.addWidget(label)
 
     def datavaultCallback(self, response):
-        self.newData = response.get
-        if hasattr(self.newData, 'asarray'):  # Backwards compatibility
-            self.newData = self.newData.asarray
-        if len(self.newData):
-            self.last_data_time = self.newData[-1, 0]
+        if self.rebuildPlot and 'variables' not in response.settings:
+            # rows of the dataset we switched from. get the new one.
+            self.dataPending = True
+            return
+        newData = response.get
+        if hasattr(newData, 'asarray'):  # Backwards compatibility
+            newData = newData.asarray
+        newData = np.asarray(newData, dtype=float)
         if 'variables' in response.settings:
             self.variables = response.variables
             self.xAxisCurrentUnit = self.variables[0][0][1]
+            self.xAxisConversion = (1.0, 0.0)
+            self.buffer.clear(1 + len(self.variables[1]))
+        if len(newData):
+            self.last_data_time = newData[-1, 0]
+            # only the new rows are converted to the current x-axis unit and zeroed
+            factor, offset = self.xAxisConversion
+            newData[:, 0] = (newData[:, 0] + offset) * factor
+            if self.xAxisZero is not None:
+                newData[:, 0] -= self.xAxisZero
+            self.buffer.append(newData)
+            self.dirtyPlots = True
         if self.rebuildPlot:
             self.buildPlot()
-            self.handleUnitConversion()
-            self.handleZeroing()
-        else:
-            self.handleUnitConversion()
-            self.handleZeroing()
-            self.plotNewData()
 
     def destroyPlot(self):
         """ Delete the current plot. """
@@ -357,6 +470,7 @@ class LabRADPlotWidget3(Qt.QWidget):
         self.figures = {}
         self.lines = []
         self.linesByLabel = {}
+        self.staleCanvases = set()
 
     def buildPlot(self):
         """ build a new plot. """
@@ -401,24 +515,22 @@ class LabRADPlotWidget3(Qt.QWidget):
                 ax = fig.axes[0]
             else:
                 ax = self.figures[label].add_subplot(111, axisbg=PLOT_BACKGROUND)
-            # the data are stored in self.data
-            self.data = self.newData.copy()
-            line = ax.plot(self.data[:, 0], self.data[:, i+1], '.-', label=legend)[0]
+            # the data are stored in self.buffer, and drawn by plotNewData
+            line = ax.plot([], [], '.-', label=legend)[0]
             self.lines.append(line)
             self.linesByLabel[label].append(line)
             ax.set_xlabel(xlabel, fontsize=19)
             ax.set_ylabel("%s [%s]" % (label, unit), fontsize=19)
             ax.grid(True, which='major')
             fig.tight_layout()
-        self.rescale()
         self.buildLineButtons()
         self.rebuildPlot = False
+        self.dirtyPlots = True
 
     def plotNewData(self):
-        if self.newData is not None and self.newData.shape[0] != 0:
-            # update data
-            self.data = np.append(self.data, self.newData, axis=0)
-        elif not self.dirtyPlots:
+        """ Draw the rows in the x range, decimated to the number of points to display. """
+        data = self.buffer.data
+        if not len(data):
             return
         # for each line, figure out which data points to plot
         if self.rescaleXCB.isChecked():
@@ -426,70 +538,65 @@ class LabRADPlotWidget3(Qt.QWidget):
         else:
             label = str(self.tab.tabText(self.tab.currentIndex()))
             xmin, xmax = self.figures[label].axes[0].get_xlim()
-        imin, imax = np.searchsorted(self.data[:, 0], [xmin, xmax])
+        imin, imax = np.searchsorted(data[:, 0], [xmin, xmax])
+        # one more point on each side, so that the lines reach the edges
+        imin, imax = max(imin - 1, 0), imax + 1
         # are we filtering points?
         try:
             if self.filterCB.isChecked():
                 points_to_display = int(self.maxPointsLE.text())
             else:
-                points_to_display = None
+                points_to_display = MAX_DRAWN_POINTS
         except ValueError:
-            points_to_display = None
-        if points_to_display:
-            step = max(1, int((imax - imin) / points_to_display))
-        else:
-            step = 1
-        start = imin
-        while start % step != (imax-1) % step:
-            start += 1
+            points_to_display = MAX_DRAWN_POINTS
         # now slice out those data points and plot them
-        for i, (legend, label, unit) in enumerate(self.variables[1]):
+        x = data[imin:imax, 0]
+        for i, line in enumerate(self.lines):
             # filter out any NaN, inf, etc.
-            x_slice = self.data[start::step, 0]
-            y_slice = self.data[start::step, i+1]
-            valid_inds = np.isfinite(y_slice)
-            self.lines[i].set_xdata(x_slice[valid_inds])
-            self.lines[i].set_ydata(y_slice[valid_inds])
-            d = self.data[-1, i+1]
+            y = data[imin:imax, i+1]
+            valid_inds = np.isfinite(y)
+            x_slice, y_slice = decimate(x[valid_inds], y[valid_inds], points_to_display // 2)
+            line.set_data(x_slice, y_slice)
+            d = data[-1, i+1]
             if 1 > d > 1e-3:
-                self.lines[i].my_label.setText('{0:.3f}'.format(d))
+                line.my_label.setText('{0:.3f}'.format(d))
             else:
-                self.lines[i].my_label.setText('{0:.3g}'.format(d))
-        self.newData = None
+                line.my_label.setText('{0:.3g}'.format(d))
         self.dirtyPlots = False
         self.rescale()
 
     def handleZeroing(self):
         # are we zero-ing the x-axis data?
         if self.zeroXAxisCB.isChecked():
-            if self.xAxisZero is not None:
-                # if we've already done it, just do to new data
-                self.newData[:, 0] -= self.xAxisZero
-            else:
-                # if not, do it to all data
-                self.xAxisZero = self.data[0, 0]
-                self.data[:, 0] -= self.xAxisZero
-                self.newData[:, 0] -= self.xAxisZero
+            # if we've already done it, new rows are zeroed as they come in
+            if self.xAxisZero is None and len(self.buffer):
+                self.xAxisZero = self.buffer.data[0, 0]
+                self.buffer.data[:, 0] -= self.xAxisZero
                 self.dirtyPlots = True
         # have we previously zeroed the data and now we undo it?
         elif self.xAxisZero is not None:
-            self.data[:, 0] += self.xAxisZero
+            self.buffer.data[:, 0] += self.xAxisZero
             self.dirtyPlots = True
             self.xAxisZero = None
 
     def handleUnitConversion(self):
-        """ Note that we only do unit conversion for the (shared) X-axis. """
+        """ Note that we only do unit conversion for the (shared) X-axis.
+
+        New rows are converted as they come in, so this only has to convert the
+        rows we have when the unit is changed. """
         import labrad.units as U
         newUnit = str(self.xAxisUnitsLE.text()).strip()
-        currentUnit = U.Unit(self.xAxisCurrentUnit)
-        originalUnit = U.Unit(self.variables[0][0][1])
         if not newUnit:
             newUnit = self.variables[0][0][1]
         # if we change units, convert old data
         if newUnit != self.xAxisCurrentUnit:
             try:
+                currentUnit = U.Unit(self.xAxisCurrentUnit)
+                originalUnit = U.Unit(self.variables[0][0][1])
                 conversion = currentUnit.conversionTupleTo(newUnit)
-                self.data[:, 0] = (self.data[:, 0] + conversion[1]) * conversion[0]
+                self.xAxisConversion = originalUnit.conversionTupleTo(newUnit)
+                data = self.buffer.data
+                data[:, 0] = (data[:, 0] + conversion[1]) * conversion[0]
                 if self.xAxisZero is not None:
                     self.xAxisZero = (self.xAxisZero + conversion[1])*conversion[0]
                 self.xAxisCurrentUnit = newUnit
@@ -498,10 +605,6 @@ class LabRADPlotWidget3(Qt.QWidget):
                 self.dirtyPlots = True
             except TypeError:
                 pass
-        # run new data through conversion
-        if self.newData is not None and self.newData.shape[0] > 0:
-            conversion = originalUnit.conversionTupleTo(self.xAxisCurrentUnit)
-            self.newData[:, 0] = (self.newData[:, 0]+conversion[1])*conversion[0]
 
     def rescale(self):
         """ scale the plots to show all the data. only use visible lines. account for absolute limits in settings. """
@@ -516,21 +619,30 @@ class LabRADPlotWidget3(Qt.QWidget):
                     if not l.get_visible():
                         continue
                     ydata = l.get_ydata()
+                    if not len(ydata):
+                        continue
                     ymax, ymin = max(ydata.max(), ymax), min(ydata.min(), ymin)
                 if ymax:
                     yrange = ymax-ymin
                     ax.set_ylim(ymin-yrange/10, ymax+yrange/10)
-        # and redraw
-        for canvas in self.canvases.values():
-            canvas.draw()
+        # and redraw. the other tabs are drawn when they are shown.
+        self.staleCanvases = set(self.canvases)
+        self.drawCurrentTab()
+
+    def drawCurrentTab(self, index=None):
+        label = str(self.tab.tabText(self.tab.currentIndex()))
+        if label in self.staleCanvases:
+            self.staleCanvases.discard(label)
+            self.canvases[label].draw()
 
     # noinspection PyUnresolvedReferences
     def handleHistory(self):
         import labrad.units as U
         hist = str(self.historyLE.text()).strip()
-        xdata = self.data[:, 0]
+        xdata = self.buffer.data[:, 0]
         xunit = self.xAxisCurrentUnit
-        xmax = xdata.max()
+        # the rows are in order of time
+        xmax = xdata[-1]
         try:
             if hist[-1] == 's':
                 xmin = xmax - (float(hist[:-1])*U.s)[xunit]
@@ -542,9 +654,9 @@ class LabRADPlotWidget3(Qt.QWidget):
                 xmin = xmax - (float(hist[:-1])*U.d)[xunit]
             else:
                 xmin = xdata[-int(hist):].min()
-            return max(xmin, xdata.min()), xmax
+            return max(xmin, xdata[0]), xmax
         except (ValueError, IndexError):
-            return xdata.min(), xdata.max()
+            return xdata[0], xmax
 
     def buildLineButtons(self):
         """ Create a toggle button for each line on each graph.
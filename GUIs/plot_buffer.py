@@ -0,0 +1,89 @@
+"""
+Storage and decimation of the rows of a live plot, with numpy only.
+
+A DataBuffer holds the rows of a dataset as they arrive from the data
+vault. Appending is amortized O(1): the array doubles its capacity when it
+is full, instead of being copied for every batch of rows as np.append
+does. When maxRows is given, the oldest rows are dropped to make room,
+keeping between maxRows and 2*maxRows of the latest rows.
+
+decimate reduces a curve to at most about 2*points points for drawing,
+keeping the minimum and maximum of each bucket of consecutive points, so
+that spikes remain visible in long histories.
+"""
+
+import numpy as np
+
+
+class DataBuffer(object):
+
+    def __init__(self, columns=0, capacity=1024, maxRows=None):
+        self.maxRows = maxRows
+        self.rows = 0
+        self.array = np.empty((capacity, columns))
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def data(self):
+        """The rows in the buffer, as a view that can be modified in place."""
+        return self.array[:self.rows]
+
+    def clear(self, columns=None):
+        if columns is None:
+            columns = self.array.shape[1]
+        self.rows = 0
+        self.array = np.empty((self.array.shape[0], columns))
+
+    def append(self, rows):
+        """Append rows, a 2D array with as many columns as the buffer."""
+        rows = np.asarray(rows, dtype=float)
+        if not len(rows):
+            return
+        if rows.ndim != 2 or rows.shape[1] != self.array.shape[1]:
+            raise ValueError('expected rows of %d columns, got shape %s' %
+                             (self.array.shape[1], rows.shape))
+        if self.maxRows is not None and len(rows) > self.maxRows:
+            rows = rows[-self.maxRows:]
+        needed = self.rows + len(rows)
+        if needed > len(self.array):
+            if self.maxRows is not None and needed > 2 * self.maxRows:
+                # keep only the newest maxRows, at the start of the array
+                keep = max(self.maxRows - len(rows), 0)
+                self.array[:keep] = \
+                    self.array[self.rows - keep:self.rows].copy()
+                self.rows = keep
+                needed = keep + len(rows)
+            capacity = max(len(self.array), 1)
+            while capacity < needed:
+                capacity *= 2
+            if self.maxRows is not None:
+                capacity = min(capacity, 2 * self.maxRows)
+            if capacity > len(self.array):
+                array = np.empty((capacity, self.array.shape[1]))
+                array[:self.rows] = self.array[:self.rows]
+                self.array = array
+        self.array[self.rows:needed] = rows
+        self.rows = needed
+
+
+def decimate(x, y, points):
+    """Reduce the curve (x, y) to the minimum and maximum of y in each of
+    about points buckets, in order. Curves with at most 2*points points are
+    returned as they are."""
+    n = len(x)
+    if not points or n <= 2 * points:
+        return x, y
+    size = int(np.ceil(n / float(points)))
+    buckets = n // size
+    end = buckets * size
+    blocks = y[:end].reshape(buckets, size)
+    lo = blocks.argmin(axis=1)
+    hi = blocks.argmax(axis=1)
+    offsets = np.arange(0, end, size)
+    idx = np.column_stack((offsets + np.minimum(lo, hi),
+                           offsets + np.maximum(lo, hi))).ravel()
+    # the remaining points, which don't fill a bucket, are kept
+    idx = np.concatenate((idx, np.arange(end, n)))
+    return x[idx], y[idx]
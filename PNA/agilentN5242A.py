@@ -32,7 +32,8 @@ timeout = 30
 
 from labrad import types as T, util
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
+from labrad.gpib import GPIBManagedServer
+from gpib_wrapper import GPIBTransactionWrapper, parseBlock
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from struct import unpack
@@ -46,7 +47,7 @@ Hz = units.Hz
 # the names of the measured parameters
 MEAS_PARAM = ['S11', 'S12', 'S21', 'S22']
 
-class PNAWrapper(GPIBDeviceWrapper):
+class PNAWrapper(GPIBTransactionWrapper):
     @inlineCallbacks
     def initialize(self):
         yield self.write('FORM:DATA REAL,64')
@@ -301,10 +302,10 @@ class AgilentPNAServer(GPIBManagedServer):
                 (ndarray(complex)): S parameters.
         """
         dev = self.selectedDevice(c)
-        resp = yield dev.query('SENS:FREQ:STAR?; STOP?')
+        resp, n_points = yield dev.queries('SENS:FREQ:STAR?; STOP?',
+                                           'SENS:SWE:POIN?')
         f_start_Hz, f_stop_Hz = (float(f) for f in resp.split(';'))
-        n_points = yield dev.query('SENS:SWE:POIN?')
-        freq = numpy.linspace(f_start_Hz, f_stop_Hz, n_points) * Hz
+        freq = numpy.linspace(f_start_Hz, f_stop_Hz, int(n_points)) * Hz
         s_params = yield self.getData(dev, trace)
         returnValue((freq, s_params))
 
@@ -525,16 +526,17 @@ class AgilentPNAServer(GPIBManagedServer):
     
     @inlineCallbacks
     def startSweep(self, dev, sweeptype):
-        yield dev.write('SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON')
-        resp = yield dev.query('SENS:SWE:TIME?; POIN?')
-        sweeptime, npoints = resp.split(';')
+        ans = yield dev.transaction([
+            ('write', 'SENS:SWE:TIME:AUTO ON; :INIT:CONT ON; :OUTP ON'),
+            ('query', 'SENS:SWE:TIME?; POIN?'),
+            ('write', 'SENS:SWE:TYPE %s' % sweeptype),
+            # ('write', 'ABORT;INIT:IMM'),
+            ('query', 'SENS:AVER:COUN?'),
+            ('write', 'ABORT;SENS:SWE:MODE GRO')])
+        sweeptime, npoints = ans[1].split(';')
         sweeptime = float(sweeptime)
         npoints = int(npoints)
-        yield dev.write('SENS:SWE:TYPE %s' % sweeptype)
-        # yield dev.write('ABORT;INIT:IMM')
-        resp = yield dev.query('SENS:AVER:COUN?')
-        sweeptime *= long(resp)
-        yield dev.write('ABORT;SENS:SWE:MODE GRO')
+        sweeptime *= long(ans[3])
         print 'sweeptime = ',sweeptime
         print 'npoints = ',npoints
         returnValue((sweeptime, npoints))
@@ -584,26 +586,13 @@ class AgilentPNAServer(GPIBManagedServer):
             d bytes: binary sweep data, as pairs of 64-bit numbers
             1 byte:  <newline> (ignored)
 
-        The 64-bit numbers are unpacked using the struct.unpack
-        function from the standard library.
+        The pairs are decoded straight into a complex numpy array.
         """
-        yield dev.write("CALC:PAR:SEL '%s'" % _parName(meas))
-        yield dev.write("CALC:DATA? SDATA")
-        # as of pyvisa 1.6 reading a set number of bytes no longer seems to work
-        # we still put in a number here because we want to use read_raw to avoid attempted conversion of non-ascii chars
-        data = yield dev.read(99999)
-        
-        # parse header for length of data
-        headerLen = long(data[1])        
-        dataLen = long(data[2:2+headerLen])
-        # parse data
-        dataStr = data[2+headerLen:]
-        nPoints = dataLen / 16
-        
-        _parse = lambda s: complex(*unpack('>dd', s))
-        data = [_parse(dataStr[16*n:16*(n+1)]) for n in range(nPoints)]
-        
-        returnValue(data)
+        ans = yield dev.transaction([
+            ('write', "CALC:PAR:SEL '%s'" % _parName(meas)),
+            ('write', "CALC:DATA? SDATA"),
+            ('read_raw', None)])
+        returnValue(parseBlock(ans[2], '>c16').astype(complex))
         
     @inlineCallbacks
     def getFormattedData(self, dev, meas):
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = IBCL GPIB
-version = 1.0
+version = 1.1
 description = 
 
 [startup]
@@ -39,6 +39,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 
 from datetime import datetime
 
+from transport import ibclDecode, ibclStatus
+
 IBCL_Script_bindl = \
   [': bindl',                                # Use: <addr> <n> bindl
        'base @ rot rot',                     # Store current base
@@ -90,8 +92,6 @@ IBCL_Script_read = \
        'endif',
    ';']
 
-replacements = [('%%%02X' % i, chr(i)) for i in range(32)+range(127,256)] + [('%%','%')]
-
 class IBCLGPIBServer(LabradServer):
     name = 'IBCL GPIB'
 
@@ -123,9 +123,7 @@ class IBCLGPIBServer(LabradServer):
     def write(self, c, addr, data):
         """Send GPIB data"""
         res = yield self.client.ibcl.command('%X " %s" write' % (addr, data), context=c.ID)
-        state = int(res[0][0],16)
-        state = [(state & 2**b)>0 for b in range(16)]
-        returnValue(state)
+        returnValue(ibclStatus(res[0][0]))
 
     @setting(30, 'Read', addr=['w'], count=['w'], returns=['s*b'])
     def read(self, c, addr, count=10000):
@@ -133,13 +131,7 @@ class IBCLGPIBServer(LabradServer):
         if count>10000:
             count=10000
         res = yield self.client.ibcl.command('%X %X %X read' % (addr, c['buffer'], count), context=c.ID)
-        state = int(res[0][0],16)
-        state = [(state & 2**b)>0 for b in range(16)]
-        res = res[0][1]
-        if '%' in res:
-            for old, new in replacements:
-                res = res.replace(old, new)
-        returnValue((res, state))
+        returnValue((ibclDecode(res[0][1]), ibclStatus(res[0][0])))
 
 __server__ = IBCLGPIBServer()
 
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = IBCL GPIB Bus
-version = 1.0
+version = 1.1
 description = 
 instancename = %LABRADNODE% IBCL GPIB Bus
 
@@ -41,6 +41,8 @@ from twisted.internet.task import LoopingCall
 
 from datetime import datetime
 
+from transport import IBCLTransport, Metrics
+
 IBCL_Script_bindl = \
   [': bindl',                                # Use: <addr> <n> bindl
        'base @ rot rot',                     # Store current base
@@ -93,33 +95,27 @@ IBCL_Script_read = \
        'endif',
    ';']
 
-replacements = [('%%%02X' % i, chr(i)) for i in range(32)+range(127,256)] + [('%%','%')]
+def seconds(timeout):
+    """A timeout in s, from a Value or a number."""
+    if isinstance(timeout, T.Value):
+        return timeout['s']
+    return timeout
+
 
 class IBCLGPIBServer(LabradServer):
     name = '%LABRADNODE% IBCL GPIB Bus'
 
     refreshInterval = 60
-    timelist = [.00001, .00003, .0001, .0003, .001, .003, .01, .03,\
-                .1, .3, 1, 3, 10, 30, 100, 300, 1000]
     refreshTimeout = 0.3
 
-    def IBCLtimeoutIndex(self, time):
-        found = False
-        for ind, t in enumerate(self.timelist):
-            if time <= t:
-                index = ind+1
-                found = True
-                break
-        if not found:
-            index = 0   # this means no timeout is in effect
-        return index
-    
     def initServer(self):
         # start refreshing only after we have started serving
         # this ensures that we are added to the list of available
         # servers before we start sending messages
         self.devices = {}
         self.ctrls = {}
+        self.transports = {}
+        self.metrics = Metrics()
         self.keepRefreshing = True
         def startLater(self):
             self.refreshLoop = self.startRefreshLoop()
@@ -271,7 +267,7 @@ class IBCLGPIBServer(LabradServer):
             raise Exception("No address selected!")
         if not ('timeout' in c):
             raise Exception("No timeout selected!")
-        state = yield self.writeGPIB(c['addr'], c['timeout'], data, c.ID)
+        state = yield self.writeGPIB(c['addr'], c['timeout'], data)
 
     @setting(4, 'Read', bytes=['w'], returns=['s'])
     def read(self, c, bytes=None):
@@ -280,41 +276,37 @@ class IBCLGPIBServer(LabradServer):
             raise Exception("No address selected!")
         if not ('timeout' in c):
             raise Exception("No timeout selected!")
-        totalres = ""
-##        if bytes is None or bytes == 0:
-            # read until carriage return
-        for block in range(bytes/10000):
-            res, state = yield self.readGPIB(c['addr'], c['timeout'], 10000, c.ID)
-            totalres += res
-        if bytes%10000 > 0:
-            res, state = yield self.readGPIB(c['addr'], c['timeout'], bytes%10000, c.ID)
-            totalres += res
-        returnValue(totalres)
+        res, state = yield self.readGPIB(c['addr'], c['timeout'], bytes)
+        returnValue(res)
         
-    @inlineCallbacks
-    def readGPIB(self, addr, timeout, bytes=1000, ctxt=(0,0)):
-        cont, gpibaddr = addr.split('::')
-        yield self.client.ibcl.select(cont, context=ctxt)   # select controller
-        tmo = self.IBCLtimeoutIndex(timeout)
-        res = yield self.client.ibcl.command('%X %X %X %X read' % (int(gpibaddr), self.buffer, bytes, tmo), timeout+0.1, context=ctxt)
-        state = int(res[0][0],16)
-        state = [(state & 2**b)>0 for b in range(16)]
-        res = res[0][1]
-        if '%' in res:
-            for old, new in replacements:
-                res = res.replace(old, new)
-        returnValue((res, state))
+    def getTransport(self, addr):
+        """Get the transport for a <controller>::<gpib address>, which
+        queues the I/O to that device."""
+        if addr not in self.transports:
+            cont, gpibaddr = addr.split('::')
+            self.transports[addr] = IBCLTransport(
+                self.client.ibcl, cont, int(gpibaddr), self.buffer,
+                self.client.context(), self.metrics)
+        return self.transports[addr]
 
     @inlineCallbacks
-    def writeGPIB(self, addr, timeout, data, ctxt=(0,0)):
-        cont, gpibaddr = addr.split('::')
-        yield self.client.ibcl.select(cont, context=ctxt)   # select controller
-        tmo = self.IBCLtimeoutIndex(timeout)
-        res = yield self.client.ibcl.command('%X " %s" %X write' % (int(gpibaddr), data, tmo), timeout+0.1, context=ctxt)
-        state = int(res[0][0], 16)
-        state = [(state & 2**b)>0 for b in range(16)]
-        returnValue(state)
-    
+    def readGPIB(self, addr, timeout, bytes=1000):
+        transport = self.getTransport(addr)
+        res = yield transport.read(bytes, seconds(timeout))
+        returnValue((res, transport.status))
+
+    def writeGPIB(self, addr, timeout, data):
+        return self.getTransport(addr).write(data, seconds(timeout))
+
+    @setting(22, addr='s', returns='*(sswwwv[s])')
+    def transport_metrics(self, c, addr=None):
+        """Get I/O counters by device address and operation.
+
+        Returns (address, op, count, bytes, errors, total time) for each
+        operation made on the given address, or on all of them.
+        """
+        return self.metrics.rows(addr)
+
 __server__ = IBCLGPIBServer()
 
 if __name__ == '__main__':
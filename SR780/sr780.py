@@ -34,7 +34,8 @@ timeout = 20
 
 from labrad import types as T, util
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
+from labrad.gpib import GPIBManagedServer
+from gpib_wrapper import GPIBTransactionWrapper
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from struct import unpack
@@ -84,7 +85,7 @@ def inverseDict(d):
     outDict = dict([(value,key) for key,value in d.items()])
     return outDict
 
-class SR780Wrapper(GPIBDeviceWrapper):
+class SR780Wrapper(GPIBTransactionWrapper):
     SETTLING_TIME = T.Value(5, 's')
     AVERAGING_TIME = T.Value(5, 's')
     
@@ -108,10 +109,11 @@ class SR780Wrapper(GPIBDeviceWrapper):
         
     @inlineCallbacks
     def waitForSettling(self, minSettle=T.Value(0,'s')):
-        yield self.write("*CLS")
-        yield self.write("UNST 0")
+        ans = yield self.transaction([('write', "*CLS"),
+                                      ('write', "UNST 0"),
+                                      ('query', "FSPN? 0")])
         # wait for 1 / (5 * bandwidth)
-        span = yield self.query("FSPN? 0")
+        span = ans[2]
         time = 0.2 / float(span)
         yield util.wakeupCall(max(time, minSettle['s']))
         done = yield self.doneSettling()
@@ -122,12 +124,8 @@ class SR780Wrapper(GPIBDeviceWrapper):
         
     @inlineCallbacks
     def doneAveraging(self):
-        n = yield self.query("FAVN? 0")
-        n = int(n)
-        ndone = yield self.query("NAVG? 0")
-        ndone = int(ndone)
-        avgOn = yield self.query("FAVG? 0")
-        avgOn = int(avgOn)
+        ans = yield self.queries("FAVN? 0", "NAVG? 0", "FAVG? 0")
+        n, ndone, avgOn = [int(a) for a in ans]
         returnValue( avgOn and ndone >= n )
         
     @inlineCallbacks
@@ -505,9 +503,8 @@ class SR780Server(GPIBManagedServer):
         freqStart = yield self.start_frequency(c)
         yield self.startsweep(c)
         yield dev.waitForAveraging()
-        n_points = yield dev.query("DSPN? 0")
+        n_points, data = yield dev.queries("DSPN? 0", "DSPY? 0")
         n_points = int(n_points)
-        data = yield dev.query("DSPY? 0")
         data = data.split(',')
         vrms = np.array([float(d) for d in data])
         freqs = np.linspace(freqStart['Hz'], (span+freqStart)['Hz'], n_points)
@@ -519,10 +516,9 @@ class SR780Server(GPIBManagedServer):
         """Initiate a frequency sweep."""
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
+        length, data = yield dev.queries("DSPN? 0", "DSPB? 0")
         length = int(length)
         print length
-        data = yield dev.query("DSPB? 0")
         print len(data)
 
         if len(data) != length*4:
@@ -532,10 +528,9 @@ class SR780Server(GPIBManagedServer):
 
         data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
         #Calculate frequencies from current span
-        resp = yield dev.query('FSTR?0')
-        fs = T.Value(float(resp), 'Hz')
-        resp = yield dev.query('FEND?0')
-        fe = T.Value(float(resp), 'Hz')
+        fs, fe = yield dev.queries('FSTR?0', 'FEND?0')
+        fs = T.Value(float(fs), 'Hz')
+        fe = T.Value(float(fe), 'Hz')
         freq = util.linspace(fs, fe, length)
         
         returnValue(zip(freq, data))
@@ -551,10 +546,9 @@ class SR780Server(GPIBManagedServer):
         """
         dev = self.selectedDevice(c)
 
-        length = yield dev.query("DSPN? 0")
+        length, data = yield dev.queries("DSPN? 0", "DSPB? 0")
         length = int(length)
         print length
-        data = yield dev.query("DSPB? 0")
         print len(data)
 
         if len(data) != length*4:
@@ -565,10 +559,9 @@ class SR780Server(GPIBManagedServer):
         data = [unpack('<f', data[i*4:i*4+4])[0] for i in range(length)]
         data = np.array(data)
         #Calculate frequencies from current span
-        resp = yield dev.query('FSTR?0')
-        fs = T.Value(float(resp), 'Hz')
-        resp = yield dev.query('FEND?0')
-        fe = T.Value(float(resp), 'Hz')
+        fs, fe = yield dev.queries('FSTR?0', 'FEND?0')
+        fs = T.Value(float(fs), 'Hz')
+        fe = T.Value(float(fe), 'Hz')
         freq = np.linspace(fs, fe, length)
         
         
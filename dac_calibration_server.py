@@ -42,18 +42,33 @@ timeout = 5
 # - loads values from registry
 # - added support for setting the border values - necessary for dualblock
 # - added support for disabling deconvolution on all IQ boards and/or all Z boards
-
-
-from twisted.internet.defer import DeferredLock, inlineCallbacks, returnValue
+#
+# 2026 Oct
+# - corrections run on a pool of workers (see ghzdac/workers.py) instead of
+#   one at a time under a global lock; only calls on the same calset are
+#   serialized
+# - added Worker Stats setting
+# - calsets cache precalculated deconvolution kernels (see KernelCache in
+#   correction.py); added Kernel Cache Stats setting
+# - added Correct IQ Batch and Correct Analog Batch settings
+# - built calsets are kept on disk (see ghzdac/calcache.py) and can be
+#   preloaded for all boards at startup; added Preload Calsets setting
+
+
+from twisted.internet.defer import (DeferredList, DeferredLock,
+                                    inlineCallbacks, returnValue)
 from twisted.internet.threads import deferToThread
 
 
 import labrad
+from labrad import types as T
 from labrad.types import Error
 from labrad.server import LabradServer, setting
 
 from ghzdac import IQcorrector, DACcorrector, keys
+from ghzdac.calcache import CalsetCache
 from ghzdac.correction import fastfftlen
+from ghzdac.workers import makeWorkers
 
 
 class CalibrationNotFoundError(Error):
@@ -85,10 +100,27 @@ class CalibrationServer(LabradServer):
     def initServer(self):
         self.IQcalsets = {}
         self.DACcalsets = {}
+        self.calsetLocks = {}
         print 'loading server settings...',
         self.loadServerSettings()
         print 'done.'
+        self.workers = makeWorkers(self.serverSettings['workerType'],
+                                   self.serverSettings['workers'])
+        print 'running corrections on {} {} workers'.format(
+            self.workers.size, self.serverSettings['workerType'])
+        if self.serverSettings['calsetCache']:
+            self.calsetCache = CalsetCache(self.serverSettings['calsetCacheDir'])
+            print 'caching calsets in', self.calsetCache.directory
+        else:
+            self.calsetCache = None
         yield LabradServer.initServer(self)
+        if self.serverSettings['preloadCalsets']:
+            # don't hold up startup, corrections wait for their calset anyway
+            d = self.preloadCalsets()
+            d.addErrback(lambda failure: failure.printTraceback())
+
+    def stopServer(self):
+        self.workers.stop()
 
     def loadServerSettings(self):
         """Load configuration information from the registry."""
@@ -99,7 +131,13 @@ class CalibrationServer(LabradServer):
             'bandwidthIQ': 0.4, #original default: 0.4
             'bandwidthZ': 0.13, #original default: 0.13
             'maxfreqZ': 0.45, #optimal parameter: 10% below Nyquist frequency of dac, 0.45
-            'maxvalueZ': 5.0 #optimal parameter: 5.0, from the jitter in 1/H fourier amplitudes
+            'maxvalueZ': 5.0, #optimal parameter: 5.0, from the jitter in 1/H fourier amplitudes
+            'workerType': 'thread', # 'thread' or 'process', see ghzdac/workers.py
+            'workers': 0, # number of correction workers, 0 for one per cpu core
+            'kernelCacheMB': 64, # memory for cached kernels of each calset
+            'calsetCache': True, # keep built calsets on disk, see ghzdac/calcache.py
+            'calsetCacheDir': None, # default ~/.ghzdac/calsets
+            'preloadCalsets': False # load calsets for all boards at startup
         }
         for key in keys.SERVERSETTINGVALUES:
             default = defaults.get(key, None)
@@ -118,56 +156,116 @@ class CalibrationServer(LabradServer):
         c['deconvIQ'] = self.serverSettings['deconvIQ']
         c['deconvZ'] = self.serverSettings['deconvZ']
 
-    @inlineCallbacks
     def call_sync(self, *args, **kw):
         """Call synchronous code in a separate thread outside the twisted event loop."""
-        if not hasattr(self, '_sync_lock'):
-            self._sync_lock = DeferredLock()
-        yield self._sync_lock.acquire()
-        try:
-            result = yield deferToThread(*args, **kw)
-            returnValue(result)
-        finally:
-            self._sync_lock.release()
+        return deferToThread(*args, **kw)
+
+    def calsetLock(self, key):
+        """Get the lock used while loading the calset for key."""
+        if key not in self.calsetLocks:
+            self.calsetLocks[key] = DeferredLock()
+        return self.calsetLocks[key]
+
+    def correct(self, key, calset, method, *args, **kw):
+        """Run a correction on the worker pool.
+
+        Settling, reflection and filter settings can be given as a list of
+        (method, args, kw) calls in the setup keyword. They are made on the
+        calset in the same worker, just before the correction itself.
+        """
+        calls = kw.pop('setup', []) + [(method, args, kw)]
+        return self.workers.run(key, calset, calls)
 
-    @inlineCallbacks
     def getIQcalset(self, c):
         """Get an IQ calset for the board in the given context, creating it if needed."""
         if 'Board' not in c:
             raise NoBoardSelectedError()
-        board = c['Board']
-
-        if board not in self.IQcalsets:
-            calset = yield self.call_sync(IQcorrector, board,
-                                                       None,
-                                                       errorClass=CalibrationNotFoundError,
-                                                       bandwidth=self.serverSettings['bandwidthIQ'])
-            self.IQcalsets[board] = calset
-        returnValue(self.IQcalsets[board])
+        return self.loadIQcalset(c['Board'])
 
-    @inlineCallbacks
     def getDACcalset(self, c):
         """Get a DAC calset for the board and DAC in the given context, creating it if needed."""
         if 'Board' not in c:
             raise NoBoardSelectedError()
-        board = c['Board']
-
         if 'DAC' not in c:
             raise NoDACSelectedError()
-        dac = c['DAC']
+        return self.loadDACcalset(c['Board'], c['DAC'])
 
+    @inlineCallbacks
+    def loadIQcalset(self, board):
+        """Get the IQ calset for a board, creating it if needed."""
+        lock = self.calsetLock(board)
+        yield lock.acquire()
+        try:
+            if board not in self.IQcalsets:
+                calset = yield self.call_sync(IQcorrector, board,
+                                                           None,
+                                                           errorClass=CalibrationNotFoundError,
+                                                           bandwidth=self.serverSettings['bandwidthIQ'],
+                                                           cache=self.calsetCache)
+                self.setCacheSize(calset)
+                self.IQcalsets[board] = calset
+        finally:
+            lock.release()
+        returnValue(self.IQcalsets[board])
+
+    @inlineCallbacks
+    def loadDACcalset(self, board, dac):
+        """Get the calset for one DAC of a board, creating it if needed."""
         if board not in self.DACcalsets:
             self.DACcalsets[board] = {}
-        if dac not in self.DACcalsets[board]:
-            calset = yield self.call_sync(DACcorrector, board,
-                                                        dac,
-                                                        None,
-                                                        errorClass=CalibrationNotFoundError,
-                                                        bandwidth=self.serverSettings['bandwidthZ'],
-                                                        maxfreqZ=self.serverSettings['maxfreqZ'])
-            self.DACcalsets[board][dac] = calset
+        lock = self.calsetLock((board, dac))
+        yield lock.acquire()
+        try:
+            if dac not in self.DACcalsets[board]:
+                calset = yield self.call_sync(DACcorrector, board,
+                                                            dac,
+                                                            None,
+                                                            errorClass=CalibrationNotFoundError,
+                                                            bandwidth=self.serverSettings['bandwidthZ'],
+                                                            maxfreqZ=self.serverSettings['maxfreqZ'],
+                                                            cache=self.calsetCache)
+                self.setCacheSize(calset)
+                self.DACcalsets[board][dac] = calset
+        finally:
+            lock.release()
         returnValue(self.DACcalsets[board][dac])
 
+    @inlineCallbacks
+    def preloadCalsets(self):
+        """Load the calsets of all boards with calibrations in the registry.
+
+        Returns the number of calsets loaded.
+        """
+        reg = self.client.registry
+        ctx = self.client.context()
+        yield reg.cd(['', keys.SESSIONNAME], context=ctx)
+        boards, _ = yield reg.dir(context=ctx)
+        loads = []
+        for board in boards:
+            yield reg.cd(['', keys.SESSIONNAME, board], context=ctx)
+            _, calibrations = yield reg.dir(context=ctx)
+            if keys.ZERONAME in calibrations or keys.PULSENAME in calibrations:
+                loads.append(self.loadIQcalset(board))
+            for dac, channel in enumerate(keys.CHANNELNAMES):
+                if channel in calibrations:
+                    loads.append(self.loadDACcalset(board, dac))
+        results = yield DeferredList(loads, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                print 'Failed to preload calset:', result.getErrorMessage()
+        loaded = len([success for success, result in results if success])
+        print 'preloaded {} calsets'.format(loaded)
+        returnValue(loaded)
+
+    def setCacheSize(self, calset):
+        calset.kernels.maxBytes = int(self.serverSettings['kernelCacheMB'] * 2**20)
+
+    def calsetName(self, c):
+        """Get the name of the calset for the context, for worker stats."""
+        if c.get('DAC') is None:
+            return c['Board']
+        return '{} {}'.format(c['Board'], keys.CHANNELNAMES[c['DAC']])
+
     @setting(1, 'Board', board=['s'], returns=['s'])
     def board(self, c, board):
         """Sets the board for which to correct the data."""
@@ -261,12 +359,13 @@ class CalibrationServer(LabradServer):
 
         calset = yield self.getIQcalset(c)
         deconv = c['deconvIQ']
-        corrected = yield self.call_sync(calset.DACify, c['Frequency'],
-                                                  data,
-                                                  loop=c['Loop'],
-                                                  zipSRAM=False,
-                                                  deconv=deconv,
-                                                  zeroEnds=zero_ends)
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACify',
+                                       c['Frequency'],
+                                       data,
+                                       loop=c['Loop'],
+                                       zipSRAM=False,
+                                       deconv=deconv,
+                                       zeroEnds=zero_ends)
         if deconv is False:
             print 'No deconv on board ' + c['Board'] 
         returnValue(corrected)
@@ -298,14 +397,15 @@ class CalibrationServer(LabradServer):
 
         calset = yield self.getIQcalset(c)
         deconv = c['deconvIQ']
-        corrected = yield self.call_sync(calset.DACifyFT, c['Frequency'],
-                                                          data,
-                                                          n=len(data),
-                                                          t0=c['t0'],
-                                                          loop=c['Loop'],
-                                                          zipSRAM=False,
-                                                          deconv=deconv,
-                                                          zeroEnds=zero_ends)
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACifyFT',
+                                       c['Frequency'],
+                                       data,
+                                       n=len(data),
+                                       t0=c['t0'],
+                                       loop=c['Loop'],
+                                       zipSRAM=False,
+                                       deconv=deconv,
+                                       zeroEnds=zero_ends)
         if deconv is False:
             print 'No deconv on board ' + c['Board']
         returnValue(corrected)
@@ -334,15 +434,17 @@ class CalibrationServer(LabradServer):
             returnValue([]) # special case for empty data
 
         calset = yield self.getDACcalset(c)
-        calset.setSettling(*c['Settling'])
-        calset.setReflection(*c['Reflection'])
+        setup = [('setSettling', c['Settling'], {}),
+                 ('setReflection', c['Reflection'], {})]
         deconv = c['deconvZ']
-        corrected = yield self.call_sync(calset.DACify, data,
-                                                  loop=c['Loop'],
-                                                  fitRange=False,
-                                                  deconv=deconv,
-                                                  dither=dither,
-                                                  averageEnds=average_ends)
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACify',
+                                       data,
+                                       loop=c['Loop'],
+                                       fitRange=False,
+                                       deconv=deconv,
+                                       dither=dither,
+                                       averageEnds=average_ends,
+                                       setup=setup)
         if deconv is False:
             print 'No deconv on board ' + c['Board']
         returnValue(corrected)
@@ -373,19 +475,100 @@ class CalibrationServer(LabradServer):
             returnValue([]) # special case for empty data
 
         calset = yield self.getDACcalset(c)
-        calset.setSettling(*c['Settling'])
-        calset.setReflection(*c['Reflection'])
-        calset.setFilter(bandwidth=c['Filter'])
+        setup = [('setSettling', c['Settling'], {}),
+                 ('setReflection', c['Reflection'], {}),
+                 ('setFilter', (), {'bandwidth': c['Filter']})]
         deconv = c['deconvZ']
-        corrected = yield self.call_sync(calset.DACifyFT, data,
-                                                          n=(len(data)-1)*2,
-                                                          t0=c['t0'],
-                                                          loop=c['Loop'],
-                                                          fitRange=False,
-                                                          deconv=deconv,
-                                                          maxvalueZ=self.serverSettings['maxvalueZ'],
-                                                          dither=dither,
-                                                          averageEnds=average_ends)
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACifyFT',
+                                       data,
+                                       n=(len(data)-1)*2,
+                                       t0=c['t0'],
+                                       loop=c['Loop'],
+                                       fitRange=False,
+                                       deconv=deconv,
+                                       maxvalueZ=self.serverSettings['maxvalueZ'],
+                                       dither=dither,
+                                       averageEnds=average_ends,
+                                       setup=setup)
+        if deconv is False:
+            print 'No deconv on board ' + c['Board']
+        returnValue(corrected)
+
+    @setting(34,
+        'Correct IQ Batch',
+        data=['*2c: I/Q data, one waveform per row'],
+        zero_ends='b',
+        returns=['*2w: SRAM words, one row per waveform'])
+    def correct_iq_batch(self, c, data, zero_ends=False):
+        """Correct a batch of IQ waveforms specified in the time domain.
+
+        All waveforms must have the same length and are corrected for the
+        frequency selected in this context. They are transformed together,
+        which is much faster than correcting them one at a time.
+
+        Args:
+            data (2D array of complex): The time-domain IQ sequences to be
+                deconvolved, one per row.
+            zero_ends (boolean): If true, the first and last 4 nanoseconds will
+                be set to the deconvolved zero value to ensure microwaves are off.
+
+        Returns:
+            The packed SRAM words (I and Q DAC values) for each waveform.
+        """
+        if data.size == 0:
+            returnValue(data.astype('uint32')) # special case for empty data
+
+        calset = yield self.getIQcalset(c)
+        deconv = c['deconvIQ']
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACify',
+                                       c['Frequency'],
+                                       data,
+                                       loop=c['Loop'],
+                                       zipSRAM=True,
+                                       deconv=deconv,
+                                       zeroEnds=zero_ends)
+        if deconv is False:
+            print 'No deconv on board ' + c['Board']
+        returnValue(corrected)
+
+    @setting(35,
+        'Correct Analog Batch',
+        data=['*2v: Single channel data, one waveform per row'],
+        average_ends='b',
+        dither='b',
+        returns=['*2i: Single channel DAC values, one row per waveform'])
+    def correct_analog_batch(self, c, data, average_ends=False, dither=False):
+        """Correct a batch of single channel waveforms in the time domain.
+
+        All waveforms must have the same length. They are transformed
+        together, which is much faster than correcting them one at a time.
+
+        Args:
+            data (2D array of float): The time-domain sequences to be
+                deconvolved, one per row.
+            average_ends (boolean): If true, the first and last 4 nanoseconds
+                of each waveform will be averaged and set to the constant
+                average value.
+            dither (boolean): If true, the sequences will be dithered.
+
+        Returns:
+            The deconvolved DAC values for each waveform.
+        """
+        if data.size == 0:
+            returnValue(data.astype('int32')) # special case for empty data
+
+        calset = yield self.getDACcalset(c)
+        setup = [('setSettling', c['Settling'], {}),
+                 ('setReflection', c['Reflection'], {})]
+        deconv = c['deconvZ']
+        corrected = yield self.correct(self.calsetName(c), calset, 'DACify',
+                                       data,
+                                       loop=c['Loop'],
+                                       fitRange=False,
+                                       deconv=deconv,
+                                       dither=dither,
+                                       averageEnds=average_ends,
+                                       setup=setup)
         if deconv is False:
             print 'No deconv on board ' + c['Board']
         returnValue(corrected)
@@ -426,6 +609,54 @@ class CalibrationServer(LabradServer):
         """Given a sequence length n, get a new length nfft >= n which is efficient for calculating fft."""
         return fastfftlen(n)
 
+    @setting(60, 'Worker Stats', percentiles='*v', returns='*(s, w, w, w, *v[s], *v[s])')
+    def worker_stats(self, c, percentiles=(50, 99)):
+        """Get queue depth and timing of corrections for each calset.
+
+        Returns a list of (calset, pending, done, errors, wait, service), where
+        calset is the board name (for IQ) or board and DAC channel (for analog),
+        pending is the number of corrections queued or running, and wait and
+        service are the given percentiles (default 50 and 99) of the time
+        corrections spent queued and running, over the last minute or so.
+        """
+        ans = []
+        for name, pending, done, errors, wait, service in \
+                self.workers.percentiles(percentiles):
+            ans.append((name, pending, done, errors,
+                        [T.Value(t, 's') for t in wait],
+                        [T.Value(t, 's') for t in service]))
+        return ans
+
+    @setting(61, 'Kernel Cache Stats', returns='*(s, w, w, w, w, w)')
+    def kernel_cache_stats(self, c):
+        """Get hit and miss counts of the kernel cache for each loaded calset.
+
+        Returns a list of (calset, hits, misses, evictions, entries, bytes).
+        The stats come from the workers, which hold their own copy of each
+        calset when corrections run in separate processes.
+        """
+        calsets = [(board, calset) for board, calset in self.IQcalsets.items()]
+        for board, dacs in self.DACcalsets.items():
+            for dac, calset in dacs.items():
+                name = '{} {}'.format(board, keys.CHANNELNAMES[dac])
+                calsets.append((name, calset))
+        ans = []
+        for name, calset in sorted(calsets):
+            stats = yield self.workers.run(name, calset,
+                                           [('kernelCacheStats', (), {})])
+            ans.append((name,) + tuple(stats))
+        returnValue(ans)
+
+    @setting(62, 'Preload Calsets', returns='w')
+    def preload_calsets(self, c):
+        """Load the calsets of all boards now, rather than on first use.
+
+        Calsets already loaded are kept. With the calset cache enabled,
+        calsets that are up to date on disk are read from there. Returns
+        the number of calsets loaded.
+        """
+        return self.preloadCalsets()
+
 
 __server__ = CalibrationServer()
 
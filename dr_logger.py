@@ -19,7 +19,7 @@
 ### BEGIN NODE INFO
 [info]
 name = DR Logger
-version = 0.1
+version = 0.2
 description = Log the DR temperatures, pressures, etc. 
 
 [startup]
@@ -34,7 +34,9 @@ timeout = 20
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (DeferredList, DeferredLock, TimeoutError,
+                                    inlineCallbacks, returnValue)
 from twisted.internet.task import LoopingCall
 
 from labrad import types as T
@@ -55,6 +57,40 @@ class ServerNotFoundError(Error):
     pass
 
 
+class WatcherTimeoutError(Error):
+    pass
+
+
+class Latency(object):
+    """Response times of a watcher, or of the data vault."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.last = 0.0
+        self.total = 0.0
+        self.max = 0.0
+        # when the last reading was taken: halfway through the request
+        self.lastTime = 0.0
+
+    def record(self, start, end, error=False, timeout=False):
+        self.count += 1
+        self.errors += bool(error)
+        self.timeouts += bool(timeout)
+        self.last = end - start
+        self.total += self.last
+        self.max = max(self.max, self.last)
+        if not error:
+            self.lastTime = (start + end) / 2
+
+    def row(self, name):
+        mean = self.total / self.count if self.count else 0.0
+        return (name, long(self.count), long(self.errors),
+                long(self.timeouts), Value(self.last, 's'), Value(mean, 's'),
+                Value(self.max, 's'), Value(self.lastTime, 's'))
+
+
 class WatchedServer(object):
     """Proxy for another server from which we pull data
 
@@ -65,16 +101,27 @@ class WatchedServer(object):
         device (str or int): Specific hardware device to access through the
             proxied server. If None (the default) we select the first available
             device, which is the pylabrad default.
+        timeout (float): Seconds to wait for a point, set by the 'timeout'
+            option.
+        label (str): Name of this watcher's entry in the DR configuration
+            (e.g. 'ruox'), which tells apart watchers of the same server.
+            Defaults to name.
     """
     server_name = 'none'
+    timeout = 10.0
 
-    def __init__(self, name, cxn, ctx, options):
+    def __init__(self, name, cxn, ctx, options, label=None):
         self.name = name
+        self.label = name if label is None else label
         self.cxn = cxn
         self.ctx = ctx
         self.options = dict(options)
         self.server = None
         self.active = False
+        timeout = self.options.get('timeout', self.timeout)
+        if hasattr(timeout, 'unit'):
+            timeout = timeout['s']
+        self.timeout = timeout
 
     def get_variables(self):
         """ Get the variables (for the data vault) logged by this server.
@@ -245,8 +292,16 @@ class DRLogger(DeviceWrapper):
     Attributes:
         name (str): Name of this DR setup. Assigned by pylabrad's device server
             code.
-        watchers (list of WatchedServer): Server proxies we watch.
+        watchers (list of WatchedServer): Server proxies we watch. They are
+            polled concurrently, each within its timeout.
+        pending (list of list of float): Rows not yet added to the data
+            vault. They are added batchSize rows at a time, or flushDelay
+            seconds after the first of them was taken.
+        latency (dict): Latency of each watcher, by label, and of the data
+            vault.
     """
+    reactor = reactor
+
     @inlineCallbacks
     def connect(self, *args, **kwargs):
         """Connect to a DR device
@@ -267,7 +322,14 @@ class DRLogger(DeviceWrapper):
         self.dvPath = kwargs.pop('dvPath', ['', 'DR', self.name])
         self.datasetName = kwargs.pop('datasetName', '%s log - [t]' % self.name)
         self.timeInterval = kwargs.pop('timeInterval', 1.0)
+        self.batchSize = kwargs.pop('batchSize', 10)
+        self.flushDelay = kwargs.pop('flushDelay', 10.0)
         self.currentDay = ''
+        self.pending = []
+        self.flushCall = None
+        self.flushLock = DeferredLock()
+        self.writeErrors = []
+        self.latency = {}
         # now make our watchers
         for k, v in kwargs.iteritems():
             server_name = v[0]
@@ -283,7 +345,8 @@ class DRLogger(DeviceWrapper):
                 cls = None
             if cls is not None:
                 print "Found watcher for %s" % server_name
-                self.watchers.append(cls(server_name, self.cxn, self.ctx, options=options))
+                self.watchers.append(cls(server_name, self.cxn, self.ctx,
+                                         options=options, label=k))
             else:
                 raise ValueError("ERROR: No watcher class found for:", server_name)
 
@@ -296,6 +359,7 @@ class DRLogger(DeviceWrapper):
             # start the loop
             self.isLogging = True
             self.loop = LoopingCall(self.take_point)
+            self.loop.clock = self.reactor
             self.loopDone = self.loop.start(self.timeInterval, now=True)
             print 'loop started'
         elif self.isLogging and not start:
@@ -307,6 +371,7 @@ class DRLogger(DeviceWrapper):
                 pass
             print 'loop stopped'
             self.isLogging = False
+            yield self.flush()
 
     @inlineCallbacks
     def shutdown(self):
@@ -331,47 +396,98 @@ class DRLogger(DeviceWrapper):
 
         yield self.data_vault.new(name, indeps, deps, context=self.ctx)
 
+    @inlineCallbacks
+    def poll(self, w):
+        """Take a point from a watcher, within its timeout."""
+        latency = self.latency.setdefault(w.label, Latency())
+        clock = self.reactor
+        start = clock.seconds()
+        d = w.take_point()
+        d.addTimeout(w.timeout, clock)
+        try:
+            r = yield d
+        except TimeoutError:
+            latency.record(start, clock.seconds(), error=True, timeout=True)
+            raise WatcherTimeoutError(
+                "no point from '{}' in {} s".format(w.name, w.timeout))
+        except Exception:
+            latency.record(start, clock.seconds(), error=True)
+            raise
+        latency.record(start, clock.seconds())
+        returnValue(r)
+
     @inlineCallbacks
     def take_point(self):
         try:
-            # gather data
-            data = [time.time() * Unit('s')]
+            # gather data from all watchers at once
+            data = [self.reactor.seconds() * Unit('s')]
             errors = []
-            for w in self.watchers:
-                try:
-                    r = yield w.take_point()
+            results = yield DeferredList([self.poll(w) for w in self.watchers],
+                                         consumeErrors=True)
+            for w, (ok, r) in zip(self.watchers, results):
+                if ok:
                     data.extend(r)
-                except T.Error as err:
-                    errors.append((w.server_name, err.msg))
+                elif r.check(T.Error):
+                    errors.append((w.server_name, r.value.msg))
+                else:
+                    r.raiseException()
             if errors:
                 self.errors = errors
                 returnValue(None)
             # strip units
             data = [x[x.unit] for x in data]
             # did the day roll over?
-            if self.currentDay != time.strftime("%d"):
+            if (self.data_vault is not None and
+                    self.currentDay != time.strftime("%d")):
+                yield self.flush()
                 self.new_dataset()
+            self.pending.append(data)
+            if len(self.pending) >= self.batchSize:
+                self.flush()
+            elif self.flushCall is None:
+                self.flushCall = self.reactor.callLater(self.flushDelay,
+                                                        self.flush)
+            self.errors = errors
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+
+    @inlineCallbacks
+    def flush(self):
+        """Add the pending rows to the data vault, in one request."""
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        yield self.flushLock.acquire()
+        try:
+            rows, self.pending = self.pending, []
+            if not rows:
+                return
+            latency = self.latency.setdefault('Data Vault', Latency())
+            start = self.reactor.seconds()
+            errors = []
             try:
                 # make dataset if first time
                 if self.data_vault is None:
                     print("Making new dataset")
                     yield self.make_dataset()
                 # add data
-                yield self.data_vault.add(data, context=self.ctx)
+                yield self.data_vault.add(rows, context=self.ctx)
             except T.Error as err:
                 print("Error when writing data to data vault: {}".format(err))
                 if 'NoDatasetError' in err.msg:
                     try:
                         yield self.make_dataset()
-                        yield self.data_vault.add(data, context=self.ctx)
+                        yield self.data_vault.add(rows, context=self.ctx)
                     except T.Error as err:
                         errors.append(("Data Vault", str(err)))
                 else:
                     errors.append(("General", str(err)))
-            self.errors = errors
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
+            latency.record(start, self.reactor.seconds(), error=bool(errors))
+            self.writeErrors = errors
+        finally:
+            self.flushLock.release()
 
 
 class DRLoggerServer(DeviceServer):
@@ -386,7 +502,8 @@ class DRLoggerServer(DeviceServer):
                     'lakeshore_diodes'.
                 <node> (s): Name of node running <server>.
                 <options> ((s, ?),...): Tuple of (key, value) tuples. Provides
-                    additional data to configure measurements.
+                    additional data to configure measurements. A 'timeout'
+                    option (in s) limits the time to wait for each point.
     """
     name = 'DR Logger'
     deviceName = 'DR'
@@ -472,7 +589,7 @@ class DRLoggerServer(DeviceServer):
         (source or type, error message)
         """
         dev = self.selectedDevice(c)
-        return dev.errors
+        return dev.errors + dev.writeErrors
 
     @setting(15, 'Current Time', returns='v['']')
     def current_time(self, c):
@@ -480,6 +597,17 @@ class DRLoggerServer(DeviceServer):
         """
         return time.time()
 
+    @setting(16, 'Latency', returns='*(swwwv[s]v[s]v[s]v[s])')
+    def latency(self, c):
+        """ Return the latency of each watcher, and of the data vault.
+
+        Each is given as (watcher label, requests, errors, timeouts, last,
+        mean and max latency, time of the last point). The time of a point
+        is halfway through its request, in seconds (as time.time()).
+        """
+        dev = self.selectedDevice(c)
+        return [dev.latency[name].row(name) for name in sorted(dev.latency)]
+
 
 __server__ = DRLoggerServer()
 
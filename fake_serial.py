@@ -0,0 +1,209 @@
+"""Pseudo terminal stand-in for a serial instrument, for testing and
+benchmarking the serial server without hardware (posix only).
+
+PtyDevice plays the instrument on the master side of a pty. The serial
+server opens the slave side, PtyDevice.port, like any other serial port.
+
+Run this module to benchmark the serial server against a PtyDevice, e.g.
+
+    python fake_serial.py --queries 200 --bytes 1000000 --delay 0.002 \
+        --request 0.001
+"""
+
+import argparse
+import os
+import threading
+import time
+import tty
+
+
+def echo(line):
+    """Default response: every line is echoed back."""
+    return line + '\r\n'
+
+
+class PtyDevice(object):
+    """An instrument that answers the lines it receives.
+
+    respond(line) gives the response to a line (without its newline), or
+    None if it doesn't produce one. Responses are sent after delay seconds.
+    """
+
+    def __init__(self, respond=echo, delay=0.0):
+        self.respond = respond
+        self.delay = delay
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.received = []
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='pty device')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        pending = ''
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            pending += data
+            while '\n' in pending:
+                line, pending = pending.split('\n', 1)
+                line = line.rstrip('\r')
+                self.received.append(line)
+                response = self.respond(line)
+                if response is not None:
+                    if self.delay:
+                        time.sleep(self.delay)
+                    self.send(response)
+
+    def send(self, data):
+        """Send data to the serial port, unprompted."""
+        while data:
+            n = os.write(self.master, data)
+            data = data[n:]
+
+    def close(self):
+        self.running = False
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def pollingReadLine(ser, timeout):
+    """How the serial server used to read a line: a byte at a time, with a
+    thread polling every 10 ms for each byte that wasn't there yet."""
+    from twisted.internet import threads
+    from twisted.internet.defer import inlineCallbacks, returnValue
+
+    @inlineCallbacks
+    def readLine():
+        recd = ''
+        while True:
+            r = ser.read(1)
+            if r == '':
+                stop = time.time() + timeout
+
+                def doRead():
+                    while True:
+                        d = ser.read(1)
+                        if d or time.time() > stop:
+                            return d
+                        time.sleep(0.01)
+                r = yield threads.deferToThread(doRead)
+            if r in ('', '\n'):
+                break
+            if r != '\r':
+                recd += r
+        returnValue(recd)
+    return readLine()
+
+
+def benchmark(nQueries, nBytes, delay, requestTime):
+    from twisted.internet import reactor
+    from twisted.internet.defer import inlineCallbacks
+    from twisted.internet.task import deferLater
+    from serial import Serial
+    import labrad.units as units
+    import serial_server
+
+    device = PtyDevice(delay=delay)
+    server = serial_server.SerialServer()
+    server.metrics = serial_server.Metrics()
+    server.SerialPorts = [serial_server.SerialDevice('pty', device.port)]
+    c = {}
+
+    @inlineCallbacks
+    def run():
+        try:
+            server.open(c, 'pty')
+            server.timeout(c, 2 * units.s)
+            start = time.time()
+            for i in range(nQueries):
+                server.write_line(c, 'MEAS%d?' % i)
+                ans = yield server.read_line(c)
+                assert ans == 'MEAS%d?' % i
+            latency = (time.time() - start) / nQueries
+
+            device.delay = 0.0
+            block = ''.join(chr(i % 256) for i in range(nBytes))
+            start = time.time()
+            device.send(block)
+            ans = yield server.read(c, nBytes)
+            assert ans == block
+            rate = nBytes / (time.time() - start)
+
+            # a gauge reading, like the MKS server's, as separate requests
+            # and as a script, each request taking requestTime to arrive
+            device.delay = delay
+            requests = [
+                lambda: server.write_line(c, 'p'),
+                lambda: server.read_line(c),
+                lambda: server.write_line(c, 'f'),
+                lambda: server.read_line(c),
+            ]
+            steps = [('write_line', 'p', 0 * units.s),
+                     ('read_line', '', 2 * units.s),
+                     ('write_line', 'f', 0 * units.s),
+                     ('read_line', '', 2 * units.s)]
+            start = time.time()
+            for i in range(nQueries):
+                for request in requests:
+                    yield deferLater(reactor, requestTime, lambda: None)
+                    yield request()
+            separate = (time.time() - start) / nQueries
+            start = time.time()
+            for i in range(nQueries):
+                yield deferLater(reactor, requestTime, lambda: None)
+                ans = yield server.run_script(c, steps)
+                assert ans == ['p', 'f']
+            script = (time.time() - start) / nQueries
+            server.close(c)
+
+            device.delay = delay
+            ser = Serial(device.port, timeout=0)
+            start = time.time()
+            for i in range(nQueries):
+                ser.write('MEAS%d?\r\n' % i)
+                ans = yield pollingReadLine(ser, 2)
+                assert ans == 'MEAS%d?' % i
+            oldLatency = (time.time() - start) / nQueries
+            ser.close()
+
+            print 'pty serial port, %d queries, %g s per response:' % \
+                (nQueries, delay)
+            print '  query latency: %.3f ms (polling reads: %.3f ms)' % \
+                (latency * 1e3, oldLatency * 1e3)
+            print '  read throughput: %.1f MB/s for %d bytes' % \
+                (rate / 1e6, nBytes)
+            print '  write/read/write/read, %g s per request: %.3f ms ' \
+                '(Run Script: %.3f ms)' % \
+                (requestTime, separate * 1e3, script * 1e3)
+        finally:
+            device.close()
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the serial server with a pty device.')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='number of line queries')
+    parser.add_argument('--bytes', type=int, default=1000000,
+                        help='size of the block read, in bytes')
+    parser.add_argument('--delay', type=float, default=0.002,
+                        help='time the device takes to respond, in s')
+    parser.add_argument('--request', type=float, default=0.001,
+                        help='time a request takes to reach the server, in s')
+    args = parser.parse_args()
+    benchmark(args.queries, args.bytes, args.delay, args.request)
@@ -0,0 +1,177 @@
+"""Fake VISA resource manager, for testing and benchmarking the GPIB Bus
+server without instruments.
+
+FakeResourceManager has the parts of the pyvisa ResourceManager used by
+gpib_server.py. Its instruments answer queries after a configurable delay,
+honour the VISA timeout (in ms) and record everything written to them, as
+well as any calls that overlapped on one instrument, which a real GPIB
+device would not survive.
+
+Run this module to benchmark the GPIB Bus server against slow fake
+instruments, e.g.
+
+    python fake_visa.py --devices 4 --queries 10 --delay 0.05
+"""
+
+import argparse
+import threading
+import time
+
+
+class FakeVisaTimeout(Exception):
+    """Raised like VisaIOError(VI_ERROR_TMO) when a read times out."""
+
+
+def identify(instr, command):
+    """Default responses: *IDN? gives a made up identification, any other
+    query is echoed back."""
+    if command.strip() == '*IDN?':
+        return 'FAKE INSTRUMENTS,MODEL %s,0,1.0' % instr.addr
+    return command
+
+
+class FakeInstrument(object):
+    """A message based instrument.
+
+    respond(instr, command) gives the response to a command, or None if it
+    doesn't produce one. Reads take delay seconds.
+    """
+
+    def __init__(self, addr, respond=identify, delay=0.0):
+        self.addr = addr
+        self.respond = respond
+        self.delay = delay
+        self.timeout = 2000  # ms
+        self.write_termination = '\n'
+        self.log = []
+        self.output = []
+        self.overlaps = 0
+        self._busy = threading.Lock()
+
+    def _enter(self, what):
+        if not self._busy.acquire(False):
+            self.overlaps += 1
+            self._busy.acquire()
+        self.log.append(what)
+
+    def _exit(self):
+        self._busy.release()
+
+    def clear(self):
+        self._enter(('clear',))
+        try:
+            self.output = []
+        finally:
+            self._exit()
+
+    def write(self, data):
+        self.write_raw(data + self.write_termination)
+
+    def write_raw(self, data):
+        self._enter(('write', data))
+        try:
+            response = self.respond(self, data.rstrip('\n'))
+            if response is not None:
+                self.output.append(response)
+        finally:
+            self._exit()
+
+    def read_raw(self, size=None):
+        self._enter(('read', size))
+        try:
+            if self.timeout is not None and self.delay > self.timeout / 1000.0:
+                # the late response is lost
+                time.sleep(self.timeout / 1000.0)
+                self.output = []
+                raise FakeVisaTimeout('timeout reading from %s' % self.addr)
+            time.sleep(self.delay)
+            if not self.output:
+                time.sleep(self.timeout / 1000.0)
+                raise FakeVisaTimeout('nothing to read from %s' % self.addr)
+            data = self.output[0]
+            if size is None or size >= len(data):
+                self.output.pop(0)
+                return data
+            self.output[0] = data[size:]
+            return data[:size]
+        finally:
+            self._exit()
+
+
+class FakeResourceManager(object):
+    """Resource manager for a set of FakeInstruments."""
+
+    def __init__(self, instruments=()):
+        self.instruments = dict((instr.addr, instr) for instr in instruments)
+
+    def add(self, instr):
+        self.instruments[instr.addr] = instr
+        return instr
+
+    def list_resources(self):
+        return tuple(sorted(self.instruments))
+
+    def get_instrument(self, addr):
+        return self.instruments[addr]
+
+    open_resource = get_instrument
+
+
+def benchmark(nDevices, nQueries, delay):
+    from twisted.internet import reactor
+    from twisted.internet.defer import inlineCallbacks, gatherResults
+    import gpib_server
+
+    rm = FakeResourceManager([
+        FakeInstrument('GPIB0::%d::INSTR' % (i + 1), delay=delay)
+        for i in range(nDevices)])
+    server = gpib_server.GPIBBusServer()
+    server.resourceManager = rm
+    server.sendDeviceMessage = lambda msg, addr: None
+    server.devices = {}
+    server.transports = {}
+    server.metrics = gpib_server.Metrics()
+    server.workers = gpib_server.AddressWorkers(server.maxWorkerThreads)
+    server.workers.start()
+
+    @inlineCallbacks
+    def client(addr):
+        c = server.newContext(addr)
+        server.initContext(c)
+        server.address(c, addr)
+        for i in range(nQueries):
+            ans = yield server.query(c, 'MEAS%d?' % i)
+            assert ans == 'MEAS%d?' % i
+
+    @inlineCallbacks
+    def run():
+        try:
+            yield server.refreshDevices()
+            start = time.time()
+            yield gatherResults([client(addr) for addr in rm.list_resources()])
+            elapsed = time.time() - start
+            serial = nDevices * nQueries * delay
+            print '%d devices x %d queries, %g s per query:' % \
+                (nDevices, nQueries, delay)
+            print '  %.3f s (one at a time: %.3f s)' % (elapsed, serial)
+            print '  overlapping calls: %d' % \
+                sum(instr.overlaps for instr in rm.instruments.values())
+        finally:
+            server.workers.stop()
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the GPIB Bus server with fake instruments.')
+    parser.add_argument('--devices', type=int, default=4,
+                        help='number of instruments')
+    parser.add_argument('--queries', type=int, default=10,
+                        help='queries per instrument')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='time each query takes, in s')
+    args = parser.parse_args()
+    benchmark(args.devices, args.queries, args.delay)
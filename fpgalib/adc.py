@@ -153,7 +153,14 @@ class ADC(fpga.FPGA):
 
 
 class AdcRunner(object):
-    pass
+
+    def runKey(self):
+        """Hashable run register settings other than reps and delay.
+
+        See DacRunner.runKey. None means the registers must be built with
+        runPacket for every sequence.
+        """
+        return None
 
 
 class ADC_Branch1(ADC):
@@ -653,6 +660,14 @@ class AdcRunner_Build7(AdcRunner_Build2):
         regs = self.dev.regRun(self.mode, self.info, self.reps, startDelay=startDelay)
         # print("ADC run packet: %s" % (regs,))
         return regs    
+
+    def runKey(self):
+        return (self.mode, self.info.get('mon0', 'start'),
+                self.info.get('mon1', 'don'))
+
+    def patchRun(self, regs, page, delay):
+        """Set reps and start delay in registers from runPacket."""
+        self.dev.patchRun(regs, self.reps, self.startDelay + delay)
     
     def extract(self, packets):
         """Extract data coming back from a readPacket."""
@@ -906,6 +921,12 @@ class ADC_Build7(ADC_Branch2):
         regs[11] = mon1
         
         return regs
+
+    @classmethod
+    def patchRun(cls, regs, reps, startDelay):
+        """Set reps and start delay in registers from regRun."""
+        regs[1:3] = littleEndian(startDelay, 2)
+        regs[7:9] = littleEndian(reps, 2)
     
     # Direct ethernet server packet creation methods
     def setup(self, info):
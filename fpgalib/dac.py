@@ -376,7 +376,15 @@ class DAC(fpga.FPGA):
 
 
 class DacRunner(object):
-    pass
+
+    def runKey(self):
+        """Hashable run register settings other than reps, page and delay.
+
+        Run registers from runners with equal keys differ only in the reps,
+        page and start delay, which patchRun sets in place. None means the
+        registers must be built with runPacket for every sequence.
+        """
+        return None
 
 
 class DacRunner_Build7(DacRunner):
@@ -395,6 +403,9 @@ class DacRunner_Build7(DacRunner):
             # word is 4 bytes? Check John's documentation
             self.sram = self.sram[:self.dev.SRAM_PAGE_LEN * 4]
 
+        # memory before master delays are added, see loadPacket
+        self.slaveMem = self.mem
+
         # calculate expected number of packets
         self.nTimers = MemorySequence.timerCount(self.mem)
         self.nPackets = self.reps * self.nTimers // DAC.TIMING_PACKET_LEN
@@ -458,8 +469,10 @@ class DacRunner_Build7(DacRunner):
     def loadPacket(self, page, isMaster):
         """Create pipelined load packet.  For DAC, upload mem and SRAM."""
         if isMaster:
-            # this will be the master, so add delays before SRAM
-            self.mem = MemorySequence.addMasterDelay(self.mem)
+            # this will be the master, so add delays before SRAM.
+            # Start from the slave memory so that loading again for a retry
+            # does not add the delays twice.
+            self.mem = MemorySequence.addMasterDelay(self.slaveMem)
             # Recompute sequence time
             # Recalculate sequence time
             self.memTime = MemorySequence.sequenceTime_sec(self.mem)
@@ -478,6 +491,13 @@ class DacRunner_Build7(DacRunner):
                                blockDelay=self.blockDelay, sync=sync)
         return regs
 
+    def runKey(self):
+        return (self.blockDelay,)
+
+    def patchRun(self, regs, page, delay):
+        """Set reps, page and start delay in registers from runPacket."""
+        self.dev.patchRun(regs, self.reps, page, self.startDelay + delay)
+
     def collectPacket(self, seqTime, ctx):
         """
         Collect appropriate number of ethernet packets for this sequence, then
@@ -558,6 +578,13 @@ class DAC_Build7(DAC):
         regs[45] = sync
         return regs
 
+    @classmethod
+    def patchRun(cls, regs, reps, page, delay):
+        """Set reps, page and start delay in registers from regRun."""
+        regs[0] = 1 + (page << 7)
+        regs[13:15] = littleEndian(reps, 2)
+        regs[44], regs[51] = littleEndian(int(delay), 2)
+
     @classmethod
     def regRunSram(cls, startAddr, endAddr, loop=True, blockDelay=0, sync=249):
         regs = np.zeros(cls.REG_PACKET_LEN, dtype='<u1')
@@ -1118,6 +1145,7 @@ class DacRunner_Build15(DacRunner_Build7):
         self.loop_delay = loop_delay
         self.jump_table = self.dev.make_jump_table(jt_entries, jt_counters)
         self.sram = sram
+        self.master_delay = 0  # set by loadPacket
         self.nPackets = 0  # we don't expect any packets back
         self.seqTime = fpga.TIMEOUT_FACTOR * (100 * self.reps) * 10**-6 + 1  # TODO: what should we do here? issue #49
 
@@ -1134,9 +1162,10 @@ class DacRunner_Build15(DacRunner_Build7):
             to the start delay.
         :return: packet for the direct ethernet server
         """
-        if isMaster:
-            # TODO: how can we add a delay to the JT?
-            self.start_delay += MASTER_SRAM_DELAY_US
+        # TODO: how can we add a delay to the JT?
+        # Kept apart from start_delay so that loading again for a retry does
+        # not add the delay twice.
+        self.master_delay = MASTER_SRAM_DELAY_US if isMaster else 0
         return self.dev.load(self.jump_table, self.sram)
 
     def runPacket(self, page, slave, delay, sync):
@@ -1148,11 +1177,19 @@ class DacRunner_Build15(DacRunner_Build7):
         :param int sync: passed through to sync option for register packet
         :return: ndarray, ready to be tostring'ed to bytes for the DE server
         """
-        start_delay = self.start_delay + delay
+        start_delay = self.start_delay + self.master_delay + delay
         regs = self.dev.regRun(self.reps, page, slave, start_delay, readback=False,
                                blockDelay=None, sync=sync, loop_delay=self.loop_delay)
         return regs
 
+    def runKey(self):
+        return (self.loop_delay,)
+
+    def patchRun(self, regs, page, delay):
+        """Set reps and start delay in registers from runPacket."""
+        start_delay = self.start_delay + self.master_delay + delay
+        self.dev.patchRun(regs, self.reps, page, start_delay)
+
 
 class DAC_Build15(DAC_Build8):
     """ DAC Build 15 is the first (working) jump table build.
@@ -1437,6 +1474,14 @@ class DAC_Build15(DAC_Build8):
 
         return regs
 
+    @classmethod
+    def patchRun(cls, regs, reps, page, delay):
+        """Set reps and start delay in registers from regRun."""
+        if page:
+            raise ValueError("JT board got a non-zero page: ", page)
+        regs[13:15] = littleEndian(reps, 2)
+        regs[43:45] = littleEndian(int(delay), 2)
+
     @classmethod
     def regRunSimple(cls, readback=True):
         """
@@ -0,0 +1,799 @@
+"""sim.py
+
+In-process simulation of a GHz FPGA board group, for testing and benchmarking
+the FPGA server pipeline without hardware.
+
+The pieces are:
+
+SimDirectEthernet
+    Stands in for a Direct Ethernet server. It hands out packets with the
+    same interface as pylabrad packets (connect, write, collect, read,
+    send_trigger, wait_for_trigger, ...) and executes their records in order
+    against per-context state, including timeouts, packet filters and
+    triggers. As on the real server, if a record fails (e.g. a collect times
+    out) the remaining records of that request are not executed.
+
+SimDac, SimAdc
+    Virtual boards. They accept register, SRAM, memory, jump table, trigger
+    table and mixer table packets, answer register readbacks, and when run
+    produce readout packets of the right number and length at the right
+    time (DAC timing packets for memory builds, ADC average and demodulator
+    packets).
+
+SimDaisyChain
+    Starts all armed slave boards when the master board starts and models
+    the time a sequence takes on the boards.
+
+SimWire
+    A full-duplex link with configurable latency, bandwidth and packet loss.
+
+SimBoardGroup
+    Builds all of the above, runs the real board detection and device
+    connection code against it and registers the devices with a real
+    FPGAServer, so that Run Sequence can be called end to end.
+
+All timing goes through a clock object providing callLater and seconds, which
+is the twisted reactor by default. Tests can pass a twisted.internet.task.Clock
+to drive the simulation deterministically.
+
+See sim_benchmark.py for a throughput benchmark built on this module.
+"""
+
+import itertools
+import random
+
+import numpy as np
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from labrad import types as T
+from labrad.units import Value
+
+import fpgalib.dac as dac
+import fpgalib.fpga as fpga
+from fpgalib.util import littleEndian
+
+
+def _seconds(t):
+    """Convert a labrad time Value (or plain number) to seconds."""
+    if isinstance(t, Value):
+        return t['s']
+    return float(t)
+
+
+class SimWire(object):
+    """One direction of an ethernet link.
+
+    Packets are serialized onto the link at the given bandwidth, in the order
+    they are sent, and arrive after an additional fixed latency. Each packet
+    is independently dropped with probability loss.
+    """
+
+    def __init__(self, clock, latency=20e-6, bandwidth=125e6, loss=0.0,
+                 rng=None):
+        self.clock = clock
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second
+        self.loss = loss
+        self.rng = rng or random.Random()
+        self.busyUntil = 0.0
+        self.packetsSent = 0
+        self.packetsLost = 0
+        self.bytesSent = 0
+
+    def transmit(self, packets, deliver):
+        """Send a list of packets, calling deliver(packets) on arrival.
+
+        Packets sent together arrive together, after the last one has been
+        serialized onto the link.
+        """
+        if self.loss:
+            kept = [p for p in packets if self.rng.random() >= self.loss]
+            self.packetsLost += len(packets) - len(kept)
+            packets = kept
+        if not packets:
+            return
+        nbytes = sum(len(p) for p in packets)
+        now = self.clock.seconds()
+        self.busyUntil = max(now, self.busyUntil) + nbytes / self.bandwidth
+        self.packetsSent += len(packets)
+        self.bytesSent += nbytes
+        self.clock.callLater(self.busyUntil + self.latency - now, deliver,
+                             packets)
+
+
+class SimResponse(object):
+    """Result of a simulated request, indexed like a pylabrad response."""
+
+    def __init__(self):
+        self._settings = {}
+        self._keys = {}
+
+    def _add(self, name, key, result):
+        self._settings[name] = result
+        if key is not None:
+            self._keys[key] = result
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            return self._keys[key]
+        return self._settings[key]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_settings'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class SimPacket(object):
+    """A request packet for the simulated direct ethernet server."""
+
+    def __init__(self, server, context):
+        self._server = server
+        self._context = context
+        self._packet = []  # list of [setting name, args, key]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in SimDirectEthernet.SETTINGS:
+            raise AttributeError(name)
+
+        def record(*args, **kw):
+            self._packet.append([name, args, kw.get('key', None)])
+            return self
+        return record
+
+    def __getitem__(self, key):
+        for name, args, k in self._packet:
+            if k == key:
+                return args[0]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        # Records are replaced, not changed, as in a labrad packet, so copies
+        # of the record list are not affected.
+        found = False
+        for i, (name, args, k) in enumerate(self._packet):
+            if k == key:
+                self._packet[i] = [name, (value,), k]
+                found = True
+        if not found:
+            raise KeyError(key)
+
+    def send(self, context=None, **kw):
+        # Copy the records now, as a real packet is flattened when sent.
+        records = [(name, args, key) for name, args, key in self._packet]
+        if context is None:
+            context = self._context
+        return self._server._execute(context, records)
+
+
+class _Context(object):
+    """State of one client context on the simulated direct ethernet server."""
+
+    def __init__(self, ID):
+        self.ID = ID
+        self.port = None
+        self.destMac = None
+        self.srcMac = None
+        self.length = None
+        self.timeout = 1.0
+        self.listening = False
+        self.buffer = []
+        self.packetWaiters = []  # list of [n, deferred, timeout call]
+        self.triggers = 0
+        self.triggerWaiters = []  # list of [n, deferred]
+
+
+class SimManager(object):
+    """The parts of the labrad manager used by the FPGA server."""
+
+    def __init__(self, servers):
+        self._servers = servers
+
+    def servers(self):
+        return defer.succeed([(s.ID, s.name) for s in self._servers])
+
+    def expire_context(self, ID, context=None):
+        for s in self._servers:
+            if s.ID == ID:
+                s._contexts.pop(context, None)
+        return defer.succeed(None)
+
+
+class SimRegistry(object):
+    """A registry that answers gets from a dict of keys."""
+
+    ID = 2
+
+    def __init__(self, keys=None):
+        self.keys = keys or {}
+        self._ctxs = itertools.count(1)
+
+    def context(self):
+        return (2, next(self._ctxs))
+
+    def packet(self, **kw):
+        return SimRegistryPacket(self)
+
+
+class SimRegistryPacket(object):
+
+    def __init__(self, registry):
+        self._registry = registry
+        self._gets = []
+
+    def cd(self, *args, **kw):
+        return self
+
+    def get(self, name, *args, **kw):
+        default = args[1] if len(args) > 1 else []
+        self._gets.append((name, default, kw.get('key', name)))
+        return self
+
+    def send(self, **kw):
+        resp = SimResponse()
+        for name, default, key in self._gets:
+            resp._add('get', key, self._registry.keys.get(name, default))
+        return defer.succeed(resp)
+
+
+class SimConnection(object):
+    """The parts of a labrad connection used by the FPGA devices."""
+
+    def __init__(self, servers, registryKeys=None):
+        self.manager = SimManager(servers)
+        self.registry = SimRegistry(registryKeys)
+
+
+class SimDirectEthernet(object):
+    """A simulated direct ethernet server for one adapter."""
+
+    SETTINGS = set([
+        'adapters', 'connect', 'listen', 'timeout', 'collect', 'read',
+        'read_as_words', 'discard', 'clear', 'source_mac', 'destination_mac',
+        'ether_type', 'write', 'require_source_mac', 'reject_source_mac',
+        'require_destination_mac', 'reject_destination_mac',
+        'require_length', 'reject_length', 'require_ether_type',
+        'reject_ether_type', 'require_content', 'reject_content',
+        'send_trigger', 'wait_for_trigger',
+    ])
+
+    ID = 1
+    MAC = '00:00:00:00:00:00'
+
+    def __init__(self, clock, port=0, name='Sim Direct Ethernet',
+                 latency=20e-6, bandwidth=125e6, loss=0.0, seed=None):
+        self.clock = clock
+        self.port = port
+        self.name = self._labrad_name = name
+        rng = random.Random(seed)
+        self.outWire = SimWire(clock, latency, bandwidth, loss, rng)
+        self.inWire = SimWire(clock, latency, bandwidth, loss, rng)
+        self.boards = {}  # mac -> SimBoard
+        self._contexts = {}
+        self._ctxIDs = itertools.count(1)
+        self._cxn = SimConnection([self])
+
+    # Client interface
+
+    def context(self):
+        return (1, next(self._ctxIDs))
+
+    def packet(self, context=None, **kw):
+        if context is None:
+            context = (0, 0)
+        return SimPacket(self, context)
+
+    def adapters(self, **kw):
+        return defer.succeed([(self.port, self.name)])
+
+    def read(self, n=1, context=None):
+        d = self._execute(context, [('read', (n,), None)])
+        return d.addCallback(lambda resp: resp.read)
+
+    # Board interface
+
+    def attach(self, board):
+        self.boards[board.mac] = board
+
+    def boardSend(self, board, packets):
+        """Send packets from a board back to this adapter."""
+        self.inWire.transmit(packets,
+                             lambda pkts: self._receive(board.mac, pkts))
+
+    # Request execution
+
+    def _state(self, context):
+        if context not in self._contexts:
+            self._contexts[context] = _Context(context)
+        return self._contexts[context]
+
+    @inlineCallbacks
+    def _execute(self, context, records):
+        state = self._state(context)
+        resp = SimResponse()
+        for name, args, key in records:
+            handler = getattr(self, '_' + name, None)
+            if handler is None:
+                result = None  # filters we do not model
+            else:
+                result = yield defer.maybeDeferred(handler, state, *args)
+            resp._add(name, key, result)
+        returnValue(resp)
+
+    def _connect(self, state, port):
+        state.port = port
+
+    def _listen(self, state):
+        state.listening = True
+
+    def _timeout(self, state, t):
+        state.timeout = _seconds(t)
+
+    def _destination_mac(self, state, mac):
+        state.destMac = mac
+
+    def _require_source_mac(self, state, mac):
+        state.srcMac = mac
+
+    def _require_length(self, state, n):
+        state.length = n
+
+    def _write(self, state, data):
+        board = self.boards.get(state.destMac, None)
+        if board is None:
+            return  # nobody at this address
+        self.outWire.transmit([data], board.receive)
+
+    def _clear(self, state):
+        state.buffer = []
+
+    def _collect(self, state, n=1):
+        return self._waitForPackets(state, n)
+
+    def _read(self, state, n=1):
+        d = self._waitForPackets(state, n)
+
+        def pop(_):
+            packets, state.buffer = state.buffer[:n], state.buffer[n:]
+            return packets
+        return d.addCallback(pop)
+
+    def _discard(self, state, n=1):
+        d = self._waitForPackets(state, n)
+
+        def drop(_):
+            state.buffer = state.buffer[n:]
+        return d.addCallback(drop)
+
+    def _send_trigger(self, state, context):
+        target = self._state(tuple(context))
+        target.triggers += 1
+        self._wakeTriggers(target)
+
+    def _wait_for_trigger(self, state, n):
+        start = self.clock.seconds()
+        d = defer.Deferred()
+        d.addCallback(lambda _: Value(self.clock.seconds() - start, 's'))
+        state.triggerWaiters.append([n, d])
+        self._wakeTriggers(state)
+        return d
+
+    def _wakeTriggers(self, state):
+        while state.triggerWaiters:
+            n, d = state.triggerWaiters[0]
+            if state.triggers < n:
+                break
+            state.triggers -= n
+            state.triggerWaiters.pop(0)
+            d.callback(None)
+
+    def _waitForPackets(self, state, n):
+        if len(state.buffer) >= n:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        waiter = [n, d, None]
+        waiter[2] = self.clock.callLater(state.timeout, self._expire, state,
+                                         waiter)
+        state.packetWaiters.append(waiter)
+        return d
+
+    def _expire(self, state, waiter):
+        state.packetWaiters.remove(waiter)
+        n, d, call = waiter
+        d.errback(T.Error('Operation timed out: wanted {} packets, have {}'
+                          .format(n, len(state.buffer))))
+
+    def _receive(self, src, packets):
+        """Put packets arriving from a board into matching contexts."""
+        for state in self._contexts.values():
+            if not state.listening or state.port != self.port:
+                continue
+            if state.srcMac is not None and state.srcMac != src:
+                continue
+            if state.length is not None:
+                matching = [p for p in packets if len(p) == state.length]
+            else:
+                matching = packets
+            if not matching:
+                continue
+            state.buffer.extend((src, self.MAC, len(p), p) for p in matching)
+            for waiter in list(state.packetWaiters):
+                n, d, call = waiter
+                if len(state.buffer) >= n:
+                    state.packetWaiters.remove(waiter)
+                    call.cancel()
+                    d.callback(None)
+
+
+class SimBoard(object):
+    """Common behaviour of simulated boards."""
+
+    def __init__(self, de, chain, board, build, startDelay=0):
+        self.de = de
+        self.chain = chain
+        self.clock = de.clock
+        self.board = board
+        self.build = build
+        self.devClass = fpga.REGISTRY[(self.BOARD_TYPE, build)]
+        self.mac = self.devClass.macFor(board)
+        self.executionCounter = 0
+        self.reps = 0
+        self.armed = False
+        self.startDelay = startDelay
+        self.packetsReceived = 0
+        de.attach(self)
+
+    def receive(self, packets):
+        for data in packets:
+            self.packetsReceived += 1
+            self.handle(np.fromstring(data, dtype='<u1'))
+
+    def reply(self, packets, delay=2e-6):
+        """Send packets to the direct ethernet server after a delay."""
+        self.clock.callLater(delay, self.de.boardSend, self, packets)
+
+    def repTime(self):
+        """Minimum time for one repetition of the loaded sequence."""
+        raise NotImplementedError()
+
+    def readout(self, reps):
+        """Readout packets produced by running reps repetitions."""
+        return []
+
+    def finishReps(self, reps):
+        """Called when reps repetitions have been run."""
+        self.executionCounter += reps
+
+
+class SimDac(SimBoard):
+    """A simulated GHz DAC board."""
+
+    BOARD_TYPE = 'DAC'
+    SRAM_PACKET_LEN = 1026
+    MEM_PACKET_LEN = 769
+    JT_PACKET_LEN = 528
+
+    def __init__(self, de, chain, board, build=15, startDelay=0):
+        SimBoard.__init__(self, de, chain, board, build, startDelay)
+        self.sram = np.zeros(self.devClass.SRAM_LEN, dtype='<u4')
+        self.sramWords = 0
+        self._sramWritten = 0
+        self.mem = np.zeros(getattr(self.devClass, 'MEM_LEN', 0),
+                            dtype='<u4')
+        self.jumpTable = None
+        self.loopDelay = 0
+        self.streamTiming = False
+        self._timers = 0
+        self._timersPerRep = 0
+
+    @property
+    def isJumpTable(self):
+        return self.devClass.HAS_JUMP_TABLE
+
+    def handle(self, data):
+        if len(data) == self.devClass.REG_PACKET_LEN:
+            self.handleRegisters(data)
+        elif len(data) == self.SRAM_PACKET_LEN:
+            derp = int(data[0]) + (int(data[1]) << 8)
+            words = np.fromstring(data[2:].tostring(), dtype='<u4')
+            start = derp * self.devClass.SRAM_WRITE_PKT_LEN
+            self.sram[start:start + len(words)] = words
+            self._sramWritten += len(words)
+        elif len(data) == self.MEM_PACKET_LEN:
+            page = int(data[0])
+            words = (data[1::3].astype('<u4') +
+                     (data[2::3].astype('<u4') << 8) +
+                     (data[3::3].astype('<u4') << 16))
+            start = page * self.devClass.MEM_PAGE_LEN
+            self.mem[start:start + len(words)] = words
+            self.memPage = page
+        elif len(data) == self.JT_PACKET_LEN:
+            self.jumpTable = data.copy()
+
+    def handleRegisters(self, regs):
+        reps = int(regs[13]) + (int(regs[14]) << 8)
+        if self.isJumpTable:
+            # 0 = idle, 1 = master, 2 = test, 3 = slave
+            start = {0: None, 1: 'master', 2: None, 3: 'slave'}[regs[0] & 3]
+            self.loopDelay = int(regs[15]) + (int(regs[16]) << 8)
+            delay = int(regs[43]) + (int(regs[44]) << 8)
+            readback = regs[1] == 1
+            self.streamTiming = False
+        else:
+            run = (regs[0] & 0x7F) == 1
+            start = ('slave' if regs[43] else 'master') if run else None
+            delay = int(regs[44]) + (int(regs[51]) << 8)
+            readback = regs[1] == 1
+            self.streamTiming = regs[1] == 3
+            self.memPage = regs[0] >> 7
+        if readback:
+            self.reply([self.readback()])
+        if start is not None:
+            self.reps = reps
+            self.startDelay = delay
+            self._timers = 0
+            # counted once: the next page may be written during the run
+            self._timersPerRep = self.timersPerRep()
+            if self._sramWritten:
+                self.sramWords = self._sramWritten
+                self._sramWritten = 0
+            self.chain.start(self, start == 'master')
+        else:
+            self.armed = False
+
+    def readback(self):
+        regs = np.zeros(self.devClass.READBACK_LEN, dtype='<u1')
+        regs[51] = self.build
+        regs[52:54] = littleEndian(self.executionCounter & 0xFFFF, 2)
+        return regs.tostring()
+
+    def memory(self):
+        page = getattr(self, 'memPage', 0)
+        start = page * self.devClass.MEM_PAGE_LEN
+        return self.mem[start:start + self.devClass.MEM_PAGE_LEN]
+
+    def repTime(self):
+        if self.isJumpTable:
+            return self.sramWords * 1e-9 + self.loopDelay * 1e-6
+        return dac.MemorySequence.sequenceTime_sec(self.memory())
+
+    def timersPerRep(self):
+        if self.isJumpTable or not self.streamTiming:
+            return 0
+        return dac.MemorySequence.timerCount(self.memory())
+
+    def readout(self, reps):
+        # Each timing packet holds TIMING_PACKET_LEN timer results. Timers
+        # left over at the end of a chunk are carried into the next one.
+        timers = self._timers + reps * self._timersPerRep
+        n, self._timers = divmod(timers, self.devClass.TIMING_PACKET_LEN)
+        data = np.zeros(self.devClass.READBACK_LEN, dtype='<u1')
+        data[3:63] = np.frombuffer(
+            np.arange(30, dtype='<u2').tostring(), dtype='<u1')
+        return [data.tostring()] * n
+
+
+class SimAdc(SimBoard):
+    """A simulated GHz ADC board (build 7 register and packet formats)."""
+
+    BOARD_TYPE = 'ADC'
+    SRAM_PACKET_LEN = 1026
+    DEMOD_PACKET_LEN = 48
+
+    def __init__(self, de, chain, board, build=7, startDelay=0):
+        SimBoard.__init__(self, de, chain, board, build, startDelay)
+        self.triggerTable = []
+        self.mode = None
+        self.readbackCount = 0
+        self.packetCount = 0
+        self._averaged = 0
+
+    def handle(self, data):
+        if len(data) == self.devClass.REG_PACKET_LEN:
+            self.handleRegisters(data)
+        elif len(data) == self.SRAM_PACKET_LEN:
+            page = int(data[0]) + (int(data[1]) << 8)
+            if page == 0:
+                self.triggerTable = self.parseTriggerTable(data[2:])
+
+    @staticmethod
+    def parseTriggerTable(data):
+        """Decode a trigger table written by ADC_Build7.makeTriggerTable."""
+        table = []
+        for ofs in range(0, len(data) - 7, 8):
+            entry = data[ofs:ofs + 8]
+            count = int(entry[0]) + (int(entry[1]) << 8) + 1
+            delay = int(entry[2]) + (int(entry[3]) << 8) + 4
+            length = int(entry[4]) + 1
+            chans = int(entry[5])
+            if delay == 4 and entry[:6].sum() == 0:
+                break  # empty entry ends the table
+            table.append((count, delay, length, chans))
+        return table
+
+    def handleRegisters(self, regs):
+        dev = self.devClass
+        mode = int(regs[0])
+        reps = int(regs[7]) + (int(regs[8]) << 8)
+        self.startDelay = int(regs[1]) + (int(regs[2]) << 8)
+        if mode not in (dev.RUN_MODE_REGISTER_READBACK, 0):
+            # counters in demodulator packets are reset on start
+            self.readbackCount = self.packetCount = self._averaged = 0
+        if mode == dev.RUN_MODE_REGISTER_READBACK:
+            self.reply([self.readback()])
+        elif mode in (dev.RUN_MODE_AVERAGE_AUTO, dev.RUN_MODE_DEMOD_AUTO):
+            self.mode = 'average' if mode == dev.RUN_MODE_AVERAGE_AUTO \
+                else 'demodulate'
+            self.reps = reps
+            self.chain.run([self], reps, self.clock.seconds())
+        elif mode in (dev.RUN_MODE_AVERAGE_DAISY, dev.RUN_MODE_DEMOD_DAISY):
+            self.mode = 'average' if mode == dev.RUN_MODE_AVERAGE_DAISY \
+                else 'demodulate'
+            self.reps = reps
+            self.chain.start(self, False)
+        else:
+            self.armed = False
+
+    def readback(self):
+        regs = np.zeros(self.devClass.READBACK_LEN, dtype='<u1')
+        regs[0] = self.build
+        regs[2:4] = littleEndian(self.executionCounter & 0xFFFF, 2)
+        return regs.tostring()
+
+    def repTime(self):
+        return 4e-9 * sum(count * (delay + length)
+                          for count, delay, length, chans in self.triggerTable)
+
+    def packetsPerRep(self):
+        pairs = sum(count * chans
+                    for count, delay, length, chans in self.triggerTable)
+        perPacket = float(self.devClass.DEMOD_CHANNELS_PER_PACKET)
+        return int(np.ceil(pairs / perPacket))
+
+    def readout(self, reps):
+        if self.mode == 'average':
+            # Average data only comes out once the whole run is finished.
+            self._averaged += reps
+            if self._averaged < self.reps:
+                return []
+            self._averaged = 0
+            return ['\x00' * self.devClass.AVERAGE_PACKET_LEN] * \
+                self.devClass.AVERAGE_PACKETS
+        packets = []
+        perRep = self.packetsPerRep()
+        for i in range(reps):
+            self.readbackCount += 1
+            for j in range(perRep):
+                data = np.zeros(self.DEMOD_PACKET_LEN, dtype='<u1')
+                data[44:46] = littleEndian(self.readbackCount & 0xFFFF, 2)
+                data[46] = self.packetCount & 0xFF
+                self.packetCount += 1
+                packets.append(data.tostring())
+        return packets
+
+
+class SimDaisyChain(object):
+    """The daisy chain connecting the boards of a simulated board group.
+
+    When the master starts, every armed board runs reps repetitions in step
+    with it. The repetition period is the longest minimum repetition time of
+    the boards taking part. Boards that are still busy with a previous run
+    start the new one as soon as they are done. Readout packets are produced
+    every chunkTime seconds of run time, rather than rep by rep, to keep the
+    number of simulation events down.
+    """
+
+    def __init__(self, clock, chunkTime=1e-3):
+        self.clock = clock
+        self.chunkTime = chunkTime
+        self.boards = []
+        self.busyUntil = 0.0
+        self.runs = []  # list of (start, end) of runs on the boards
+        self.overruns = 0
+
+    def start(self, board, isMaster):
+        if not isMaster:
+            board.armed = True
+            return
+        boards = [board] + [b for b in self.boards
+                            if b.armed and b is not board]
+        for b in boards:
+            b.armed = False
+        self.run(boards, board.reps, self.clock.seconds())
+
+    def run(self, boards, reps, now):
+        if self.busyUntil > now:
+            self.overruns += 1
+        start = max(now, self.busyUntil)
+        period = max([b.repTime() for b in boards] + [1e-6])
+        duration = max(b.startDelay for b in boards) * 1e-9 + reps * period
+        self.busyUntil = start + duration
+        self.runs.append((start, self.busyUntil))
+        repsPerChunk = max(1, int(self.chunkTime // period))
+        for b in boards:
+            done = 0
+            while done < reps:
+                n = min(repsPerChunk, reps - done)
+                done += n
+                t = start + b.startDelay * 1e-9 + done * period
+                self.clock.callLater(t - now, self._emit, b, n)
+
+    def _emit(self, board, reps):
+        board.finishReps(reps)
+        packets = board.readout(reps)
+        if packets:
+            board.de.boardSend(board, packets)
+
+    def occupancy(self, start, end):
+        """Fraction of the time between start and end that boards ran."""
+        busy = 0.0
+        for s, e in self.runs:
+            busy += max(0.0, min(e, end) - max(s, start))
+        return busy / (end - start) if end > start else 0.0
+
+
+class SimBoardGroup(object):
+    """A simulated board group hooked up to a real FPGAServer.
+
+    Call setup() (which returns a Deferred) before use. Afterwards
+    self.boardGroup is the server's BoardGroup for the simulated adapter and
+    self.devices holds the connected device wrappers, in daisy chain order.
+    """
+
+    def __init__(self, server, clock, nDacs=2, nAdcs=0, name='Sim',
+                 dacBuild=15, adcBuild=7, boardDelay=0, **wireArgs):
+        self.server = server
+        self.clock = clock
+        self.name = name
+        self.de = SimDirectEthernet(clock, **wireArgs)
+        self.chain = SimDaisyChain(clock)
+        self.boards = []
+        # DACs go first so that the master is always a DAC.
+        for i in range(nDacs):
+            self.boards.append(SimDac(self.de, self.chain, i + 1, dacBuild))
+        for i in range(nAdcs):
+            self.boards.append(SimAdc(self.de, self.chain, i + 1, adcBuild))
+        self.chain.boards = self.boards
+        self.boardDelay = boardDelay
+        self.devices = []
+
+    @property
+    def boardNames(self):
+        return ['{} {}'.format(b.BOARD_TYPE, b.board) for b in self.boards]
+
+    @inlineCallbacks
+    def setup(self):
+        # Circular import: the server module imports fpgalib.
+        import ghz_fpga_server
+        server = self.server
+        # Outside of a running labrad server these are not set up yet.
+        if not hasattr(server, 'boardGroups'):
+            server.boardGroups = {}
+        if not hasattr(server, 'client'):
+            server.client = self.de._cxn
+        bg = ghz_fpga_server.BoardGroup(server, self.de, self.de.port)
+        server.boardGroups[self.de.name, self.de.port] = bg
+        yield bg.init()
+        bg.configure(self.name, [(name, self.boardDelay)
+                                 for name in self.boardNames])
+        found = yield bg.detectBoards()
+        found = dict(found)
+        for devName in bg.boardOrder:
+            args = found[devName]
+            cls = server.chooseDeviceWrapper(devName, *args)
+            guid = len(server.devices) + 1
+            dev = cls(guid, devName)
+            yield dev.connect(*args)
+            server.devices[guid] = dev
+            server.devices[devName] = dev
+            self.devices.append(dev)
+        self.boardGroup = bg
+        returnValue(self)
+
+
+def callSetting(server, name, c, *args, **kw):
+    """Call a server setting directly, returning a Deferred."""
+    return defer.maybeDeferred(getattr(server, name), c, *args, **kw)
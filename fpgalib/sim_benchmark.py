@@ -0,0 +1,164 @@
+"""sim_benchmark.py
+
+Measure GHz FPGA server throughput against simulated board groups.
+
+For each board count, a simulated board group (see sim.py) is built with
+about one ADC per four boards and the rest DACs, all of them in the daisy
+chain. The DACs are build 8 by default, which run memory sequences that fit
+in one SRAM page, so that sequences can be pipelined. Jump table builds
+(--dac-build 15) can't page, so Run Sequence Batch runs them one at a time
+like Run Sequence. We then time a number of back to back calls to Run Sequence, which
+run one at a time, and one call to Run Sequence Batch over the same number
+of points, which pipelines them. For each we print the sequence rate, the
+fraction of wall time the simulated boards spent running (pipeline
+occupancy), and the median and 99th percentile time spent in each pipeline
+stage.
+
+Everything runs against the real twisted reactor, so the numbers include the
+server's own CPU time. Example:
+
+    python -m fpgalib.sim_benchmark --boards 2 4 8 16 20 --sequences 50
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import fpgalib.dac as dac
+import fpgalib.fpga as fpga
+import fpgalib.sim as sim
+import ghz_fpga_server
+from labrad.units import Value
+
+
+def boardCounts(nBoards):
+    """Split a number of boards into (DACs, ADCs). The master is a DAC."""
+    nAdcs = nBoards // 4
+    return nBoards - nAdcs, nAdcs
+
+
+@inlineCallbacks
+def makeSim(nBoards, name, loss=0.0, dacBuild=8):
+    """Make a server and a simulated board group with nBoards boards."""
+    nDacs, nAdcs = boardCounts(nBoards)
+    server = ghz_fpga_server.FPGAServer()
+    server.boardGroups = {}
+    server.devices = {}
+    server.retries = 3
+    s = sim.SimBoardGroup(server, reactor, nDacs=nDacs, nAdcs=nAdcs,
+                          name=name, loss=loss, dacBuild=dacBuild)
+    yield s.setup()
+    returnValue((server, s))
+
+
+def configure(server, s, sramLen, loopDelay, mode):
+    """Set up a sequence on all boards in a new context."""
+    c = server.newContext(1)
+    server.initContext(c)
+    names = []
+    for dev in s.devices:
+        server.select_device(c, dev.devName)
+        server.start_delay(c, 0)
+        if dev.devName.split()[-2] == 'DAC' and dev.HAS_JUMP_TABLE:
+            server.jump_table_clear(c)
+            server.jump_table_add_entry(c, 'END', sramLen)
+            server.dac_sram(c, np.zeros(sramLen, dtype='<u4'))
+            server.loop_delay(c, Value(loopDelay, 'us'))
+        elif dev.devName.split()[-2] == 'DAC':
+            # the loop delay, in 25 MHz cycles, then the SRAM
+            mem = dac.MemorySequence().delayCycles(int(loopDelay * 25))
+            mem.sramStartAddress(0).sramEndAddress(sramLen - 1).runSram()
+            server.dac_memory(c, mem.branchToStart())
+            server.dac_sram(c, np.zeros(sramLen, dtype='<u4'))
+        else:
+            server.adc_run_mode(c, mode)
+            server.adc_trigger_table(c, [(1, 100, 50, 1)])
+            server.adc_mixer_table(c, 0, np.zeros((256, 2), dtype=int))
+        names.append(dev.devName)
+    server.sequence_boards(c, names)
+    adcs = [name for name in names if name.split()[-2] == 'ADC']
+    if mode == 'demodulate':
+        adcs = [name + '::0' for name in adcs]
+    server.sequence_timing_order(c, adcs)
+    return c
+
+
+def report(label, s, n, start, end):
+    bg = s.boardGroup
+    occupancy = s.chain.occupancy(start, end)
+    print '  {:<6} {:8.1f} seq/s   occupancy {:5.1f}%'.format(
+        label, n / (end - start), 100 * occupancy)
+    for stage, count, (p50, p99) in bg.stats.percentiles([50, 99]):
+        print '    {:<14} p50 {:9.3f} ms   p99 {:9.3f} ms'.format(
+            stage, p50 * 1e3, p99 * 1e3)
+    bg.stats.histograms.clear()
+
+
+@inlineCallbacks
+def benchmark(nBoards, nSequences, reps, sramLen, loopDelay, mode, loss,
+              dacBuild=8):
+    server, s = yield makeSim(nBoards, 'Bench{}'.format(nBoards), loss,
+                              dacBuild)
+    c = configure(server, s, sramLen, loopDelay, mode)
+    nDacs, nAdcs = boardCounts(nBoards)
+    print '{} boards ({} build {} DACs, {} ADCs):'.format(
+        nBoards, nDacs, dacBuild, nAdcs)
+
+    # prime setup state so both runs start from the same place
+    yield sim.callSetting(server, 'run_sequence', c, reps, bool(nAdcs))
+    s.boardGroup.stats.histograms.clear()
+
+    start = time.time()
+    for i in range(nSequences):
+        yield sim.callSetting(server, 'run_sequence', c, reps, bool(nAdcs))
+    report('serial', s, nSequences, start, time.time())
+
+    points = [([], [], [])] * nSequences
+    start = time.time()
+    yield sim.callSetting(server, 'run_sequence_batch', c, reps, bool(nAdcs),
+                          points)
+    report('batch', s, nSequences, start, time.time())
+
+
+@inlineCallbacks
+def main(args):
+    try:
+        for nBoards in args.boards:
+            yield benchmark(nBoards, args.sequences, args.reps, args.sram,
+                            args.loop_delay, args.mode, args.loss,
+                            args.dac_build)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the GHz FPGA server on simulated boards.')
+    parser.add_argument('--boards', type=int, nargs='+',
+                        default=[2, 4, 8, 12, 16, 20],
+                        help='board counts to benchmark')
+    parser.add_argument('--sequences', type=int, default=50,
+                        help='sequences to run for each board count')
+    parser.add_argument('--reps', type=int, default=300,
+                        help='reps per sequence')
+    parser.add_argument('--sram', type=int, default=1024,
+                        help='SRAM words per DAC')
+    parser.add_argument('--loop-delay', type=float, default=50,
+                        help='DAC loop delay in us')
+    parser.add_argument('--mode', default='average',
+                        choices=['average', 'demodulate'],
+                        help='ADC run mode')
+    parser.add_argument('--dac-build', type=int, default=8,
+                        choices=sorted(b for t, b in fpga.REGISTRY
+                                       if t == 'DAC'),
+                        help='DAC build; 15 has a jump table, and never '
+                             'pipelines')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='probability of losing each ethernet packet')
+    args = parser.parse_args()
+    reactor.callWhenRunning(main, args)
+    reactor.run()
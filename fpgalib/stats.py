@@ -0,0 +1,212 @@
+"""stats.py
+
+Timing statistics for the GHz FPGA server pipeline.
+
+Each board group keeps a PipelineStats object. Every sequence run on the
+board group gets a SequenceTrace, and each stage of the sequence (building
+packets, waiting for locks, loading, collecting, reading, ...) is recorded
+as a span on that trace. Span durations go into one rolling histogram per
+stage, from which percentiles can be read out at any time, and the spans of
+the last few sequences are kept so they can be dumped in the Chrome trace
+event format (load the JSON in chrome://tracing or https://ui.perfetto.dev)
+to see where the pipeline stalls.
+"""
+
+import collections
+import json
+import math
+import time
+
+import numpy as np
+
+
+class LatencyHistogram(object):
+    """A histogram of durations with logarithmically spaced buckets.
+
+    Like an HDR histogram, the bucket width is proportional to the value,
+    so every recorded duration is kept to within a fixed relative precision
+    no matter how large or small it is, and recording is O(1).
+    """
+
+    MIN_VALUE = 1e-6  # seconds; shorter durations go in the first bucket
+    MAX_VALUE = 1e4  # seconds; longer durations go in the last bucket
+    PRECISION = 0.01  # relative width of each bucket
+
+    _LOG_STEP = math.log1p(PRECISION)
+    NUM_BUCKETS = int(math.ceil(
+        math.log(MAX_VALUE / MIN_VALUE) / _LOG_STEP)) + 1
+
+    def __init__(self):
+        self.counts = np.zeros(self.NUM_BUCKETS, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucketFor(cls, value):
+        """Get the index of the bucket that holds the given value."""
+        if value <= cls.MIN_VALUE:
+            return 0
+        idx = int(math.log(value / cls.MIN_VALUE) / cls._LOG_STEP) + 1
+        return min(idx, cls.NUM_BUCKETS - 1)
+
+    @classmethod
+    def bucketValue(cls, idx):
+        """Get the value at the top of a bucket."""
+        return cls.MIN_VALUE * math.exp(idx * cls._LOG_STEP)
+
+    def record(self, value):
+        self.counts[self.bucketFor(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, ps):
+        """Get the values below which the given percentages of data fall.
+
+        Returns a list of durations in seconds, one for each percentage in
+        ps, or zeros if nothing has been recorded.
+        """
+        if not self.count:
+            return [0.0 for p in ps]
+        cumulative = np.cumsum(self.counts)
+        ans = []
+        for p in ps:
+            rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+            idx = int(np.searchsorted(cumulative, rank))
+            if idx == self.NUM_BUCKETS - 1:
+                # The last bucket is open ended.
+                ans.append(self.max)
+            else:
+                ans.append(min(self.bucketValue(idx), self.max))
+        return ans
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class RollingHistogram(object):
+    """A LatencyHistogram covering only the last few periods of time.
+
+    Data is recorded into a ring of histograms, each covering `period`
+    seconds. Old slices are cleared as time moves on, so percentiles always
+    describe roughly the last `period * slices` seconds.
+    """
+
+    def __init__(self, period=10.0, slices=6, clock=time.time):
+        self.period = period
+        self.clock = clock
+        self.slices = [LatencyHistogram() for _ in range(slices)]
+        self.current = int(self.clock() // self.period)
+
+    def _rotate(self):
+        now = int(self.clock() // self.period)
+        elapsed = min(now - self.current, len(self.slices))
+        for i in range(1, elapsed + 1):
+            self.slices[(self.current + i) % len(self.slices)] = \
+                LatencyHistogram()
+        self.current = max(now, self.current)
+
+    def record(self, value):
+        self._rotate()
+        self.slices[self.current % len(self.slices)].record(value)
+
+    def histogram(self):
+        """Get one histogram with all data in the rolling window."""
+        self._rotate()
+        total = LatencyHistogram()
+        for h in self.slices:
+            total.merge(h)
+        return total
+
+
+class SequenceTrace(object):
+    """Timing spans recorded while running one sequence."""
+
+    def __init__(self, stats, seqId):
+        self.stats = stats
+        self.seqId = seqId
+        self.spans = []  # list of (stage, start, end)
+
+    def span(self, stage, start, end=None):
+        """Record that a stage ran from start until end (default now)."""
+        if end is None:
+            end = time.time()
+        self.spans.append((stage, start, end))
+        self.stats.record(stage, end - start)
+        return end
+
+    def finish(self):
+        """Mark this sequence as done so it shows up in trace dumps."""
+        self.stats.traces.append(self)
+
+
+class PipelineStats(object):
+    """Per-stage timing for all sequences run on one board group."""
+
+    TRACES_TO_KEEP = 100
+
+    def __init__(self, name=''):
+        self.name = name
+        self.histograms = collections.OrderedDict()
+        self.traces = collections.deque(maxlen=self.TRACES_TO_KEEP)
+        self.sequences = 0
+
+    def newSequence(self):
+        """Start a trace for a new sequence."""
+        self.sequences += 1
+        return SequenceTrace(self, self.sequences)
+
+    def record(self, stage, dt):
+        """Add a duration for a stage that is not part of any trace."""
+        if stage not in self.histograms:
+            self.histograms[stage] = RollingHistogram()
+        self.histograms[stage].record(dt)
+
+    def percentiles(self, ps):
+        """Get (stage, count, [durations]) for every stage seen so far."""
+        ans = []
+        for stage, rolling in self.histograms.items():
+            h = rolling.histogram()
+            ans.append((stage, h.count, h.percentiles(ps)))
+        return ans
+
+    def traceEvents(self, n=None, pid=0):
+        """Get Chrome trace events for the last n sequences.
+
+        The board group is shown as process pid, labelled with our name.
+        Each sequence is drawn on its own row (thread id) so that sequences
+        which overlap in the pipeline are shown side by side.
+        """
+        traces = list(self.traces)
+        if n is not None:
+            traces = traces[-n:] if n else []
+        events = [{
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': pid,
+            'args': {'name': self.name},
+        }]
+        for trace in traces:
+            for stage, start, end in trace.spans:
+                events.append({
+                    'name': stage,
+                    'cat': 'sequence',
+                    'ph': 'X',
+                    'ts': start * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': pid,
+                    'tid': trace.seqId,
+                })
+        return events
+
+
+def chromeTrace(events):
+    """Format a list of trace events as Chrome trace JSON."""
+    return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
@@ -21,10 +21,12 @@ being sent to the boards.
 import mock
 import numpy as np
 import pytest
+from twisted.internet import task
 
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
 import fpgalib.jump_table as jump_table
+import fpgalib.sim as sim
 import ghz_fpga_server
 from labrad.units import Value
 
@@ -192,6 +194,128 @@ class TestFPGAServer(object):
             # check JT
             assert np.array_equal(matching_jt_packet, load_writes[0])
 
+    def test_batch_point_deltas(self):
+        s, c = self.server, self.ctx
+        s.select_device(c, 1)
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 256)
+        s.dac_sram(c, np.zeros(256, dtype='<u4'))
+        info = c[self.dev]
+
+        sram_data = np.arange(256, dtype='<u4')
+        point = ghz_fpga_server._apply_sequence_delta(
+            self.dev, info, 'sram', sram_data)
+        point = ghz_fpga_server._apply_sequence_delta(
+            self.dev, point, 'jt_entries', [('IDLE', (128, 1000)),
+                                            ('END', 256)])
+        point = ghz_fpga_server._apply_sequence_delta(
+            self.dev, point, 'startDelay', 7)
+
+        # the context itself is left alone
+        assert info['sram'] == np.zeros(256, dtype='<u4').tostring()
+        assert len(info['jt_entries']) == 1
+        assert 'startDelay' not in info or info['startDelay'] != 7
+
+        assert point['sram'] == sram_data.tostring()
+        assert len(point['jt_entries']) == 2
+        assert point['startDelay'] == 7
+        runner = self.dev.buildRunner(self.global_reps, point)
+        assert runner.sram == sram_data.tostring()
+
+        with pytest.raises(Exception):
+            ghz_fpga_server._apply_sequence_delta(self.dev, info, 'bogus', 0)
+
+    def test_run_packet_template(self):
+        s, c = self.server, self.ctx
+        names = ['Test DAC {}'.format(i) for i in range(1, NUM_DACS + 1)]
+        de = sim.SimDirectEthernet(task.Clock())
+        bg = ghz_fpga_server.BoardGroup(s, de, 0)
+        bg.configure('Test', [(name[len('Test '):], 0) for name in names])
+        for i, name in enumerate(names):
+            dev = s.devices[name]
+            dev.devName = name
+            dev.MAC = dac.DAC.macFor(i + 1)
+            s.select_device(c, i + 1)
+            s.jump_table_clear(c)
+            s.jump_table_add_entry(c, 'END', 256)
+            s.dac_sram(c, np.zeros(256, dtype='<u4'))
+            s.start_delay(c, 0)
+
+        # run the first and last boards; the middle one is idle
+        def runnerInfo():
+            return dict((name, s.devices[name].buildRunner(
+                self.global_reps, c[s.devices[name]]))
+                for name in (names[0], names[-1]))
+
+        def writes(pkt):
+            return [(args[0], k) for name, args, k in pkt._packet
+                    if name in ('destination_mac', 'write')]
+
+        template = bg.runTemplate(runnerInfo(), 249)
+        assert template.update(runnerInfo(), 0) == 0
+        wait, run, both = bg.makeRunPackets(template)
+        assert bg.runTemplateMisses == 1
+        records = writes(run)
+        assert writes(both) == records
+        assert [mac for mac, k in records[::2]] == [
+            dac.DAC.macFor(2), dac.DAC.macFor(3),
+            dac.DAC.macFor(1)]  # master last
+        idle = s.devices[names[1]].regIdle(0).tostring()
+        assert records[1] == (idle, names[1])
+        assert wait['nTriggers'] == 0
+
+        template = bg.runTemplate(runnerInfo(), 249)
+        assert template.update(runnerInfo(), 0) == 0
+        assert bg.runTemplateHits == 1
+
+        # changing the start delay and reps patches just the one board
+        s.select_device(c, NUM_DACS)
+        s.start_delay(c, 10)
+        info = runnerInfo()
+        info[names[0]].reps = 10
+        template = bg.runTemplate(info, 249)
+        assert bg.runTemplateHits == 2
+        assert template.update(info, 0) == 2
+        wait2, run2, both2 = bg.makeRunPackets(template)
+        wait2['nTriggers'] = 2
+        records2 = writes(run2)
+        assert records2[:3] == records[:3]
+        assert records2[4] == records[4]
+        for n, i, delay, reps in [(names[-1], 3, 10, self.global_reps),
+                                  (names[0], 5, 0, 10)]:
+            regs = np.fromstring(records2[i][0], dtype='u1')
+            expected = info[n].runPacket(0, i == 3, 0, 249)
+            assert np.array_equal(regs, expected)
+            assert regs[43] == delay
+            assert regs[13] + 256 * regs[14] == reps
+        # the packets of the earlier sequence are not changed
+        assert writes(run) == records
+        assert wait['nTriggers'] == 0
+        # the board group counts patches, so they are kept when templates
+        # are dropped; here both boards change, as the first one runs the
+        # original reps again
+        s.start_delay(c, 20)
+        bg.makePackets(runnerInfo().values(), 0, self.global_reps, [], 249)
+        assert bg.runTemplatePatches == 2
+        bg.runTemplates.clear()
+        assert bg.runTemplatePatches == 2
+
+    def test_reload_master(self):
+        s, c = self.server, self.ctx
+        s.select_device(c, 1)
+        s.jump_table_clear(c)
+        s.jump_table_add_entry(c, 'END', 256)
+        s.dac_sram(c, np.zeros(256, dtype='<u4'))
+        s.start_delay(c, 12)
+        runner = self.dev.buildRunner(self.global_reps, c[self.dev])
+        runner.loadPacket(page=0, isMaster=True)
+        first = runner.runPacket(page=0, slave=0, delay=0, sync=249)
+        # loading again, as when retrying after a timeout, changes nothing
+        runner.loadPacket(page=0, isMaster=True)
+        second = runner.runPacket(page=0, slave=0, delay=0, sync=249)
+        assert np.array_equal(first, second)
+        assert first[43] == 12 + dac.MASTER_SRAM_DELAY_US
+
     def _fake_run_sequence(self):
         """ Emulate some of the logic of run_sequence for testing purposes.
         """
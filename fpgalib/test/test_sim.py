@@ -0,0 +1,176 @@
+"""
+Run sequences through the GHz FPGA server against simulated boards.
+
+The boards, the direct ethernet server and the wire between them are the
+ones in fpgalib.sim, driven by a twisted task.Clock, so everything here runs
+deterministically and in no time.
+"""
+
+import numpy as np
+import pytest
+
+from twisted.internet import task
+from twisted.python import failure
+
+import fpgalib.adc as adc
+import fpgalib.dac as dac
+import fpgalib.sim as sim
+import ghz_fpga_server
+from labrad.units import Value
+
+
+def pump(clock, d, limit=100.0):
+    """Advance clock from one scheduled call to the next until d fires."""
+    result = []
+    d.addBoth(result.append)
+    while not result:
+        calls = clock.getDelayedCalls()
+        assert calls, 'deferred never fired'
+        dt = min(call.getTime() for call in calls) - clock.seconds()
+        clock.advance(max(dt, 0))
+        assert clock.seconds() < limit, 'deferred did not fire in time'
+    if isinstance(result[0], failure.Failure):
+        result[0].raiseException()
+    return result[0]
+
+
+def settle(clock):
+    """Run all scheduled calls, including ones they schedule."""
+    while clock.getDelayedCalls():
+        calls = clock.getDelayedCalls()
+        dt = min(call.getTime() for call in calls) - clock.seconds()
+        clock.advance(max(dt, 0))
+
+
+class TestSim(object):
+
+    def setup_method(self, method):
+        self.clock = task.Clock()
+        self.server = ghz_fpga_server.FPGAServer()
+        self.ctx = self.server.newContext(10)
+        self.server.initServer()
+        self.server.initContext(self.ctx)
+        self.sim = sim.SimBoardGroup(self.server, self.clock, nDacs=2,
+                                     nAdcs=1)
+        pump(self.clock, self.sim.setup())
+
+    def call(self, name, *args, **kw):
+        d = sim.callSetting(self.server, name, self.ctx, *args, **kw)
+        return pump(self.clock, d)
+
+    def setupDacs(self, sramLen=256, loopDelay=50):
+        for dev in self.sim.devices:
+            if not isinstance(dev, dac.DAC):
+                continue
+            self.server.select_device(self.ctx, dev.devName)
+            self.server.jump_table_clear(self.ctx)
+            self.server.jump_table_add_entry(self.ctx, 'END', sramLen)
+            self.server.dac_sram(self.ctx, np.zeros(sramLen, dtype='<u4'))
+            self.server.loop_delay(self.ctx, Value(loopDelay, 'us'))
+            self.server.start_delay(self.ctx, 0)
+
+    def setupAdc(self, mode, triggerTable):
+        self.server.select_device(self.ctx, 'Sim ADC 1')
+        self.server.adc_run_mode(self.ctx, mode)
+        self.server.start_delay(self.ctx, 0)
+        self.server.adc_trigger_table(self.ctx, triggerTable)
+        self.server.adc_mixer_table(self.ctx, 0, np.zeros((256, 2), dtype=int))
+
+    def test_detect(self):
+        names = [dev.devName for dev in self.sim.devices]
+        assert names == ['Sim DAC 1', 'Sim DAC 2', 'Sim ADC 1']
+        assert isinstance(self.sim.devices[0], dac.DAC_Build15)
+        assert isinstance(self.sim.devices[2], adc.ADC_Build7)
+        assert self.server.devices['Sim DAC 1'].boardGroup is \
+            self.sim.boardGroup
+
+    def test_run_dacs(self):
+        self.setupDacs()
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim DAC 2'])
+        self.server.sequence_timing_order(self.ctx, [])
+        for i in range(3):
+            ans = self.call('run_sequence', 100, False)
+            assert ans is None
+        settle(self.clock)
+        for board in self.sim.boards[:2]:
+            assert board.executionCounter == 300
+        # each run takes 100 reps of 256 ns of SRAM plus 50 us loop delay
+        start, end = self.sim.chain.runs[-1]
+        assert end - start == pytest.approx(100 * (256e-9 + 50e-6))
+
+    def test_run_adc_average(self):
+        self.setupDacs()
+        self.setupAdc('average', [(1, 100, 50, 1)])
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim DAC 2',
+                                               'Sim ADC 1'])
+        self.server.sequence_timing_order(self.ctx, ['Sim ADC 1'])
+        ans = self.call('run_sequence', 100, True)
+        # (board, I/Q, time sample)
+        assert ans.shape == (1, 2, adc.ADC_Build7.AVERAGE_PACKETS *
+                             adc.ADC_Build7.AVERAGE_PACKET_LEN // 4)
+        assert self.sim.boards[2].executionCounter == 100
+
+    def test_run_adc_demod(self):
+        self.setupDacs()
+        self.setupAdc('demodulate', [(3, 100, 50, 1)])
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim ADC 1'])
+        self.server.sequence_timing_order(self.ctx, ['Sim ADC 1::0'])
+        ans = self.call('run_sequence', 20, True)
+        # (channel, stat, retrigger, I/Q)
+        assert ans.shape == (1, 20, 3, 2)
+
+    def test_pipelined_batch(self):
+        self.setupDacs()
+        self.setupAdc('average', [(1, 100, 50, 1)])
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim DAC 2',
+                                               'Sim ADC 1'])
+        self.server.sequence_timing_order(self.ctx, ['Sim ADC 1'])
+        points = [([('Sim ADC 1', 'startDelay', i)], [], [])
+                  for i in range(5)]
+        bg = self.sim.boardGroup
+        ans = self.call('run_sequence_batch', 100, True, points)
+        assert ans.shape[0] == 5
+        assert bg.stats.sequences == 5
+        stages = [stage for stage, count, ps in bg.stats.percentiles([50])]
+        assert 'collect' in stages
+
+    def test_lost_packets_time_out(self, monkeypatch, tmpdir):
+        monkeypatch.setenv('HOME', str(tmpdir))  # for dac_timeout_log.txt
+        self.setupDacs()
+        self.setupAdc('average', [(1, 100, 50, 1)])
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim ADC 1'])
+        self.server.sequence_timing_order(self.ctx, ['Sim ADC 1'])
+        self.server.retries = 1
+        self.sim.de.inWire.loss = 1.0  # lose everything the boards send
+        with pytest.raises(ghz_fpga_server.TimeoutError):
+            self.call('run_sequence', 100, True)
+        log = tmpdir.join('dac_timeout_log.txt').read()
+        assert 'recovered in' in log
+        # the run context got its trigger back, so the pipeline can go on
+        self.sim.de.inWire.loss = 0.0
+        ans = self.call('run_sequence', 100, True)
+        assert ans.shape[0] == 1
+
+    def test_recovery_is_concurrent(self, monkeypatch, tmpdir):
+        monkeypatch.setenv('HOME', str(tmpdir))
+        self.setupDacs()
+        self.setupAdc('average', [(1, 100, 50, 1)])
+        self.server.sequence_boards(self.ctx, ['Sim DAC 1', 'Sim DAC 2',
+                                               'Sim ADC 1'])
+        self.server.sequence_timing_order(self.ctx, ['Sim ADC 1'])
+        self.server.retries = 1
+        self.sim.de.inWire.loss = 1.0
+        start = self.clock.seconds()
+        with pytest.raises(ghz_fpga_server.TimeoutError):
+            self.call('run_sequence', 100, True)
+        # one collect timeout plus one ping timeout for all three boards
+        collectTimeout = self.sim.devices[2].buildRunner(
+            100, self.ctx[self.sim.devices[2]]).seqTime
+        assert self.clock.seconds() - start < collectTimeout + 1.5
+        stages = [stage for stage, count, ps
+                  in self.sim.boardGroup.stats.percentiles([50])]
+        assert 'recover' in stages
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,77 @@
+import json
+
+import numpy as np
+import pytest
+
+import fpgalib.stats as stats
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.t = 1000.0
+
+    def __call__(self):
+        return self.t
+
+
+def test_histogram_percentiles():
+    h = stats.LatencyHistogram()
+    values = np.linspace(1e-3, 1.0, 1000)
+    for v in values:
+        h.record(v)
+    assert h.count == 1000
+    for p, got in zip([50, 90, 99, 100], h.percentiles([50, 90, 99, 100])):
+        expected = np.percentile(values, p, interpolation='higher')
+        assert got == pytest.approx(expected, rel=2 * h.PRECISION)
+    assert h.mean() == pytest.approx(np.mean(values))
+
+
+def test_histogram_out_of_range():
+    h = stats.LatencyHistogram()
+    h.record(0)
+    h.record(1e9)
+    assert h.counts[0] == 1
+    assert h.counts[-1] == 1
+    assert h.percentiles([100]) == [1e9]
+
+
+def test_empty_histogram():
+    assert stats.LatencyHistogram().percentiles([50, 99]) == [0.0, 0.0]
+
+
+def test_rolling_histogram_forgets_old_data():
+    clock = FakeClock()
+    rolling = stats.RollingHistogram(period=10.0, slices=3, clock=clock)
+    rolling.record(1.0)
+    clock.t += 15
+    rolling.record(2.0)
+    assert rolling.histogram().count == 2
+    clock.t += 20
+    h = rolling.histogram()
+    assert h.count == 1
+    assert h.max == 2.0
+    clock.t += 100
+    assert rolling.histogram().count == 0
+
+
+def test_chrome_trace():
+    s = stats.PipelineStats('Test Group')
+    for _ in range(3):
+        trace = s.newSequence()
+        trace.span('load', 1.0, 1.5)
+        trace.span('collect', 1.5, 3.0)
+        trace.finish()
+    names = [stage for stage, count, ps in s.percentiles([50])]
+    assert names == ['load', 'collect']
+    assert all(count == 3 for stage, count, ps in s.percentiles([50]))
+
+    events = json.loads(stats.chromeTrace(s.traceEvents(n=2, pid=4)))
+    events = events['traceEvents']
+    assert events[0]['ph'] == 'M'
+    assert events[0]['args']['name'] == 'Test Group'
+    spans = events[1:]
+    assert len(spans) == 4
+    assert set(e['tid'] for e in spans) == set([2, 3])
+    assert all(e['pid'] == 4 for e in events)
+    assert spans[0]['ts'] == 1.0e6
+    assert spans[0]['dur'] == 0.5e6
@@ -136,6 +136,13 @@
 # For information on the format of the data returned by Run Sequence see its
 # docstring.
 #
+# ++ USING RUN SEQUENCE BATCH
+# Run Sequence Batch runs a whole sweep in one call. Set up the boards as for
+# Run Sequence, then pass a list of points, each giving the board settings
+# (SRAM, jump table, start delay, ...) and setup packets that differ from
+# those in the context. The points are pipelined inside the server and the
+# data for all points is returned as one stacked array.
+#
 # ++ REGISTRY KEYS
 # In order for the server to set up the board groups and fpga devices properly
 # there are a couple of registry entries that need to be set up. Registry keys
@@ -190,6 +197,7 @@ timeout = 20
 ### END NODE INFO
 """
 
+import collections
 import itertools
 import logging
 import os
@@ -212,6 +220,7 @@ import labrad.util
 import fpgalib.adc as adc
 import fpgalib.dac as dac
 import fpgalib.fpga as fpga
+import fpgalib.stats as stats
 from fpgalib.util import TimedLock, LoggingPacket
 
 
@@ -256,7 +265,89 @@ I2C_END = 0x400
 
 
 class TimeoutError(Exception):
-    """Error raised when boards timeout."""
+    """Error raised when boards timeout.
+
+    recoveryTime is the time in seconds taken to recover the board group, or
+    None if recovery did not run.
+    """
+    recoveryTime = None
+
+
+class RunPacketTemplate(object):
+    """Run packets used to start one set of boards in a board group.
+
+    Between sequence points, the run registers for a given set of boards
+    usually differ only in the reps, page and start delay of each running
+    board, if at all. The template keeps the register bytes of every board
+    and the wait, run and both packets that write them, with one
+    destination MAC and write record per board. For each sequence, only the
+    reps, page and delay bytes of the running boards are patched in place,
+    and only the write records of boards whose registers changed are
+    replaced. Registers of runners without a runKey are built again.
+
+    The packets are kept in the template and copied for each sequence (see
+    BoardGroup.makeRunPackets), because the packets of one sequence must not
+    change while it waits in the pipeline.
+    """
+    def __init__(self, boards, devices, sync, makePacket):
+        self.boards = boards
+        self.sync = sync
+        self.regs = [None] * len(boards)
+        self.bytes = [None] * len(boards)
+        for i, (board, delay, slave, idleRegs) in enumerate(boards):
+            if idleRegs is not None:
+                self.regs[i] = idleRegs
+                self.bytes[i] = idleRegs.tostring()
+        self.macs = [devices[board].MAC for board, _, _, _ in boards]
+        self.makePacket = makePacket
+        self.wait = self.run = self.both = None
+
+    def update(self, runnerInfo, page):
+        """Update the registers of the running boards for a sequence.
+
+        Returns the number of boards whose registers were patched, not
+        counting those written for the first time.
+        """
+        patches = 0
+        for i, (board, delay, slave, idleRegs) in enumerate(self.boards):
+            if idleRegs is not None:
+                continue
+            runner = runnerInfo[board]
+            regs = self.regs[i]
+            if regs is None or runner.runKey() is None:
+                regs = runner.runPacket(page, slave, delay, self.sync)
+                self.regs[i] = regs
+            else:
+                runner.patchRun(regs, page, delay)
+            bytes = regs.tostring()
+            if bytes == self.bytes[i]:
+                continue
+            if self.bytes[i] is not None:
+                patches += 1
+                self.run[board] = bytes
+                self.both[board] = bytes
+            self.bytes[i] = bytes
+        if self.run is None:
+            self.makePackets()
+        return patches
+
+    def makePackets(self):
+        self.wait = self.makePacket()
+        self.run = self.makePacket()
+        self.both = self.makePacket()
+        # Wait for triggers and discard them. The actual number of triggers to
+        # wait for will be decided later. The 0 is a placeholder here.
+        self.wait.wait_for_trigger(0, key='nTriggers')
+        self.both.wait_for_trigger(0, key='nTriggers')
+        for (board, _, _, _), mac, bytes in zip(self.boards, self.macs,
+                                                self.bytes):
+            # We must switch to each board's destination MAC each time we write
+            # data because our packets for the direct ethernet server is in the
+            # main context of the board group, and therefore does not have a
+            # specific destination MAC. The write is keyed by board, so that
+            # its bytes can be replaced.
+            self.run.destination_mac(mac).write(bytes, key=board)
+            self.both.destination_mac(mac).write(bytes, key=board)
 
 
 class BoardGroup(object):
@@ -270,6 +361,10 @@ class BoardGroup(object):
     on some set of the boards in the group, new sequence data for the next
     point can be uploaded.
     """
+    # Number of run packet templates (combinations of boards, master sync and
+    # run keys) to keep.
+    RUN_TEMPLATES_TO_KEEP = 32
+
     def __init__(self, fpgaServer, directEthernetServer, port):
         self.fpgaServer = fpgaServer
         self.directEthernetServer = directEthernetServer
@@ -278,11 +373,18 @@ class BoardGroup(object):
         self.pipeSemaphore = defer.DeferredSemaphore(NUM_PAGES)
         self.pageNums = itertools.cycle(range(NUM_PAGES))
         self.pageLocks = [TimedLock() for _ in range(NUM_PAGES)]
+        self.pagingOff = False
         self.runLock = TimedLock()
         self.readLock = TimedLock()
         self.setupState = set()
         self.runWaitTimes = []
         self.prevTriggers = 0
+        self.runTemplates = collections.OrderedDict()
+        self.runTemplateHits = 0
+        self.runTemplateMisses = 0
+        self.runTemplatePatches = 0
+        self.makePacketTimes = []
+        self.stats = stats.PipelineStats()
 
     @inlineCallbacks
     def init(self):
@@ -309,6 +411,9 @@ class BoardGroup(object):
         self.boardOrder = ['{} {}'.format(name, boardName) for
                            (boardName, delay) in boards]
         self.boardDelays = [delay for (boardName, delay) in boards]
+        self.stats.name = name
+        # The board order may have changed, so templates are out of date.
+        self.runTemplates.clear()
 
     @inlineCallbacks
     def detectBoards(self):
@@ -519,42 +624,79 @@ class BoardGroup(object):
                 if p is not None:
                     setupPkts.append(p)
         # Run all boards (master last).
-        # Set the first board which is both in the boardOrder and also in the
-        # list of runners for this sequence as the master. Any subsequent boards
-        # for which we have a runner are set to slave mode, while subsequent
-        # unused boards are set to idle mode. For example:
-        # All boards:   000000
-        # runners:      --XX-X
-        # mode:           msis (i: idle, m: master, s: slave) -DTS
-        boards = []  # List of (<device object>, <register bytes to write>).
+        # The run packets for each set of boards are kept in a template, so
+        # only registers which change between sequences need to be patched.
+        # See RunPacketTemplate.
+        template = self.runTemplate(runnerInfo, sync)
+        self.runTemplatePatches += template.update(runnerInfo, page)
+        runPkts = self.makeRunPackets(template)
+        # Collect and read (or discard) timing results.
+        seqTime = max(runner.seqTime for runner in runners)
+        collectPkts = [runner.collectPacket(seqTime, self.ctx)
+                       for runner in runners]
+        readPkts = [runner.readPacket(timingOrder) for runner in runners]
+
+        return loadPkts, setupPkts, runPkts, collectPkts, readPkts
+
+    def runTemplate(self, runnerInfo, sync):
+        """Get the run packet template for a set of boards.
+
+        Templates are kept for the most recently used combinations of
+        running boards, master sync and run keys of the runners (see
+        DacRunner.runKey). Templates for board combinations that have not
+        been used recently are dropped.
+        """
+        names = tuple(board for board in self.boardOrder
+                      if board in runnerInfo)
+        runKeys = tuple(runnerInfo[board].runKey() for board in names)
+        key = (names, sync, runKeys)
+        template = self.runTemplates.pop(key, None)
+        if template is None:
+            self.runTemplateMisses += 1
+            template = RunPacketTemplate(
+                    self.runOrder(names), self.fpgaServer.devices, sync,
+                    lambda: self.directEthernetServer.packet(context=self.ctx))
+        else:
+            self.runTemplateHits += 1
+        # Re-insert so that the most recently used templates come last.
+        self.runTemplates[key] = template
+        while len(self.runTemplates) > self.RUN_TEMPLATES_TO_KEEP:
+            self.runTemplates.popitem(last=False)
+        return template
+
+    def runOrder(self, names):
+        """Get the order in which boards are started for a set of runners.
+
+        Set the first board which is both in the boardOrder and also in the
+        list of runners for this sequence as the master. Any subsequent boards
+        for which we have a runner are set to slave mode, while subsequent
+        unused boards are set to idle mode. For example:
+        All boards:   000000
+        runners:      --XX-X
+        mode:           msis (i: idle, m: master, s: slave) -DTS
+
+        Returns a list of (board, delay, slave, idleRegs) with the master
+        moved to the end. idleRegs is None for boards that run, and the
+        register bytes for idle mode for boards that do not.
+        """
+        boards = []
         for board, delay in zip(self.boardOrder, self.boardDelays):
-            if board in runnerInfo:
-                runner = runnerInfo[board]
+            if board in names:
                 slave = len(boards) > 0
-                regs = runner.runPacket(page, slave, delay, sync)
-                boards.append((runner.dev, regs))
+                boards.append((board, delay, slave, None))
             elif len(boards):
                 # This board is after the master, but will not itself run, so
                 # we put it in idle mode.
                 dev = self.fpgaServer.devices[board]  # Look up device wrapper.
                 if isinstance(dev, dac.DAC):
-                    regs = dev.regIdle(delay)
-                    boards.append((dev, regs))
+                    boards.append((board, delay, None, dev.regIdle(delay)))
                 elif isinstance(dev, adc.ADC):
                     # ADC boards always pass through signals, so no need for
                     # Idle mode.
                     pass
-        boards = boards[1:] + boards[:1]  # move master to the end.
-        runPkts = self.makeRunPackets(boards)
-        # Collect and read (or discard) timing results.
-        seqTime = max(runner.seqTime for runner in runners)
-        collectPkts = [runner.collectPacket(seqTime, self.ctx)
-                       for runner in runners]
-        readPkts = [runner.readPacket(timingOrder) for runner in runners]
-
-        return loadPkts, setupPkts, runPkts, collectPkts, readPkts
+        return boards[1:] + boards[:1]  # move master to the end.
 
-    def makeRunPackets(self, data):
+    def makeRunPackets(self, template):
         """Create packets to run a set of boards.
 
         There are two options as to how this can work, depending on
@@ -567,49 +709,56 @@ class BoardGroup(object):
         the 'wait' and 'run' packets do.  We create both here because
         we can't tell until it is our turn in the pipe which method
         will be used.
-        """
 
-        wait = self.directEthernetServer.packet(context=self.ctx)
-        run = self.directEthernetServer.packet(context=self.ctx)
-        both = self.directEthernetServer.packet(context=self.ctx)
-        if LOGGING_PACKET:
-            wait = LoggingPacket(wait, name='run=wait')
-            run = LoggingPacket(run, name='run=run')
-            both = LoggingPacket(both, name='run=both')
-        # Wait for triggers and discard them. The actual number of triggers to
-        # wait for will be decide later. The 0 is a placeholder here.
-        wait.wait_for_trigger(0, key='nTriggers')
-        both.wait_for_trigger(0, key='nTriggers')
-        # Run all boards.
-        for dev, regs in data:
-            bytes = regs.tostring()
-            # We must switch to each board's destination MAC each time we write
-            # data because our packets for the direct ethernet server is in the
-            # main context of the board group, and therefore does not have a
-            # specific destination MAC.
-            run.destination_mac(dev.MAC).write(bytes)
-            both.destination_mac(dev.MAC).write(bytes)
-        return wait, run, both
+        The packets are copies of the records in the template for this set
+        of boards, so that the template can be updated for later sequences.
+        """
+        pkts = []
+        for name, pkt in [('wait', template.wait), ('run', template.run),
+                          ('both', template.both)]:
+            p = self.directEthernetServer.packet(context=self.ctx)
+            p._packet = list(pkt._packet)
+            if LOGGING_PACKET:
+                p = LoggingPacket(p, name='run=' + name)
+            pkts.append(p)
+        return tuple(pkts)
 
     @inlineCallbacks
     def run(self, runners, reps, setupPkts, setupState, sync, getTimingData,
-            timingOrder):
-        """Run a sequence on this board group."""
+            timingOrder, trace=None):
+        """Run a sequence on this board group.
+
+        The time spent in each stage of the pipeline is recorded as a span on
+        trace, a SequenceTrace from self.stats. If no trace is given, one is
+        made for this call.
+        """
+        ownTrace = trace is None
+        if ownTrace:
+            trace = self.stats.newSequence()
 
         # Check whether this sequence will fit in just one page.
         if all(runner.pageable() for runner in runners):
             # Lock just one page.
             page = self.pageNums.next()
             pageLocks = [self.pageLocks[page]]
+            self.pagingOff = False
         else:
             # Start on page 0 and set pageLocks to all pages.
-            print 'Paging off: SRAM too long.'
+            # Only say so when paging turns off, not for every sequence.
+            if not self.pagingOff:
+                print 'Paging off: SRAM too long.'
+                self.pagingOff = True
             page = 0
             pageLocks = self.pageLocks
 
         # Prepare packets.
         logging.info('making packets')
+        start = time.time()
         pkts = self.makePackets(runners, page, reps, timingOrder, sync)
+        t = trace.span('build', start)
+        self.makePacketTimes.append(t - start)
+        if len(self.makePacketTimes) > 100:
+            self.makePacketTimes.pop(0)
         loadPkts, boardSetupPkts, runPkts, collectPkts, readPkts = pkts
 
         # Add setup packets from boards (ADCs) to that provided in the args:
@@ -620,11 +769,13 @@ class BoardGroup(object):
 
         try:
             yield self.pipeSemaphore.acquire()
+            t = trace.span('pipe wait', t)
             logging.info('pipe semaphore acquired')
             try:
                 # Stage 1: load.
                 for pageLock in pageLocks:  # Lock pages to be written.
                     yield pageLock.acquire()
+                t = trace.span('page lock', t)
                 logging.info('page locks acquired')
                 # Send load packets. Do not wait for response. We already
                 # acquired the page lock, so sending data to SRAM and memory is
@@ -632,12 +783,15 @@ class BoardGroup(object):
                 # TODO: Need to check what 'load packets' is for ADC and make
                 # sure sending load packets here is ok.
                 loadDone = self.sendAll(loadPkts, 'Load')
+                loadDone.addCallback(_traceSpan, trace, 'load', t)
                 # stage 2: run
                 # Send a request for the run lock, do not wait for response.
                 runNow = self.runLock.acquire()
                 try:
                     yield loadDone  # wait until load is finished.
+                    t = time.time()
                     yield runNow  # Wait for acquisition of the run lock.
+                    t = trace.span('run lock', t)
                     logging.info('run lock acquired')
                     # Set the number of triggers needed before we can actually
                     # run. We expect to get one trigger for each board that
@@ -666,11 +820,13 @@ class BoardGroup(object):
                         # collected.
                         # If this fails, something BAD happened!
                         r = yield waitPkt.send()
+                        t = trace.span('trigger wait', t)
                         logging.info('waitPkt sent')
                         try:
                             # Then set up
                             logging.info('sending setupPkts...')
                             yield self.sendAll(setupPkts, 'Setup')
+                            t = trace.span('setup', t)
                             logging.info('...setupPkts sent')
                             self.setupState = setupState
                         except Exception as e:
@@ -683,11 +839,13 @@ class BoardGroup(object):
                         # and finally run the sequence
                         logging.info('sending runPkt...')
                         yield runPkt.send()
+                        t = trace.span('run', t)
                         logging.info('...runPkt sent')
                     else:
                         # if this fails, something BAD happened!
                         logging.info('need setup = false')
                         r = yield bothPkt.send()
+                        t = trace.span('trigger wait', t)
 
                     # Keep track of how long the packet waited before being
                     # able to run.
@@ -699,6 +857,7 @@ class BoardGroup(object):
                         self.runWaitTimes.pop(0)
 
                     yield self.readLock.acquire()  # wait for our turn to read
+                    t = trace.span('read lock', t)
                     logging.info('read lock acquired')
                     # stage 3: collect
                     # Collect appropriate number of packets and then trigger
@@ -733,6 +892,7 @@ class BoardGroup(object):
                     logging.info('run lock released')
                 # Wait for data to be collected.
                 results = yield collectAll
+                t = trace.span('collect', t)
                 logging.info('results collected')
             finally:
                 for pageLock in pageLocks:
@@ -744,9 +904,12 @@ class BoardGroup(object):
                 for success, result in results:
                     if not success:
                         result.printTraceback()
-                yield self.recoverFromTimeout(runners, results)
+                recoveryTime = yield self.recoverFromTimeout(runners, results)
+                trace.span('recover', t)
                 self.readLock.release()
-                raise TimeoutError(self.timeoutReport(runners, results))
+                err = TimeoutError(self.timeoutReport(runners, results))
+                err.recoveryTime = recoveryTime
+                raise err
 
             # stage 4: read
             # no timeout, so go ahead and read data
@@ -757,6 +920,7 @@ class BoardGroup(object):
             # At 9600 stats the next line takes 10s out of 20s per
             # sequence.
             results = yield readAll  # wait for read to complete
+            t = trace.span('read', t)
 
             if getTimingData:
                 answers = []
@@ -800,9 +964,12 @@ class BoardGroup(object):
                     else:
                         extractedChannel = extracted
                     answers.append(extractedChannel)
+                trace.span('extract', t)
                 returnValue(tuple(answers))
         finally:
             self.pipeSemaphore.release()
+            if ownTrace:
+                trace.finish()
 
     @inlineCallbacks
     def sendAll(self, packets, info, infoList=None):
@@ -847,29 +1014,41 @@ class BoardGroup(object):
         group run context from each failed board. We must do this to unlock the
         run context since the trigger would not have been sent yet if packet
         collection failed.
+
+        Each step talks to all boards at once, so recovery takes about one
+        ping timeout however many boards there are. Sequences queued behind
+        this one are left alone; the next one starts as soon as the triggers
+        are in. Returns the time taken, in seconds.
         """
         print 'RECOVERING FROM TIMEOUT'
+        start = time.time()
 
         # Get execution counts.
-        for runner, (success, result) in zip(runners, results):
-            yield runner.dev.clear().send()
+        @inlineCallbacks
+        def ping(runner):
+            # NOTE: in the current implementation of regPing for DAC boards
+            # (build 15) the start field is set to master, which means when
+            # we ping these boards they will emit daisy chain signals.
+            p = runner.dev.clear()
+            p.write(runner.dev.regPing().tostring())
+            p.timeout(U.Value(1.0, 's')).read(1)
             try:
-                # NOTE: in the current implementation of regPing for DAC boards
-                # (build 15) the start field is set to master, which means when
-                # we ping these boards they will emit daisy chain signals.
-                p = runner.dev.regPingPacket()
-                p.timeout(U.Value(1.0, 's')).read(1)
                 resp = yield p.send()
                 regs = runner.dev.processReadback(resp.read[0][3])
                 runner.executionCount = regs.get('executionCounter', None)
             except Exception:
                 logging.error('Exception in recoverFromTimeout', exc_info=True)
-
-        # Send triggers.
-        for runner, (success, result) in zip(runners, results):
-            yield runner.dev.clear().send()
-            if not success:
-                yield runner.dev.trigger(self.ctx).send()
+        yield defer.DeferredList([ping(runner) for runner in runners])
+
+        # Send triggers. All buffers are cleared before any trigger goes out,
+        # because the triggers may start the next sequence.
+        yield self.sendAll([runner.dev.clear() for runner in runners],
+                           'Recover clear')
+        yield self.sendAll([runner.dev.trigger(self.ctx)
+                            for runner, (success, result)
+                            in zip(runners, results) if not success],
+                           'Recover trigger')
+        returnValue(time.time() - start)
 
     def timeoutReport(self, runners, results):
         """Create a nice error message explaining which boards timed out."""
@@ -1431,63 +1610,186 @@ class FPGAServer(DeviceServer):
         """
         logging.info('Run sequence')
         logging.debug('Setup packets: {}'.format(setupPkts))
-        # determine timing order
-        if getTimingData:
-            if c['timing_order'] is None:
-                if len(c['daisy_chain']):
-                    # Changed in this version: require timing order to be
-                    # specified for multiple boards.
-                    raise Exception('You must specify a timing order to get'
-                                    'data back from multiple boards')
-                else:
-                    # Only running one board, which must be a DAC, so just get
-                    # timing from it.
-                    timingOrder = [d.devName for d in devs]
-            else:
-                timingOrder = c['timing_order']
-        else:
-            timingOrder = []
+        start = time.time()
+        devs = self._sequenceDevices(c)
+        timingOrder = self._timingOrder(c, devs, getTimingData)
+        reps = self._roundReps(reps, timingOrder)
+
+        logging.info('You have {} devs'.format(len(devs)))
+        bg = self._sequenceBoardGroup(devs)
+        trace = bg.stats.newSequence()
+        try:
+            # build a list of runners which have necessary sequence
+            # information for each board
+            runners = [dev.buildRunner(reps, c.get(dev, {})) for dev in devs]
+            t = trace.span('runners', start)
+
+            # build setup requests
+            setupReqs = _process_setup_packets(self.client, setupPkts)
+            trace.span('setup packets', t)
+            logging.debug('Setup Reqs: {}'.format(setupReqs))
+
+            ans = yield self._runWithRetries(c, bg, runners, reps, setupReqs,
+                                             setupState, getTimingData,
+                                             timingOrder, trace)
+            trace.span('sequence', start)
+        finally:
+            trace.finish()
+        returnValue(ans)
 
-        # Round reps to multiple of 30 if DACs are in timing order.
+    @setting(51, 'Run Sequence Batch',
+             reps='w',
+             getTimingData='b',
+             points='*(*(ss?)?*s)',
+             setupPkts='?{(((ww), s, ((s?)(s?)(s?)...))...)}',
+             setupState='*s',
+             returns=['*5i', '*4i', ''])
+    def run_sequence_batch(self, c, reps=30, getTimingData=True, points=[],
+                           setupPkts=[], setupState=[]):
+        """Executes a whole sweep of sequences in one call.
+
+        The boards, timing order and master sync are taken from this context,
+        exactly as for Run Sequence. Board settings made in this context (SRAM,
+        Memory, jump table, Start Delay, ADC settings, ...) are shared by all
+        points. Each point then overrides some of those settings.
+
+        Args:
+            reps:
+                number of repetitions per point, as for Run Sequence.
+            getTimingData:
+                whether timing data should be returned, as for Run Sequence.
+            points:
+                list of (deltas, setupPkts, setupState) clusters, one per
+                point. deltas is a list of (device name, key, value) giving
+                the board settings that differ from this context for this
+                point. Supported keys are 'sram', 'mem', 'startDelay',
+                'loop_delay', 'jt_entries' (a list of (op name, arg) as for
+                Jump Table Add Entry), 'jt_counters' and 'runMode'. If a point
+                specifies no setupPkts and no setupState, those given for the
+                whole batch are used.
+            setupPkts:
+                default setup packets, as for Run Sequence.
+            setupState:
+                default setup state, as for Run Sequence.
+
+        Returns:
+            The Run Sequence data for every point stacked along a new first
+            axis, or nothing if getTimingData is False.
+
+        Points are pushed through the board group pipeline back to back, so
+        the next point's SRAM is uploaded while the current one runs. A point
+        that times out is retried on its own; the other points are unaffected.
+        """
+        devs = self._sequenceDevices(c)
+        timingOrder = self._timingOrder(c, devs, getTimingData)
+        reps = self._roundReps(reps, timingOrder)
+        bg = self._sequenceBoardGroup(devs)
+        devNames = dict((dev.devName, dev) for dev in devs)
+
+        # Limit the number of points in flight so that runners (and their
+        # SRAM) are only built shortly before they are needed. One point more
+        # than the number of pages keeps every page busy.
+        window = defer.DeferredSemaphore(NUM_PAGES + 1)
+
+        @inlineCallbacks
+        def runPoint(point):
+            deltas, pointSetupPkts, pointSetupState = point
+            if not pointSetupPkts and not pointSetupState:
+                pointSetupPkts, pointSetupState = setupPkts, setupState
+            infos = dict((dev, c.get(dev, {})) for dev in devs)
+            for devName, key, value in deltas:
+                if devName not in devNames:
+                    raise Exception('Device "{}" is not in the daisy chain.'
+                                    .format(devName))
+                dev = devNames[devName]
+                infos[dev] = _apply_sequence_delta(dev, infos[dev], key,
+                                                   value)
+            start = time.time()
+            trace = bg.stats.newSequence()
+            try:
+                runners = [dev.buildRunner(reps, infos[dev]) for dev in devs]
+                t = trace.span('runners', start)
+                setupReqs = _process_setup_packets(self.client,
+                                                   pointSetupPkts)
+                trace.span('setup packets', t)
+                ans = yield self._runWithRetries(c, bg, runners, reps,
+                                                 setupReqs, pointSetupState,
+                                                 getTimingData, timingOrder,
+                                                 trace)
+                trace.span('sequence', start)
+            finally:
+                trace.finish()
+            returnValue(ans)
+
+        logging.info('Run sequence batch: {} points'.format(len(points)))
+        try:
+            results = yield defer.DeferredList(
+                    [window.run(runPoint, point) for point in points],
+                    fireOnOneErrback=True, consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        answers = [ans for success, ans in results]
+        if not getTimingData or not answers or answers[0] is None:
+            returnValue(None)
+        returnValue(np.asarray(answers))
+
+    def _sequenceDevices(self, c):
+        """Get the devices to run in a sequence for this context."""
+        if len(c['daisy_chain']):
+            # Run multiple boards, with first board as master.
+            return [self.getDevice(c, name) for name in c['daisy_chain']]
+        else:
+            # run the selected device only (must be a DAC)
+            return [self.selectedDAC(c)]
+
+    def _timingOrder(self, c, devs, getTimingData):
+        """Determine the timing order for a sequence run in this context."""
+        if not getTimingData:
+            return []
+        if c['timing_order'] is None:
+            if len(c['daisy_chain']):
+                # Changed in this version: require timing order to be
+                # specified for multiple boards.
+                raise Exception('You must specify a timing order to get'
+                                'data back from multiple boards')
+            # Only running one board, which must be a DAC, so just get
+            # timing from it.
+            return [d.devName for d in devs]
+        return c['timing_order']
+
+    @staticmethod
+    def _roundReps(reps, timingOrder):
+        """Round reps to multiple of 30 if DACs are in timing order."""
         for chan in timingOrder:
             if 'DAC' in chan:
                 # Round stats up to multiple of the timing packet length.
                 reps += dac.DAC.TIMING_PACKET_LEN - 1
                 reps -= reps % dac.DAC.TIMING_PACKET_LEN
                 break
+        return reps
 
-        if len(c['daisy_chain']):
-            # Run multiple boards, with first board as master.
-            devs = [self.getDevice(c, name) for name in c['daisy_chain']]
-        else:
-            # run the selected device only (must be a DAC)
-            devs = [self.selectedDAC(c)]
-
-        logging.info('You have {} devs'.format(len(devs)))
-
+    @staticmethod
+    def _sequenceBoardGroup(devs):
+        """Get the board group shared by all devices in a sequence."""
         # check to make sure that all boards are in the same board group
         if len(set(dev.boardGroup for dev in devs)) > 1:
             raise Exception('Can only run multiboard sequence if all boards '
                             'are in the same board group!')
-        bg = devs[0].boardGroup
-
-        # build a list of runners which have necessary sequence information
-        # for each board
-        # print "fpga server: buildRunner reps: %s" % (reps, )
-        runners = [dev.buildRunner(reps, c.get(dev, {})) for dev in devs]
+        return devs[0].boardGroup
 
-        # build setup requests
-        setupReqs = _process_setup_packets(self.client, setupPkts)
-        logging.debug('Setup Reqs: {}'.format(setupReqs))
-
-        # run the sequence, with possible retries if it fails
+    @inlineCallbacks
+    def _runWithRetries(self, c, bg, runners, reps, setupReqs, setupState,
+                        getTimingData, timingOrder, trace):
+        """Run a sequence on a board group, retrying if boards time out."""
         retries = self.retries
         attempt = 1
         while True:
             try:
-                ans = yield bg.run(runners, reps, setupReqs, set(setupState),
-                                   c['master_sync'], getTimingData,
-                                   timingOrder)
+                # bg.run extends the list of setup packets it is given, so
+                # hand it a fresh copy on every attempt.
+                ans = yield bg.run(runners, reps, list(setupReqs),
+                                   set(setupState), c['master_sync'],
+                                   getTimingData, timingOrder, trace)
                 # For ADCs in demodulate mode, store their I and Q ranges to
                 # check for possible clipping.
                 for runner in runners:
@@ -1496,7 +1798,9 @@ class FPGAServer(DeviceServer):
                             runner.dev.devName in timingOrder):
                         c[runner.dev]['ranges'] = runner.ranges
                 if ans is not None:
+                    t = time.time()
                     ans = np.asarray(ans)
+                    trace.span('answer', t)
                 returnValue(ans)
             except TimeoutError as err:
                 # log attempt to stdout and file
@@ -1507,6 +1811,12 @@ class FPGAServer(DeviceServer):
                     msg = '{}: attempt {} - error: {}'.format(t, attempt, err)
                     print(msg)
                     logfile.write(msg+'\n')
+                    if err.recoveryTime is not None:
+                        msg = '{}: {}'.format(
+                                t, _recovery_summary(bg.stats,
+                                                     err.recoveryTime))
+                        print(msg)
+                        logfile.write(msg+'\n')
                     if attempt == retries:
                         logfile.write('FAIL\n')
                         # TODO: notify users via SMS.
@@ -1616,6 +1926,74 @@ class FPGAServer(DeviceServer):
                                          runWaitTime, readTime)))
         return ans
 
+    @setting(60, 'Packet Build Data', returns='*((sw)(*v, w, w, w))')
+    def sequence_packet_build_data(self, c):
+        """Get data about building the packets for each sequence.
+
+        For each board group (as defined in the registry), this returns:
+            the last 100 times spent in makePackets, in seconds
+            number of run packet template hits
+            number of run packet template misses
+            number of board registers patched in existing templates
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            ans.append(((server, port), (group.makePacketTimes,
+                                         group.runTemplateHits,
+                                         group.runTemplateMisses,
+                                         group.runTemplatePatches)))
+        return ans
+
+    @setting(61, 'Stage Latencies', percentiles='*v',
+             returns='*((sw)*(sw*v))')
+    def sequence_stage_latencies(self, c,
+                                 percentiles=[50, 90, 99, 99.9, 100]):
+        """Get percentiles of the time spent in each stage of a sequence.
+
+        For each board group (as defined in the registry), this returns a
+        list of (stage, count, times) where times are the durations in
+        seconds below which the given percentages of sequences fall, over
+        roughly the last minute. Stages are recorded in the order they are
+        first seen. They include:
+            runners         building board runners (server)
+            setup packets   building setup packets (server)
+            build           building direct ethernet packets
+            pipe wait       waiting for a free pipeline slot
+            page lock       waiting for the SRAM page
+            load            uploading memory/SRAM/jump table
+            run lock        waiting for the run lock after loading
+            trigger wait    waiting for the previous sequence to finish
+            setup           sending setup packets (if setup state changed)
+            run             sending the run packet (if setup state changed)
+            read lock       waiting for our turn to read
+            collect         waiting for the boards to return all data
+            read            reading data from the direct ethernet server
+            extract         parsing the data
+            answer          converting the data to an array
+            sequence        the whole Run Sequence call
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            ans.append(((server, port),
+                        group.stats.percentiles(percentiles)))
+        return ans
+
+    @setting(62, 'Pipeline Trace', n='w', returns='s')
+    def sequence_pipeline_trace(self, c, n=None):
+        """Get the stage timings of recent sequences as Chrome trace JSON.
+
+        Returns the spans of the last n sequences (default: all that are kept,
+        currently 100) for every board group. Save the string to a file and
+        open it in chrome://tracing or https://ui.perfetto.dev. Each board
+        group is a process and each sequence is a thread, so gaps between the
+        stages of consecutive sequences show bubbles in the pipeline.
+        """
+        events = []
+        groups = sorted(self.boardGroups.items())
+        for pid, ((server, port), group) in enumerate(groups):
+            events.extend(group.stats.traceEvents(n, pid))
+        return stats.chromeTrace(events)
+
     @setting(200, 'PLL Init', returns='')
     def pll_init(self, c, data):
         """Sends the initialization sequence to the PLL. (DAC and ADC)
@@ -2189,6 +2567,54 @@ def _assert_has_jump_table(dev):
   assert dev.HAS_JUMP_TABLE, 'device is not a jump table board: {}'.format(dev)
 
 
+def _apply_sequence_delta(dev, info, key, value):
+    """
+    Return a copy of a device's context info with one setting overridden.
+
+    This is used by Run Sequence Batch to build the settings for each point
+    from those in the context without modifying the context itself. Values
+    are converted the same way as by the corresponding settings.
+    """
+    info = dict(info)
+    if key == 'sram':
+        if not isinstance(value, str):
+            value = np.array(value, dtype='<u4').tostring()
+    elif key == 'jt_entries':
+        _assert_has_jump_table(dev)
+        entries = []
+        for name, arg in value:
+            # we always want a list of int, even if there's only one
+            if name == 'NOP' or name == 'END':
+                arg = [arg]
+            entries.append(dev.make_jump_table_entry(name, arg))
+        value = entries
+    elif key == 'jt_counters':
+        _assert_has_jump_table(dev)
+    elif key == 'loop_delay':
+        _assert_has_jump_table(dev)
+        value = int(value['us']) if isinstance(value, Value) else int(value)
+    elif key not in ('mem', 'startDelay', 'runMode'):
+        raise Exception('Unknown sequence setting "{}" for {}'.format(
+                key, dev.devName))
+    info[key] = value
+    return info
+
+
+def _recovery_summary(pipelineStats, recoveryTime):
+    """Describe one timeout recovery and the recent ones before it."""
+    counts = dict((stage, (n, ps)) for stage, n, ps
+                  in pipelineStats.percentiles([50, 100]))
+    n, (median, longest) = counts.get('recover', (0, (0, 0)))
+    return ('recovered in {:.3f} s ({} recent recoveries: median {:.3f} s, '
+            'max {:.3f} s)'.format(recoveryTime, n, median, longest))
+
+
+def _traceSpan(result, trace, stage, start):
+    """Deferred callback that records a span on a trace when it fires."""
+    trace.span(stage, start)
+    return result
+
+
 def _process_setup_packets(cxn, setupPkts):
     """
     Process packets sent in flattened form into actual labrad packets on the
@@ -60,13 +60,53 @@ def getDataSets(cxn, boardname, caltype, errorClass=None):
     return (calfiles)
 
 
+def getDataSetsKey(cxn, boardname, caltypes):
+    """
+    Returns the ids and modification times of the datasets of the given
+    calibration types, to tell whether a cached corrector is up to date.
+    The data vault must be in the board's directory.
+    """
+    ds = cxn.data_vault
+    key = []
+    for caltype in caltypes:
+        datasets = []
+        for dataset in getDataSets(cxn, boardname, caltype, 'quiet'):
+            ds.open(long(dataset))
+            try:
+                mtime = str(ds.get_mtime())
+            except Exception:
+                # not all data vault backends keep modification times
+                mtime = None
+            datasets.append((long(dataset), mtime))
+        key.append((caltype, tuple(datasets)))
+    return tuple(key)
+
+
+def saveCorrector(cache, name, key, corrector):
+    """
+    Saves a corrector to a calcache.CalsetCache. The cache is only there
+    to speed up the next load, so failing to write it (e.g. a full disk, or
+    another process replacing the same entry) is logged, not raised.
+    """
+    try:
+        cache.save(name, key, corrector)
+    except (IOError, OSError) as e:
+        logging.warning('Could not save {} to the calset cache: {}'.format(
+            name, e))
+
+
 def IQcorrector(fpganame, connection,
                      zerocor=True, pulsecor=True, iqcor=True,
-                     lowpass=cosinefilter, bandwidth=0.4, errorClass='quiet'):
+                     lowpass=cosinefilter, bandwidth=0.4, errorClass='quiet',
+                     cache=None):
     """
     Returns a DACcorrection object for the given DAC board.
     The argument has the same form as the
     dms.python_fpga_server.connect argument
+
+    If cache (a calcache.CalsetCache) is given, the corrector is read from
+    it if it is up to date with the calibration datasets, and saved to it
+    otherwise.
     """
 
     if connection:
@@ -77,6 +117,19 @@ def IQcorrector(fpganame, connection,
 
     ds = cxn.data_vault
     ds.cd(['', keys.SESSIONNAME, fpganame], True)
+    if cache is not None:
+        name = ('IQ', fpganame)
+        caltypes = [caltype for caltype, use in [(keys.ZERONAME, zerocor),
+                                                 (keys.PULSENAME, pulsecor),
+                                                 (keys.IQNAME, iqcor)] if use]
+        key = (getattr(lowpass, '__name__', lowpass), bandwidth,
+               getDataSetsKey(cxn, fpganame, caltypes))
+        corrector = cache.load(name, key)
+        if corrector is not None:
+            logging.debug('Loaded cached IQ corrector for {}'.format(fpganame))
+            if not connection:
+                cxn.disconnect()
+            return corrector
     corrector = IQcorrection(fpganame, lowpass, bandwidth)
     # Load Zero Calibration
     if zerocor:
@@ -115,17 +168,24 @@ def IQcorrector(fpganame, connection,
             datapoints = ds.get()
             datapoints = np.array(datapoints)
             corrector.loadSidebandCal(datapoints, sidebandStep, dataset)
+    if cache is not None:
+        saveCorrector(cache, name, key, corrector)
     if not connection:
         cxn.disconnect()
     return corrector
 
 
 def DACcorrector(fpganame, channel, connection=None,
-                      lowpass=gaussfilter, bandwidth=0.13, errorClass='quiet', maxfreqZ=0.45):
+                      lowpass=gaussfilter, bandwidth=0.13, errorClass='quiet', maxfreqZ=0.45,
+                      cache=None):
     """
     Returns a DACcorrection object for the given DAC board.
     The argument has the same form as the
     dms.python_fpga_server.connect argument
+
+    If cache (a calcache.CalsetCache) is given, the corrector is read from
+    it if it is up to date with the calibration dataset, and saved to it
+    otherwise.
     """
     if connection:
         cxn = connection
@@ -136,6 +196,18 @@ def DACcorrector(fpganame, channel, connection=None,
 
     ds.cd(['', keys.SESSIONNAME, fpganame], True)
 
+    if cache is not None:
+        name = ('Z', fpganame, channel)
+        caltype = channel if isinstance(channel, str) else keys.CHANNELNAMES[channel]
+        key = (getattr(lowpass, '__name__', lowpass), bandwidth, maxfreqZ,
+               getDataSetsKey(cxn, fpganame, [caltype]))
+        cached = cache.load(name, key)
+        if cached is not None:
+            logging.debug('Loaded cached Z corrector for {} {}'.format(fpganame, caltype))
+            if not connection:
+                cxn.disconnect()
+            return cached
+
     corrector = DACcorrection(fpganame, channel, lowpass, bandwidth)
 
     if not isinstance(channel, str):
@@ -150,6 +222,8 @@ def DACcorrector(fpganame, channel, connection=None,
         datapoints = ds.get()
         datapoints = np.array(datapoints)
         corrector.loadCal(datapoints, maxfreqZ=maxfreqZ)
+    if cache is not None:
+        saveCorrector(cache, name, key, corrector)
     if not connection:
         cxn.disconnect()
 
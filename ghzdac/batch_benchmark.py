@@ -0,0 +1,85 @@
+"""batch_benchmark.py
+
+Compare correcting waveforms one at a time with correcting them as a batch.
+
+Z (DACcorrection) and IQ (IQcorrection) calsets are made up from a simple
+exponential step response and a flat pulse calibration, so no registry or
+data vault is needed. For each batch size we time DACify called once per
+waveform and once on the whole batch, after a warm up call so that the
+kernel cache is filled in both cases, and print the waveforms per second.
+Example:
+
+    python -m ghzdac.batch_benchmark --batch 1 10 50 --length 1000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from ghzdac.correction import DACcorrection, IQcorrection
+
+
+def makeDACcorrection():
+    t = np.arange(-20.0, 400.0)
+    step = (t >= 0) * (1 - np.exp(-np.clip(t, 0, None) / 2.0))
+    cor = DACcorrection('Benchmark', 0)
+    cor.loadCal(np.vstack((t, step)).T)
+    return cor
+
+
+def makeIQcorrection():
+    cor = IQcorrection('Benchmark')
+    cor.correctionI = np.ones(5121, dtype=complex)
+    cor.correctionQ = np.ones(5121, dtype=complex)
+    return cor
+
+
+def waveforms(nBatch, length, iq):
+    t = np.arange(length)
+    amps = np.linspace(0.1, 0.5, nBatch)[:, None]
+    ans = amps * np.exp(-(t - length / 4.0)**2 / 100.0)
+    if iq:
+        ans = ans * np.exp(0.2j * t)
+    return ans
+
+
+def timeit(f, reps):
+    f()  # warm up, fills the kernel cache
+    start = time.time()
+    for _ in range(reps):
+        f()
+    return (time.time() - start) / reps
+
+
+def benchmark(label, dacify, data, reps):
+    single = timeit(lambda: [dacify(w) for w in data], reps)
+    batch = timeit(lambda: dacify(data), reps)
+    n = len(data)
+    print '  {:<3} batch {:4d}   single {:9.0f}/s   batch {:9.0f}/s   ' \
+          'speedup {:5.1f}x'.format(label, n, n / single, n / batch,
+                                   single / batch)
+
+
+def main(args):
+    dac = makeDACcorrection()
+    iq = makeIQcorrection()
+    print 'waveform length {} ns'.format(args.length)
+    for nBatch in args.batch:
+        benchmark('Z', lambda d: dac.DACify(d, fitRange=False),
+                  waveforms(nBatch, args.length, False), args.reps)
+        benchmark('IQ', lambda d: iq.DACify(6.0, d),
+                  waveforms(nBatch, args.length, True), args.reps)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark batched DAC corrections.')
+    parser.add_argument('--batch', type=int, nargs='+',
+                        default=[1, 4, 16, 64],
+                        help='batch sizes to benchmark')
+    parser.add_argument('--length', type=int, default=1000,
+                        help='waveform length in ns')
+    parser.add_argument('--reps', type=int, default=20,
+                        help='repetitions of each measurement')
+    main(parser.parse_args())
@@ -0,0 +1,149 @@
+"""calcache.py
+
+Keep fully built correction objects on local disk.
+
+Building an IQcorrection or DACcorrection means fetching every zero, pulse
+and sideband dataset of a board from the data vault and processing them,
+which takes seconds per board. CalsetCache saves the built object so that
+the next time it is needed (typically after a restart of the DAC calibration
+server) it can be read back instead.
+
+Each entry is a directory holding the numpy arrays of the correction object
+as .npy files, which are memory mapped (copy on write) when loaded, and a
+pickle of everything else. The entry also stores the key it was built for:
+a format version, the build parameters, and the ids and modification times
+of the datasets it was built from. When the key no longer matches, e.g.
+because a new calibration has been added to the registry, the entry is
+rebuilt.
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+
+from correction import KernelCache
+
+# Bump this when the attributes of the correction classes change.
+VERSION = 1
+
+# Arrays smaller than this are pickled with the rest of the object rather
+# than memory mapped from files of their own.
+MMAP_MIN_BYTES = 64 * 1024
+
+
+def defaultDirectory():
+    return os.path.join(os.path.expanduser('~'), '.ghzdac', 'calsets')
+
+
+class CalsetCache(object):
+    """Correction objects saved on disk, by name.
+
+    The name says which calset an entry is for (e.g. board and channel),
+    the key says what it was built from. Entries are read and written
+    whole, and written atomically, so several processes can share a cache
+    directory.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = defaultDirectory()
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, name):
+        digest = hashlib.sha1(repr(name)).hexdigest()[:16]
+        safe = ''.join(ch if ch.isalnum() else '_' for ch in str(name))
+        return os.path.join(self.directory, '{}-{}'.format(safe, digest))
+
+    def load(self, name, key):
+        """Get the saved correction object for name if it was built for key.
+
+        Returns None if there is no entry or it is out of date.
+        """
+        path = self._path(name)
+        try:
+            with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+                savedKey, obj = pickle.load(f)
+            if savedKey != (VERSION, key):
+                self.misses += 1
+                return None
+            for attr, value in obj.__dict__.items():
+                if isinstance(value, list):
+                    value = [self._loadArray(path, v) for v in value]
+                else:
+                    value = self._loadArray(path, value)
+                setattr(obj, attr, value)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                ValueError, AttributeError, ImportError):
+            # missing, half written or from an incompatible version
+            self.misses += 1
+            return None
+        self.hits += 1
+        return obj
+
+    def save(self, name, key, obj):
+        """Save a correction object built for key."""
+        # a copy of obj with large arrays replaced by _NpyFiles
+        state = copy.copy(obj)
+        tmp = tempfile.mkdtemp(dir=self._ensureDirectory())
+        try:
+            for attr, value in obj.__dict__.items():
+                if attr == 'kernels':
+                    # precalculated kernels are not worth keeping
+                    value = KernelCache(value.maxBytes)
+                elif isinstance(value, list):
+                    value = [self._saveArray(tmp, '{}.{}'.format(attr, i), v)
+                             for i, v in enumerate(value)]
+                else:
+                    value = self._saveArray(tmp, attr, value)
+                setattr(state, attr, value)
+            with open(os.path.join(tmp, 'state.pkl'), 'wb') as f:
+                pickle.dump(((VERSION, key), state), f,
+                            pickle.HIGHEST_PROTOCOL)
+            path = self._path(name)
+            old = None
+            if os.path.exists(path):
+                # can't rename over a directory on windows
+                old = tempfile.mkdtemp(dir=self.directory)
+                os.rename(path, os.path.join(old, 'entry'))
+            os.rename(tmp, path)
+            if old is not None:
+                shutil.rmtree(old, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def _ensureDirectory(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return self.directory
+
+    def _saveArray(self, directory, name, value):
+        """Save large arrays to their own file, returning an _NpyFile.
+
+        Anything else is returned as is, to be pickled.
+        """
+        if not isinstance(value, np.ndarray) or value.dtype == object or \
+                value.nbytes < MMAP_MIN_BYTES:
+            return value
+        fname = name + '.npy'
+        np.save(os.path.join(directory, fname), np.ascontiguousarray(value))
+        return _NpyFile(fname)
+
+    def _loadArray(self, directory, value):
+        if isinstance(value, _NpyFile):
+            return np.load(os.path.join(directory, value.fname), mmap_mode='c')
+        return value
+
+
+class _NpyFile(object):
+    """Stands in for an array saved in a file of its own."""
+
+    def __init__(self, fname):
+        self.fname = fname
@@ -18,7 +18,10 @@
 # calibration but also for recalibration. The user interface is provided
 # by GHz_DAC_calibrate in "scripts".
 
+import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import labrad
 from labrad.types import Value
@@ -96,13 +99,25 @@ def makeSample(a,b):
     return long(a & 0x3FFFL) | (long(b & 0x3FFFL) << 14)
 
      
+def zeroSequence(point):
+    """SRAM sequence with constant DAC values point = (a, b)"""
+    dac = [makeSample(*point)] * SEQUENCE_LENGTH
+    dac[0] |= trigger
+    return dac
+
+
 def measurePower(spec,fpga,a,b):
     """returns signal power from the spectrum analyzer"""
-    dac = [makeSample(a,b)] * SEQUENCE_LENGTH
-    dac[0] |= trigger
-    # fpga.dac_run_sram(dac,True)
-    fpga.dac_write_sram(dac)
-    return ((signalPower(spec)))
+    return measureZeros(spec, fpga, [(a, b)])[0]
+
+
+def measureZeros(spec, fpga, points, pool=None):
+    """returns the signal power for each (a, b) in points"""
+    def measure(dac):
+        # fpga.dac_run_sram(dac,True)
+        fpga.dac_write_sram(dac)
+        return signalPower(spec)
+    return measurePoints(zeroSequence, measure, points, pool)
 
 
 def datasetNumber(dataset):
@@ -133,31 +148,180 @@ def minPos(l, c, r):
     return d
 
 
+####################################################################
+# Scan engine                                                      #
+####################################################################
+
+# Rows collected before they are sent to the data vault in one request.
+DATAVAULT_BLOCK = 16
+
+
+def tune(uwaveSource, spec, carrierfreq, analyzerfreq):
+    """Sets the microwave source frequency and the spectrum analyzer center
+    frequency. Both requests are sent before waiting for either, so that
+    the two instruments settle at the same time."""
+    source = uwaveSource.frequency.future(Value(carrierfreq, 'GHz'))
+    analyzer = spec.gpib_write.future(':FREQ:CENT %gGHz' % analyzerfreq)
+    source.result()
+    analyzer.result()
+
+
+def measurePoints(prepare, measure, points, pool=None):
+    """Measures a list of points in order and returns the results.
+
+    prepare(point) computes what has to be sent to the instruments, e.g.
+    the SRAM sequence, and measure(prepared) sends it and reads the
+    spectrum analyzer. With a pool (a multiprocessing.pool.ThreadPool),
+    each point is prepared in the background while the point before it is
+    being measured. Without one, points are prepared and measured one
+    after the other.
+    """
+    if pool is None:
+        return [measure(prepare(point)) for point in points]
+    results = []
+    if not len(points):
+        return results
+    pending = pool.apply_async(prepare, (points[0],))
+    for i in range(len(points)):
+        prepared = pending.get()
+        if i + 1 < len(points):
+            pending = pool.apply_async(prepare, (points[i+1],))
+        results.append(measure(prepared))
+    return results
+
+
+class DatasetWriter(object):
+    """Collects the rows of a data vault dataset and adds them in blocks
+    rather than one request per row. Call flush() at the end of the scan,
+    also when it fails, so that no measured rows are lost."""
+
+    def __init__(self, ds, blockSize=None):
+        if blockSize is None:
+            blockSize = DATAVAULT_BLOCK
+        self.ds = ds
+        self.blockSize = blockSize
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.ds.add(self.rows)
+            self.rows = []
+
+
+def boardResources(cxn, boardname, use_switch=True):
+    """Returns the instruments used to calibrate the IQ mixer of a board:
+    its spectrum analyzer, its microwave source and, if it is used, its
+    microwave switch."""
+    reg = cxn.registry
+    reg.cd(['', keys.SESSIONNAME, boardname])
+    resources = set([('spectrum analyzer', reg.get(keys.SPECTID)),
+                     ('microwave source', reg.get(keys.ANRITSUID))])
+    if use_switch:
+        # boards without a switch don't share one
+        switch = reg.get(keys.SWITCHNAME, True, '')
+        if switch:
+            resources.add(('microwave switch', switch))
+    return resources
+
+
+def groupBoards(boardnames, resources):
+    """Splits boards into groups that don't share any instruments.
+
+    resources is a dict giving the set of instruments used by each board.
+    Boards that share an instrument, directly or through other boards, end
+    up in the same group. Groups and the boards in them keep the order of
+    boardnames.
+    """
+    groups = []
+    for board in boardnames:
+        used = set(resources[board])
+        members = [board]
+        for group in groups[:]:
+            if group[0] & used:
+                used |= group[0]
+                members = group[1] + members
+                groups.remove(group)
+        groups.append((used, members))
+    order = dict((board, i) for i, board in enumerate(boardnames))
+    groups = [sorted(group[1], key=order.get) for group in groups]
+    groups.sort(key=lambda group: order[group[0]])
+    return groups
+
+
+def scanBoards(boardnames, scan, connect=labrad.connect, use_switch=True):
+    """Runs scan(cxn, boardname) for several boards, concurrently where the
+    boards don't share instruments.
+
+    Boards that share a spectrum analyzer, microwave source or microwave
+    switch are scanned one after the other. Each group of boards gets a
+    connection of its own from connect(), so that the contexts (selected
+    devices, data vault directory) of concurrent scans are separate.
+    Returns a dict with the return value of scan for each board. If scans
+    fail, the other groups are finished before the first error is raised.
+    """
+    cxn = connect()
+    try:
+        resources = dict((board, boardResources(cxn, board, use_switch))
+                         for board in boardnames)
+    finally:
+        cxn.disconnect()
+    groups = groupBoards(boardnames, resources)
+    results = {}
+    errors = []
+
+    def runGroup(group):
+        cxn = connect()
+        try:
+            for board in group:
+                results[board] = scan(cxn, board)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            cxn.disconnect()
+
+    print 'Scanning %d boards in %d groups: %s' % \
+        (len(boardnames), len(groups),
+         '; '.join(', '.join(group) for group in groups))
+    threads = [threading.Thread(target=runGroup, args=(group,))
+               for group in groups]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
 ####################################################################
 # DAC zero calibration                                             #
 ####################################################################
 
 
-def zero(anr, spec, fpga, freq):
+def zero(anr, spec, fpga, freq, pool=None):
     """Calibrates the zeros for DAC A and B using the spectrum analyzer"""
    
-    anr.frequency(Value(freq,'GHz'))
-    spectFreq(spec,freq)
+    tune(anr, spec, freq, freq)
     a = 0
     b = 0
     precision = 0x800
     print '    calibrating at %g GHz...' % freq
     while precision > 0:
         fpga.dac_run_sram([0] * SEQUENCE_LENGTH,  True)
-        al = measurePower(spec, fpga, a-precision, b)
-        ar = measurePower(spec, fpga, a+precision, b)
-        ac = measurePower(spec, fpga, a, b)
+        al, ar, ac = measureZeros(spec, fpga, [(a-precision, b),
+                                               (a+precision, b),
+                                               (a, b)], pool)
         corra = long(round(precision*minPos(al, ac, ar)))
         a += corra
 
-        bl = measurePower(spec, fpga, a, b-precision)
-        br = measurePower(spec, fpga, a, b+precision)
-        bc = measurePower(spec, fpga, a, b)
+        bl, br, bc = measureZeros(spec, fpga, [(a, b-precision),
+                                               (a, b+precision),
+                                               (a, b)], pool)
         corrb = long(round(precision*minPos(bl, bc, br)))
         b += corrb
         optprec = 2*np.max([abs(corra), abs(corrb)]) 
@@ -240,10 +404,16 @@ def zeroScanCarrier(cxn, scanparams, boardname, use_switch=True):
                             ('DAC zero', 'B', 'clics')])
     ds.add_parameter(keys.ANRITSUPOWER, uwavePower)
 
-    freq = scanparams['carrierMin']
-    while freq < scanparams['carrierMax']+0.001*scanparams['carrierStep']:
-        ds.add([freq]+(zero(uwaveSource, spec, fpga, freq)))
-        freq += scanparams['carrierStep']
+    writer = DatasetWriter(ds)
+    pool = ThreadPool(1)
+    try:
+        freq = scanparams['carrierMin']
+        while freq < scanparams['carrierMax']+0.001*scanparams['carrierStep']:
+            writer.add([freq]+(zero(uwaveSource, spec, fpga, freq, pool)))
+            freq += scanparams['carrierStep']
+    finally:
+        pool.close()
+        writer.flush()
     uwaveSource.output(False)
     spectDeInit(spec)
     if use_switch:
@@ -560,10 +730,10 @@ def calibrateDCPulse_infiniium(cxn, boardname, channel, conf_10_MHz):
 ####################################################################
 
  
-def measureOppositeSideband(spec, fpga, corrector,
-                            carrierfreq, sidebandfreq, compensation):
-    """Put out a signal at carrierfreq+sidebandfreq and return the power at
-    carrierfreq-sidebandfreq"""
+def sidebandSequence(corrector, carrierfreq, sidebandfreq, compensation):
+    """SRAM sequence for a signal at carrierfreq+sidebandfreq with
+    compensation at carrierfreq-sidebandfreq. Returns the sequence and
+    the factor it was rescaled by."""
 
     arg = -2.0j*np.pi*sidebandfreq*np.arange(PERIOD)
     signal = corrector.DACify(carrierfreq,
@@ -571,11 +741,34 @@ def measureOppositeSideband(spec, fpga, corrector,
                             loop=True, iqcor=False, rescale=True)
     for i in range(4):
         signal[i] |= trigger
-    fpga.dac_run_sram(signal, True)
-    return ((signalPower(spec)) / corrector.last_rescale_factor)
+    return signal, corrector.last_rescale_factor
+
+
+def measureOppositeSideband(spec, fpga, corrector,
+                            carrierfreq, sidebandfreq, compensation):
+    """Put out a signal at carrierfreq+sidebandfreq and return the power at
+    carrierfreq-sidebandfreq"""
+    return measureOppositeSidebands(spec, fpga, corrector, carrierfreq,
+                                    sidebandfreq, [compensation])[0]
+
+
+def measureOppositeSidebands(spec, fpga, corrector, carrierfreq,
+                             sidebandfreq, compensations, pool=None):
+    """measureOppositeSideband for each compensation in compensations. With
+    a pool, the next sequence is computed while the spectrum analyzer
+    measures the current one."""
+    def prepare(compensation):
+        return sidebandSequence(corrector, carrierfreq, sidebandfreq,
+                                compensation)
+    def measure(prepared):
+        signal, rescale = prepared
+        fpga.dac_run_sram(signal, True)
+        return ((signalPower(spec)) / rescale)
+    return measurePoints(prepare, measure, compensations, pool)
 
  
-def sideband(anr, spect, fpga, corrector, carrierfreq, sidebandfreq):
+def sideband(anr, spect, fpga, corrector, carrierfreq, sidebandfreq,
+             pool=None):
     """When the IQ mixer is used for sideband mixing, imperfections in the
     IQ mixer and the DACs give rise to a signal not only at
     carrierfreq+sidebandfreq but also at carrierfreq-sidebandfreq.
@@ -587,27 +780,20 @@ def sideband(anr, spect, fpga, corrector, carrierfreq, sidebandfreq):
 
     if abs(sidebandfreq) < 3e-5:
         return (0.0j)
-    anr.frequency(Value(carrierfreq,'GHz'))
+    tune(anr, spect, carrierfreq, carrierfreq-sidebandfreq)
     comp = 0.0j
     precision = 1.0
-    spectFreq(spect,carrierfreq-sidebandfreq)
     while precision > 2.0**-14:
         fpga.dac_run_sram(np.array([0] * PERIOD, dtype='<u4'), True)
-        lR = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp - precision)
-        rR = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp + precision)
-        cR = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp)
+        lR, rR, cR = measureOppositeSidebands(spect, fpga, corrector,
+                carrierfreq, sidebandfreq,
+                [comp - precision, comp + precision, comp], pool)
         
         corrR = precision * minPos(lR,cR,rR)
         comp += corrR
-        lI = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp - 1.0j * precision)
-        rI = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp + 1.0j * precision)
-        cI = measureOppositeSideband(spect, fpga, corrector, carrierfreq,
-                                           sidebandfreq, comp)
+        lI, rI, cI = measureOppositeSidebands(spect, fpga, corrector,
+                carrierfreq, sidebandfreq,
+                [comp - 1.0j * precision, comp + 1.0j * precision, comp], pool)
         
         corrI = precision * minPos(lI,cI,rI)
         comp += 1.0j * corrI
@@ -665,17 +851,24 @@ def sidebandScanCarrier(cxn, scanparams, boardname, corrector, use_switch=True):
                      Value(scanparams['sidebandFreqStep']*1e3, 'MHz'))
     ds.add_parameter('Number of sideband frequencies',
                      scanparams['sidebandFreqCount'])
-    freq = scanparams['carrierMin']
-    while freq < scanparams['carrierMax'] + \
-              0.001 * scanparams['sidebandCarrierStep']:
-        print '  carrier frequency: %g GHz' % freq
-        datapoint = [freq]
-        for sidebandfreq in sidebandfreqs:
-            print '    sideband frequency: %g GHz' % sidebandfreq
-            comp = sideband(uwaveSource, spec, fpga, corrector, freq, sidebandfreq)
-            datapoint += [np.real(comp), np.imag(comp)]
-        ds.add(datapoint)
-        freq += scanparams['sidebandCarrierStep']
+    writer = DatasetWriter(ds)
+    pool = ThreadPool(1)
+    try:
+        freq = scanparams['carrierMin']
+        while freq < scanparams['carrierMax'] + \
+                  0.001 * scanparams['sidebandCarrierStep']:
+            print '  carrier frequency: %g GHz' % freq
+            datapoint = [freq]
+            for sidebandfreq in sidebandfreqs:
+                print '    sideband frequency: %g GHz' % sidebandfreq
+                comp = sideband(uwaveSource, spec, fpga, corrector, freq,
+                                sidebandfreq, pool)
+                datapoint += [np.real(comp), np.imag(comp)]
+            writer.add(datapoint)
+            freq += scanparams['sidebandCarrierStep']
+    finally:
+        pool.close()
+        writer.flush()
     uwaveSource.output(False)
     spectDeInit(spec)
     if use_switch:
@@ -14,6 +14,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
+import collections
+
 import numpy as np
 
 # CHANGELOG
@@ -101,67 +104,93 @@ def flatfilter(n, width=0):
     #return np.ones(nr)
 
     
-savedfftlens = np.zeros(8193,dtype=int)
-    
+def _smoothLengths(limit):
+    """All products 2**i * 3**j * 5**k up to limit, sorted."""
+    lengths = []
+    p5 = 1
+    while p5 <= limit:
+        p35 = p5
+        while p35 <= limit:
+            n = p35
+            while n <= limit:
+                lengths.append(n)
+                n *= 2
+            p35 *= 3
+        p5 *= 5
+    lengths.sort()
+    return lengths
+
+# FFT lengths that factorize in 2, 3 and 5, up to way beyond any sequence
+# the boards can play (about 3500 entries).
+FFTLENGTHS = _smoothLengths(1 << 40)
+
+
+def _fastfftlen(n):
+    """fastfftlen beyond FFTLENGTHS, in exact integer arithmetic."""
+    best = None
+    p5 = 1
+    while True:
+        p35 = p5
+        while True:
+            m = p35
+            while m < n:
+                m *= 2
+            if best is None or m < best:
+                best = m
+            if p35 >= n:
+                break
+            p35 *= 3
+        if p5 >= n:
+            break
+        p5 *= 5
+    return best
+
 
 def fastfftlen(n):
     """
     Computes the smallest multiple of 2 3 and 5 larger or equal n.
     FFT is fastest for sizes that factorize in small numbers.
-    Sizes up to 8192 are only calculated once and later looked up.
+    Looked up by bisection in the precomputed FFTLENGTHS.
     """
-    def _fastfftlen(n):
-        logn = np.log(n)
-        n5 = 5L ** np.arange(long(logn/np.log(5.) + 2. + 1.e-6))
-        n3 = 3L ** np.arange(long(logn/np.log(3.) + 2. + 1.e-6))
-        n35 = np.outer(n3, n5).flat
-        n35 = np.compress(n35<2*n, n35)
-        n235 = ((-np.log(n35)+logn)/np.log(2.) + 0.999999).astype(int)
-        n235 *= (n235>0)
-        n235 = 2**n235 * n35
-        return np.min(n235)
-    
-    if n < np.alen(savedfftlens):
-        nfft = savedfftlens[n]
-        if nfft < n:
-            nfft = _fastfftlen(n)
-            savedfftlens[n] = nfft
-        return nfft
-    else:
-        return _fastfftlen(n)
+    i = bisect.bisect_left(FFTLENGTHS, n)
+    if i < len(FFTLENGTHS):
+        return FFTLENGTHS[i]
+    return _fastfftlen(n)
     
 def moving_average(x,m):
     """Moving average on x, with length m. Expects a numpy array for x. Elements are given by
     y[i] = Sum_{k=0..m-1}   y[l] / m
-    with l=i-fix(m/2)+k between 0 and length(x)-1. Try to keep m odd. RB."""
-    n=np.alen(x)
-    before=-np.fix(int(m)/2.0)
-    y=[]
-    for i in np.arange(len(x)):
-        a=0.0
-        for tel in np.arange(int(m)):
-            idx=i+before+tel
-            if idx<0:
-                idx=0
-            elif idx>=n:
-                idx=n-1
-            a += x[idx]/np.float(m)
-        y.append(a)
-    return np.array(y)
+    with l=i-fix(m/2)+k between 0 and length(x)-1. Try to keep m odd. RB.
+
+    The window is summed one offset at a time over the whole array, which
+    adds the same terms in the same order as a loop over each sample would,
+    so the result does not depend on how it is computed."""
+    x = np.asarray(x)
+    n = np.alen(x)
+    m = int(m)
+    if n == 0:
+        return np.array([])
+    before = -(m//2)
+    # edge-padded copy of x, so that window element k of sample i is
+    # padded[i+k]
+    idx = np.clip(np.arange(before, n + before + m - 1), 0, n-1)
+    padded = x[idx] / np.float(m)
+    y = np.zeros(n, dtype=np.result_type(padded, 0.0))
+    for k in range(m):
+        y += padded[k:k+n]
+    return y
 
 
 def derivative(x,y):
     """Taking derivative, uses both adjacent points for estimate of derivative. 
     Returns array with the same number of points (different than np.diff). RB."""
+    x = np.asarray(x)
+    y = np.asarray(y)
     n=np.alen(x)
-    deriv=np.array(np.linspace(0.0,0.0,n),dtype=complex)
-    for k in np.arange(n):
-        if k==0:
-            deriv[k]=1.0*(y[k+1]-y[k])/(x[k+1]-x[k])
-        elif k==(n-1):
-            deriv[k]=1.0*(y[k]-y[k-1])/(x[k]-x[k-1])
-        else:
-            deriv[k]=1.0*(y[k+1]-y[k-1])/(x[k+1]-x[k-1])
+    deriv=np.zeros(n,dtype=complex)
+    deriv[0]=1.0*(y[1]-y[0])/(x[1]-x[0])
+    deriv[1:-1]=1.0*(y[2:]-y[:-2])/(x[2:]-x[:-2])
+    deriv[-1]=1.0*(y[-1]-y[-2])/(x[-1]-x[-2])
     return deriv
 
 
@@ -169,65 +198,89 @@ def interpol_cubic(h,x2,fill_value=None):
     """Fast cubic interpolator (slightly faster than linear version of scipy interp1d; 
     much faster than cubic version of scipy interp1d).
     Returns the values in in the same way interpol. Can deal with complex input.
-    Uses linear interpolation at the edges, and returns the values at the edges outside of the range. RB."""
-    xlen=np.alen(h)
+    Uses linear interpolation at the edges, and returns the values at the edges outside of the range. RB.
+
+    Every index is evaluated in one pass through the same cubic, and only
+    the few indices near or beyond the edges are redone. h can have more
+    than one column (e.g. zeros for I and Q, one column per sideband
+    frequency), which are then interpolated along the first axis together.
+    A scalar x2 gives an array of length 1."""
     if type(h) is not np.ndarray:
         #we need a numpy array
         h=1.0*np.array(h)
-    def func(xdet):
-        if type(xdet) is not list and type(xdet) is not np.ndarray:
-            xdet=np.array([xdet]) 
-        yout=np.zeros(np.alen(xdet)).astype(h.dtype) #predefine
-        x2=xdet  #x2 = (xdet-xstart) #map xdet onto h index: x ->   (x-xstart)/dx = 0... length
-        
-        #indices outside of the range
-        xdet_idx = x2<0 #maps which index in x2 it is
-        if xdet_idx.any():       
-            x2_idx = x2[ xdet_idx ] #maps x2 to x index
-            h_idx = np.array(x2_idx).astype(int) #maps which h,x to take
-            if fill_value is None:
-                yout[xdet_idx]=h[0]
-            else:
-                yout[xdet_idx]=fill_value
-        xdet_idx = x2>(xlen-1) #maps which index in x2 it is
-        if xdet_idx.any():       
-            x2_idx = x2[ xdet_idx ] #maps x2 to x index
-            h_idx = np.array(x2_idx).astype(int) #maps which h,x to take
-            if fill_value is None:            
-                yout[xdet_idx]=h[xlen-1]
-            else:
-                yout[xdet_idx]=fill_value                
-            
-        #indices on the rim: linear interpolation
-        xdet_idx =  np.logical_and(x2>=0,x2<1) #maps which index in x2 it is
-        if xdet_idx.any():
-            x2_idx = x2[ xdet_idx ] #maps x2 to x index
-            h_idx = np.array(x2_idx).astype(int) #maps which h,x to take        
-            yout[xdet_idx]=(h[1]-h[0])*x2_idx  + h[0]
-        xdet_idx =  np.logical_and(x2>=(xlen-2),x2<=(xlen-1)) #maps which index in x2 it is
-        if xdet_idx.any():
-            x2_idx = x2[ xdet_idx ] #maps x2 to x index
-            h_idx = np.array(x2_idx).astype(int) #maps which h,x to take        
-            yout[xdet_idx]=(h[xlen-1]-h[xlen-2])*(x2_idx-h_idx[0])  + h[xlen-2]
-            
-        #indices inside the range: cubic interpolation        
-        xdet_idx = np.logical_and(x2>=1,x2<(xlen-2)) #maps which index in x2 it is
-        if xdet_idx.any():        
-            x2_idx = x2[ xdet_idx ] #maps x2 to x index
-            h_idx = np.array(x2_idx).astype(int) #maps which h,x to take
-            hp2=h[h_idx+2]
-            hp1=h[h_idx+1]
-            hp0=h[h_idx]
-            hm1=h[h_idx-1]     
-            d=hp0
-            c=(hp1-hm1)/2.
-            b=(-hp2+4*hp1-5*hp0+2*hm1)/2.
-            a=(hp2-3*hp1+3*hp0-hm1)/2.
-            xi=(x2_idx - h_idx)
-            yout[xdet_idx]=((a * xi + b) * xi + c) * xi + d
-            
-        return np.array(yout)          
-    return func(x2)
+    xlen=np.alen(h)
+    x=np.atleast_1d(np.asarray(x2,dtype=float))
+    #interval of each index, clipped to the intervals with 2 neighbours
+    k=np.floor(x)
+    np.clip(k,1,max(xlen-3,1),out=k)
+    k[np.isnan(k)]=1
+    xi=x-k
+    k=k.astype(int)
+    if h.ndim>1:
+        xi=xi.reshape(xi.shape+(1,)*(h.ndim-1))
+    if xlen>3:
+        hm1=h.take(k-1,axis=0)
+        hp0=h.take(k,axis=0)
+        hp1=h.take(k+1,axis=0)
+        hp2=h.take(k+2,axis=0)
+        #Horner steps on ((a*xi + b)*xi + c)*xi + d with
+        #a=(hp2-3*hp1+3*hp0-hm1)/2., b=(-hp2+4*hp1-5*hp0+2*hm1)/2.,
+        #c=(hp1-hm1)/2., d=hp0, in place but in the same order
+        tmp=np.multiply(3,hp1)
+        yout=np.subtract(hp2,tmp)
+        np.multiply(3,hp0,out=tmp)
+        yout+=tmp
+        yout-=hm1
+        yout/=2.
+        yout*=xi
+        coef=np.negative(hp2)
+        np.multiply(4,hp1,out=tmp)
+        coef+=tmp
+        np.multiply(5,hp0,out=tmp)
+        coef-=tmp
+        np.multiply(2,hm1,out=tmp)
+        coef+=tmp
+        coef/=2.
+        yout+=coef
+        yout*=xi
+        np.subtract(hp1,hm1,out=coef)
+        coef/=2.
+        yout+=coef
+        yout*=xi
+        yout+=hp0
+    else:
+        yout=np.zeros(x.shape+h.shape[1:],dtype=np.result_type(h,0.5))
+
+    if not len(x):
+        return yout.astype(h.dtype,copy=False)
+    xmin=x.min()
+    xmax=x.max()
+    hasnan=xmin!=xmin
+    if hasnan:
+        xmin=np.nanmin(x)
+        xmax=np.nanmax(x)
+    #indices on the rim: linear interpolation
+    if xmin<1:
+        idx=x<1
+        xr=x[idx]
+        if h.ndim>1:
+            xr=xr[:,None]
+        yout[idx]=(h[1]-h[0])*xr + h[0]
+    if xmax>=(xlen-2):
+        idx=x>=(xlen-2)
+        xr=x[idx]-(xlen-2)
+        if h.ndim>1:
+            xr=xr[:,None]
+        yout[idx]=(h[xlen-1]-h[xlen-2])*xr + h[xlen-2]
+
+    #indices outside of the range
+    if xmin<0:
+        yout[x<0]=h[0] if fill_value is None else fill_value
+    if xmax>(xlen-1):
+        yout[x>(xlen-1)]=h[xlen-1] if fill_value is None else fill_value
+    if hasnan:
+        yout[np.isnan(x)]=0
+    return yout.astype(h.dtype,copy=False)
 
 
 def interpol(signal, x, extrapolate=False):
@@ -235,7 +288,8 @@ def interpol(signal, x, extrapolate=False):
     Linear interpolation of array signal at floating point indices x
     (x can be an array or a scalar). If x is beyond range either the first or
     last element is returned. If extrapolate=True, the linear extrapolation of
-    the first/last two points is returned instead.
+    the first/last two points is returned instead. If signal has several
+    columns, they are interpolated together along the first axis.
     """
     n = np.alen(signal)
     if n == 1:
@@ -245,16 +299,80 @@ def interpol(signal, x, extrapolate=False):
     p = x - i
     if not extrapolate:
         p = np.clip(p,0.0,1.0)
+    if np.ndim(signal) > 1:
+        p = np.reshape(p, np.shape(p) + (1,) * (np.ndim(signal) - 1))
     return signal[i] * (1.0 - p) + signal[i+1] * p
 
 
 def findRelevant(starts, ends):
+    """
+    Returns the indices of the calibrations covering ranges starts[i] to
+    ends[i] that are not covered completely by a later calibration.
+    """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
     n = np.size(starts)
-    relevant = np.resize(True, n)
-    for i in np.arange(n-1):
-        relevant[i] = not np.any((starts[i+1:] <= starts[i]) &
-                                    (ends[i+1:] >= ends[i]))
-    return np.argwhere(relevant)[:,0]
+    # covered[i,j]: calibration j comes after i and covers its whole range
+    covered = (starts[None,:] <= starts[:,None]) & \
+              (ends[None,:] >= ends[:,None]) & \
+              np.tri(n, k=-1, dtype=bool).T
+    return np.argwhere(~np.any(covered, axis=1))[:,0]
+
+
+class KernelCache(object):
+    """
+    Least recently used cache for precalculated correction data, such as
+    the deconvolution transfer function for a given FFT length or the
+    sideband compensation at a given carrier frequency.
+
+    Values are arrays (or tuples/lists of arrays) and are counted by their
+    size in bytes. When the total exceeds maxBytes the least recently used
+    entries are dropped. Cached values are shared, so callers must not
+    modify them in place.
+
+    Entries depend on the calibration data of the correction object that
+    owns the cache, so the cache must be cleared whenever that changes.
+    Anything else a value depends on (lowpass filter, settling, ...) goes
+    in the key.
+    """
+
+    def __init__(self, maxBytes=64*2**20):
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict() # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        """Get the value for key, calling compute() to make it if needed."""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            size = sum(np.asarray(v).nbytes for v in
+                       (value if isinstance(value, (tuple, list)) else [value]))
+            if size <= self.maxBytes:
+                self.entries[key] = (value, size)
+                self.nbytes += size
+                while self.nbytes > self.maxBytes:
+                    old, oldSize = self.entries.popitem(last=False)[1]
+                    self.nbytes -= oldSize
+                    self.evictions += 1
+            return value
+        self.hits += 1
+        self.entries[key] = entry # most recently used go at the end
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Returns (hits, misses, evictions, entries, bytes)."""
+        return (self.hits, self.misses, self.evictions, len(self.entries),
+                self.nbytes)
 
 
 ##################################################
@@ -284,6 +402,9 @@ class IQcorrection:
 
         self.flipChannels = False
 
+        # precalculated zeros, sideband compensation and deconvolution
+        self.kernels = KernelCache()
+
         # Set the Lowpass, i.e. the transfer function we want after correction
         # Unless otherwise specified, the filter will be flat and then roll off
         # between (1-bandwidth)*Nyquist and Nyquist
@@ -323,6 +444,7 @@ class IQcorrection:
 
 
     def loadZeroCal(self, zeroData, calfile):
+        self.kernels.clear()
         l = np.shape(zeroData)[0]
         self.zeroTableI.append(zeroData[:,(1 + self.flipChannels)])
         self.zeroTableQ.append(zeroData[:,(1 + (not self.flipChannels))])
@@ -348,6 +470,7 @@ class IQcorrection:
         You should not need to call this function. It is used internally
         during a recalibration.
         """
+        self.kernels.clear()
         keep = findRelevant(self.zeroTableStart,self.zeroTableEnd)
         self.zeroTableI = [self.zeroTableI[i] for i in keep]
         self.zeroTableQ = [self.zeroTableQ[i] for i in keep]
@@ -362,6 +485,7 @@ class IQcorrection:
         """
         Load IQ sideband mixing calibration
         """
+        self.kernels.clear()
         self.sidebandStep = np.append(self.sidebandStep, sidebandStep)
         
         l,sidebandCount = np.shape(sidebandData)
@@ -400,6 +524,7 @@ class IQcorrection:
         You should not need to call this function. It is used internally
         during a recalibration.
         """
+        self.kernels.clear()
         keep = findRelevant(self.sidebandCarrierStart,self.sidebandCarrierEnd)
         self.sidebandCompensation = [self.sidebandCompensation[i] for i in keep]
         self.sidebandStep = self.sidebandStep[keep]
@@ -419,6 +544,7 @@ class IQcorrection:
         It is stored in self.correctionI and self.correctionQ.
         """
         #read pulse calibration from data server
+        self.kernels.clear()
         self.flipChannels = flipChannels
         dataPoints = np.asarray(dataPoints)
         i = dataPoints[:,1 + self.flipChannels]
@@ -486,6 +612,7 @@ class IQcorrection:
         For each frequency use the lastest calibration available. This
         is the default behaviour.
         """
+        self.kernels.clear()
         self.zeroCalIndex = None
         self.sidebandCalIndex = None
         print 'For each correction the best calfile will be chosen.'
@@ -496,7 +623,7 @@ class IQcorrection:
         Only use the latest calibration and extrapolate it if the
         carrier frequency lies outside the calibrated range
         """
-
+        self.kernels.clear()
         self.zeroCalIndex = -1
         self.sidebandCalIndex = -1
         print 'Zero     calibration:  selecting calset %d' % \
@@ -524,6 +651,7 @@ class IQcorrection:
         there is no such calibration use the one that is closest to
         covering it.
         """
+        self.kernels.clear()
         print 'Zero     calibration:',        
         self.zeroCalIndex = self.findCalset(start, end, self.zeroTableStart,
                                        self.zeroTableEnd, 'zero')
@@ -541,20 +669,21 @@ class IQcorrection:
         """
         Returns the DAC values for which, at the given carrier
         frequency, the IQmixer output power is smallest.
-        Uses cubic interpolation
+        Uses cubic interpolation. carrierFreq can also be an array of
+        frequencies, which are all looked up in the same calset.
         """
         if self.zeroTableI == []:
             return [0.0,0.0]
         i = self.zeroCalIndex
         if i is None:
-            i = self.findCalset(carrierFreq, carrierFreq, self.zeroTableStart,
-                                self.zeroTableEnd, 'zero')
-        carrierFreqFreq=carrierFreq
+            i = self.findCalset(np.min(carrierFreq), np.max(carrierFreq),
+                                self.zeroTableStart, self.zeroTableEnd, 'zero')
         carrierFreq = (carrierFreq - self.zeroTableStart[i]) / self.zeroTableStep[i]  #now it becomes and index
-        #zeroI=interpol_cubic(self.zeroTableI[i], carrierFreq)
-        #zeroQ=interpol_cubic(self.zeroTableQ[i], carrierFreq)
-        #print 'board:',self.board,'  freq:',carrierFreqFreq,'  zeroI,Q:',zeroI,zeroQ
-        return [interpol_cubic(self.zeroTableI[i], carrierFreq), interpol_cubic(self.zeroTableQ[i], carrierFreq)]
+        # I and Q in one pass
+        zeros = interpol_cubic(np.column_stack((self.zeroTableI[i],
+                                                self.zeroTableQ[i])),
+                               carrierFreq)
+        return [zeros[:,0], zeros[:,1]]
         #return [interpol(self.zeroTableI[i], carrierFreq), interpol(self.zeroTableQ[i], carrierFreq)] #old
                 
     def _IQcompensation(self, carrierFreq, n):
@@ -562,12 +691,15 @@ class IQcorrection:
         Returns the sideband correction at the given carrierFreq and for
         sideband frequencies
         (0, 1, 2, ..., n/2, n/2+1-n, ..., -1, 0) * (1.0 / n) GHz
+        carrierFreq can also be an array of frequencies, which are all
+        looked up in the same calset; the result then has one row per
+        carrier.
         """
         if self.sidebandCompensation == []:
-            return np.zeros(n+1, dtype = complex)
+            return np.zeros(np.shape(carrierFreq) + (n+1,), dtype = complex)
         i = self.sidebandCalIndex
         if i is None:
-            i = self.findCalset(carrierFreq, carrierFreq, 
+            i = self.findCalset(np.min(carrierFreq), np.max(carrierFreq),
                            self.sidebandCarrierStart,
                            self.sidebandCarrierEnd, 'sideband')
         carrierFreq = (carrierFreq - self.sidebandCarrierStart[i]) / \
@@ -579,13 +711,49 @@ class IQcorrection:
         freqs[1:n/2+1] = np.arange(1,n/2+1)
         freqs[n/2+1:n] = np.arange(n/2+1-n,0)
         freqs /= n
-        compensation = np.zeros(w+2,complex)
-        compensation[1:w+1] = interpol(self.sidebandCompensation[i],carrierFreq)
+        compensation = np.zeros(np.shape(carrierFreq) + (w+2,), complex)
+        compensation[...,1:w+1] = interpol(self.sidebandCompensation[i],
+                                           carrierFreq)
+        # the sidebands along the first axis, one column per carrier
+        compensation = compensation.T
         compensation[0]   = (1 - p) * compensation[1] + p * compensation[w]
         compensation[w+1] = (1 - p) * compensation[w] + p * compensation[1]
         return interpol(compensation,
             (freqs + maxfreq + self.sidebandStep[i]) / self.sidebandStep[i],
-            extrapolate=True)
+            extrapolate=True).T
+
+
+    def _zeros(self, carrierFreq):
+        """Cached DACzeros."""
+        return self.kernels.get(('zeros', carrierFreq),
+                                lambda: self.DACzeros(carrierFreq))
+
+    def _compensation(self, carrierFreq, n):
+        """Cached _IQcompensation."""
+        return self.kernels.get(('compensation', carrierFreq, n),
+                                lambda: self._IQcompensation(carrierFreq, n))
+
+    def _transfer(self, nfft):
+        """
+        Returns the deconvolution transfer functions (I, Q) for an FFT
+        of length nfft, i.e. the pulse correction resampled at intervals
+        of 1 ns / nfft times the lowpass filter. Cached.
+        """
+        def compute():
+            nrfft = nfft/2+1
+            l = np.alen(self.correctionI)
+            freqs = np.arange(0,nrfft) * 2.0 * (l - 1.0) / nfft
+            lp = self.lowpass(nfft, self.bandwidth)
+            #correctionI = interpol(self.correctionI, freqs,extrapolate=True)
+            #correctionQ = interpol(self.correctionQ, freqs,extrapolate=True)
+            return (interpol_cubic(self.correctionI, freqs, fill_value=0.0) * lp,
+                    interpol_cubic(self.correctionQ, freqs, fill_value=0.0) * lp)
+        return self.kernels.get(('transfer', nfft, self.lowpass,
+                                 self.bandwidth), compute)
+
+    def kernelCacheStats(self):
+        """Returns (hits, misses, evictions, entries, bytes) of the kernel cache."""
+        return self.kernels.stats()
 
 
     def DACify(self, carrierFreq, i, q=None, loop=False, rescale=False,
@@ -642,6 +810,12 @@ class IQcorrection:
         zipSRAM=False: returns (I,Q) tuples instead of packed SRAM data,
             tuples are not clipped to fit the DAC range.
 
+        i (and q) can also be 2-D arrays holding a batch of waveforms of
+        the same length, one per row, to be corrected for the same carrier
+        frequency. They are transformed together, and the result has one
+        row per waveform. With rescale=True each waveform is rescaled on
+        its own, and last_rescale_factor is the smallest factor used.
+
         Example:
             cor = DACcorrection('DR Lab FPGA 0')
             t = arange(-50.0,50.0)
@@ -654,20 +828,20 @@ class IQcorrection:
             fpga.loop_sram(signal)
         """
         i = np.asarray(i)
-        if q == None:
+        if q is None:
             i = i.astype(complex)
         else:
-            i = i + 1.0j * q
-        n = np.alen(i)
+            i = i + 1.0j * np.asarray(q)
+        n = np.shape(i)[-1]
         if loop:
             nfft = n
         else:
             nfft = fastfftlen(n)
         if n > 1:
             # treat offset properly even when n != nfft
-            background = 0.5*(i[0]+i[-1])
-            i = np.fft.fft(i-background,n=nfft)
-            i[0] += background * nfft
+            background = 0.5*(i[...,0]+i[...,-1])
+            i = np.fft.fft(i-background[...,None],n=nfft)
+            i[...,0] += background * nfft
         return self.DACifyFT(carrierFreq, i, n=n, loop=loop, rescale=rescale,
                zerocor=zerocor, deconv=deconv, iqcor=iqcor, zipSRAM=zipSRAM,
                zeroEnds=zeroEnds)
@@ -688,6 +862,7 @@ class IQcorrection:
            np.linspace(0.5, 1.5, nfft, endpoint=False) % 1 - 0.5
         If you want DACifyFT to be fast nfft should factorize in 2 3 and 5.
         If n < nfft, the result is truncated to n samples.
+        signal can also be a 2-D array with one waveform per row.
         For the rest of the arguments see DACify.
         """
         if n == 0:
@@ -699,7 +874,7 @@ class IQcorrection:
                 nfft = fastfftlen(n)
         elif signal is None:
             if zerocor:
-                i,q = self.DACzeros(carrierFreq)
+                i,q = self._zeros(carrierFreq)
                 signal = np.uint32((int(np.round(i)) & 0x3FFF) \
                                 << (14 * self.flipChannels) | \
                                 (int(np.round(q)) & 0x3FFF) \
@@ -709,7 +884,7 @@ class IQcorrection:
             return np.resize(signal, n)
         else:
             signal = np.asarray(signal)
-            nfft = np.alen(signal)
+            nfft = np.shape(signal)[-1]
         if n > nfft:
             n = nfft
         nrfft = nfft/2+1
@@ -724,39 +899,33 @@ class IQcorrection:
             #FT the input
             #add the first point at the end so that the elements of signal and
             #signal[::-1] are the Fourier components at opposite frequencies
-            signal = np.hstack((signal, signal[0]))
+            signal = np.concatenate((signal, signal[...,:1]), axis=-1)
 
             #correct for the non-orthoganality of the IQ channels
             if iqcor:
-                signal += signal[::-1].conjugate() * \
-                          self._IQcompensation(carrierFreq, nfft)
+                signal += signal[...,::-1].conjugate() * \
+                          self._compensation(carrierFreq, nfft)
             
 
             #separate I (FT of a real signal) and Q (FT of an imaginary signal)
-            i =  0.5  * (signal[0:nrfft] + \
-                             signal[nfft:nfft-nrfft:-1].conjugate())
-            q = -0.5j * (signal[0:nrfft] - \
-                             signal[nfft:nfft-nrfft:-1].conjugate())
+            i =  0.5  * (signal[...,0:nrfft] + \
+                             signal[...,nfft:nfft-nrfft:-1].conjugate())
+            q = -0.5j * (signal[...,0:nrfft] - \
+                             signal[...,nfft:nfft-nrfft:-1].conjugate())
 
             #resample the FT of the response function at intervals 1 ns / nfft
-            if deconv and (self.correctionI != None):
-                l = np.alen(self.correctionI)
-                freqs = np.arange(0,nrfft) * 2.0 * (l - 1.0) / nfft
-                #correctionI = interpol(self.correctionI, freqs,extrapolate=True)
-                #correctionQ = interpol(self.correctionQ, freqs,extrapolate=True)
-                correctionI = interpol_cubic(self.correctionI, freqs, fill_value=0.0)
-                correctionQ = interpol_cubic(self.correctionQ, freqs, fill_value=0.0)                
-                lp = self.lowpass(nfft, self.bandwidth)
-                i *= correctionI * lp
-                q *= correctionQ * lp
+            if deconv and (self.correctionI is not None):
+                transferI, transferQ = self._transfer(nfft)
+                i *= transferI
+                q *= transferQ
             #do the actual deconvolution and transform back to time space
-            i = np.fft.irfft(i, n=nfft)[:n]
-            q = np.fft.irfft(q, n=nfft)[:n]
+            i = np.fft.irfft(i, n=nfft)[...,:n]
+            q = np.fft.irfft(q, n=nfft)[...,:n]
         else:
             #only apply iq correction for sideband frequency 0
             if iqcor:
                 signal += signal.conjugate() * \
-                    self._IQcompensation(carrierFreq,1)[0]
+                    self._compensation(carrierFreq,1)[0]
             i = signal.real
             q = signal.imag
             
@@ -764,41 +933,46 @@ class IQcorrection:
         fullscale = 0x1FFF / self.dynamicReserve
 
         if zerocor:
-            zeroI, zeroQ = self.DACzeros(carrierFreq)
+            zeroI, zeroQ = self._zeros(carrierFreq)
         else:
             zeroI = zeroQ = 0.0
         
+        clip = not rescale
         if rescale:
-            rescale = np.min([1.0,
-                           ( 0x1FFF - zeroI) / fullscale / np.max(i),
-                           (-0x2000 - zeroI) / fullscale / np.min(i),
-                           ( 0x1FFF - zeroQ) / fullscale / np.max(q),
-                           (-0x2000 - zeroQ) / fullscale / np.min(q)])
-            if rescale < 1.0:
+            # one factor per waveform
+            rescale = reduce(np.minimum, [
+                           ( 0x1FFF - zeroI) / fullscale / np.max(i, axis=-1),
+                           (-0x2000 - zeroI) / fullscale / np.min(i, axis=-1),
+                           ( 0x1FFF - zeroQ) / fullscale / np.max(q, axis=-1),
+                           (-0x2000 - zeroQ) / fullscale / np.min(q, axis=-1)],
+                           1.0)
+            rescale = np.reshape(rescale, np.shape(i)[:-1])
+            smallest = float(np.min(rescale))
+            if smallest < 1.0:
                 print 'Corrected signal scaled by %g to fit DAC range.' % \
-                    rescale
+                    smallest
             # keep track of rescaling in the object data
-            self.last_rescale_factor = rescale
+            self.last_rescale_factor = smallest
             if not isinstance(self.min_rescale_factor, float) \
-               or rescale < self.min_rescale_factor:
-                self.min_rescale_factor = rescale
-            fullscale *= rescale
+               or smallest < self.min_rescale_factor:
+                self.min_rescale_factor = smallest
+            fullscale = fullscale * rescale[...,None]
 
         # Due to deconvolution, the signal to put in the dacs can be nonzero at
         # the end of a sequence even with a short pulse. This nonzero value
         # exists even when running the board with an empty envelope. To remove
         # it, the first and last 4 (FOUR) values must be set to zero.
         if zeroEnds:
-            i[:4] = 0.0
-            i[-4:] = 0.0
-            q[:4] = 0.0
-            q[-4:] = 0.0
+            i[...,:4] = 0.0
+            i[...,-4:] = 0.0
+            q[...,:4] = 0.0
+            q[...,-4:] = 0.0
         i = np.round(i * fullscale + zeroI).astype(np.int32)
         q = np.round(q * fullscale + zeroQ).astype(np.int32)
         
 
 
-        if not rescale:
+        if clip:
             clippedI = np.clip(i,-0x2000,0x1FFF)
             clippedQ = np.clip(q,-0x2000,0x1FFF)
             if np.any((clippedI != i) | (clippedQ != q)):
@@ -888,7 +1062,8 @@ class DACcorrection:
         self.decayAmplitudes = np.array([])
         self.reflectionRates = np.array([])
         self.reflectionAmplitudes = np.array([])        
-        self.precalc = np.array([])
+        # precalculated deconvolution transfer functions
+        self.kernels = KernelCache()
 
 
 
@@ -972,7 +1147,7 @@ class DACcorrection:
         self.correction += [correction]        
         self.zero = zero
         self.clicsPerVolt = clicsPerVolt
-        self.precalc = np.array([])
+        self.kernels.clear()
      
         
     def setSettling(self, rates, amplitudes):
@@ -992,11 +1167,10 @@ class DACcorrection:
         s = np.size(rates)
         rates = np.reshape(np.asarray(rates),s)
         amplitudes = np.reshape(np.asarray(amplitudes),s)
-        if (not np.array_equal(self.decayRates,rates)) or (not np.array_equal(self.decayAmplitudes,amplitudes)):
-            print 'emptying precalc (settling)'
-            self.decayRates = rates
-            self.decayAmplitudes = amplitudes
-            self.precalc = np.array([])
+        # The transfer functions are cached by settling parameters, so there
+        # is no need to recalculate anything here.
+        self.decayRates = rates
+        self.decayAmplitudes = amplitudes
         
     def setReflection(self, rates, amplitudes):
         """ Correct for reflections in the line.
@@ -1010,11 +1184,8 @@ class DACcorrection:
         s = np.size(rates)
         rates = np.reshape(np.asarray(rates),s)
         amplitudes = np.reshape(np.asarray(amplitudes),s)
-        if (not np.array_equal(self.reflectionRates,rates)) or (not np.array_equal(self.reflectionAmplitudes,amplitudes)):
-            print 'emptying precalc (reflection)'
-            self.reflectionRates = rates
-            self.reflectionAmplitudes = amplitudes
-            self.precalc = np.array([])
+        self.reflectionRates = rates
+        self.reflectionAmplitudes = amplitudes
         
         
     def setFilter(self, lowpass=None, bandwidth=0.15):
@@ -1038,10 +1209,75 @@ class DACcorrection:
         if lowpass is None:
             lowpass=self.lowpass
             
-        if (self.lowpass != lowpass) or (self.bandwidth != bandwidth):
-            self.lowpass = lowpass
-            self.bandwidth = bandwidth
-            self.precalc = np.array([])
+        self.lowpass = lowpass
+        self.bandwidth = bandwidth
+
+    def kernelCacheStats(self):
+        """Returns (hits, misses, evictions, entries, bytes) of the kernel cache."""
+        return self.kernels.stats()
+
+    def _transfer(self, nfft, decayRates, decayAmplitudes, reflectionRates,
+                  reflectionAmplitudes, maxvalueZ):
+        """
+        Returns the deconvolution transfer function for an FFT of length
+        nfft: lowpass filter, pulse correction, settling and reflections.
+        Cached for each combination of arguments and filter.
+        """
+        key = ('transfer', nfft, tuple(decayRates), tuple(decayAmplitudes),
+               tuple(reflectionRates), tuple(reflectionAmplitudes), maxvalueZ,
+               self.lowpass, self.bandwidth)
+        def compute():
+            nrfft = nfft/2+1
+            # lowpass filter
+            precalc = self.lowpass(nfft, self.bandwidth).astype(complex)
+
+            freqs = np.linspace(0, nrfft * 1.0 / nfft,
+                                       nrfft, endpoint=False)
+            i_two_pi_freqs = 2j*np.pi*freqs
+
+            # pulse correction
+            for correction in self.correction:
+                l = np.alen(correction)
+                precalc *= interpol_cubic(correction, freqs*2.0*(l-1)) #cubic, as fast as linear interpol
+                
+            # Decay times:
+            # add to qubit registry the following keys:
+            # settlingAmplitudes=[-0.05]  #relative amplitude
+            # settlingRates = [0.01 GHz]    #rate is in GHz, (1/ns)
+            if np.alen(decayRates):
+                precalc /= (1.0 + np.sum(decayAmplitudes[:, None] * i_two_pi_freqs[None, :] / (i_two_pi_freqs[None, :] + decayRates[:, None]), axis=0))
+
+            # Reflections:
+            # add to qubit registry the following keys:
+            # reflectionAmplitudes=[0.05]  #relative amplitude
+            # reflectionRates = [0.01 GHz]    #rate is in GHz, (1/ns)
+            #
+            # Reflections are dealt with by modelling a wire with round-trip time 1/rate, 
+            # and reflection coefficient amplitude.
+            # It's the simplest model which can describe the effect of reflections in wiring 
+            # in for example the wiring between the DAC output and fridge ports. Think about echo, 
+            # reflections give rise to an endless sum of copies of the original signal with decreasing amplitude:
+            # f(t) -> (1-amplitude) Sum_k=0^\infty (amplitude^k f(t-k 1/rate) ).
+            #
+            # Suppose X is an ideal pulse, H the impulse response of a piece of cable (with reflection, settling etc). 
+            # To get X at the end of the cable you need to send Y = X/H.
+            # So if you have different impulse responses H1, H2, H3: Y = X / (H1 * H2 * H3)                
+            if np.alen(reflectionRates):
+                for rate,amplitude in zip(reflectionRates,reflectionAmplitudes):
+                    if abs(rate) > 0.0:
+                        precalc /= (1.0 - amplitude) / (1.0-amplitude*np.exp(-i_two_pi_freqs/rate))
+
+            
+            # The correction window can have very large amplitudes,
+            # therefore the time domain signal can have large oscillations which will be truncated digitally, 
+            # leading to deterioration of the waveform. The large amplitudes in the correction window have low S/N ratios.
+            # Here, we apply a maximum value, i.e. truncate the value, but keep the phase. 
+            # This way we still have a partial correction, within the limits of the boards. 
+            # Doing it this way also helps a lot with the waveforms being scalable.
+            if maxvalueZ:
+                precalc = precalc * (1.0 * (abs(precalc)<=maxvalueZ)) + np.exp(1j*np.angle(precalc))*maxvalueZ * 1.0 * (abs(precalc) > maxvalueZ)
+            return precalc
+        return self.kernels.get(key, compute)
 
 
     def DACify(self, signal, loop=False, rescale=False, fitRange=True,
@@ -1098,23 +1334,28 @@ class DACcorrection:
         volts=False: Do not correct the gain. A input signal of
              amplitude 1 will then result in an output signal with
              amplitude DACrange/dynamicReserve
+
+        signal can also be a 2-D array holding a batch of waveforms of the
+        same length, one per row. They are transformed together, and the
+        result has one row per waveform. With rescale=True each waveform
+        is rescaled on its own, and last_rescale_factor is the smallest
+        factor used.
         """
 
         signal = np.asarray(signal)
 
-        if np.alen(signal) == 0:
-            return np.zeros(0)
+        if np.shape(signal)[-1] == 0:
+            return np.zeros(np.shape(signal))
 
-        n = np.alen(signal)
+        n = np.shape(signal)[-1]
 
         if loop:
             nfft = n
         else:
             nfft = fastfftlen(n)
             
-        nrfft = nfft/2+1
-        background = 0.5*(signal[0] + signal[-1])
-        signal_FD = np.fft.rfft(signal-background, n=nfft) #FT the input
+        background = 0.5*(signal[...,0] + signal[...,-1])
+        signal_FD = np.fft.rfft(signal-background[...,None], n=nfft) #FT the input
         signal = self.DACifyFT(signal_FD, t0=0, n=n, nfft=nfft, offset=background,
                              loop=loop,
                              rescale=rescale, fitRange=fitRange, deconv=deconv,
@@ -1132,8 +1373,9 @@ class DACcorrection:
         points (or the length in ns), t0 the start time.  Signal can
         either be an array of length n/2 + 1 giving the frequency
         components from 0 to 500 MHz. or a function which will be
-        evaluated between 0 and 0.5 (GHz). For the rest of the
-        arguments see DACify
+        evaluated between 0 and 0.5 (GHz). signal can also be a 2-D array
+        with one waveform per row, and offset one value per row. For the
+        rest of the arguments see DACify
         """
 
         # TODO: Remove this hack that strips units
@@ -1171,7 +1413,7 @@ class DACcorrection:
             return np.resize(signal, n)
         else:
             signal = np.asarray(signal)
-            nrfft = len(signal)
+            nrfft = np.shape(signal)[-1]
             if nfft is None or nfft/2 + 1 != nrfft:
                 nfft = 2*(nrfft-1)
 
@@ -1179,103 +1421,55 @@ class DACcorrection:
         if t0 != 0:
             signal *= np.exp(np.linspace(0.0,
                 2.0j * np.pi * t0 * nrfft / nfft, nrfft, endpoint=False))
-        signal[0] += nfft*offset
+        signal[...,0] += nfft*offset
         #do the actual deconvolution and transform back to time space
         if deconv:
-            # check if the precalculated correction matches the
-            # length of the data, if not we have to recalculate        
-            if np.alen(self.precalc) != nrfft:
-                # lowpass filter
-                precalc = self.lowpass(nfft, self.bandwidth).astype(complex)
-
-                freqs = np.linspace(0, nrfft * 1.0 / nfft,
-                                           nrfft, endpoint=False)
-                i_two_pi_freqs = 2j*np.pi*freqs
-
-                # pulse correction
-                for correction in self.correction:
-                    l = np.alen(correction)
-                    precalc *= interpol_cubic(correction, freqs*2.0*(l-1)) #cubic, as fast as linear interpol
-                    
-                # Decay times:
-                # add to qubit registry the following keys:
-                # settlingAmplitudes=[-0.05]  #relative amplitude
-                # settlingRates = [0.01 GHz]    #rate is in GHz, (1/ns)
-                if np.alen(decayRates):
-                    precalc /= (1.0 + np.sum(decayAmplitudes[:, None] * i_two_pi_freqs[None, :] / (i_two_pi_freqs[None, :] + decayRates[:, None]), axis=0))
-
-                # Reflections:
-                # add to qubit registry the following keys:
-                # reflectionAmplitudes=[0.05]  #relative amplitude
-                # reflectionRates = [0.01 GHz]    #rate is in GHz, (1/ns)
-                #
-                # Reflections are dealt with by modelling a wire with round-trip time 1/rate, 
-                # and reflection coefficient amplitude.
-                # It's the simplest model which can describe the effect of reflections in wiring 
-                # in for example the wiring between the DAC output and fridge ports. Think about echo, 
-                # reflections give rise to an endless sum of copies of the original signal with decreasing amplitude:
-                # f(t) -> (1-amplitude) Sum_k=0^\infty (amplitude^k f(t-k 1/rate) ).
-                #
-                # Suppose X is an ideal pulse, H the impulse response of a piece of cable (with reflection, settling etc). 
-                # To get X at the end of the cable you need to send Y = X/H.
-                # So if you have different impulse responses H1, H2, H3: Y = X / (H1 * H2 * H3)                
-                if np.alen(reflectionRates):
-                    for rate,amplitude in zip(reflectionRates,reflectionAmplitudes):
-                        if abs(rate) > 0.0:
-                            precalc /= (1.0 - amplitude) / (1.0-amplitude*np.exp(-i_two_pi_freqs/rate))
-
-                
-                # The correction window can have very large amplitudes,
-                # therefore the time domain signal can have large oscillations which will be truncated digitally, 
-                # leading to deterioration of the waveform. The large amplitudes in the correction window have low S/N ratios.
-                # Here, we apply a maximum value, i.e. truncate the value, but keep the phase. 
-                # This way we still have a partial correction, within the limits of the boards. 
-                # Doing it this way also helps a lot with the waveforms being scalable.
-                if maxvalueZ:
-                    precalc = precalc * (1.0 * (abs(precalc)<=maxvalueZ)) + np.exp(1j*np.angle(precalc))*maxvalueZ * 1.0 * (abs(precalc) > maxvalueZ)
-                
-                self.precalc = precalc
-            signal *= self.precalc
+            signal *= self._transfer(nfft, decayRates, decayAmplitudes,
+                                     reflectionRates, reflectionAmplitudes,
+                                     maxvalueZ)
         else:
             signal *= self.lowpass(nfft, self.bandwidth)
                 
         # transform to real space
         signal = np.fft.irfft(signal, n=nfft)
-        signal = signal[0:n]
+        signal = signal[...,0:n]
         
         # Due to deconvolution, the signal to put in the dacs can be nonzero at
         # the end of a sequence with even a short pulse. This nonzero value
         # exists even when running the board with an empty envelope. To remove
         # this, the first and last 4 values must be set.
         if averageEnds:
-            signal[0:4] = np.mean(signal[0:4])
-            signal[-4:] = np.mean(signal[-4:])
+            signal[...,0:4] = np.mean(signal[...,0:4], axis=-1)[...,None]
+            signal[...,-4:] = np.mean(signal[...,-4:], axis=-1)[...,None]
 
+        clip = not rescale
         if rescale:
-            rescale = np.min([1.0,
-                           ( 0x1FFF - zero) / fullscale / np.max(signal),
-                           (-0x2000 - zero) / fullscale / np.min(signal)])
-            if rescale < 1.0:
+            # one factor per waveform
+            rescale = np.minimum(1.0, np.minimum(
+                           ( 0x1FFF - zero) / fullscale / np.max(signal, axis=-1),
+                           (-0x2000 - zero) / fullscale / np.min(signal, axis=-1)))
+            smallest = float(np.min(rescale))
+            if smallest < 1.0:
                 print 'Corrected signal scaled by %g to fit DAC range.' % \
-                    rescale
+                    smallest
             # keep track of rescaling in the object data
-            self.last_rescale_factor = rescale
+            self.last_rescale_factor = smallest
             if not isinstance(self.min_rescale_factor, float) \
-               or rescale < self.min_rescale_factor:
-                self.min_rescale_factor = rescale
-            fullscale *= rescale
+               or smallest < self.min_rescale_factor:
+                self.min_rescale_factor = smallest
+            fullscale = fullscale * np.asarray(rescale)[...,None]
             
         if dither:
             ditheringspan = 2. #a dithering span of 3 goes from -1.5.. 1.5, i.e. 0..3 = 0,1,2,3 = 4 numbers = 2 bits exactly
         else:
             ditheringspan = 0.
-        dithering = ditheringspan * (np.random.rand( len(signal ) )-0.5)
-        dithering[0:4] = 0.0
-        dithering[-4:] = 0.0
+        dithering = ditheringspan * (np.random.rand(*np.shape(signal))-0.5)
+        dithering[...,0:4] = 0.0
+        dithering[...,-4:] = 0.0
 
         signal = np.round(1.0*signal * fullscale + zero + dithering).astype(np.int32)
 
-        if not rescale:
+        if clip:
             if (np.max(signal) > 0x1FFF) or (np.min(signal) < -0x2000):
                 print 'Corrected Z signal beyond DAC range, clipping'
                 print 'max: ', np.max(signal)  ,'   min: ', np.min(signal)
@@ -53,5 +53,11 @@ SERVERSETTINGVALUES = [
     'bandwidthZ',
     'maxfreqZ',
     'maxvalueZ',
-    'dither'
+    'dither',
+    'workerType',
+    'workers',
+    'kernelCacheMB',
+    'calsetCache',
+    'calsetCacheDir',
+    'preloadCalsets'
 ]
@@ -0,0 +1,134 @@
+"""load_benchmark.py
+
+Measure how long it takes to build the correction objects for all boards,
+which is what the DAC calibration server does the first time each board is
+used after a restart.
+
+By default the calibration data is made up, with the same shapes as the
+data taken by calibrate.py (5120 point sampling scope traces, zero and
+sideband scans over a few GHz of carrier frequency), and the time spent in
+each load method is printed. With --live the real calsets of every board in
+the registry are loaded through IQcorrector and DACcorrector instead, which
+includes the time spent getting the data from the data vault. Example:
+
+    python -m ghzdac.load_benchmark --iq-boards 8 --z-boards 16
+"""
+
+import argparse
+import collections
+import time
+
+import numpy as np
+
+from ghzdac import keys
+from ghzdac.correction import DACcorrection, IQcorrection
+
+
+SCOPE_POINTS = 5120
+SCOPE_RATE = 20  # GHz
+
+
+class Timer(object):
+    """Adds up time spent in named stages."""
+
+    def __init__(self):
+        self.totals = collections.OrderedDict()
+
+    def time(self, stage, f, *args, **kw):
+        start = time.time()
+        ans = f(*args, **kw)
+        self.totals[stage] = self.totals.get(stage, 0.0) + time.time() - start
+        return ans
+
+    def report(self):
+        total = sum(self.totals.values())
+        for stage, t in self.totals.items():
+            print '  {:<24} {:8.3f} s'.format(stage, t)
+        print '  {:<24} {:8.3f} s'.format('total', total)
+
+
+def zeroData(start=4.0, end=7.0, step=0.025):
+    carriers = np.arange(start, end + step / 2, step)
+    return np.vstack((carriers, 100 * np.sin(carriers),
+                      -100 * np.cos(carriers))).T
+
+
+def sidebandData(start=4.0, end=7.0, step=0.05, sidebandCount=14):
+    carriers = np.arange(start, end + step / 2, step)
+    comp = 0.01 * np.ones((len(carriers), 2 * sidebandCount))
+    return np.hstack((carriers[:, None], comp))
+
+
+def pulseData(carrier=6.0):
+    t = np.arange(SCOPE_POINTS) / float(SCOPE_RATE)
+    envelope = np.exp(-(t - 10.0)**2 / 2.0)
+    return np.vstack((t, envelope * np.cos(2 * np.pi * carrier * t),
+                      envelope * np.sin(2 * np.pi * carrier * t))).T
+
+
+def stepData():
+    t = np.arange(SCOPE_POINTS) / float(SCOPE_RATE)
+    step = (t >= 10) * (1 - np.exp(-np.clip(t - 10, 0, None) / 2.0))
+    return np.vstack((t, step)).T
+
+
+def loadFake(nIQ, nZ, nZeroCals, nSidebandCals):
+    timer = Timer()
+    for board in range(nIQ):
+        cor = IQcorrection('IQ {}'.format(board))
+        for i in range(nZeroCals):
+            timer.time('loadZeroCal', cor.loadZeroCal, zeroData(), i)
+        timer.time('loadPulseCal', cor.loadPulseCal, pulseData(), 6.0, 0)
+        for i in range(nSidebandCals):
+            timer.time('loadSidebandCal', cor.loadSidebandCal,
+                       sidebandData(), 0.05, i)
+        timer.time('eliminateZeroCals', cor.eliminateZeroCals)
+        timer.time('eliminateSidebandCals', cor.eliminateSidebandCals)
+    for board in range(nZ):
+        for channel in [0, 1]:
+            cor = DACcorrection('Z {}'.format(board), channel)
+            timer.time('loadCal', cor.loadCal, stepData())
+    print '{} IQ boards, {} Z boards:'.format(nIQ, nZ)
+    timer.report()
+
+
+def loadLive():
+    import labrad
+    from ghzdac import IQcorrector, DACcorrector
+    cxn = labrad.connect()
+    reg = cxn.registry
+    reg.cd(['', keys.SESSIONNAME])
+    boards = reg.dir()[0]
+    timer = Timer()
+    for board in boards:
+        reg.cd(['', keys.SESSIONNAME, board])
+        calibrations = reg.dir()[1]
+        if keys.PULSENAME in calibrations or keys.ZERONAME in calibrations:
+            timer.time('IQcorrector', IQcorrector, board, cxn)
+        for channel in [0, 1]:
+            if keys.CHANNELNAMES[channel] in calibrations:
+                timer.time('DACcorrector', DACcorrector, board, channel, cxn)
+    cxn.disconnect()
+    print '{} boards:'.format(len(boards))
+    timer.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark loading calibrations for all boards.')
+    parser.add_argument('--iq-boards', type=int, default=8,
+                        help='number of made up IQ boards')
+    parser.add_argument('--z-boards', type=int, default=16,
+                        help='number of made up Z boards (two DACs each)')
+    parser.add_argument('--zero-cals', type=int, default=3,
+                        help='zero calibrations per IQ board')
+    parser.add_argument('--sideband-cals', type=int, default=3,
+                        help='sideband calibrations per IQ board')
+    parser.add_argument('--live', action='store_true',
+                        help='load the real calibrations from labrad')
+    args = parser.parse_args()
+    if args.live:
+        loadLive()
+    else:
+        loadFake(args.iq_boards, args.z_boards, args.zero_cals,
+                 args.sideband_cals)
@@ -0,0 +1,82 @@
+"""
+Save correction objects to a CalsetCache and read them back.
+"""
+
+import numpy as np
+import pytest
+
+import ghzdac
+from ghzdac import calcache, correction
+from labrad.units import Value
+
+
+def stepResponse(rise=2.0, length=400):
+    t = np.arange(-20.0, length)
+    return np.vstack((t, (t >= 0) * (1 - np.exp(-np.clip(t, 0, None) / rise)))).T
+
+
+def pulse(n=200):
+    t = np.arange(n)
+    return 0.5 * np.exp(-(t - 50.0)**2 / 20.0)
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return calcache.CalsetCache(str(tmpdir.join('calsets')))
+
+
+def test_dac_correction_round_trip(cache):
+    cor = correction.DACcorrection('board', 0)
+    cor.loadCal(stepResponse())
+    cor.setSettling([Value(0.01, 'GHz')], [-0.05])
+    expected = cor.DACify(pulse(), fitRange=False)
+    key = ('gaussfilter', 0.13, (('DAC A', ((5L, 'then'),)),))
+    cache.save(('Z', 'board', 0), key, cor)
+
+    loaded = cache.load(('Z', 'board', 0), key)
+    assert isinstance(loaded, correction.DACcorrection)
+    # the big correction array is memory mapped rather than unpickled
+    assert isinstance(loaded.correction[0], np.memmap)
+    assert loaded.kernels.stats()[3] == 0
+    assert np.all(loaded.DACify(pulse(), fitRange=False) == expected)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_iq_correction_round_trip(cache):
+    cor = correction.IQcorrection('board')
+    cor.loadZeroCal(np.array([[5.9, 10.0, -10.0], [6.0, 11.0, -11.0],
+                              [6.1, 12.0, -12.0], [6.2, 13.0, -13.0]]), 1)
+    cor.correctionI = np.exp(0.1j * np.arange(5121))
+    cor.correctionQ = np.ones(5121, dtype=complex)
+    expected = cor.DACify(6.05, pulse())
+    cache.save(('IQ', 'board'), 'key', cor)
+    loaded = cache.load(('IQ', 'board'), 'key')
+    assert np.all(loaded.DACify(6.05, pulse()) == expected)
+
+
+def test_stale_and_missing_entries(cache):
+    cor = correction.DACcorrection('board', 1)
+    cor.loadCal(stepResponse())
+    assert cache.load(('Z', 'board', 1), 'old') is None
+    cache.save(('Z', 'board', 1), 'old', cor)
+    # a new calibration dataset changes the key
+    assert cache.load(('Z', 'board', 1), 'new') is None
+    cache.save(('Z', 'board', 1), 'new', cor)
+    assert cache.load(('Z', 'board', 1), 'new') is not None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_failed_save_is_not_an_error(tmpdir):
+    cor = correction.DACcorrection('board', 0)
+    cor.loadCal(stepResponse())
+    # the cache directory can't be created under a file
+    tmpdir.join('home').write('')
+    cache = calcache.CalsetCache(str(tmpdir.join('home', 'calsets')))
+    with pytest.raises(OSError):
+        cache.save(('Z', 'board', 0), 'key', cor)
+    ghzdac.saveCorrector(cache, ('Z', 'board', 0), 'key', cor)
+    assert cache.load(('Z', 'board', 0), 'key') is None
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
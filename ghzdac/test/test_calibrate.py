@@ -0,0 +1,379 @@
+"""
+Run the zero and sideband scans of ghzdac.calibrate against a simulated
+spectrum analyzer, FPGA board and microwave source.
+"""
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+from ghzdac import calibrate, correction, keys
+from labrad.units import Value
+
+
+class FakeFuture(object):
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class FakeSetting(object):
+    """A bound server setting, which can also be called as a future."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, *args, **kw):
+        return self.f(*args, **kw)
+
+    def future(self, *args, **kw):
+        return FakeFuture(self.f(*args, **kw))
+
+
+class FakePacket(object):
+    def __init__(self, server):
+        self.server = server
+        self.records = []
+
+    def __getattr__(self, name):
+        def record(*args, **kw):
+            self.records.append((kw.pop('key', name), name, args))
+            return self
+        return record
+
+    def send(self):
+        return dict((key, getattr(self.server, name)(*args))
+                    for key, name, args in self.records)
+
+
+class FakeServer(object):
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if callable(attr) and not name.startswith('_') and name != 'packet':
+            return FakeSetting(attr)
+        return attr
+
+    def packet(self):
+        return FakePacket(self)
+
+    def select_device(self, name):
+        self.device = name
+        return name
+
+
+class Bench(object):
+    """The signal seen by the spectrum analyzer.
+
+    The IQ mixer turns the DAC output s = I + jQ into s + nu * conj(s) + z0,
+    where z0 is carrier leakage that the DAC zeros have to cancel and nu
+    gives rise to the opposite sideband.
+    """
+
+    nu = 0.05 * np.exp(0.3j)
+
+    def __init__(self):
+        self.carrier = None
+        self.center = None
+        self.sram = np.zeros(1, dtype=np.uint32)
+        self.measurements = 0
+
+    def leakage(self, carrier):
+        return -(200 + 100 * np.sin(carrier)) - 1j * (150 * np.cos(carrier))
+
+    def zeros(self, carrier):
+        """The DAC values that cancel the carrier leakage."""
+        z0 = -self.leakage(carrier)
+        m = (z0 - self.nu * np.conj(z0)) / (1 - abs(self.nu)**2)
+        return m.real, m.imag
+
+    def power(self):
+        """Power in mW at the analyzer center frequency."""
+        def signed(x):
+            return ((x & 0x3FFF) ^ 0x2000).astype(float) - 0x2000
+        sram = np.asarray(self.sram, dtype=np.uint32)
+        s = signed(sram) + 1j * signed(sram >> 14)
+        out = s + self.nu * np.conj(s) + self.leakage(self.carrier)
+        # a positive sideband frequency f is exp(-2j pi f t)
+        t = np.arange(len(out))
+        amplitude = np.mean(out * np.exp(2.0j * np.pi *
+                                         (self.center - self.carrier) * t))
+        self.measurements += 1
+        return 1e-9 * (1 + abs(amplitude)**2)
+
+
+class FakeSpectrumAnalyzer(FakeServer):
+    def __init__(self, bench):
+        self.bench = bench
+
+    def query_10_mhz_ref(self):
+        return 'EXT'
+
+    def gpib_write(self, command):
+        if command.startswith(':FREQ:CENT'):
+            self.bench.center = float(command[len(':FREQ:CENT '):-3])
+
+    def gpib_query(self, query):
+        assert query == '*TRG;*OPC?;:TRAC:MATH:MEAN? TRACE1'
+        return '1;%.12g' % (10 * np.log10(self.bench.power()))
+
+
+class FakeFPGA(FakeServer):
+    def __init__(self, bench):
+        self.bench = bench
+
+    def dac_run_sram(self, data, loop=False):
+        self.bench.sram = np.array(data)
+
+    def dac_write_sram(self, data):
+        self.bench.sram = np.array(data)
+
+
+class FakeMicrowaveSource(FakeServer):
+    def __init__(self, bench):
+        self.bench = bench
+
+    def list_devices(self):
+        return [(0, 'source')]
+
+    def frequency(self, f):
+        self.bench.carrier = f['GHz']
+
+    def amplitude(self, a):
+        pass
+
+    def output(self, on):
+        pass
+
+
+class FakeSwitch(FakeServer):
+    def switch(self, channel):
+        return channel
+
+
+class FakeRegistry(FakeServer):
+    def __init__(self, boards):
+        self.boards = boards
+
+    def cd(self, path, create=False):
+        self.board = path[-1]
+
+    def get(self, key, setType=False, default=None):
+        return self.boards[self.board].get(key, default)
+
+
+class FakeDataVault(FakeServer):
+    def __init__(self):
+        self.requests = []
+        self.rows = []
+
+    def cd(self, path, create=False):
+        pass
+
+    def new(self, name, independents, dependents):
+        return [''], '00001 - %s' % name
+
+    def add_parameter(self, name, value):
+        pass
+
+    def add(self, rows):
+        self.requests.append(len(rows))
+        self.rows.extend(rows)
+
+
+class FakeConnection(object):
+    def __init__(self, boards, bench=None):
+        bench = bench or Bench()
+        self.bench = bench
+        self.registry = FakeRegistry(boards)
+        self.data_vault = FakeDataVault()
+        self.spectrum_analyzer_server = FakeSpectrumAnalyzer(bench)
+        self.microwave_switch = FakeSwitch()
+        self.anritsu_server = FakeMicrowaveSource(bench)
+        self.hittite_t2100_server = FakeMicrowaveSource(bench)
+        self.hittite_t2100_server.list_devices = lambda: []
+        self.servers = {'anritsu_server': self.anritsu_server}
+        self.fpga = FakeFPGA(bench)
+        self.disconnected = False
+
+    def __getitem__(self, name):
+        assert name == calibrate.FPGA_SERVER_NAME
+        return self.fpga
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+def boardConfig(spect='analyzer', source='source', switch='switch'):
+    return {keys.SPECTID: spect, keys.ANRITSUID: source,
+            keys.ANRITSUPOWER: Value(2.7, 'dBm'), keys.SWITCHNAME: switch}
+
+
+def makeCorrector():
+    cor = correction.IQcorrection('board')
+    cor.correctionI = np.ones(5121, dtype=complex)
+    cor.correctionQ = np.ones(5121, dtype=complex)
+    return cor
+
+
+def test_measure_points_pipelined_matches_serial():
+    log = []
+    lock = threading.Lock()
+
+    def prepare(x):
+        with lock:
+            log.append(('prepare', x))
+        return x * 10
+
+    def measure(x):
+        time.sleep(0.01)
+        with lock:
+            log.append(('measure', x))
+        return x + 1
+
+    points = range(5)
+    assert calibrate.measurePoints(prepare, measure, points) == \
+        [1, 11, 21, 31, 41]
+    del log[:]
+    pool = ThreadPool(1)
+    try:
+        assert calibrate.measurePoints(prepare, measure, points, pool) == \
+            [1, 11, 21, 31, 41]
+        assert calibrate.measurePoints(prepare, measure, [], pool) == []
+    finally:
+        pool.close()
+    # each point is prepared before the one before it has been measured
+    for i in range(1, 5):
+        assert log.index(('prepare', i)) < log.index(('measure', 10 * (i - 1)))
+
+
+def test_zero_finds_dac_zeros():
+    cxn = FakeConnection({'board': boardConfig()})
+    bench = cxn.bench
+    source = cxn.anritsu_server
+    spec = cxn.spectrum_analyzer_server
+    serial = calibrate.zero(source, spec, cxn.fpga, 5.0)
+    pool = ThreadPool(1)
+    try:
+        pipelined = calibrate.zero(source, spec, cxn.fpga, 5.0, pool)
+    finally:
+        pool.close()
+    assert serial == pipelined
+    a0, b0 = bench.zeros(5.0)
+    assert abs(serial[0] - a0) <= 2 and abs(serial[1] - b0) <= 2
+
+
+def test_sideband_cancels_opposite_sideband():
+    cxn = FakeConnection({'board': boardConfig()})
+    source = cxn.anritsu_server
+    spec = cxn.spectrum_analyzer_server
+    cor = makeCorrector()
+    serial = calibrate.sideband(source, spec, cxn.fpga, cor, 5.0, 0.05)
+    pool = ThreadPool(1)
+    try:
+        pipelined = calibrate.sideband(source, spec, cxn.fpga, cor, 5.0,
+                                       0.05, pool)
+    finally:
+        pool.close()
+    assert serial == pipelined
+    before = calibrate.measureOppositeSideband(spec, cxn.fpga, cor, 5.0,
+                                               0.05, 0.0)
+    after = calibrate.measureOppositeSideband(spec, cxn.fpga, cor, 5.0,
+                                              0.05, serial)
+    assert after < 0.01 * before
+
+
+def test_zero_scan_writes_rows_in_blocks(monkeypatch):
+    monkeypatch.setattr(calibrate, 'DATAVAULT_BLOCK', 4)
+    cxn = FakeConnection({'board': boardConfig()})
+    scanparams = {'carrierMin': 4.0, 'carrierMax': 4.9, 'carrierStep': 0.1}
+    assert calibrate.zeroScanCarrier(cxn, scanparams, 'board') == 1
+    rows = cxn.data_vault.rows
+    assert [row[0] for row in rows] == pytest.approx(np.arange(4.0, 4.95, 0.1))
+    assert cxn.data_vault.requests == [4, 4, 2]
+    for freq, a, b in rows:
+        a0, b0 = cxn.bench.zeros(freq)
+        assert abs(a - a0) <= 2 and abs(b - b0) <= 2
+
+
+def test_group_boards():
+    resources = {
+        'A': set([('spectrum analyzer', 1), ('microwave source', 1)]),
+        'B': set([('spectrum analyzer', 2), ('microwave source', 2)]),
+        'C': set([('spectrum analyzer', 3), ('microwave source', 1)]),
+        'D': set([('spectrum analyzer', 2), ('microwave source', 4)]),
+        'E': set([('spectrum analyzer', 5), ('microwave source', 5)]),
+    }
+    groups = calibrate.groupBoards(['A', 'B', 'C', 'D', 'E'], resources)
+    assert groups == [['A', 'C'], ['B', 'D'], ['E']]
+    # a board sharing with two groups joins them
+    resources['F'] = set([('spectrum analyzer', 1), ('microwave source', 5)])
+    groups = calibrate.groupBoards(['A', 'B', 'C', 'D', 'E', 'F'], resources)
+    assert groups == [['A', 'C', 'E', 'F'], ['B', 'D']]
+
+
+def test_scan_boards_runs_groups_concurrently():
+    boards = {
+        'A': boardConfig('analyzer 1', 'source 1', 'switch 1'),
+        'B': boardConfig('analyzer 2', 'source 2', 'switch 2'),
+        'C': boardConfig('analyzer 1', 'source 3', 'switch 3'),
+    }
+    connections = []
+    running = []
+    overlap = []
+
+    def connect():
+        cxn = FakeConnection(boards)
+        connections.append(cxn)
+        return cxn
+
+    def scan(cxn, board):
+        running.append(board)
+        time.sleep(0.05)
+        overlap.append(len(running))
+        running.remove(board)
+        return board.lower()
+
+    results = calibrate.scanBoards(['A', 'B', 'C'], scan, connect)
+    assert results == {'A': 'a', 'B': 'b', 'C': 'c'}
+    # one connection to look up the instruments, one per group
+    assert len(connections) == 3
+    assert all(cxn.disconnected for cxn in connections)
+    assert max(overlap) == 2
+
+
+def test_boards_without_a_switch_do_not_share_one():
+    boards = {'A': boardConfig('analyzer 1', 'source 1', ''),
+              'B': boardConfig('analyzer 2', 'source 2', '')}
+    del boards['B'][keys.SWITCHNAME]
+    cxn = FakeConnection(boards)
+    resources = dict((board, calibrate.boardResources(cxn, board))
+                     for board in boards)
+    assert resources['A'] == set([('spectrum analyzer', 'analyzer 1'),
+                                  ('microwave source', 'source 1')])
+    assert calibrate.groupBoards(['A', 'B'], resources) == [['A'], ['B']]
+
+
+def test_scan_boards_raises_first_error():
+    boards = {'A': boardConfig('analyzer 1', 'source 1'),
+              'B': boardConfig('analyzer 2', 'source 2')}
+    done = []
+
+    def scan(cxn, board):
+        if board == 'A':
+            raise ValueError('no signal')
+        time.sleep(0.02)
+        done.append(board)
+
+    with pytest.raises(ValueError):
+        calibrate.scanBoards(['A', 'B'], scan,
+                             lambda: FakeConnection(boards), use_switch=False)
+    assert done == ['B']
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
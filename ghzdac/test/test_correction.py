@@ -0,0 +1,344 @@
+"""
+Tests for the correction classes in ghzdac.correction, using made up
+calibration data.
+"""
+
+import numpy as np
+import pytest
+
+from ghzdac import correction
+from labrad.units import Value
+
+
+def stepResponse(rise=2.0, length=400):
+    """An exponential step response sampled at 1 GHz, as loadCal expects."""
+    t = np.arange(-20.0, length)
+    return np.vstack((t, (t >= 0) * (1 - np.exp(-np.clip(t, 0, None) / rise)))).T
+
+
+def makeDACcorrection():
+    cor = correction.DACcorrection('board', 0)
+    cor.loadCal(stepResponse())
+    return cor
+
+
+def pulse(n=200):
+    t = np.arange(n)
+    return 0.5 * np.exp(-(t - 50.0)**2 / 20.0)
+
+
+def moving_average_loop(x, m):
+    """The original, loop based moving_average, for comparison.
+
+    Float indices, which numpy used to truncate, are now cast explicitly.
+    """
+    n=np.alen(x)
+    before=-np.fix(int(m)/2.0)
+    y=[]
+    for i in np.arange(len(x)):
+        a=0.0
+        for tel in np.arange(int(m)):
+            idx=i+before+tel
+            if idx<0:
+                idx=0
+            elif idx>=n:
+                idx=n-1
+            a += x[int(idx)]/np.float(m)
+        y.append(a)
+    return np.array(y)
+
+
+def derivative_loop(x,y):
+    """The original, loop based derivative, for comparison."""
+    n=np.alen(x)
+    deriv=np.array(np.linspace(0.0,0.0,n),dtype=complex)
+    for k in np.arange(n):
+        if k==0:
+            deriv[k]=1.0*(y[k+1]-y[k])/(x[k+1]-x[k])
+        elif k==(n-1):
+            deriv[k]=1.0*(y[k]-y[k-1])/(x[k]-x[k-1])
+        else:
+            deriv[k]=1.0*(y[k+1]-y[k-1])/(x[k+1]-x[k-1])
+    return deriv
+
+
+def findRelevant_loop(starts, ends):
+    """The original, loop based findRelevant, for comparison."""
+    n = np.size(starts)
+    relevant = np.resize(True, n)
+    for i in np.arange(n-1):
+        relevant[i] = not np.any((starts[i+1:] <= starts[i]) &
+                                    (ends[i+1:] >= ends[i]))
+    return np.argwhere(relevant)[:,0]
+
+
+def fastfftlen_log(n):
+    """The original fastfftlen calculation, for comparison."""
+    logn = np.log(n)
+    n5 = 5L ** np.arange(long(logn/np.log(5.) + 2. + 1.e-6))
+    n3 = 3L ** np.arange(long(logn/np.log(3.) + 2. + 1.e-6))
+    n35 = np.outer(n3, n5).flat
+    n35 = np.compress(n35<2*n, n35)
+    n235 = ((-np.log(n35)+logn)/np.log(2.) + 0.999999).astype(int)
+    n235 *= (n235>0)
+    n235 = 2**n235 * n35
+    return np.min(n235)
+
+
+def interpol_cubic_masks(h,x2,fill_value=None):
+    """The original, mask based interpol_cubic, for comparison."""
+    xlen=np.alen(h)
+    if type(h) is not np.ndarray:
+        h=1.0*np.array(h)
+    xdet=x2
+    if type(xdet) is not list and type(xdet) is not np.ndarray:
+        xdet=np.array([xdet])
+    yout=np.zeros(np.alen(xdet)).astype(h.dtype)
+    x2=xdet
+    xdet_idx = x2<0
+    if xdet_idx.any():
+        yout[xdet_idx]=h[0] if fill_value is None else fill_value
+    xdet_idx = x2>(xlen-1)
+    if xdet_idx.any():
+        yout[xdet_idx]=h[xlen-1] if fill_value is None else fill_value
+    xdet_idx =  np.logical_and(x2>=0,x2<1)
+    if xdet_idx.any():
+        x2_idx = x2[ xdet_idx ]
+        yout[xdet_idx]=(h[1]-h[0])*x2_idx  + h[0]
+    xdet_idx =  np.logical_and(x2>=(xlen-2),x2<=(xlen-1))
+    if xdet_idx.any():
+        x2_idx = x2[ xdet_idx ]
+        h_idx = np.array(x2_idx).astype(int)
+        yout[xdet_idx]=(h[xlen-1]-h[xlen-2])*(x2_idx-h_idx[0])  + h[xlen-2]
+    xdet_idx = np.logical_and(x2>=1,x2<(xlen-2))
+    if xdet_idx.any():
+        x2_idx = x2[ xdet_idx ]
+        h_idx = np.array(x2_idx).astype(int)
+        hp2=h[h_idx+2]
+        hp1=h[h_idx+1]
+        hp0=h[h_idx]
+        hm1=h[h_idx-1]
+        d=hp0
+        c=(hp1-hm1)/2.
+        b=(-hp2+4*hp1-5*hp0+2*hm1)/2.
+        a=(hp2-3*hp1+3*hp0-hm1)/2.
+        xi=(x2_idx - h_idx)
+        yout[xdet_idx]=((a * xi + b) * xi + c) * xi + d
+    return np.array(yout)
+
+
+def test_fastfftlen():
+    smooth = set(correction.FFTLENGTHS)
+    for n in range(1, 20000):
+        nfft = correction.fastfftlen(n)
+        assert nfft >= n and nfft in smooth
+        assert nfft == fastfftlen_log(n)
+    # the logarithms of the original lose the last digits of large sizes
+    n = 2**30 + 1
+    nfft = correction.fastfftlen(n)
+    assert nfft >= n and correction.FFTLENGTHS.index(nfft) > 0
+    assert correction.FFTLENGTHS[correction.FFTLENGTHS.index(nfft) - 1] < n
+    # beyond the table
+    assert correction.fastfftlen((1 << 41) - 1) == 1 << 41
+
+
+@pytest.mark.parametrize('n', [2, 3, 4, 5, 50])
+@pytest.mark.parametrize('fill', [None, 0.0])
+def test_interpol_cubic_matches_masks(n, fill):
+    rng = np.random.RandomState(n)
+    x = np.sort(rng.rand(500) * (n + 3) - 1.5)
+    x = np.concatenate((x, np.arange(-1, n + 1), np.arange(-1, n, 0.25)))
+    for h in [rng.randn(n), rng.randn(n) + 1j * rng.randn(n),
+              list(rng.randn(n))]:
+        expected = interpol_cubic_masks(h, x, fill)
+        actual = correction.interpol_cubic(h, x, fill)
+        assert actual.dtype == expected.dtype
+        # the right edge of the original depends on which index comes first
+        inner = x < n - 2
+        assert np.array_equal(actual[inner], expected[inner])
+        assert np.allclose(actual, expected)
+    assert np.array_equal(correction.interpol_cubic(h, 1.5),
+                          interpol_cubic_masks(h, 1.5))
+    x = np.array([np.nan, -1.0, 0.5, 1.5])
+    assert np.array_equal(correction.interpol_cubic(h, x),
+                          interpol_cubic_masks(h, x))
+
+
+def test_interpol_cubic_columns():
+    rng = np.random.RandomState(1)
+    table = rng.randn(40, 3) + 1j * rng.randn(40, 3)
+    x = rng.rand(100) * 45 - 2
+    columns = correction.interpol_cubic(table, x)
+    assert columns.shape == (100, 3)
+    for j in range(3):
+        assert np.array_equal(columns[:,j],
+                              correction.interpol_cubic(table[:,j], x))
+
+
+def test_dac_zeros_for_many_carriers():
+    cor = correction.IQcorrection('board')
+    carriers = np.arange(4.0, 7.0, 0.025)
+    cor.loadZeroCal(np.vstack((carriers, 100 * np.sin(carriers),
+                               -100 * np.cos(carriers))).T, 1)
+    freqs = np.linspace(3.9, 7.1, 77)
+    zeroI, zeroQ = cor.DACzeros(freqs)
+    for f, i, q in zip(freqs, zeroI, zeroQ):
+        single = cor.DACzeros(f)
+        assert single[0].shape == (1,)
+        assert single[0][0] == i and single[1][0] == q
+        if 4.1 < f < 6.9:
+            assert abs(i - 100 * np.sin(f)) < 1e-3
+
+
+def sidebandCal(carriers, sidebandCount=7):
+    sidebands = np.arange(sidebandCount) - sidebandCount // 2
+    c, s = np.meshgrid(carriers, sidebands, indexing='ij')
+    data = np.empty((len(carriers), 2 * sidebandCount + 1))
+    data[:,0] = carriers
+    data[:,1::2] = np.cos(c + 0.1 * s)
+    data[:,2::2] = np.sin(c - 0.2 * s)
+    return data
+
+
+@pytest.mark.parametrize('carriers', [np.arange(4.0, 7.0, 0.05),
+                                      np.array([5.0])])
+def test_iq_compensation_for_many_carriers(carriers):
+    cor = correction.IQcorrection('board')
+    freqs = np.linspace(3.9, 7.1, 33)
+    assert cor._IQcompensation(freqs, 64).shape == (33, 65)
+    cor.loadSidebandCal(sidebandCal(carriers), 0.05, 1)
+    for n in [64, 101]:
+        compensation = cor._IQcompensation(freqs, n)
+        assert compensation.shape == (33, n + 1)
+        for f, row in zip(freqs, compensation):
+            assert np.array_equal(row, cor._IQcompensation(f, n))
+
+
+@pytest.mark.parametrize('m', [1, 2, 3, 4, 5.0, 8, 31, 300])
+def test_moving_average_matches_loop(m):
+    rng = np.random.RandomState(int(m))
+    for x in [rng.randn(200), rng.randn(100) + 1j * rng.randn(100),
+              rng.randint(-100, 100, 50), rng.randn(1)]:
+        expected = moving_average_loop(x, m)
+        actual = correction.moving_average(x, m)
+        assert actual.dtype == expected.dtype
+        assert np.array_equal(actual, expected)
+
+
+def test_derivative_matches_loop():
+    rng = np.random.RandomState(0)
+    for n in [2, 3, 100]:
+        x = np.cumsum(rng.rand(n) + 0.1)
+        for y in [rng.randn(n), rng.randn(n) + 1j * rng.randn(n)]:
+            assert np.array_equal(correction.derivative(x, y),
+                                  derivative_loop(x, y))
+
+
+def test_findRelevant_matches_loop():
+    rng = np.random.RandomState(0)
+    for n in [0, 1, 2, 5, 40]:
+        for trial in range(20):
+            starts = np.round(rng.rand(n) * 4, 1)
+            ends = starts + np.round(rng.rand(n) * 4, 1)
+            assert np.array_equal(correction.findRelevant(starts, ends),
+                                  findRelevant_loop(starts, ends))
+
+
+def test_kernel_cache_lru():
+    cache = correction.KernelCache(maxBytes=3 * 800)
+    calls = []
+
+    def compute(key):
+        def f():
+            calls.append(key)
+            return np.zeros(100)  # 800 bytes
+        return f
+
+    for key in ['a', 'b', 'c', 'a', 'd', 'b']:
+        cache.get(key, compute(key))
+    # 'b' was least recently used when 'd' went in
+    assert calls == ['a', 'b', 'c', 'd', 'b']
+    hits, misses, evictions, entries, nbytes = cache.stats()
+    assert (hits, misses, evictions, entries, nbytes) == (1, 5, 2, 3, 2400)
+
+    cache.get('big', lambda: np.zeros(1000))  # too big to keep
+    assert 'big' not in cache.entries
+    cache.clear()
+    assert cache.stats()[3:] == (0, 0)
+
+
+def test_dac_correction_hits_cache():
+    cor = makeDACcorrection()
+    first = cor.DACify(pulse(), fitRange=False)
+    second = cor.DACify(pulse(), fitRange=False)
+    assert np.all(first == second)
+    hits, misses = cor.kernelCacheStats()[:2]
+    assert (hits, misses) == (1, 1)
+    # a different length needs a new transfer function
+    cor.DACify(pulse(300), fitRange=False)
+    assert cor.kernelCacheStats()[:2] == (1, 2)
+
+
+def test_dac_correction_cache_tracks_settings():
+    cor = makeDACcorrection()
+    plain = cor.DACify(pulse(), fitRange=False)
+    cor.setSettling([Value(0.01, 'GHz')], [-0.05])
+    settled = cor.DACify(pulse(), fitRange=False)
+    assert np.any(plain != settled)
+    # same settings as a fresh object gives the same answer
+    fresh = makeDACcorrection()
+    fresh.setSettling([Value(0.01, 'GHz')], [-0.05])
+    assert np.all(fresh.DACify(pulse(), fitRange=False) == settled)
+    # going back to no settling reuses the first transfer function
+    cor.setSettling([], [])
+    assert np.all(cor.DACify(pulse(), fitRange=False) == plain)
+    assert cor.kernelCacheStats()[:2] == (1, 2)
+    # changing maxvalueZ must not reuse a kernel made with another value
+    a = cor.DACifyFT(np.fft.rfft(pulse(256)), n=256, maxvalueZ=5.0,
+                     fitRange=False)
+    b = cor.DACifyFT(np.fft.rfft(pulse(256)), n=256, maxvalueZ=1.0,
+                     fitRange=False)
+    assert np.any(a != b)
+
+
+def test_iq_correction_caches_zeros_and_compensation():
+    cor = correction.IQcorrection('board')
+    zeros = np.array([[5.9, 10.0, -10.0], [6.0, 11.0, -11.0], [6.1, 12.0, -12.0],
+                      [6.2, 13.0, -13.0]])
+    cor.loadZeroCal(zeros, 1)
+    first = cor.DACify(6.05, pulse(), zipSRAM=False)
+    second = cor.DACify(6.05, pulse(), zipSRAM=False)
+    assert np.all(first[0] == second[0]) and np.all(first[1] == second[1])
+    hits, misses = cor.kernelCacheStats()[:2]
+    # zeros and sideband compensation; there is no pulse calibration
+    assert (hits, misses) == (2, 2)
+    # loading a new calibration clears the cache
+    cor.loadZeroCal(zeros, 2)
+    assert cor.kernelCacheStats()[3] == 0
+
+
+@pytest.mark.parametrize('kw', [{}, {'rescale': True}, {'averageEnds': True}])
+def test_dac_correction_batch_matches_single(kw):
+    cor = makeDACcorrection()
+    waves = np.array([pulse() * a for a in (0.5, 1.0, 5.0)])
+    batch = cor.DACify(waves, fitRange=False, **kw)
+    single = [cor.DACify(w, fitRange=False, **kw) for w in waves]
+    assert batch.shape == waves.shape
+    assert np.all(batch == np.array(single))
+
+
+@pytest.mark.parametrize('kw', [{}, {'rescale': True}, {'zeroEnds': True}])
+def test_iq_correction_batch_matches_single(kw):
+    cor = correction.IQcorrection('board')
+    cor.correctionI = np.exp(0.1j * np.arange(5121))
+    cor.correctionQ = np.ones(5121, dtype=complex)
+    t = np.arange(200)
+    waves = np.array([pulse() * a * np.exp(0.3j * t) for a in (0.5, 1.0, 5.0)])
+    batch = cor.DACify(6.0, waves, **kw)
+    single = [cor.DACify(6.0, w, **kw) for w in waves]
+    assert batch.dtype == np.uint32
+    assert np.all(batch == np.array(single))
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
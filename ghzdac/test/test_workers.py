@@ -0,0 +1,151 @@
+"""
+Run calls on fake calsets through the correction worker pools.
+"""
+
+import Queue
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from twisted.internet.defer import DeferredList
+from twisted.python import failure
+
+from ghzdac import workers
+
+
+class FakeReactor(object):
+    """Collects calls from worker threads, to run them in the test thread."""
+
+    def __init__(self):
+        self.calls = Queue.Queue()
+
+    def callFromThread(self, f, *args, **kw):
+        self.calls.put((f, args, kw))
+
+    def wait(self, d, timeout=10.0):
+        result = []
+        d.addBoth(result.append)
+        end = time.time() + timeout
+        while not result:
+            f, args, kw = self.calls.get(timeout=end - time.time())
+            f(*args, **kw)
+        if isinstance(result[0], failure.Failure):
+            result[0].raiseException()
+        return result[0]
+
+
+class FakeCalset(object):
+    """Shifts data by an offset set before each call, like setFilter."""
+
+    def __init__(self):
+        self.offset = 0
+        self.active = 0
+        self.maxActive = 0
+        self.lock = threading.Lock()
+
+    def setOffset(self, offset):
+        self.offset = offset
+
+    def DACify(self, data, delay=0.01):
+        with self.lock:
+            self.active += 1
+            self.maxActive = max(self.maxActive, self.active)
+        time.sleep(delay)
+        ans = data + self.offset
+        with self.lock:
+            self.active -= 1
+        return ans
+
+    def fail(self):
+        raise ValueError('bad data')
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        del d['lock']
+        return d
+
+    def __setstate__(self, d):
+        if d.get('broken'):
+            raise ValueError('can not unpickle')
+        self.__dict__.update(d)
+        self.lock = threading.Lock()
+
+
+def runMany(pool, reactor, calsets):
+    ds = []
+    for i in range(12):
+        key = 'board{}'.format(i % len(calsets))
+        calls = [('setOffset', (i,), {}),
+                 ('DACify', (np.arange(4),), {})]
+        ds.append(pool.run(key, calsets[i % len(calsets)], calls))
+    results = reactor.wait(DeferredList(ds))
+    for i, (ok, ans) in enumerate(results):
+        assert ok
+        assert np.all(ans == np.arange(4) + i)
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_calls_on_a_calset_do_not_interleave(kind):
+    reactor = FakeReactor()
+    pool = workers.makeWorkers(kind, 3, reactor)
+    try:
+        calsets = [FakeCalset(), FakeCalset()]
+        runMany(pool, reactor, calsets)
+        if kind == 'thread':
+            assert [cs.maxActive for cs in calsets] == [1, 1]
+        stats = pool.percentiles([50, 99])
+        assert [row[:4] for row in stats] == [('board0', 0, 6, 0),
+                                              ('board1', 0, 6, 0)]
+        for key, pending, done, errors, wait, service in stats:
+            assert service[0] >= 0.005
+    finally:
+        pool.stop()
+
+
+def test_thread_pool_runs_calsets_in_parallel():
+    reactor = FakeReactor()
+    pool = workers.makeWorkers('thread', 4, reactor)
+    try:
+        calsets = [FakeCalset() for _ in range(4)]
+        start = time.time()
+        ds = [pool.run(i, cs, [('DACify', (np.zeros(2), 0.2), {})])
+              for i, cs in enumerate(calsets)]
+        reactor.wait(DeferredList(ds))
+        assert time.time() - start < 0.6
+    finally:
+        pool.stop()
+
+
+@pytest.mark.parametrize('kind', ['thread', 'process'])
+def test_errors_are_passed_back(kind):
+    reactor = FakeReactor()
+    pool = workers.makeWorkers(kind, 1, reactor)
+    try:
+        with pytest.raises(ValueError):
+            reactor.wait(pool.run('board', FakeCalset(), [('fail', (), {})]))
+        assert pool.percentiles([50])[0][:4] == ('board', 0, 0, 1)
+    finally:
+        pool.stop()
+
+
+def test_calset_is_sent_again_after_a_failed_first_call():
+    reactor = FakeReactor()
+    pool = workers.makeWorkers('process', 1, reactor)
+    try:
+        calset = FakeCalset()
+        calset.broken = True
+        calls = [('DACify', (np.arange(4), 0), {})]
+        with pytest.raises(ValueError):
+            reactor.wait(pool.run('board', calset, calls))
+        calset.broken = False
+        assert np.all(reactor.wait(pool.run('board', calset, calls)) ==
+                      np.arange(4))
+        assert pool.percentiles([50])[0][:4] == ('board', 0, 1, 1)
+    finally:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,260 @@
+"""workers.py
+
+Run calibration corrections on a pool of workers.
+
+Correction objects (IQcorrection and DACcorrection) are not safe to use from
+several threads at once: DACify caches precalculated data on the calset and
+keeps track of rescale factors, and the settling, reflection and filter
+settings used for a correction are stored on the calset too. So all work on
+one calset is done in order, while work on different calsets (different
+boards or DAC channels) runs in parallel.
+
+Work is given as a list of calls, (method name, args, kw), which are made on
+the calset one after the other in the same worker, so that e.g. setting the
+filter and deconvolving can not be interleaved with another request. The
+result of the last call is returned.
+
+There are two kinds of pool. ThreadWorkers runs the calls on a twisted
+thread pool; numpy releases the GIL in most of the heavy lifting, so this
+gets some parallelism without copying anything. ProcessWorkers runs them in
+separate processes, which scales across cores. Each calset is assigned to
+one process and pickled over to it the first time it is used, after which
+the process keeps its own copy (and its own precalculated data) and only the
+signal data is sent along with each request. If the process turns out not to
+have the calset, because its first call failed or the pool replaced the
+process, the calset is pickled over again.
+"""
+
+import logging
+import multiprocessing
+import pickle
+import time
+import traceback
+
+from twisted.internet.defer import (Deferred, DeferredLock, inlineCallbacks,
+                                    returnValue)
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import threadpool
+
+from fpgalib.stats import RollingHistogram
+
+
+def runCalls(calset, calls):
+    """Make a list of (method name, args, kw) calls on a calset.
+
+    Returns (result of the last call, start time, end time).
+    """
+    start = time.time()
+    result = None
+    for name, args, kw in calls:
+        result = getattr(calset, name)(*args, **kw)
+    return result, start, time.time()
+
+
+class CalsetStats(object):
+    """Queue depth and timing for the work done on one calset."""
+
+    def __init__(self):
+        self.pending = 0  # submitted but not yet finished
+        self.done = 0
+        self.errors = 0
+        self.wait = RollingHistogram()  # from submission until started
+        self.service = RollingHistogram()  # from start until finished
+
+    def submit(self):
+        self.pending += 1
+        return time.time()
+
+    def finish(self, submitted, start=None, end=None):
+        self.pending -= 1
+        if start is None:
+            self.errors += 1
+        else:
+            self.done += 1
+            self.wait.record(start - submitted)
+            self.service.record(end - start)
+
+
+class Workers(object):
+    """Base class for pools of correction workers.
+
+    Subclasses implement _run(key, calset, calls), which returns a Deferred
+    firing with the output of runCalls, and must not start calls for a key
+    before the previous calls for that key have finished.
+    """
+
+    def __init__(self, size, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.reactor = reactor
+        self.stats = {}
+
+    @inlineCallbacks
+    def run(self, key, calset, calls):
+        """Make calls on calset, after all earlier calls for the same key.
+
+        Returns a Deferred that fires with the result of the last call.
+        """
+        if key not in self.stats:
+            self.stats[key] = CalsetStats()
+        stats = self.stats[key]
+        submitted = stats.submit()
+        try:
+            result, start, end = yield self._run(key, calset, calls)
+        except Exception:
+            stats.finish(submitted)
+            raise
+        stats.finish(submitted, start, end)
+        returnValue(result)
+
+    def _run(self, key, calset, calls):
+        raise NotImplementedError()
+
+    def stop(self):
+        pass
+
+    def percentiles(self, ps):
+        """Get (key, pending, done, errors, wait, service) for each calset.
+
+        wait and service are lists of durations in seconds, one for each
+        percentage in ps.
+        """
+        ans = []
+        for key, stats in sorted(self.stats.items()):
+            ans.append((key, stats.pending, stats.done, stats.errors,
+                        stats.wait.histogram().percentiles(ps),
+                        stats.service.histogram().percentiles(ps)))
+        return ans
+
+
+class ThreadWorkers(Workers):
+    """Run corrections on a pool of threads, one calset at a time."""
+
+    def __init__(self, size, reactor=None):
+        Workers.__init__(self, size, reactor)
+        self.locks = {}
+        self.pool = threadpool.ThreadPool(0, size, 'DAC Calibration')
+        self.pool.start()
+
+    @inlineCallbacks
+    def _run(self, key, calset, calls):
+        if key not in self.locks:
+            self.locks[key] = DeferredLock()
+        lock = self.locks[key]
+        yield lock.acquire()
+        try:
+            ans = yield deferToThreadPool(self.reactor, self.pool,
+                                          runCalls, calset, calls)
+        finally:
+            lock.release()
+        returnValue(ans)
+
+    def stop(self):
+        self.pool.stop()
+
+
+# calsets sent to this worker process, by key
+_calsets = {}
+
+
+def _runInProcess(key, calset, calls):
+    """Run calls in a worker process, keeping calset for later calls.
+
+    calset is the pickled calset the first time a key is used, None after.
+
+    Exceptions are passed back as (False, exception, traceback) since the
+    pool has no way of reporting them to an asynchronous caller. If calset
+    is None but this process does not have it, (None, None, None) is
+    returned, to have it sent again.
+    """
+    try:
+        if calset is not None:
+            _calsets[key] = pickle.loads(calset)
+        elif key not in _calsets:
+            return None, None, None
+        return True, runCalls(_calsets[key], calls), None
+    except Exception as e:
+        tb = traceback.format_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(str(e))
+        return False, e, tb
+
+
+class ProcessWorkers(Workers):
+    """Run corrections in a pool of processes.
+
+    Each process is a single worker pool of its own, so that every calset
+    can be pinned to one process. That process then runs all calls for the
+    calset in order, and keeps the calset between calls.
+    """
+
+    def __init__(self, size, reactor=None):
+        Workers.__init__(self, size, reactor)
+        self.pools = [multiprocessing.Pool(1) for _ in range(size)]
+        self.load = [0] * size  # calsets assigned to each process
+        self.assigned = {}  # key -> process index
+
+    def _run(self, key, calset, calls):
+        d = Deferred()
+        if key in self.assigned:
+            data = None  # the process should already have it
+        else:
+            # Pickle here, so that a calset which can't be pickled fails
+            # this call rather than the pool's task handler thread.
+            data = pickle.dumps(calset, pickle.HIGHEST_PROTOCOL)
+            idx = self.load.index(min(self.load))
+            self.assigned[key] = idx
+            self.load[idx] += 1
+        self._apply(d, key, calset, data, calls)
+        return d
+
+    def _apply(self, d, key, calset, data, calls):
+        def done(response):
+            # called in the pool's result handler thread
+            self.reactor.callFromThread(self._finish, d, key, calset, calls,
+                                        response)
+
+        self.pools[self.assigned[key]].apply_async(_runInProcess,
+                                                   (key, data, calls),
+                                                   callback=done)
+
+    def _finish(self, d, key, calset, calls, response):
+        ok, ans, tb = response
+        if ok is None:
+            # The process does not have the calset: its first call failed
+            # or the process was replaced. Send the calset again.
+            logging.info('Sending calset {} to its worker again'.format(key))
+            try:
+                data = pickle.dumps(calset, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                d.errback()
+                return
+            self._apply(d, key, calset, data, calls)
+        elif ok:
+            d.callback(ans)
+        else:
+            logging.error('Error in correction worker for {}:\n{}'.format(
+                key, tb))
+            d.errback(ans)
+
+    def stop(self):
+        for pool in self.pools:
+            pool.terminate()
+
+
+def makeWorkers(kind, size, reactor=None):
+    """Make a pool of correction workers.
+
+    kind is 'thread' or 'process'. If size is 0 or None, use one worker per
+    CPU core.
+    """
+    if not size:
+        size = multiprocessing.cpu_count()
+    if kind == 'process':
+        return ProcessWorkers(size, reactor)
+    elif kind == 'thread':
+        return ThreadWorkers(size, reactor)
+    raise ValueError("Unknown worker kind {!r}".format(kind))
@@ -229,7 +229,8 @@ def calibrate_iq(cxn,
                  sideband_carrier_step=0.05*labrad.units.GHz,
                  sideband_step=0.05*labrad.units.GHz,
                  sideband_count=14,
-                 use_switch=True):
+                 use_switch=True,
+                 parallel=False):
     """Runs IQ mixer calibration for one or more DACs
 
     :param cxn: labrad connection object
@@ -243,6 +244,8 @@ def calibrate_iq(cxn,
     :param labrad.Value sideband_carrier_step: e.g. 0.05 GHz
     :param labrad.Value sideband_step: e.g. 0.05 GHz
     :param labrad.Value sideband_count: e.g. 14
+    :param bool parallel: calibrate DACs that use different spectrum
+        analyzers, microwave sources and switches at the same time
     """
 
     if dacs_to_calibrate == 'all':
@@ -261,6 +264,25 @@ def calibrate_iq(cxn,
     scan_params = modify_scan_params(carrier_start, carrier_stop, carrier_step,
                                      sideband_carrier_step, sideband_step, sideband_count)
 
+    if parallel:
+        def calibrate_dac(dac_cxn, dac):
+            reg = dac_cxn.registry
+            if zero:
+                iq_dataset = calibrate.zeroScanCarrier(dac_cxn, scan_params, dac,
+                                                       use_switch=use_switch)
+                reg.cd(['', keys.SESSIONNAME, dac], True)
+                reg.set(keys.ZERONAME, [iq_dataset])
+            if sideband:
+                corrector = ghzdac.IQcorrector(dac, dac_cxn, pulsecor=False)
+                corrector.dynamicReserve = 4.0
+                sideband_dataset = calibrate.sidebandScanCarrier(
+                    dac_cxn, scan_params, dac, corrector, use_switch=use_switch)
+                reg.cd(['', keys.SESSIONNAME, dac], True)
+                reg.set(keys.IQNAME, [sideband_dataset])
+        calibrate.scanBoards(dacs_to_calibrate, calibrate_dac,
+                             use_switch=use_switch)
+        return
+
     # TODO: do we want to change how we get the registry keys? (i.e. away from ghzdac.keys)
     reg = cxn.registry
     for dac in dacs_to_calibrate:
@@ -19,6 +19,13 @@
 #     device registration would fail if the server had a custom IDN handling
 #     function because this setting could not be properly accessed through the
 #     LabRAD manager at the time of execution.
+# 1.4 Identify devices on different bus servers concurrently, one at a time
+#     per bus server. Cache the names found by ident functions in the
+#     registry, so that after a restart each device is first tried with the
+#     server that identified it before, and devices that don't answer *IDN?
+#     are not queried again. Added a startup report.
+
+import time
 
 from twisted.internet.defer import DeferredList, DeferredLock
 from twisted.internet.reactor import callLater
@@ -31,7 +38,7 @@ from labrad.units import Unit,Value
 ### BEGIN NODE INFO
 [info]
 name = GPIB Device Manager
-version = 1.3
+version = 1.4
 description = Manages discovery and lookup of GPIB devices
 
 [startup]
@@ -46,11 +53,95 @@ timeout = 5
 
 UNKNOWN = '<unknown>'
 
+CACHE_PATH = ['', 'Servers', 'GPIB Device Manager', 'Ident Cache']
+CACHE_KEY = 'devices'
+
 def parseIDNResponse(s):
     """Parse the response from *IDN? to get mfr and model info."""
     mfr, model, ver, rev = s.split(',')
     return mfr.strip() + ' ' + model.strip()
 
+class IdentCache(object):
+    """Device names found by ident functions, saved in the registry.
+
+    Maps (bus server, address) to (idn, name, identifier), where idn is the
+    response to *IDN? (None if the query failed) and identifier the name of
+    the server whose ident function gave the device name.
+    """
+
+    def __init__(self, reg, path=CACHE_PATH):
+        self.reg = reg
+        self.path = path
+        self.entries = {}
+
+    @inlineCallbacks
+    def load(self):
+        yield self.reg.cd(self.path, True)
+        dirs, keys = yield self.reg.dir()
+        if CACHE_KEY in keys:
+            entries = yield self.reg.get(CACHE_KEY)
+            for server, addr, answered, idn, name, identifier in entries:
+                idn = idn if answered else None
+                self.entries[server, addr] = (idn, name, identifier)
+
+    def get(self, server, addr):
+        return self.entries.get((server, addr))
+
+    def update(self, server, addr, idn, name, identifier):
+        if self.entries.get((server, addr)) != (idn, name, identifier):
+            self.entries[server, addr] = (idn, name, identifier)
+            return self.save()
+
+    def remove(self, server, addr):
+        if (server, addr) in self.entries:
+            del self.entries[server, addr]
+            return self.save()
+
+    def save(self):
+        entries = [(server, addr, idn is not None, idn or '', name, identifier)
+                   for (server, addr), (idn, name, identifier)
+                   in sorted(self.entries.items())]
+        d = self.reg.set(CACHE_KEY, entries)
+        d.addErrback(self._saveFailed)
+        return d
+
+    def _saveFailed(self, failure):
+        print 'Failed to save ident cache:', failure.getErrorMessage()
+
+class IdentStats(object):
+    """Counts and times the work done to identify devices."""
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.started = time.time()
+        self.stopped = None
+        self.counts = {}
+        self.times = {} # maps (server, channel) to (name, seconds)
+
+    def stop(self):
+        self.stopped = time.time()
+
+    def count(self, what):
+        self.counts[what] = self.counts.get(what, 0) + 1
+
+    def identified(self, key, name, seconds):
+        self.times[key] = (name, seconds)
+
+    def report(self):
+        end = self.stopped if self.stopped is not None else time.time()
+        lines = ['Identified %d devices in %.2f s' % (len(self.times),
+                                                      end - self.started)]
+        for what, n in sorted(self.counts.items()):
+            lines.append('  %s: %d' % (what, n))
+        # slowest devices first
+        for (server, channel), (name, seconds) in sorted(
+                self.times.items(), key=lambda (k, v): -v[1]):
+            lines.append('  %6.2f s  %s %s: %s' % (seconds, server, channel,
+                                                  name))
+        return '\n'.join(lines)
+
 class GPIBDeviceManager(LabradServer):
     """Manages autodetection and identification of GPIB devices.
 
@@ -71,7 +162,15 @@ class GPIBDeviceManager(LabradServer):
         self.deviceServers = {} # maps device name to list of interested servers.
                                 # each interested server is {'target':<>,'context':<>,'messageID':<>}
         self.identFunctions = {} # maps server to (setting, ctx) for ident
-        self.identLock = DeferredLock()
+        self.busLocks = {} # maps bus server to lock for identifying its devices
+        self.pending = set() # (server, channel) being identified
+        self.unconfirmed = set() # (server, channel) waiting for cached identifier
+        self.stats = IdentStats()
+        self.cache = IdentCache(self.client.registry())
+        try:
+            yield self.cache.load()
+        except Exception, e:
+            print 'Failed to load ident cache:', e
         
         # named messages are sent with source ID first, which we ignore
         connect_func = lambda c, (s, payload): self.gpib_device_connect(*payload)
@@ -87,32 +186,62 @@ class GPIBDeviceManager(LabradServer):
         
     @inlineCallbacks
     def refreshDeviceLists(self):
-        """Ask all GPIB bus servers for their available GPIB devices."""
+        """Ask all GPIB bus servers for their available GPIB devices.
+
+        The new devices are identified in the background. self.scanning
+        fires when they all have been, and the startup report is printed.
+        """
         servers = [s for n, s in self.client.servers.items()
                      if (('GPIB Bus' in n) or ('gpib_bus' in n)) and \
                         (('List Devices' in s.settings) or \
                          ('list_devices' in s.settings))]
         serverNames = [s.name for s in servers]
         print 'Pinging servers:', serverNames
+        self.stats.start()
         resp = yield DeferredList([s.list_devices() for s in servers])
+        connects = []
         for serverName, (success, addrs) in zip(serverNames, resp):
             if not success:
                 print 'Failed to get device list for:', serverName
             else:
                 print 'Server %s has devices: %s' % (serverName, addrs)
                 for addr in addrs:
-                    self.gpib_device_connect(serverName, addr)
+                    connects.append(self.gpib_device_connect(serverName, addr))
+        self.scanning = DeferredList(connects, consumeErrors=True)
+        self.scanning.addCallback(self._scanDone)
+
+    def _scanDone(self, results):
+        self.stats.stop()
+        for success, result in results:
+            if not success:
+                print 'Error identifying device:', result.getErrorMessage()
+                self.stats.count('errors')
+        print self.stats.report()
+
+    def busLock(self, server):
+        """Get the lock for talking to devices on a bus server.
+
+        Devices are identified one at a time on each bus server, and
+        concurrently on different ones.
+        """
+        return self.busLocks.setdefault(server, DeferredLock())
 
     @inlineCallbacks
     def gpib_device_connect(self, gpibBusServer, channel):
         """Handle messages when devices connect."""
         print 'Device Connect:', gpibBusServer, channel
-        if (gpibBusServer, channel) in self.knownDevices:
+        key = gpibBusServer, channel
+        if key in self.knownDevices or key in self.pending:
             return
-        device, idnResult = yield self.lookupDeviceName(gpibBusServer, channel)
-        if device == UNKNOWN:
-            device = yield self.identifyDevice(gpibBusServer, channel, idnResult)
-        self.knownDevices[gpibBusServer, channel] = (device, idnResult)
+        self.pending.add(key)
+        start = time.time()
+        try:
+            device, idnResult = yield self.busLock(gpibBusServer).run(
+                    self.identify, gpibBusServer, channel)
+        finally:
+            self.pending.discard(key)
+        self.stats.identified(key, device, time.time() - start)
+        self.knownDevices[key] = (device, idnResult)
         # forward message if someone cares about this device
         if device in self.deviceServers:
             self.notifyServers(device, gpibBusServer, channel, True)
@@ -120,6 +249,7 @@ class GPIBDeviceManager(LabradServer):
     def gpib_device_disconnect(self, server, channel):
         """Handle messages when devices connect."""
         print 'Device Disconnect:', server, channel
+        self.unconfirmed.discard((server, channel))
         if (server, channel) not in self.knownDevices:
             return
         device, idnResult = self.knownDevices[server, channel]
@@ -127,6 +257,43 @@ class GPIBDeviceManager(LabradServer):
         # forward message if someone cares about this device
         if device in self.deviceServers:
             self.notifyServers(device, server, channel, False)
+
+    @inlineCallbacks
+    def identify(self, server, channel):
+        """Find the name of a new device, holding the lock of its bus.
+
+        Devices that did not answer *IDN? when they were last identified
+        are not queried again, but checked with the ident function that
+        identified them. If that server is not registered yet, the device
+        stays unknown until it is. Returns the name and the response to
+        *IDN?, if any.
+        """
+        self.unconfirmed.discard((server, channel))
+        cached = self.cache.get(server, channel)
+        rejectedBy = None
+        if cached is not None and cached[0] is None:
+            idn, name, identifier = cached
+            ID = self.findIdentifier(identifier)
+            if ID is None:
+                self.unconfirmed.add((server, channel))
+                self.stats.count('deferred to cache')
+                returnValue((UNKNOWN, None))
+            resp = yield self.tryIdentFunc(server, channel, None, ID)
+            if resp is not None:
+                self.stats.count('cache hits')
+                returnValue((resp, None))
+            # the device has changed
+            self.cache.remove(server, channel)
+            rejectedBy = ID
+        device, idnResult = yield self.lookupDeviceName(server, channel)
+        if device == UNKNOWN:
+            # don't ask the server that just rejected the device again
+            exclude = rejectedBy if idnResult is None else None
+            device = yield self.identifyDevice(server, channel, idnResult,
+                                               exclude)
+        else:
+            self.cache.remove(server, channel)
+        returnValue((device, idnResult))
         
     @inlineCallbacks
     def lookupDeviceName(self, server, channel):
@@ -139,6 +306,7 @@ class GPIBDeviceManager(LabradServer):
         p = self.client.servers[server].packet()
         p.address(channel).timeout(Value(1,'s')).write('*CLS').write('*IDN?').read()
         print 'Sending *IDN? to', server, channel
+        self.stats.count('*IDN? queries')
         resp = None
         try:
             resp = (yield p.send()).read
@@ -148,42 +316,99 @@ class GPIBDeviceManager(LabradServer):
             name = UNKNOWN
         returnValue((name, resp))
 
-    def identifyDevice(self, server, channel, idn):
-        """Try to identify a new device with all ident functions.
+    @inlineCallbacks
+    def identifyDevice(self, server, channel, idn, exclude=None):
+        """Try to identify a new device with all ident functions, except
+        exclude's.
 
-        Returns the first name returned by a successful identification.
+        The caller holds the lock of the bus. If the device was identified
+        before with the same *IDN? response, the server that identified it
+        is tried first. Returns the first name returned by a successful
+        identification.
         """
-        @inlineCallbacks
-        def _doIdentifyDevice():
-            for identifier in list(self.identFunctions.keys()):
-                name = yield self.tryIdentFunc(server, channel, idn, identifier)
-                if name is not None:
-                    returnValue(name)
-            returnValue(UNKNOWN)
-        return self.identLock.run(_doIdentifyDevice)
+        identifiers = [ID for ID in self.identFunctions if ID != exclude]
+        cached = self.cache.get(server, channel)
+        preferred = None
+        if cached is not None and cached[0] == idn:
+            preferred = self.findIdentifier(cached[2])
+            if preferred in identifiers:
+                identifiers.remove(preferred)
+                identifiers.insert(0, preferred)
+        for identifier in identifiers:
+            name = yield self.tryIdentFunc(server, channel, idn, identifier)
+            if name is not None:
+                if identifier == preferred:
+                    self.stats.count('cache hits')
+                returnValue(name)
+        returnValue(UNKNOWN)
 
     def identifyDevicesWithServer(self, identifier):
-        """Try to identify all unknown devices with a new server."""
-        @inlineCallbacks
-        def _doServerIdentify():
-            #yield self.client.refresh()
-            for (server, channel), (device, idn) in list(self.knownDevices.items()):
-                if device != UNKNOWN:
-                    continue
-                name = yield self.tryIdentFunc(server, channel, idn, identifier)
+        """Try to identify all unknown devices with a new server.
+
+        Devices on different bus servers are tried concurrently.
+        """
+        channels = {}
+        for (server, channel), (device, idn) in self.knownDevices.items():
+            if device == UNKNOWN:
+                channels.setdefault(server, []).append(channel)
+        return DeferredList([
+            self.busLock(server).run(self._identifyWithServer,
+                                     server, sorted(chans), identifier)
+            for server, chans in sorted(channels.items())])
+
+    @inlineCallbacks
+    def _identifyWithServer(self, server, channels, identifier):
+        for channel in channels:
+            key = server, channel
+            if key not in self.knownDevices:
+                continue
+            device, idn = self.knownDevices[key]
+            if device != UNKNOWN:
+                continue
+            # before trying, as a successful identification updates the cache
+            cached = self.cache.get(server, channel)
+            isCached = cached is not None and \
+                self.findIdentifier(cached[2]) == identifier
+            name = yield self.tryIdentFunc(server, channel, idn, identifier)
+            if key in self.unconfirmed:
                 if name is None:
-                    continue
-                self.knownDevices[server, channel] = (name, idn)
-                if name in self.deviceServers:
-                    self.notifyServers(name, server, channel, True)
-        return self.identLock.run(_doServerIdentify)        
+                    if not isCached:
+                        continue
+                    # the device changed, so identify it from scratch
+                    self.unconfirmed.discard(key)
+                    self.cache.remove(server, channel)
+                    name, idn = yield self.identify(server, channel)
+                    if name == UNKNOWN:
+                        self.knownDevices[key] = (name, idn)
+                        continue
+                else:
+                    self.unconfirmed.discard(key)
+                    if isCached:
+                        self.stats.count('cache hits')
+            elif name is None:
+                continue
+            if key not in self.knownDevices:
+                continue
+            self.knownDevices[key] = (name, idn)
+            if name in self.deviceServers:
+                self.notifyServers(name, server, channel, True)
+
+    def findIdentifier(self, name):
+        """Get the ID of the registered ident server with the given name."""
+        for ID in self.identFunctions:
+            try:
+                if self.client[ID].name == name:
+                    return ID
+            except Exception:
+                pass
+        return None
 
     @inlineCallbacks
     def tryIdentFunc(self, server, channel, idn, identifier):
         """Try calling one registered identification function.
 
-        If the identification succeeds, returns the new name,
-        otherwise returns None.
+        If the identification succeeds, returns the new name and saves it
+        in the ident cache, otherwise returns None.
         """
         try:
             #yield self.client.refresh()
@@ -192,6 +417,7 @@ class GPIBDeviceManager(LabradServer):
             print 'Trying to identify device', server, channel,
             print 'on server', identifier,
             print 'with *IDN?:', repr(idn)
+            self.stats.count('ident calls')
             if idn is None:
                 resp = yield s[setting](server, channel, context=context)
             else:
@@ -199,6 +425,7 @@ class GPIBDeviceManager(LabradServer):
             if resp is not None:
                 data = (identifier, server, channel, resp)
                 print 'Server %s identified device %s %s as "%s"' % data
+                self.cache.update(server, channel, idn, resp, s.name)
                 returnValue(resp)
         except Exception, e:
             print 'Error during ident:', str(e)
@@ -269,6 +496,16 @@ class GPIBDeviceManager(LabradServer):
         return (str(self.knownDevices),
                 str(self.deviceServers),
                 str(self.identFunctions))
+
+    @setting(11, 'Startup Report', returns='s')
+    def startup_report(self, c):
+        """Returns how long the last device scan took, and why.
+
+        Lists the number of *IDN? queries, ident function calls and
+        ident cache hits, and how long each device took to identify,
+        including time spent waiting for other devices on its bus.
+        """
+        return self.stats.report()
     
     def notifyServers(self, device, server, channel, isConnected):
         """Notify all registered servers about a device status change."""
@@ -37,18 +37,20 @@
 # connections work, and should be improved.
 
 from labrad.server import LabradServer, setting
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.reactor import callLater
 from labrad.errors import DeviceNotSelectedError
 import labrad.units as units
 import visa
 
+from transport import AddressWorkers, Metrics, VisaTransport
+
 
 """
 ### BEGIN NODE INFO
 [info]
 name = GPIB Bus
-version = 1.5.0-no-refresh
+version = 1.8.0-no-refresh
 description = Gives access to GPIB devices via pyvisa.
 instancename = %LABRADNODE% GPIB Bus
 
@@ -66,15 +68,98 @@ timeout = 20
 KNOWN_DEVICE_TYPES = ('GPIB', 'TCPIP', 'USB')
 
 
+def openDevice(rm, addr):
+    instr = rm.get_instrument(addr)
+    instr.write_termination = ''
+    instr.clear()
+    if addr.endswith('SOCKET'):
+        instr.write_termination = '\n'
+    return instr
+
+
+def readDevice(instr, n_bytes=None):
+    if n_bytes is None:
+        return instr.read_raw()
+    return instr.read_raw(n_bytes)
+
+
+def queryDevice(instr, data):
+    instr.write(data)
+    return instr.read_raw()
+
+
+# transaction ops, and whether their arg is a number of bytes to read
+TRANSACTION_OPS = {
+    'write': False,
+    'write_raw': False,
+    'query': False,
+    'read': True,
+    'read_raw': True,
+}
+
+
+def parseTransaction(ops):
+    """Check the ops of a transaction, before any of them is run.
+
+    Returns a list of (op, arg) pairs, with the byte counts of reads
+    converted to numbers (None to read until the device stops sending).
+    """
+    parsed = []
+    for i, (op, arg) in enumerate(ops):
+        op = op.lower()
+        if op not in TRANSACTION_OPS:
+            raise ValueError('Unknown transaction op %d: %r' % (i, op))
+        if TRANSACTION_OPS[op]:
+            try:
+                arg = long(arg) if arg.strip() else None
+            except ValueError:
+                raise ValueError('Bad byte count for transaction op %d: %r'
+                                 % (i, arg))
+        parsed.append((op, arg))
+    return parsed
+
+
+def runTransaction(instr, ops):
+    """Run parsed transaction ops on instr, returning one result per op.
+
+    Reads and queries give the data read, stripped of termination
+    characters except for read_raw. Writes give an empty string.
+    """
+    results = []
+    for op, arg in ops:
+        if op == 'write':
+            instr.write(arg)
+            ans = ''
+        elif op == 'write_raw':
+            instr.write_raw(arg)
+            ans = ''
+        elif op == 'query':
+            ans = str(queryDevice(instr, arg)).strip()
+        elif op == 'read':
+            ans = str(readDevice(instr, arg)).strip()
+        else:
+            ans = bytes(readDevice(instr, arg))
+        results.append(ans)
+    return results
+
+
 class GPIBBusServer(LabradServer):
     """Provides direct access to GPIB-enabled devices."""
     name = '%LABRADNODE% GPIB Bus'
 
     refreshInterval = 10
     defaultTimeout = 1.0 * units.s
+    # instruments talked to at the same time
+    maxWorkerThreads = 10
+    # if set, used instead of visa.ResourceManager(), e.g. for testing
+    resourceManager = None
 
     def initServer(self):
         self.devices = {}
+        self.transports = {}
+        self.metrics = Metrics()
+        self.workers = AddressWorkers(self.maxWorkerThreads)
+        self.workers.start()
         # start refreshing only after we have started serving
         # this ensures that we are added to the list of available
         # servers before we start sending messages
@@ -97,32 +182,36 @@ class GPIBBusServer(LabradServer):
         if hasattr(self, 'refresher'):
             self.refresher.stop()
             yield self.refresherDone
+        self.workers.stop()
 
+    @inlineCallbacks
     def refreshDevices(self):
         """Refresh the list of known devices on this bus.
 
         Currently supported are GPIB devices and GPIB over USB.
         """
         try:
-            rm = visa.ResourceManager()
-            addresses = [str(x) for x in rm.list_resources()]
+            rm = self.resourceManager
+            if rm is None:
+                rm = visa.ResourceManager()
+            resources = yield self.workers.run(None, rm.list_resources)
+            addresses = [str(x) for x in resources]
             additions = set(addresses) - set(self.devices.keys())
             deletions = set(self.devices.keys()) - set(addresses)
             for addr in additions:
                 try:
                     if not addr.startswith(KNOWN_DEVICE_TYPES):
                         continue
-                    instr = rm.get_instrument(addr)
-                    instr.write_termination = ''
-                    instr.clear()
-                    if addr.endswith('SOCKET'):
-                        instr.write_termination = '\n'
+                    instr = yield self.workers.run(addr, openDevice, rm, addr)
                     self.devices[addr] = instr
+                    self.transports[addr] = VisaTransport(
+                        instr, addr, self.workers, self.metrics)
                     self.sendDeviceMessage('GPIB Device Connect', addr)
                 except Exception, e:
                     print 'Failed to add ' + addr + ':' + str(e)
             for addr in deletions:
                 del self.devices[addr]
+                del self.transports[addr]
                 self.sendDeviceMessage('GPIB Device Disconnect', addr)
         except Exception, e:
             print 'Problem while refreshing devices:', str(e)
@@ -142,6 +231,18 @@ class GPIBBusServer(LabradServer):
         instr = self.devices[c['addr']]
         return instr
 
+    def callDevice(self, c, op, f, *args, **kw):
+        """Call f(instr, *args) for the device of this context.
+
+        The call is made by the transport of the device address, in its
+        worker thread, with the timeout of this context, and counted in
+        the metrics as op. kw may give the number of bytes sent. Returns a
+        Deferred with the result.
+        """
+        self.getDevice(c)
+        transport = self.transports[c['addr']]
+        return transport.call(op, f, *args, timeout=c['timeout']['s'], **kw)
+
     @setting(0, addr='s', returns='s')
     def address(self, c, addr=None):
         """Get or set the GPIB address for this context.
@@ -163,12 +264,15 @@ class GPIBBusServer(LabradServer):
     @setting(3, data='s', returns='')
     def write(self, c, data):
         """Write a string to the GPIB bus."""
-        self.getDevice(c).write(data)
+        yield self.callDevice(c, 'write', lambda instr: instr.write(data),
+                              sent=len(data))
 
     @setting(8, data='y', returns='')
     def write_raw(self, c, data):
         """Write a string to the GPIB bus."""
-        self.getDevice(c).write_raw(data)
+        yield self.callDevice(c, 'write_raw',
+                              lambda instr: instr.write_raw(data),
+                              sent=len(data))
 
     @setting(4, n_bytes='w', returns='s')
     def read(self, c, n_bytes=None):
@@ -179,12 +283,8 @@ class GPIBBusServer(LabradServer):
         binary data. If specified, reads only the given number
         of bytes. Otherwise, reads until the device stops sending.
         """
-        instr = self.getDevice(c)
-        if n_bytes is None:
-            ans = instr.read_raw()
-        else:
-            ans = instr.read_raw(n_bytes)
-        return str(ans).strip()
+        ans = yield self.callDevice(c, 'read', readDevice, n_bytes)
+        returnValue(str(ans).strip())
 
     @setting(5, data='s', returns='s')
     def query(self, c, data):
@@ -193,10 +293,9 @@ class GPIBBusServer(LabradServer):
         This query is atomic.  No other communication to the
         device will occur while the query is in progress.
         """
-        instr = self.getDevice(c)
-        instr.write(data)
-        ans = instr.read_raw()
-        return str(ans).strip()
+        ans = yield self.callDevice(c, 'query', queryDevice, data,
+                                    sent=len(data))
+        returnValue(str(ans).strip())
 
     @setting(7, n_bytes='w', returns='y')
     def read_raw(self, c, n_bytes=None):
@@ -206,12 +305,27 @@ class GPIBBusServer(LabradServer):
         If n_bytes is specified, reads only that many bytes.
         Otherwise, reads until the device stops sending.
         """
-        instr = self.getDevice(c)
-        if n_bytes is None:
-            ans = instr.read_raw()
-        else:
-            ans = instr.read_raw(n_bytes)
-        return bytes(ans)
+        ans = yield self.callDevice(c, 'read_raw', readDevice, n_bytes)
+        returnValue(bytes(ans))
+
+    @setting(9, ops='*(sy)', returns='*y')
+    def transaction(self, c, ops):
+        """Run a list of (op, arg) pairs on the device, in order.
+
+        The ops are write, write_raw, query, read and read_raw, which
+        work like the settings of the same name. The arg of read and
+        read_raw is the number of bytes to read, or an empty string to
+        read until the device stops sending.
+
+        Returns one result per op, an empty string for writes. Like a
+        query, the transaction is atomic, and it takes only one request
+        to the server. If any op is invalid, none of them are run.
+        """
+        ops = parseTransaction(ops)
+        sent = sum(len(arg) for op, arg in ops if op.startswith('write'))
+        ans = yield self.callDevice(c, 'transaction', runTransaction, ops,
+                                    sent=sent)
+        returnValue(ans)
 
     @setting(20, returns='*s')
     def list_devices(self, c):
@@ -221,7 +335,16 @@ class GPIBBusServer(LabradServer):
     @setting(21)
     def refresh_devices(self, c):
         """ manually refresh devices """
-        self.refreshDevices()
+        yield self.refreshDevices()
+
+    @setting(22, addr='s', returns='*(sswwwv[s])')
+    def transport_metrics(self, c, addr=None):
+        """Get I/O counters by device address and operation.
+
+        Returns (address, op, count, bytes, errors, total time) for each
+        operation made on the given address, or on all of them.
+        """
+        return self.metrics.rows(addr)
 
 
 __server__ = GPIBBusServer()
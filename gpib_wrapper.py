@@ -0,0 +1,169 @@
+"""
+Device wrapper for GPIB device servers that batches its I/O.
+
+GPIBTransactionWrapper is a drop in replacement for
+labrad.gpib.GPIBDeviceWrapper, as the deviceWrapper of a GPIBManagedServer.
+It adds transaction, which sends a list of write, query and read ops to the
+GPIB Bus server in one request, and helpers for the common combinations
+built on it. The ops run atomically, without other traffic to the device
+in between, in one trip to the instrument's worker thread on the bus
+server.
+
+Older GPIB Bus servers without the Transaction setting get the ops as the
+records of one packet instead, which saves round trips but is not atomic.
+
+Binary data, e.g. traces, comes as IEEE 488.2 blocks, which parseBlock
+decodes straight into a numpy array. Run this module to benchmark it
+against unpacking a trace one sample at a time.
+"""
+
+import argparse
+import struct
+import time
+
+import numpy as np
+
+from labrad import errors
+import labrad.units as units
+from labrad.gpib import GPIBDeviceWrapper
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+class BinaryBlockError(errors.Error):
+    """Could not decode binary response."""
+
+
+def parseBlock(data, dtype):
+    """Decode an IEEE 488.2 binary block into an array of dtype.
+
+    A definite length block is '#', a digit n, n digits giving the length
+    of the payload in bytes, and the payload. Anything after it, e.g. the
+    termination character, is ignored. An indefinite length block is '#0'
+    followed by the payload and a newline. Leading whitespace is skipped.
+
+    dtype gives the size and byte order of the samples, e.g. '>i4' for
+    big endian 32 bit integers. The array is read-only and shares memory
+    with data, so no copy is made.
+    """
+    dtype = np.dtype(dtype)
+    head = data[:16]
+    start = len(head) - len(head.lstrip())
+    if data[start:start+1] != '#' or not data[start+1:start+2].isdigit():
+        raise BinaryBlockError('Could not decode binary response: '
+                               'no block header.')
+    n = int(data[start+1])
+    offset = start + 2 + n
+    if n == 0:
+        length = len(data) - offset
+        if data.endswith('\n') and length % dtype.itemsize:
+            length -= 1
+    else:
+        digits = data[start+2:offset]
+        if len(digits) != n or not digits.isdigit():
+            raise BinaryBlockError('Could not decode binary response: '
+                                   'bad block header.')
+        length = int(digits)
+        if len(data) - offset < length:
+            raise BinaryBlockError('Could not decode binary response: '
+                                   'got %d of %d bytes.'
+                                   % (len(data) - offset, length))
+    if length % dtype.itemsize:
+        raise BinaryBlockError('Could not decode binary response: '
+                               '%d bytes is not a whole number of %s.'
+                               % (length, dtype))
+    return np.frombuffer(data, dtype, length // dtype.itemsize, offset)
+
+
+class GPIBTransactionWrapper(GPIBDeviceWrapper):
+    """A wrapper for a gpib device, with batched I/O."""
+
+    @inlineCallbacks
+    def transaction(self, ops, timeout=None):
+        """Run a list of (op, arg) pairs on this device in one request.
+
+        The ops are 'write', 'write_raw', 'query', 'read' and 'read_raw'.
+        The arg of a read is the number of bytes to read, or None to read
+        until the device stops sending. Returns a list with one result per
+        op, the empty string for writes.
+        """
+        p = self._packet()
+        if timeout is not None:
+            p.timeout(timeout)
+        batched = hasattr(self.gpib, 'transaction')
+        if batched:
+            p.transaction([(op, '' if arg is None else str(arg))
+                           for op, arg in ops], key='ans')
+        else:
+            for i, (op, arg) in enumerate(ops):
+                getattr(p, op)(arg, key=i)
+        if timeout is not None:
+            p.timeout(self._timeout)
+        resp = yield p.send()
+        if batched:
+            returnValue(list(resp['ans']))
+        returnValue(['' if resp[i] is None else resp[i]
+                     for i in range(len(ops))])
+
+    @inlineCallbacks
+    def queries(self, *queries):
+        """Make several queries in one request, returning the responses."""
+        ans = yield self.transaction([('query', q) for q in queries])
+        returnValue(ans)
+
+    @inlineCallbacks
+    def read_raw(self, bytes=None, timeout=None):
+        """Read raw bytes from the device."""
+        ans = yield self.transaction([('read_raw', bytes)], timeout)
+        returnValue(ans[0])
+
+    @inlineCallbacks
+    def write_read_raw(self, s, bytes=None, timeout=None):
+        """Write a string and read the raw response, e.g. binary data."""
+        ans = yield self.transaction([('write', s), ('read_raw', bytes)],
+                                     timeout)
+        returnValue(ans[1])
+
+    @inlineCallbacks
+    def query_block(self, query, dtype, timeout=None):
+        """Query binary data sent as an IEEE 488.2 block.
+
+        Returns the data as an array of dtype, see parseBlock.
+        """
+        resp = yield self.write_read_raw(query, timeout=timeout)
+        returnValue(parseBlock(resp, dtype))
+
+
+def benchmark(nPoints, repeat):
+    """Time decoding a trace of 32 bit integers in mV to Values in V."""
+    payload = np.arange(nPoints, dtype='>i4').tostring()
+    length = str(len(payload))
+    data = '#%d%s%s\n' % (len(length), length, payload)
+
+    def perSample():
+        h = int(data[1])
+        d = int(data[2:2+h])
+        vals = struct.unpack('>' + 'l' * (d / 4), data[2+h:2+h+d])
+        return [units.Value(v / 1000.0, 'V') for v in vals]
+
+    def block():
+        return units.ValueArray(parseBlock(data, '>i4') / 1000.0, 'V')
+
+    assert np.all([v['V'] for v in perSample()] == block()['V'])
+    print '%d point trace, %d bytes:' % (nPoints, len(data))
+    for name, f in [('struct and Values', perSample),
+                    ('parseBlock and ValueArray', block)]:
+        start = time.time()
+        for i in range(repeat):
+            f()
+        print '  %-26s %8.3f ms' % (name, (time.time() - start) / repeat * 1e3)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark decoding binary traces.')
+    parser.add_argument('--points', type=int, default=100000,
+                        help='samples per trace')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of traces to decode')
+    args = parser.parse_args()
+    benchmark(args.points, args.repeat)
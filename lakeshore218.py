@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Lakeshore Diodes
-version = 2.2
+version = 2.3
 description = 
 
 [startup]
@@ -30,10 +30,12 @@ timeout = 20
 ### END NODE INFO
 """
 
-from labrad.units import K, V
-from labrad.server import setting
+from labrad.units import K, V, s
+from labrad.server import Signal, setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from reading_cache import ReadingCache
 
 
 def parse(val):
@@ -49,20 +51,54 @@ def parse(val):
         return 0.0
 
 
+class DiodeWrapper(GPIBDeviceWrapper):
+
+    def initialize(self):
+        # the temperatures of channels 1 to 8, shared by all contexts
+        self.readings = ReadingCache(self.readTemperatures)
+
+    @inlineCallbacks
+    def readTemperatures(self):
+        resp = yield self.query('KRDG? 0')
+        vals = [parse(val) * K for val in resp.split(',')]
+        returnValue(dict(zip(range(1, len(vals) + 1), vals)))
+
+    @inlineCallbacks
+    def getTemperatures(self, maxAge=None):
+        yield self.readings.latest(maxAge)
+        returnValue(self.cachedTemperatures())
+
+    def cachedTemperatures(self):
+        return [self.readings[ch][0] for ch in sorted(self.readings)]
+
+    def shutdown(self):
+        self.readings.stop()
+
+
 class LakeshoreDiodeServer(GPIBManagedServer):
     name = 'Lakeshore Diodes'
     deviceName = 'LSCI MODEL218S'
-    deviceWrapper = GPIBDeviceWrapper
+    deviceWrapper = DiodeWrapper
+
+    onNewTemperatures = Signal(218100, 'signal: new temperatures', '*v[K]')
+
+    def expireContext(self, c):
+        for dev in self.devices.values():
+            dev.readings.unsubscribe(c.ID)
+        GPIBManagedServer.expireContext(self, c)
 
-    @setting(10, 'Temperatures', returns=['*v[K]'])
-    def temperatures(self, c):
+    @setting(10, 'Temperatures', maxAge='v[s]', returns=['*v[K]'])
+    def temperatures(self, c, maxAge=None):
         """Read channel temperatures.
 
-        Returns a ValueList of the channel temperatures in Kelvin.
+        Returns a ValueList of the channel temperatures in Kelvin. They are
+        read again only if the last reading, by any client, is older than
+        maxAge (by default the device's Max Age).
         """
         dev = self.selectedDevice(c)
-        resp = yield dev.query('KRDG? 0')
-        vals = [parse(val) * K for val in resp.split(',')]
+        if maxAge is not None:
+            maxAge = maxAge['s']
+        vals = yield dev.getTemperatures(maxAge)
         returnValue(vals)
 
     @setting(11, 'Voltages', returns=['*v[V]'])
@@ -76,6 +112,39 @@ class LakeshoreDiodeServer(GPIBManagedServer):
         vals = [parse(val) * V for val in resp.split(',')]
         returnValue(vals)
 
+    @setting(20, 'Max Age', maxAge='v[s]', returns='v[s]')
+    def max_age(self, c, maxAge=None):
+        """Get/set how old readings may be, to answer Temperatures."""
+        dev = self.selectedDevice(c)
+        if maxAge is not None:
+            dev.readings.maxAge = maxAge['s']
+        return dev.readings.maxAge * s
+
+    @setting(30, 'Subscribe', minPeriod='v[s]', returns='')
+    def subscribe(self, c, minPeriod):
+        """Get 'new temperatures' messages in this context, at most once
+        every minPeriod, instead of polling Temperatures.
+
+        The temperatures are read for the subscribers, but not more often
+        than Max Age.
+        """
+        dev = self.selectedDevice(c)
+
+        def notify(key):
+            self.onNewTemperatures(dev.cachedTemperatures(), key)
+        dev.readings.subscribe(c.ID, minPeriod['s'], notify)
+
+    @setting(31, 'Unsubscribe', returns='')
+    def unsubscribe(self, c):
+        """Stop 'new temperatures' messages in this context."""
+        self.selectedDevice(c).readings.unsubscribe(c.ID)
+
+    @setting(32, 'Cache Statistics', returns='*(sw)')
+    def cache_statistics(self, c):
+        """Get the number of instrument queries made and saved by the
+        cache of readings, messages to subscribers, and subscribers."""
+        return self.selectedDevice(c).readings.statistics()
+
 
 __server__ = LakeshoreDiodeServer()
 
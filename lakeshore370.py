@@ -77,12 +77,18 @@
 
 # Also note that the read order for a given device now can be stored in the
 # registry as well. If not, it defaults to [1, 2, 1, 3, 1, 4, 1, 5]
+#
+# The read order sets the priority of each channel: how often it is read
+# relative to the others, e.g. 4 for channel 1 in the default order. The
+# channels are not read in that order, but by a ScanScheduler, which also
+# reads channels more often while their resistance changes quickly. See the
+# Scan Schedule and Scan Priority settings.
 
 """
 ### BEGIN NODE INFO
 [info]
 name = Lakeshore RuOx
-version = 2.6.1
+version = 2.8.0
 description = 
 
 [startup]
@@ -97,16 +103,19 @@ timeout = 20
 
 from datetime import datetime
 import math
+import time
 
 from twisted.python import log
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad import types as T, util, units as U
-from labrad.server import setting
+from labrad.server import Signal, setting
 from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
 import labrad.units as units
 import numpy as np
 
+from reading_cache import ReadingCache
+
 Ohm, K, s = [U.Unit(s) for s in ['Ohm', 'K', 's']]
 
 READ_ORDER = [1, 2, 1, 3, 1, 4, 1, 5]
@@ -127,6 +136,237 @@ def temp2res(t):
     except Exception:
         return units.Ohm * 0.0
 
+
+def finite(x):
+    """Replace the results of failed conversions (nan, inf) by 0."""
+    x = np.asarray(x, dtype=float)
+    return np.where(np.isfinite(x), x, 0.0)
+
+
+class ArrayMath(object):
+    """The math module, for calibration functions evaluated on arrays."""
+    def __getattr__(self, name):
+        f = getattr(np, name, None)
+        return f if f is not None else getattr(math, name)
+
+
+class Calibration(object):
+    """Converts resistances, in Ohm, to temperatures, in K, and back.
+
+    temperatures(r) and resistances(t) take and return arrays of floats,
+    with 0 where the conversion fails. This is the server default,
+    res2temp and temp2res.
+    """
+    kind = DEFAULT
+
+    def temperatures(self, r):
+        with np.errstate(all='ignore'):
+            return finite(((np.log(r) - 6.02) / 1.76) ** (-1/.345))
+
+    def resistances(self, t):
+        with np.errstate(all='ignore'):
+            return finite(np.exp(1.76*(np.asarray(t, dtype=float)**(-0.345))
+                                 + 6.02))
+
+    def __str__(self):
+        return "DEFAULT"
+
+
+class InterpolationCalibration(Calibration):
+    """Log-log interpolation of a table of resistances and temperatures."""
+    kind = INTERPOLATION
+
+    def __init__(self, res, temp):
+        res = np.asarray(res, dtype=float)
+        temp = np.asarray(temp, dtype=float)
+        order = np.argsort(res)
+        self.res, self.temp = res[order], temp[order]
+        self.logR, self.logT = np.log(self.res), np.log(self.temp)
+        inverse = np.argsort(self.logT)
+        self.invLogT, self.invLogR = self.logT[inverse], self.logR[inverse]
+
+    def temperatures(self, r):
+        with np.errstate(all='ignore'):
+            return finite(np.exp(np.interp(np.log(r), self.logR, self.logT)))
+
+    def resistances(self, t):
+        with np.errstate(all='ignore'):
+            return finite(np.exp(np.interp(np.log(t), self.invLogT,
+                                           self.invLogR)))
+
+    def __str__(self):
+        return "INTERPOLATION --  Resistances: %s -- Temperatures: %s" % \
+            (self.res, self.temp)
+
+
+class VRHCalibration(Calibration):
+    """Variable-range hopping: T = T0 / ln(R0/R)**4."""
+    kind = VRHOPPING
+
+    def __init__(self, R0, T0):
+        self.R0 = R0['Ohm'] if hasattr(R0, 'unit') else float(R0)
+        self.T0 = T0['K'] if hasattr(T0, 'unit') else float(T0)
+
+    def temperatures(self, r):
+        with np.errstate(all='ignore'):
+            return finite(self.T0 / np.log(self.R0 / np.asarray(r))**4)
+
+    def resistances(self, t):
+        with np.errstate(all='ignore'):
+            return finite(self.R0 * np.exp((self.T0 / np.asarray(t))**.25))
+
+    def __str__(self):
+        return "Variable-range hopping model: r0: %s, t0: %s" % \
+            (self.R0 * Ohm, self.T0 * K)
+
+
+class FunctionCalibration(Calibration):
+    """Python expressions of r, in Ohm, and of t, in K, for the inverse.
+
+    The expressions are compiled once, and evaluated on arrays, with the
+    functions of the math module taken from numpy where it has them. An
+    expression that can't be evaluated on arrays is evaluated one value at
+    a time, and values it fails for read 0. Both are reported once for each
+    expression.
+    """
+    kind = FUNCTION
+
+    def __init__(self, function, inverse):
+        self.function, self.inverse = function, inverse
+        self.code = compile(function, '<calibration>', 'eval')
+        self.inverseCode = compile(inverse, '<calibration inverse>', 'eval')
+        self.warned = set()
+
+    def warn(self, code, problem, e):
+        if (code, problem) not in self.warned:
+            self.warned.add((code, problem))
+            expression = self.function if code is self.code else self.inverse
+            print "WARNING: calibration %r %s: %s" % (expression, problem, e)
+
+    def evaluate(self, code, name, x):
+        x = np.asarray(x, dtype=float)
+        try:
+            with np.errstate(all='ignore'):
+                y = eval(code, {'math': ArrayMath(), 'np': np}, {name: x})
+            return finite(np.broadcast_to(y, x.shape))
+        except Exception as e:
+            self.warn(code, 'is evaluated one value at a time', e)
+            y = []
+            for v in x.flat:
+                try:
+                    y.append(eval(code, {'math': math, 'np': np},
+                                  {name: float(v)}))
+                except Exception as e:
+                    self.warn(code, 'failed, reading 0', e)
+                    y.append(0.0)
+            return finite(np.reshape(y, x.shape))
+
+    def temperatures(self, r):
+        return self.evaluate(self.code, 'r', r)
+
+    def resistances(self, t):
+        return self.evaluate(self.inverseCode, 't', t)
+
+    def __str__(self):
+        return "FUNCTION: %s -- Inverse: %s" % (self.function, self.inverse)
+
+
+DEFAULT_CALIBRATION = Calibration()
+
+
+class ScanScheduler(object):
+    """Chooses the channel to read next.
+
+    Each channel has a priority: how often it is read, relative to the
+    others, while its readings don't change. A channel whose resistance
+    changes quickly is read more often: its weight is its priority times
+    1 + rate / rateScale, where rate is a moving average of |d ln R/dt|.
+    Channels are read in proportion to their weights, interleaved (smooth
+    weighted round robin: each channel gains its weight in credit at every
+    reading, and the one with the most credit is read and pays the total
+    weight). Channels with priority 0 are not read.
+    """
+    # relative change per s that doubles the weight of a channel
+    rateScale = 1e-3
+    # weight of the newest rate in the moving average
+    smoothing = 0.3
+
+    def __init__(self, readOrder, clock=time.time):
+        self.clock = clock
+        self.order = []
+        for ch in readOrder:
+            if ch not in self.order:
+                self.order.append(ch)
+        self.priorities = dict((ch, float(readOrder.count(ch)))
+                               for ch in self.order)
+        self.rates = dict.fromkeys(self.order, 0.0)
+        self.visits = dict.fromkeys(self.order, 0)
+        self.credits = dict.fromkeys(self.order, 0.0)
+        # channel -> (time, resistance) of the last reading
+        self.last = {}
+
+    def setPriority(self, channel, priority):
+        if channel not in self.priorities:
+            self.order.append(channel)
+            self.rates[channel] = 0.0
+            self.visits[channel] = 0
+            self.credits[channel] = 0.0
+        self.priorities[channel] = float(priority)
+
+    def weight(self, channel):
+        return self.priorities[channel] * \
+            (1 + self.rates[channel] / self.rateScale)
+
+    def pick(self, credits):
+        channels = [ch for ch in self.order if self.priorities[ch] > 0]
+        if not channels:
+            return None
+        weights = [self.weight(ch) for ch in channels]
+        for ch, w in zip(channels, weights):
+            credits[ch] += w
+        best = max(channels, key=lambda ch: (credits[ch],
+                                             -self.order.index(ch)))
+        credits[best] -= sum(weights)
+        return best
+
+    def next(self):
+        """The channel to read next, or None if there is none."""
+        return self.pick(self.credits)
+
+    def record(self, channel, resistance):
+        """Record a reading of channel, in Ohm."""
+        now = self.clock()
+        if channel not in self.priorities:
+            self.setPriority(channel, 0)
+        if channel in self.last:
+            t, r = self.last[channel]
+            if now > t and r > 0 and resistance > 0:
+                rate = abs(math.log(resistance / r)) / (now - t)
+                self.rates[channel] += self.smoothing * \
+                    (rate - self.rates[channel])
+        self.last[channel] = now, resistance
+        self.visits[channel] += 1
+
+    def schedule(self, n):
+        """The next n channels to read, if the rates stay as they are."""
+        credits = dict(self.credits)
+        channels = []
+        for i in range(n):
+            ch = self.pick(credits)
+            if ch is None:
+                break
+            channels.append(ch)
+        return channels
+
+    def rows(self):
+        """(channel, priority, rate, time since read, readings) of each
+        channel."""
+        now = self.clock()
+        return [(long(ch), self.priorities[ch], self.rates[ch],
+                 (now - self.last[ch][0] if ch in self.last else 0.0) * s,
+                 long(self.visits[ch]))
+                for ch in self.order]
+
 class RuOxWrapper(GPIBDeviceWrapper):
     
     @inlineCallbacks
@@ -134,6 +374,8 @@ class RuOxWrapper(GPIBDeviceWrapper):
         """Set up initial state for this wrapper"""
         self.alive = False
         self.onlyChannel = 0
+        # readings of the channels, taken by readLoop, for all contexts
+        self.readings = ReadingCache()
         print "Initializing %s" % self.name
         yield self.loadDeviceInformation()
         # also we should set the box settings here
@@ -188,14 +430,10 @@ class RuOxWrapper(GPIBDeviceWrapper):
         path = directory where registry keys are. For example:
         ["", "Servers", "Lakeshore 370", "GPIB1::12", "Channel 1"]
         
-        Returns a list: [regType, parameters...]
-        
-        For regType == DEFAULT there are no parameters and len(returnValue) = 1
-        For regType == FUNCTION, the returnValue [1] is a string of python code
-        to be eval'd in a place where r (float) is a resistance, in ohms, and
-        returnValue[2] is the inverse of the function, where t (float) is a
-        temp, in kelvin for regType == INTERPOLATION, then returnValue[1] is a
-        list of resistances for interpolation, and returnValue[2] is a list of
+        Returns a Calibration, with kind DEFAULT if there is none at path.
+        For FUNCTION, the function is python code of r (float), a resistance
+        in ohms, and the inverse is code of t (float), a temp, in kelvin.
+        For INTERPOLATION, there are a list of resistances and a list of
         temperatures.
         """
         try:
@@ -209,51 +447,35 @@ class RuOxWrapper(GPIBDeviceWrapper):
                 p.get("Resistances", key="res")
                 p.get("Temperatures", key="temp")
                 ans = yield p.send()
-                calOrder = np.argsort(ans.res)
-                returnValue([INTERPOLATION, np.array(ans.res)[calOrder], np.array(ans.temp)[calOrder]])
+                returnValue(InterpolationCalibration(ans.res, ans.temp))
             elif ans.type.upper() == "FUNCTION":
                 p = reg.packet()
                 p.cd(path)
                 p.get("Function", key="fun")
                 p.get("Inverse", key="inv")
                 ans = yield p.send()
-                returnValue([FUNCTION, ans.fun, ans.inv])
+                returnValue(FunctionCalibration(ans.fun, ans.inv))
             elif ans.type.upper() == "VRHOPPING":
                 p = reg.packet()
                 p.cd(path)
                 p.get("R0", key='res')
                 p.get("T0", key='temp')
                 ans = yield p.send()
-                returnValue([VRHOPPING, ans.res, ans.temp])
+                returnValue(VRHCalibration(ans.res, ans.temp))
             else:
-                returnValue([DEFAULT])
+                returnValue(DEFAULT_CALIBRATION)
         except Exception as e:
             print e
-            returnValue([DEFAULT])
+            returnValue(DEFAULT_CALIBRATION)
     
     def printCalibration(self, channel):
-        str = ''
         try:
-            if self.calibrations[channel][0] == INTERPOLATION:
-                str = "INTERPOLATION --  Resistances: %s -- Temperatures: %s"%\
-                (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == VRHOPPING:
-                str = "Variable-range hopping model: r0: %s, t0: %s" % (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == FUNCTION:
-                str = "FUNCTION: %s -- Inverse: %s" %\
-                (self.calibrations[channel][1], self.calibrations[channel][2])
-            elif self.calibrations[channel][0] == DEFAULT:
-                str = "DEFAULT"
-            else:
-                raise Exception('Invalid calibration for channel %s: "%s"' %\
-                                   (channel, str))
+            return str(self.calibrations[channel])
         except Exception as e:
-            str += e.__str__()
-            
-        return str
+            return e.__str__()
     
     @inlineCallbacks
-    def reloadCalibrations(self, dir):
+    def reloadCalibrations(self, dir=None):
         """Load read order and resistance->temperature function from registry
         
         There are actually multiple functions--one for each channel, and a
@@ -262,6 +484,8 @@ class RuOxWrapper(GPIBDeviceWrapper):
         self.calibrations[1-N] for channels 1-N. See docstring for
         loadSingleCalibration
         """
+        if dir is None:
+            dir = self.getRegistryPath()
         self.calibrations = []
         self.readOrder = []
         reg = self.gpib._cxn.registry
@@ -276,22 +500,21 @@ class RuOxWrapper(GPIBDeviceWrapper):
             self.readOrder = READ_ORDER
         
         # initialize the readings variable.
-        # len(set(x)) gets the number of unique elements in x
-        self.readings = {}
-        for channel in self.readOrder:
-            self.readings[channel] = (0*Ohm, datetime.now())
+        self.readings.reset(dict((channel, (0*Ohm, datetime.now()))
+                                 for channel in self.readOrder))
+        self.scheduler = ScanScheduler(self.readOrder)
         
         # now start with the calibrations
         # first get the default one
         calib = yield self.loadSingleCalibration(reg, dir)
         self.calibrations.append(calib)
-        if self.calibrations[0][0] == DEFAULT:
+        if self.calibrations[0].kind == DEFAULT:
             print "WARNING: %s -- no calibration found for device default. Using server default calibration." % (self.addr)
-        elif self.calibrations[0][0] == INTERPOLATION:
+        elif self.calibrations[0].kind == INTERPOLATION:
             print "%s -- found INTERPOLATION calibration for device default." % (self.addr)
-        elif self.calibrations[0][0] == VRHOPPING:
+        elif self.calibrations[0].kind == VRHOPPING:
             print "%s -- found VRHOPPING calibration for device default." % (self.addr,)
-        elif self.calibrations[0][0] == FUNCTION:
+        elif self.calibrations[0].kind == FUNCTION:
             print "%s -- found FUNCTION calibration for device default." % (self.addr)
         else:
             raise Exception("Calibration loader messed up. This shouldn't have happened.")
@@ -299,19 +522,29 @@ class RuOxWrapper(GPIBDeviceWrapper):
         for i in range(max(self.readOrder)):
             calib = yield self.loadSingleCalibration(reg, dir + ['Channel %d' % (i+1)])
             self.calibrations.append(calib)
-            if self.calibrations[i+1][0] == DEFAULT:
+            if self.calibrations[i+1].kind == DEFAULT:
                 print "WARNING: %s -- no calibration found for channel %d. Using device default calibration." % (self.addr, i+1)
-            elif self.calibrations[i+1][0] == INTERPOLATION:
+            elif self.calibrations[i+1].kind == INTERPOLATION:
                 print "%s -- found INTERPOLATION calibration for channel %d." % (self.addr, i+1)
-            elif self.calibrations[i+1][0] == VRHOPPING:
+            elif self.calibrations[i+1].kind == VRHOPPING:
                 print "%s -- found VRHOPPING calibration for channel %d." % (self.addr, i+1)
-            elif self.calibrations[i+1][0] == FUNCTION:
+            elif self.calibrations[i+1].kind == FUNCTION:
                 print "%s -- found FUNCTION calibration for channel %d." % (self.addr, i+1)
             else:
                 raise Exception("Calibration loader messed up. This shouldn't have happened.")
     
+    def calibration(self, calIndex):
+        """The calibration for a channel, or 0 for the device: its own,
+        or else the device default, or else the server default."""
+        for i in (calIndex, 0):
+            if i < len(self.calibrations) and \
+                    self.calibrations[i].kind != DEFAULT:
+                return self.calibrations[i]
+        return DEFAULT_CALIBRATION
+    
     def shutdown(self):
         self.alive = False
+        self.readings.stop()
     
     @inlineCallbacks
     def selectChannel(self, channel):
@@ -347,90 +580,61 @@ class RuOxWrapper(GPIBDeviceWrapper):
         yield self.write('PID %f, %f, %f' % (P, I, D))
     
     @inlineCallbacks
-    def readLoop(self, idx=0):
+    def readLoop(self):
         while self.alive:
             # read only one specific channel
             if self.onlyChannel > 0:
                 chan = self.onlyChannel
                 yield util.wakeupCall(self.settleTime['s'])
-                r = yield self.query('RDGR? %d' % chan)
-                self.readings[chan] = float(r)*Ohm, datetime.now()
             # scan over channels
             else:
-                if len(self.readOrder) > 0:
-                    chan = self.readOrder[idx]
-                else:
+                chan = self.scheduler.next()
+                if chan is None:
                     yield util.wakeupCall(self.settleTime['s'])
                     continue
                 yield self.selectChannel(chan)
                 yield util.wakeupCall(self.settleTime['s'])
-                r = yield self.query('RDGR? %d' % chan)
-                self.readings[chan] = float(r)*Ohm, datetime.now()
-                idx = (idx + 1) % len(self.readOrder)
+            r = yield self.query('RDGR? %d' % chan)
+            self.readings.queries += 1
+            self.readings[chan] = float(r)*Ohm, datetime.now()
+            self.scheduler.record(chan, float(r))
     
     def getSingleTemp(self, channel, calIndex=-1):
         """Get a single temperature for a given channel
         
         Use that channel's calibration, or if it's default, the device
-        calibration (and if that's zero, the default function) the first
-        argument is the channel the second argument is the channel to use for
-        the calibration, where 0 means use device default calibration if we
-        don't find a calibration on the given channel, we try again with 0 if
-        that doesn't work, we use the old-fashioned res2temp.
+        calibration (and if that's default too, the old-fashioned res2temp).
+        The second argument is the channel to use for the calibration, where
+        0 means use the device calibration.
         """
         if calIndex == -1:
             calIndex = channel
-        try:
-            #print("lakeshore370: Computing temperature for channel %d"%channel)
-            #print("Resistance is %s"%str(self.readings[channel][0]))
-            #print("Calibration type %s" % (self.calibrations[calIndex][0],))
-            #print self.calibrations[calIndex]
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # log-log interpolation
-                return (np.exp(np.interp(np.log(self.readings[channel][0]['Ohm']),
-                              np.log(np.array(self.calibrations[calIndex][1])),
-                              np.log(np.array(self.calibrations[calIndex][2]))
-                              ))) * K
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                T0 = self.calibrations[calIndex][2]
-                R0 = self.calibrations[calIndex][1]
-                res = self.readings[channel][0]
-                T = T0 / (np.log(R0/res)**4)
-                return T
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # hack alert--using eval is bad:
-                # (1) This depends on the function string being good python
-                #     code.
-                # (2) It also depends on it having "r" as the variable for 
-                #     resistance, in ohms.
-                # (3) very unsafe if anyone ever hacks the registry. of course,
-                #     then we have bigger problems
-                r = self.readings[channel][0][units.Ohm]
-                return eval(self.calibrations[calIndex][1]) * units.K
-            elif self.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    # use calibration 0--the device calibration
-                    return self.getSingleTemp(channel, 0) 
-                else:
-                    #If there is no calibration at all use res2temp
-                    return res2temp(self.readings[channel][0])
-        except Exception as e:
-            print "Exception getting temperature: ", e
-            return 0.0*K
+        r = self.readings[channel][0]['Ohm']
+        return float(self.calibration(calIndex).temperatures(r)) * K
+    
+    def temperatureArray(self, channels):
+        """Temperatures, in K, of the channels.
+
+        The channels that share a calibration are converted in one call.
+        """
+        r = np.array([self.readings[ch][0]['Ohm'] for ch in channels])
+        temps = np.zeros(len(channels))
+        groups = {}
+        for i, ch in enumerate(channels):
+            groups.setdefault(self.calibration(ch), []).append(i)
+        for calibration, idx in groups.items():
+            temps[idx] = calibration.temperatures(r[idx])
+        return temps
     
     def getTemperatures(self):
-        # we now do this channel by channel. oh yeah.
-        result = []
-        for channel in sorted(self.readings.keys()):
-            result.append((self.getSingleTemp(channel), self.readings[channel][1]))
-        return result
+        channels = sorted(self.readings.keys())
+        temps = self.temperatureArray(channels)
+        return [(t * K, self.readings[ch][1]) for ch, t in zip(channels, temps)]
     
     def getNamedTemperatures(self):
-        # we now do this channel by channel. oh yeah.
-        result = []
-        for channel in sorted(self.readings.keys()):
-            result.append((self.channelNames[channel-1],(self.getSingleTemp(channel), self.readings[channel][1])))
-        return result
+        channels = sorted(self.readings.keys())
+        names = [self.channelNames[ch-1] for ch in channels]
+        return zip(names, self.getTemperatures())
     
     def getResistances(self):
         result = []
@@ -453,32 +657,20 @@ class RuOxWrapper(GPIBDeviceWrapper):
         """
         if calIndex == -1:
             calIndex = channel
-        try:
-            if self.calibrations[calIndex][0] == INTERPOLATION:
-                # do the log-log interpolation in reverse
-                return (np.exp(np.interp(np.log(temp),
-                                            np.log(np.array(self.calibrations[calIndex][2][::-1])),
-                                            np.log(np.array(self.calibrations[calIndex][1][::-1]))
-                                            )))
-            elif self.calibrations[calIndex][0] == VRHOPPING:
-                return self.calibrations[calIndex][1]['K'] * np.exp((self.calibrations[calIndex][2]['K']/temp)**.25)
-            elif self.calibrations[calIndex][0] == FUNCTION:
-                # same as getSingleTemp, but use inverse instead of function
-                t = temp
-                return eval(self.calibrations[calIndex][2])
-            elif eslf.calibrations[calIndex][0] == DEFAULT:
-                if calIndex > 0:
-                    return self.singleTempToRes(temp, channel, 0) # use calibration 0
-                else:
-                    return temp2res(temp) # if no calibration for the device either, use old-fashioned temp2res
-        except Exception as e:
-            print "Exception converting temp to res: %s" % e.__str__()
-            return 0.0
+        return float(self.calibration(calIndex).resistances(temp))
             
 class LakeshoreRuOxServer(GPIBManagedServer):
     name = 'Lakeshore RuOx'
     deviceName = 'LSCI MODEL370'
     deviceWrapper = RuOxWrapper
+
+    onNewTemperatures = Signal(370100, 'signal: new temperatures',
+                               '*(v[K], t)')
+
+    def expireContext(self, c):
+        for dev in self.devices.values():
+            dev.readings.unsubscribe(c.ID)
+        GPIBManagedServer.expireContext(self, c)
     
     @setting(111, "r", returns='v[Ohm]')
     def r(self, c):
@@ -497,11 +689,13 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         Returns a ValueList of the channel temperatures in Kelvin.
         """
         dev = self.selectedDevice(c)
+        dev.readings.saved += 1
         return dev.getTemperatures()
     
     @setting(11, 'Named Temperatures', returns='*(s, (v[K], t))')
     def named_temperatures(self, c):
         dev = self.selectedDevice(c)
+        dev.readings.saved += 1
         return dev.getNamedTemperatures()
     
     @setting(12, 'Resistances', returns='*(v[Ohm], t)')
@@ -511,11 +705,13 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         Returns a ValueList of the channel resistances in Ohms.
         """
         dev = self.selectedDevice(c)
+        dev.readings.saved += 1
         return dev.getResistances()
     
     @setting(13, 'Named Resistances', returns='*(s, (v[Ohm], t))')
     def named_resistances(self, c):
         dev = self.selectedDevice(c)
+        dev.readings.saved += 1
         return dev.getNamedResistances()
     
     @setting(20, 'Select channel', channel='w', returns='w')
@@ -566,6 +762,31 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         dev = self.selectedDevice(c)
         dev.reloadCalibrations()
     
+    @setting(24, 'Scan Schedule', n='w',
+             returns='*(w, v, v, v[s], w), *w')
+    def scan_schedule(self, c, n=10):
+        """Get the state of the channel scan, and the next n channels.
+
+        For each channel: (channel, priority, rate of change of ln R in 1/s,
+        time since it was read, number of readings). Channels are read in
+        proportion to priority * (1 + rate / rateScale). The next channels
+        assume that the rates stay as they are.
+        """
+        dev = self.selectedDevice(c)
+        return dev.scheduler.rows(), dev.scheduler.schedule(n)
+
+    @setting(25, 'Scan Priority', channel='w', priority='v', returns='v')
+    def scan_priority(self, c, channel, priority=None):
+        """Get/set how often a channel is read, relative to the others.
+
+        The priorities start as the number of times each channel appears
+        in the Read Order. Channels with priority 0 are not read.
+        """
+        dev = self.selectedDevice(c)
+        if priority is not None:
+            dev.scheduler.setPriority(channel, priority)
+        return dev.scheduler.priorities.get(channel, 0.0)
+
     @setting(23, 'Print Settings', returns='s')
     def print_settings(self, c):
         """Prints the settings loaded from the registry for this device."""
@@ -624,6 +845,31 @@ class LakeshoreRuOxServer(GPIBManagedServer):
         ans = yield dev.setHeaterRange(limit)
         returnValue(ans)
     
+    @setting(30, 'Subscribe', minPeriod='v[s]', returns='')
+    def subscribe(self, c, minPeriod):
+        """Get 'new temperatures' messages in this context, at most once
+        every minPeriod, instead of polling Temperatures.
+
+        A message is sent when a channel has been read again, with the
+        temperatures as returned by Temperatures.
+        """
+        dev = self.selectedDevice(c)
+
+        def notify(key):
+            self.onNewTemperatures(dev.getTemperatures(), key)
+        dev.readings.subscribe(c.ID, minPeriod['s'], notify)
+
+    @setting(31, 'Unsubscribe', returns='')
+    def unsubscribe(self, c):
+        """Stop 'new temperatures' messages in this context."""
+        self.selectedDevice(c).readings.unsubscribe(c.ID)
+
+    @setting(32, 'Cache Statistics', returns='*(sw)')
+    def cache_statistics(self, c):
+        """Get the number of channel readings taken, requests answered
+        from them, messages to subscribers, and subscribers."""
+        return self.selectedDevice(c).readings.statistics()
+
     @setting(56, 'Heater Output', returns='v[%]')
     def heateroutput(self, c):
         """Queries the current Heater Output"""
@@ -0,0 +1,104 @@
+"""Benchmark the Logger's storage: write throughput, and range queries
+through the time index compared with scanning the times of a whole day.
+
+    python log_benchmark.py --points 100000000 --channels 4 --interval 0.01
+
+writes the points (split between the channels, interval seconds apart)
+into a temporary directory, or into --dir, which is then kept.
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from log_server import DAY, Log, toMicros
+
+
+class Hub(object):
+    """Stands in for the server, which the log sends its messages to."""
+    notifyDelay = 0.1
+
+    def onNewVar(self, data, contexts=None):
+        pass
+
+    def onNewData(self, data, contexts=None):
+        pass
+
+
+def benchmark(points, channels, interval, batch, queries, window, limit,
+              directory=None):
+    root = directory or tempfile.mkdtemp(prefix='logbench')
+    try:
+        log = Log.create(('bench',), root, Hub())
+        step = int(interval * 1e6)
+        perChannel = points // channels
+        base = toMicros(datetime(2020, 1, 1))
+        start = time.time()
+        for i in range(0, perChannel, batch):
+            times = base + np.arange(i, min(i + batch, perChannel)) * step
+            values = np.random.randn(len(times))
+            for n in range(channels):
+                log['ch%d' % n].addEntries(times, values)
+        log.close()
+        elapsed = time.time() - start
+        written = perChannel * channels
+
+        log = Log(('bench',), root, Hub())
+        channel = log.channel('ch0')
+        end = base + perChannel * step
+        windows = base + np.random.randint(0, max(end - base - window, 1),
+                                           size=queries)
+        start = time.time()
+        found = 0
+        for t in windows:
+            found += len(channel.get(int(t), int(t) + window, limit)[0])
+        indexed = (time.time() - start) / queries
+
+        # the same queries, scanning the times of the day they start in
+        start = time.time()
+        for t in windows:
+            times = channel.segment(int(t) // DAY).columns()[0]
+            match = np.flatnonzero((times >= t) & (times < t + window))
+            np.array(times[match[:limit]])
+        scan = (time.time() - start) / queries
+        log.close()
+
+        print '%d points in %d channels, %g s apart, over %d days:' % \
+            (written, channels, interval, len(channel.days))
+        print '  write: %.2f M points/s (%.1f MB/s), batches of %d' % \
+            (written / elapsed / 1e6, written * 16 / elapsed / 1e6, batch)
+        print '  range query of %g s, limit %d: %.3f ms, %.1f points ' \
+            '(scanning the day: %.3f ms)' % \
+            (window / 1e6, limit, indexed * 1e3, found / float(queries),
+             scan * 1e3)
+    finally:
+        if directory is None:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the Logger storage.')
+    parser.add_argument('--points', type=float, default=1e8,
+                        help='number of points written, in all channels')
+    parser.add_argument('--channels', type=int, default=4,
+                        help='number of channels')
+    parser.add_argument('--interval', type=float, default=0.01,
+                        help='time between points of a channel, in s')
+    parser.add_argument('--batch', type=int, default=100000,
+                        help='points written to a channel at a time')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='number of range queries')
+    parser.add_argument('--window', type=float, default=60.0,
+                        help='length of the range queried, in s')
+    parser.add_argument('--limit', type=int, default=1000,
+                        help='limit of each range query')
+    parser.add_argument('--dir', default=None,
+                        help='directory to write the log into, and keep')
+    args = parser.parse_args()
+    benchmark(int(args.points), args.channels, args.interval, args.batch,
+              args.queries, int(args.window * 1e6), args.limit, args.dir)
@@ -17,8 +17,8 @@
 ### BEGIN NODE INFO
 [info]
 name = Logger
-version = 1.0
-description = Manages log files with the data vault and registry.
+version = 1.1
+description = Logs time series of values, in append-only files by day.
 
 [startup]
 cmdline = %PYTHON% %FILE%
@@ -30,61 +30,545 @@ timeout = 5
 ### END NODE INFO
 """
 
-from labrad.server import LabradServer, setting, inlineCallbacks, returnValue
-from labrad.units import degC, K, psi, torr, min as minutes, A
+import bisect
+import os
+import urllib
+from datetime import datetime, timedelta
 
-from datetime import datetime
+import numpy as np
 
-# registry (metadata about logs and nonnumeric logs)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
 
-# data vault (for logging of numerical data)
-# Logs -> {logPath} -> {YYYY} -> {MM} -> {DD}
+from labrad import util
+from labrad.errors import Error
+from labrad.server import LabradServer, Signal, setting
+from labrad.units import Value
 
-class Log(object):
-    def __new__(self):
-        pass
+# Logs are directories under the repository, one for each log path, each
+# with its channel list in log.txt and one directory per day of data:
+# {root} -> {logPath} -> {YYYY} -> {MM} -> {DD}
+#
+# Each channel has an append-only segment per day in the day's directory:
+# {channel}.t holds the times of its entries, as int64 microseconds since
+# 1970 (local time), and {channel}.v the values, as a column in the type of
+# the channel. Text channels keep the end offset of each entry in the
+# {channel}.v bytes in {channel}.o. The times of a channel only increase,
+# so a range of entries is found by bisecting the days that have data, and
+# then the times of the first and last day.
+
+EPOCH = datetime(1970, 1, 1)
+DAY = 86400 * 10**6 # in microseconds
+INDEX = 'log.txt'
+
+# column dtype of each channel type
+DTYPES = {'v': '<f8', 'i': '<i8', 'b': '?', 's': None}
+
+
+class NoLogOpenError(Error):
+    """No log opened in this context."""
+    code = 1
+
+
+class NoSuchLogError(Error):
+    """Log does not exist."""
+    code = 2
+
+
+class NoSuchChannelError(Error):
+    """Channel does not exist in this log."""
+    code = 3
+
+
+class ChannelTypeError(Error):
+    """Value does not match the type of the channel."""
+    code = 4
+
+
+def toMicros(t):
+    """Microseconds since 1970 of a datetime."""
+    d = t - EPOCH
+    return (d.days * 86400 + d.seconds) * 10**6 + d.microseconds
+
+
+def fromMicros(us):
+    return EPOCH + timedelta(microseconds=int(us))
+
+
+def dayDir(day):
+    """Directory of a day's segments, relative to its log."""
+    t = fromMicros(day * DAY)
+    return os.path.join('%04d' % t.year, '%02d' % t.month, '%02d' % t.day)
+
+
+def channelType(value):
+    """The type of a channel, from the first value logged on it."""
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, (int, long)):
+        return 'i'
+    if isinstance(value, Value):
+        return 'v[%s]' % value.unit
+    if isinstance(value, float):
+        return 'v'
+    if isinstance(value, basestring):
+        return 's'
+    raise ChannelTypeError('Cannot log values of type %s'
+                           % type(value).__name__)
+
+
+def increasing(times, last):
+    """Times, moved forward where needed so that each is after the last."""
+    n = np.arange(len(times))
+    times = np.asarray(times, dtype='<i8') - n
+    if last is not None:
+        times[0] = max(times[0], last + 1)
+    return np.maximum.accumulate(times) + n
+
+
+class Segment(object):
+    """One day of entries of a channel, appended to files path.t, path.v
+    (and path.o for text) which are memory mapped for reading."""
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = dtype
+        self.files = None
+        self.cache = None
+        self.count = 0
+        self.last = None
+        self.end = 0
+        if os.path.exists(path + '.t'):
+            self.count = os.path.getsize(path + '.t') // 8
+            if self.count:
+                self.last = int(self.read(self.count - 1, self.count)[0][0])
+            if dtype is None:
+                self.end = os.path.getsize(path + '.v')
+
+    def append(self, times, values):
+        if self.files is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            exts = ['.t', '.v'] + (['.o'] if self.dtype is None else [])
+            self.files = [open(self.path + ext, 'ab') for ext in exts]
+        self.files[0].write(times.tostring())
+        if self.dtype is None:
+            ends = self.end + np.cumsum([len(v) for v in values], dtype='<i8')
+            self.files[1].write(''.join(values))
+            self.files[2].write(ends.tostring())
+            self.end = int(ends[-1])
+        else:
+            self.files[1].write(np.asarray(values, self.dtype).tostring())
+        self.count += len(times)
+        self.last = int(times[-1])
+
+    def flush(self):
+        if self.files is not None:
+            for f in self.files:
+                f.flush()
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+            self.files = None
+        self.cache = None
+
+    def columns(self):
+        """The times and values (or text end offsets) columns."""
+        if self.cache is None or len(self.cache[0]) != self.count:
+            self.flush()
+            if self.count:
+                second = ('.v', self.dtype) if self.dtype else ('.o', '<i8')
+                self.cache = (
+                    np.memmap(self.path + '.t', '<i8', 'r', shape=(self.count,)),
+                    np.memmap(self.path + second[0], second[1], 'r',
+                              shape=(self.count,)))
+            else:
+                self.cache = (np.zeros(0, '<i8'), np.zeros(0))
+        return self.cache
+
+    def search(self, start, end=None):
+        """Index range of the entries from start up to, not including, end."""
+        times = self.columns()[0]
+        i = np.searchsorted(times, start) if start is not None else 0
+        j = np.searchsorted(times, end) if end is not None else len(times)
+        return int(i), int(j)
+
+    def read(self, i, j):
+        times, values = self.columns()
+        if j <= i:
+            return np.zeros(0, '<i8'), [] if self.dtype is None else \
+                np.zeros(0, self.dtype)
+        times = np.array(times[i:j])
+        if self.dtype is not None:
+            return times, np.array(values[i:j])
+        ends = np.array(values[max(i-1, 0):j])
+        first = int(ends[0]) if i else 0
+        with open(self.path + '.v', 'rb') as f:
+            f.seek(first)
+            data = f.read(int(ends[-1]) - first if len(ends) else 0)
+        starts = np.hstack(([first], ends[:-1]))[-len(times):] - first
+        stops = ends[-len(times):] - first
+        return times, [data[a:b] for a, b in zip(starts, stops)]
 
-    def __getitem__(self, key):
-        """Get or create a variable with the specified key."""
 
 class Channel(object):
-    def __new__(self):
-        pass
-    
-    def __init__(self):
-        pass
+    """A variable in a log, with a segment for each day it has data.
+
+    The type of a channel is set by the first value logged on it: 'v' or
+    'v[unit]' for numbers, 'i' for integers, 'b' for booleans and 's' for
+    text.
+    """
+
+    def __init__(self, log, name, type=None):
+        self.log = log
+        self.name = name
+        self.file = urllib.quote(name, safe='')
+        self.type = None
+        self.segments = {}
+        self.days = []
+        if type is not None:
+            self.setType(type)
+            self.days = [day for day in log.days if os.path.exists(
+                    os.path.join(log.directory, dayDir(day), self.file + '.t'))]
+
+    def setType(self, type):
+        self.type = type
+        self.unit = type[2:-1] if type.startswith('v[') else None
+        self.dtype = DTYPES[type[0]]
+
+    def segment(self, day):
+        if day not in self.segments:
+            path = os.path.join(self.log.directory, dayDir(day), self.file)
+            self.segments[day] = Segment(path, self.dtype)
+        return self.segments[day]
+
+    @property
+    def start(self):
+        if self.days:
+            return self.segment(self.days[0]).read(0, 1)[0][0]
+
+    @property
+    def last(self):
+        if self.days:
+            return self.segment(self.days[-1]).last
+
+    def convert(self, values):
+        """The values for the column of this channel."""
+        kind = channelType(values[0])
+        if self.type is None:
+            self.setType(kind)
+            self.log.addChannel(self)
+        try:
+            if self.unit is not None:
+                return [v[self.unit] for v in values]
+            if kind[0] != self.type[0] and (kind, self.type) != ('i', 'v'):
+                raise TypeError()
+            if self.type == 's':
+                return [str(v) for v in values]
+            return values
+        except (TypeError, ValueError, AttributeError):
+            raise ChannelTypeError('Cannot log %r on channel %s of type %s'
+                                   % (values[0], self.name, self.type))
 
     def addEntry(self, time, value):
         """Add an entry for this channel."""
+        self.addEntries([toMicros(time)], [value])
+
+    def addEntries(self, times, values):
+        """Add entries, with times in microseconds since 1970.
+
+        The times of a channel only increase: entries logged at or before
+        the last one are moved to 1 us after it.
+        """
+        if not len(times):
+            return
+        values = self.convert(values)
+        times = increasing(times, self.last)
+        days = times // DAY
+        splits = np.flatnonzero(np.diff(days)) + 1
+        for i, j in zip(np.hstack(([0], splits)), np.hstack((splits, [len(times)]))):
+            day = int(days[i])
+            if not self.days or self.days[-1] != day:
+                if self.days:
+                    self.segment(self.days[-1]).close()
+                self.days.append(day)
+                self.log.addDay(day)
+            self.segment(day).append(times[i:j], values[i:j])
+        self.log.dataAdded(self)
+
+    def get(self, start, end=None, limit=None):
+        """Times and values of the entries from start up to, but not
+        including, end, at most limit of them."""
+        lo = bisect.bisect_left(self.days, start // DAY)
+        if end is None:
+            hi = len(self.days)
+        else:
+            hi = bisect.bisect_right(self.days, (end - 1) // DAY)
+        times, values = [], []
+        count = 0
+        for day in self.days[lo:hi]:
+            segment = self.segment(day)
+            i, j = segment.search(start, end)
+            if limit is not None:
+                j = min(j, i + limit - count)
+            if j > i:
+                t, v = segment.read(i, j)
+                times.append(t)
+                values.append(v)
+                count += j - i
+            if limit is not None and count >= limit:
+                break
+        if not times:
+            return np.zeros(0, '<i8'), []
+        return np.hstack(times), [x for vs in values for x in vs]
+
+    def hasMore(self, after, end=None):
+        """Whether there are entries from after up to end."""
+        last = self.last
+        if last is None or last < after:
+            return False
+        return end is None or len(self.get(after, end, limit=1)[0]) > 0
+
+    def entries(self, times, values):
+        """Entries as (time, value) clusters, as returned by 'get'."""
+        if self.unit is not None:
+            values = [Value(v, self.unit) for v in values]
+        elif self.type != 's':
+            values = np.asarray(values).tolist()
+        return [(fromMicros(t), v) for t, v in zip(times, values)]
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+
+class Log(object):
+    """A log, with its channels, stored in directory.
+
+    Streaming contexts wait for data from some of the channels. The first
+    entries added to any of them, after a context has read to the end,
+    send it a single 'new data' message, delayed by notifyDelay to coalesce
+    messages for data logged soon after.
+    """
+
+    def __init__(self, path, directory, hub, reactor=reactor):
+        self.path = path
+        self.directory = directory
+        self.hub = hub
+        self.reactor = reactor
+        self.channels = {}
+        self.order = []
+        self.days = []
+        self.listeners = {}
+        self.pending = set()
+        self.notifyCall = None
+        self.created = None
+        with open(os.path.join(directory, INDEX)) as f:
+            for line in f:
+                words = line.split()
+                if words[0] == 'created':
+                    self.created = int(words[1])
+                elif words[0] == 'channel':
+                    name = urllib.unquote(words[2])
+                    self.channels[name] = None
+                    self.order.append((name, words[1]))
+        for year in self.subdirs(directory, 4):
+            for month in self.subdirs(os.path.join(directory, year), 2):
+                for day in self.subdirs(os.path.join(directory, year, month), 2):
+                    t = datetime(int(year), int(month), int(day))
+                    self.days.append(toMicros(t) // DAY)
+        self.days.sort()
+        for name, type in self.order:
+            self.channels[name] = Channel(self, name, type)
+
+    @staticmethod
+    def subdirs(directory, digits):
+        return [name for name in os.listdir(directory)
+                if len(name) == digits and name.isdigit()
+                and os.path.isdir(os.path.join(directory, name))]
+
+    @classmethod
+    def create(cls, path, directory, hub, reactor=reactor):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, INDEX), 'a') as f:
+            f.write('created %d\n' % toMicros(datetime.now()))
+        return cls(path, directory, hub, reactor)
+
+    def __getitem__(self, key):
+        """Get or create a variable with the specified key."""
+        if key not in self.channels:
+            self.channels[key] = Channel(self, key)
+        return self.channels[key]
+
+    def channel(self, name):
+        """An existing channel of this log."""
+        channel = self.channels.get(name)
+        if channel is None or channel.type is None:
+            raise NoSuchChannelError('No channel %s in log %s'
+                                     % (name, '/'.join(self.path)))
+        return channel
+
+    def addChannel(self, channel):
+        """Record a new channel, once its type is known."""
+        with open(os.path.join(self.directory, INDEX), 'a') as f:
+            f.write('channel %s %s\n' % (channel.type, channel.file))
+        self.order.append((channel.name, channel.type))
+        self.hub.onNewVar(('/'.join(self.path), channel.name))
+
+    def addDay(self, day):
+        if day not in self.days:
+            bisect.insort(self.days, day)
+
+    def describe(self):
+        """The start and last times of the log, and the name, type, start
+        and last times of each channel."""
+        channels = []
+        for name, type in self.order:
+            channel = self.channels[name]
+            start, last = channel.start, channel.last
+            if start is None:
+                start = last = self.created
+            channels.append((name, type, fromMicros(start), fromMicros(last)))
+        times = [toMicros(t) for ch in channels for t in ch[2:]]
+        start = min(times) if times else self.created
+        last = max(times) if times else self.created
+        return fromMicros(start), fromMicros(last), channels
+
+    def keepStreaming(self, context, waiting, more):
+        """Send context a message when there is data for it to read: now if
+        there is more already, otherwise once the channels in waiting get
+        new entries."""
+        self.listeners.pop(context, None)
+        if more:
+            self.hub.onNewData(None, [context])
+        elif waiting:
+            self.listeners[context] = set(waiting)
+
+    def dataAdded(self, channel):
+        for context, waiting in self.listeners.items():
+            if channel.name in waiting:
+                del self.listeners[context]
+                self.pending.add(context)
+        if self.pending and self.notifyCall is None:
+            self.notifyCall = self.reactor.callLater(self.hub.notifyDelay,
+                                                     self.notify)
+
+    def notify(self):
+        self.notifyCall = None
+        contexts, self.pending = self.pending, set()
+        self.hub.onNewData(None, contexts)
+
+    def forget(self, context):
+        self.listeners.pop(context, None)
+        self.pending.discard(context)
+
+    def close(self):
+        for channel in self.channels.values():
+            if channel is not None:
+                channel.close()
+
 
 class Logger(LabradServer):
+    """Logs time series of values in channels, grouped into logs."""
     name = 'Logger'
+    notifyDelay = 0.1 # s to coalesce 'new data' messages
+    reactor = reactor
+
+    def __init__(self, root=None):
+        LabradServer.__init__(self)
+        self.root = root
+        self.logs = {}
+        self.onNewLog = Signal(654321, 'signal: new log', '*s')
+        self.onNewVar = Signal(654322, 'signal: new channel', 'ss')
+        self.onNewData = Signal(654323, 'signal: new data', '')
 
     @inlineCallbacks
     def initServer(self):
-        pass
+        if self.root is None:
+            # the repository is set in the registry, for this node or all
+            reg = self.client.registry
+            yield reg.cd(['', 'Servers', self.name, 'Repository'], True)
+            dirs, keys = yield reg.dir()
+            node = util.getNodeName()
+            if node in keys:
+                self.root = yield reg.get(node)
+            elif '__default__' in keys:
+                self.root = yield reg.get('__default__')
+            else:
+                self.root = os.path.expanduser('~/.labrad/logs')
+                yield reg.set('__default__', self.root)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
 
-    onNewLog = Signal(654321, 'signal: new log', '*s')
-    onNewVar = Signal(654322, 'signal: new channel', 'ss')
-    onNewData = Signal(654323, 'signal: new data', '')
+    def stopServer(self):
+        for log in self.logs.values():
+            log.close()
+
+    def contextKey(self, c):
+        """The key used to identify a given context for notifications"""
+        return c.ID
+
+    def expireContext(self, c):
+        key = self.contextKey(c)
+        for log in self.logs.values():
+            log.forget(key)
+
+    def logPath(self, logPath):
+        if isinstance(logPath, str):
+            logPath = logPath.split('/')
+        return tuple(p for p in logPath if p)
 
     def getLog(self, c):
         if 'log' not in c:
-            raise Exception('No log opened in this context.')
+            raise NoLogOpenError()
         return c['log']
 
-    @setting(1, 'list', filters=['s', '*s'])
-    def get_log_list(self, c, filters):
+    def findLog(self, logPath, create=False):
+        path = self.logPath(logPath)
+        if path not in self.logs:
+            directory = os.path.join(self.root, *path)
+            if os.path.exists(os.path.join(directory, INDEX)):
+                log = Log(path, directory, self, self.reactor)
+            elif create:
+                log = Log.create(path, directory, self, self.reactor)
+                self.onNewLog(list(path))
+            else:
+                raise NoSuchLogError('No log %s' % '/'.join(path))
+            self.logs[path] = log
+        return self.logs[path]
+
+    @setting(1, 'list', filters=['s', '*s'], returns='*s')
+    def get_log_list(self, c, filters=[]):
         """Get a list of available logs matching the given filters.
+
+        Logs are listed by path, with '/' separating the parts. Only the
+        logs whose path contains every filter string are listed.
         """
+        if isinstance(filters, str):
+            filters = [filters]
+        logs = []
+        for directory, dirs, files in os.walk(self.root):
+            if INDEX in files:
+                # the rest is the log's data
+                dirs[:] = []
+                path = os.path.relpath(directory, self.root).replace(os.sep, '/')
+                if all(f in path for f in filters):
+                    logs.append(path)
+            dirs.sort()
+        return logs
 
     @setting(2, 'describe', logPath=['s', '*s'],
-             returns='t{start} t{last} *(s{name} s{type} t{start} t{last}')
+             returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
     def describe(self, c, logPath):
         """Get information about the specified log.
         """
-    
+        return self.findLog(logPath).describe()
+
     @setting(100, 'open', logPath=['s', '*s'], create='b',
              returns='t{start} t{last} *(s{name} s{type} t{start} t{last})')
     def open_log(self, c, logPath, create=False):
@@ -96,6 +580,12 @@ class Logger(LabradServer):
         Returns the start time of the log, as well as a list
         with the name and type tag of each channel in the log.
         """
+        log = self.findLog(logPath, create)
+        if 'log' in c:
+            c['log'].forget(self.contextKey(c))
+        c['log'] = log
+        c['streams'] = {}
+        return log.describe()
 
     @setting(300, 'log', data='?: ((s?)(s?)...)', returns='')
     def log_data(self, c, data):
@@ -134,16 +624,40 @@ class Logger(LabradServer):
         given list.  If there is more data available beyond the limit,
         a 'new data' message will be fired to listeners signed up for
         the message.  This is the same 'streaming' protocol used by
-        clients of the data vault.
+        clients of the data vault.  Repeating a get with the same
+        channels and range returns the entries after those already
+        returned.
         """
-        
+        log = self.getLog(c)
+        if isinstance(channels, str):
+            channels = [channels]
+        if isinstance(range, tuple):
+            start, end = [toMicros(t) for t in range]
+        else:
+            start, end = toMicros(range), None
+        # where the last get of these channels and range stopped
+        key = (tuple(channels), start, end)
+        positions = c['streams'].setdefault(key, {})
+        result = []
+        more = False
+        for name in channels:
+            channel = log.channel(name)
+            pos = positions.get(name, start)
+            times, values = channel.get(pos, end, limit)
+            if len(times):
+                positions[name] = pos = int(times[-1]) + 1
+            more = more or channel.hasMore(pos, end)
+            result.append(channel.entries(times, values))
+        waiting = channels if end is None else []
+        log.keepStreaming(self.contextKey(c), waiting, more)
+        return tuple(result)
+
 #####
 # Create a server instance and run it
 
 __server__ = Logger()
 
 if __name__ == '__main__':
-    from labrad import util
     util.runServer(__server__)
 
 
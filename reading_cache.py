@@ -0,0 +1,188 @@
+"""
+The latest readings of an instrument's channels, shared by all clients of
+its server, so that loggers, GUIs and notifiers don't each make the
+instrument read the same thermometers again.
+
+A ReadingCache is a dict of channel -> (value, time) that also records
+when each channel was last read. Device servers store readings in it,
+either from their own read loop (the Lakeshore 370) or by calling
+read() when a client asks for readings that are older than maxAge (the
+Lakeshore 218). Requests that arrive while a read is in progress wait
+for it rather than starting another.
+
+Clients can subscribe instead of polling: a subscriber is notified when
+the readings change, at most once every minPeriod seconds. If the cache
+has a read function, it reads the instrument as often as the most
+demanding subscriber needs, but not more often than every maxAge.
+"""
+
+from datetime import datetime
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class Subscription(object):
+    def __init__(self, minPeriod, notify):
+        self.minPeriod = minPeriod
+        self.notify = notify
+        self.last = None
+        self.call = None
+
+
+class ReadingCache(dict):
+    """Channel -> (value, time) of the latest reading of each channel.
+
+    read, if given, reads all channels of the instrument and returns a
+    Deferred dict of channel -> value. Counters:
+
+        queries:       reads of the instrument
+        saved:         requests answered without reading the instrument
+        notifications: messages sent to subscribers
+    """
+
+    def __init__(self, read=None, maxAge=1.0, reactor=reactor):
+        dict.__init__(self)
+        self.read = read
+        self.maxAge = maxAge
+        self.reactor = reactor
+        # channel -> time of the reading, on the reactor's clock
+        self.times = {}
+        self.subscribers = {}
+        self.waiting = None
+        self.loop = None
+        self.queries = 0
+        self.saved = 0
+        self.notifications = 0
+
+    def __setitem__(self, channel, reading):
+        self.store({channel: reading})
+
+    def store(self, readings):
+        """Record new (value, time) readings of some channels."""
+        now = self.reactor.seconds()
+        for channel, reading in readings.items():
+            dict.__setitem__(self, channel, reading)
+            self.times[channel] = now
+        self.changed()
+
+    def reset(self, readings):
+        """Replace the contents with placeholders, which are never fresh."""
+        dict.clear(self)
+        dict.update(self, readings)
+        self.times = {}
+
+    def age(self, channels=None):
+        """Seconds since the oldest of the channels, or all, was read."""
+        if channels is None:
+            channels = self.keys()
+        if not channels:
+            return float('inf')
+        now = self.reactor.seconds()
+        return max(now - self.times.get(ch, float('-inf')) for ch in channels)
+
+    def isFresh(self, channels=None, maxAge=None):
+        if maxAge is None:
+            maxAge = self.maxAge
+        return self.age(channels) <= maxAge
+
+    def latest(self, maxAge=None):
+        """Get the readings, from the cache if they are fresh, or else from
+        the instrument. Returns a Deferred dict of channel -> (value, time).
+        """
+        if self.read is None or self.isFresh(maxAge=maxAge):
+            self.saved += 1
+            return succeed(dict(self))
+        d = Deferred()
+        if self.waiting is not None:
+            # a read is in progress
+            self.saved += 1
+            self.waiting.append(d)
+            return d
+        self.waiting = [d]
+        self.queries += 1
+        maybeDeferred(self.read).addBoth(self._readDone)
+        return d
+
+    def _readDone(self, result):
+        waiting, self.waiting = self.waiting, None
+        if not isinstance(result, dict):
+            # a failure
+            for d in waiting:
+                d.errback(result)
+            return
+        now = datetime.now()
+        self.store(dict((ch, (value, now)) for ch, value in result.items()))
+        for d in waiting:
+            d.callback(dict(self))
+
+    def subscribe(self, key, minPeriod, notify):
+        """Call notify(key) when the readings change, at most once every
+        minPeriod seconds."""
+        self.unsubscribe(key)
+        self.subscribers[key] = Subscription(minPeriod, notify)
+        self._startPolling()
+
+    def unsubscribe(self, key):
+        sub = self.subscribers.pop(key, None)
+        if sub is not None:
+            if sub.call is not None and sub.call.active():
+                sub.call.cancel()
+            self._startPolling()
+
+    def changed(self):
+        now = self.reactor.seconds()
+        for key, sub in self.subscribers.items():
+            if sub.call is None:
+                delay = 0
+                if sub.last is not None:
+                    delay = max(sub.last + sub.minPeriod - now, 0)
+                sub.call = self.reactor.callLater(delay, self._send, key)
+
+    def _send(self, key):
+        sub = self.subscribers.get(key)
+        if sub is None:
+            return
+        sub.call = None
+        sub.last = self.reactor.seconds()
+        self.notifications += 1
+        sub.notify(key)
+
+    def _startPolling(self):
+        """Read the instrument for the subscribers, if we have to."""
+        if self.read is None:
+            return
+        period = None
+        if self.subscribers:
+            period = max(min(s.minPeriod for s in self.subscribers.values()),
+                         self.maxAge)
+        if self.loop is not None:
+            if self.loop.interval == period:
+                return
+            self.loop.stop()
+            self.loop = None
+        if period is not None:
+            self.loop = LoopingCall(self.poll)
+            self.loop.clock = self.reactor
+            self.loop.start(period, now=True)
+
+    def poll(self):
+        if self.isFresh(maxAge=self.loop.interval / 2.0):
+            # clients' requests keep it fresh
+            return
+        d = self.latest(0)
+        d.addErrback(log.err)
+        return d
+
+    def stop(self):
+        """Stop notifying subscribers and reading for them."""
+        for key in list(self.subscribers):
+            self.unsubscribe(key)
+
+    def statistics(self):
+        return [('queries', long(self.queries)),
+                ('saved', long(self.saved)),
+                ('notifications', long(self.notifications)),
+                ('subscribers', long(len(self.subscribers)))]
@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = RF Mux
-version = 1.0.0
+version = 1.0.1
 description = RF Mux for the DR lab
 
 [startup]
@@ -30,6 +30,7 @@ timeout = 5
 ### END NODE INFO
 """
 
+from labrad import types as T
 from labrad.devices import DeviceServer, DeviceWrapper
 from labrad.server import setting, inlineCallbacks, returnValue
 
@@ -75,9 +76,12 @@ class RFMuxDevice(DeviceWrapper):
     
     @inlineCallbacks
     def get_channel(self): # found that when stringing together commands in the serial server, need about a 20ms delay between write and read for the mux board to operate properly. Either add a delay or change the baud rate
-        self.write('?')    # this command is currently not working properly
-        read_chan = yield self.read()
-        print read_chan
+        # the serial server runs the delay between write and read itself
+        script = [('write', '?', T.Value(0, 's')),
+                  ('pause', '', T.Value(0.02, 's')),
+                  ('read', '1', T.Value(TIMEOUT, 's'))]
+        ans = yield self.server.run_script(script, context=self.ctx)
+        read_chan = ans[0]
         returnValue(ord(read_chan) - ord('A')) # queries received from RF Mux are in ASCII, channel 0 = 'A', channel 1 = 'B' etc
 
     def set_channel(self, channel):
@@ -37,9 +37,12 @@ import numpy as np
 
 from labrad import types as T, errors, util
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
+from labrad.gpib import GPIBManagedServer
+from labrad.units import ValueArray
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from gpib_wrapper import GPIBTransactionWrapper
+
 __QUERY__ = 'ENC WAV:BIN;BYT. LSB;OUT TRA%d;WAV?'
 
 class NotConnectedError(errors.Error):
@@ -66,7 +69,7 @@ class SendTraceError(errors.Error):
 TIMEOUT = 120
 
 
-class SamplingScopeDevice(GPIBDeviceWrapper):
+class SamplingScopeDevice(GPIBTransactionWrapper):
     @inlineCallbacks
     def initialize(self):
         yield self.timeout(TIMEOUT)
@@ -86,7 +89,7 @@ class SamplingScope(GPIBManagedServer):
     @setting(10, 'Get Trace',
                  trace=[': Query TRACE1',
                         'w: Specify trace to query: 1, 2, or 3'],
-                 returns=['*v: y-values', 'v: x-increment'])
+                 returns=['*v[V]: y-values', 'v[s]: x-increment'])
     def get_trace(self, c, trace=1):
         """Returns the y-values of the current trace from the sampling scope.
         
@@ -104,9 +107,9 @@ class SamplingScope(GPIBManagedServer):
                 break
             yield util.wakeupCall(2)
 
-        resp = yield dev.query(__QUERY__ % trace, bytes=20000L)
+        resp = yield dev.write_read_raw(__QUERY__ % trace)
         ofs, incr, vals = _parseBinaryData(resp)
-        returnValue([T.Value(v, 'V') for v in np.hstack(([ofs, incr], vals))])
+        returnValue(ValueArray(np.hstack(([ofs, incr], vals)), 'V'))
 
     @setting(99, 'Multi Trace',
                  cstar='w', cend='w',
@@ -130,18 +133,11 @@ class SamplingScope(GPIBManagedServer):
                 break
             yield util.wakeupCall(2)
 
-        resp = yield dev.query('ENC WAV:BIN;BYT. LSB;OUT TRA%dTOTRA%d;WAV?' % (cstar, cend), bytes=20000L)
-        splits = resp.split(";WFMPRE")
-        traces = []
-        ofs = 0
-        incr = 0
-        for trace in splits:
-            ofs, incr, vals = _parseBinaryData(trace)
-            traces.append(vals)
-        #ofs1, incr1, vals1 = _parseBinaryData(t1)
-        #ofs2, incr2, vals2 = _parseBinaryData(t2)
-        #traces = np.vstack((vals1, vals2))
-        returnValue((ofs, incr, traces))
+        resp = yield dev.write_read_raw('ENC WAV:BIN;BYT. LSB;OUT TRA%dTOTRA%d;WAV?' % (cstar, cend))
+        waveforms = _parseWaveforms(resp)
+        ofs, incr = waveforms[-1][:2]
+        traces = np.vstack([w[2] for w in waveforms])
+        returnValue((ofs, incr, ValueArray(traces, 'V')))
     
     @setting(241, 'Send Trace To Data Vault',
                   server=['s'], session=['*s'], dataset=['s'], trace=['w'],
@@ -151,16 +147,11 @@ class SamplingScope(GPIBManagedServer):
         """
         dev = self.selectedDevice(c)
 
-        resp = yield dev.query(__QUERY__ % trace, bytes=20000L)
-        vals = _parseBinaryData(resp)
-
-        startx = vals[0]
-        stepx = vals[1]
-        vals = vals[2:]
-        for _ in np.shape(vals)[:-1]:
-            vals = vals[0]
+        resp = yield dev.write_read_raw(__QUERY__ % trace)
+        startx, stepx, vals = _parseBinaryData(resp)
 
-        out = [[(startx + i*stepx)*1e9, d] for i, d in enumerate(vals)]
+        t = (startx + stepx * np.arange(len(vals))) * 1e9
+        out = np.column_stack((t, vals))
         p = self.client[server].packet()
         p.cd(session,True)
         p.new(dataset,[('time', 'ns')],[('amplitude','trace %d' % trace, 'V')])
@@ -319,17 +310,40 @@ _xincr = re.compile('XINCR:(-?\d*.?\d+E?-?\+?\d*),')
 _yzero = re.compile('YZERO:(-?\d*.?\d+E?-?\+?\d*),')
 _ymult = re.compile('YMULT:(-?\d*.?\d+E?-?\+?\d*),')
     
+def _parseWaveforms(data):
+    """Parse the waveforms coming back from the scope.
+
+    Each waveform is a WFMPRE header, ';CURVE' and a binary block: '%', the
+    number of bytes that follow as two bytes MSB first, the samples as 16
+    bit integers LSB first, and a checksum byte. Returns a list of
+    (xzero, xincr, y-values) tuples.
+    """
+    waveforms = []
+    start = 0
+    while True:
+        curve = data.find(';CURVE', start)
+        if curve < 0:
+            break
+        hdr = data[start:curve]
+        block = data.index('%', curve) + 3
+        count, = struct.unpack('>H', data[block-2:block])
+        if count < 1 or block + count > len(data):
+            raise MeasurementError()
+        dat = np.frombuffer(data, '<i2', (count - 1) // 2, block)
+        xzero = float(_xzero.findall(hdr)[0])
+        xincr = float(_xincr.findall(hdr)[0])
+        yzero = float(_yzero.findall(hdr)[0])
+        ymult = float(_ymult.findall(hdr)[0])
+        waveforms.append((xzero, xincr, dat*ymult + yzero))
+        start = block + count
+    if not waveforms:
+        raise MeasurementError()
+    return waveforms
+
+
 def _parseBinaryData(data):
     """Parse the data coming back from the scope"""
-    hdr, dat = data.split(';CURVE')
-    dat = dat[dat.find('%')+3:-1]
-    dat = np.array(struct.unpack('h'*(len(dat)/2), dat))
-    xzero = float(_xzero.findall(hdr)[0])
-    xincr = float(_xincr.findall(hdr)[0])
-    yzero = float(_yzero.findall(hdr)[0])
-    ymult = float(_ymult.findall(hdr)[0])
-
-    return xzero, xincr, dat*ymult + yzero
+    return _parseWaveforms(data)[0]
 
 
 __server__ = SamplingScope()
@@ -19,7 +19,7 @@
 ### BEGIN NODE INFO
 [info]
 name = Serial Server
-version = 1.2
+version = 1.6
 description =
 instancename = %LABRADNODE% Serial Server
 
@@ -37,19 +37,21 @@ import collections
 import os
 import os.path
 import sys
-import time
-from time import sleep
+import threading
 
+import numpy as np
 from labrad import types as T
 from labrad.errors import Error
 from labrad.server import LabradServer, setting
-from twisted.internet import reactor, threads
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, returnValue, succeed
 from twisted.internet.task import deferLater
 from serial import Serial
 from serial.serialutil import SerialException
 import serial.tools.list_ports
 
+from transport import Metrics, SerialTransport, TransportTimeoutError
+
 
 class NoPortSelectedError(Error):
     """Please open a port first."""
@@ -61,14 +63,300 @@ class NoPortsAvailableError(Error):
     code = 3
 
 
+class ExpectTimeoutError(Error):
+    """The expected delimiter was not received."""
+    code = 4
+
+
+SCRIPT_OPS = ('write', 'write_line', 'pause', 'read', 'read_line', 'expect')
+
+
+def parseScript(steps):
+    """Check the steps of a script, before any of them is run.
+
+    Returns a list of (op, arg, time) triples, with the byte counts of reads
+    converted to numbers and times in seconds.
+    """
+    parsed = []
+    for i, (op, arg, t) in enumerate(steps):
+        op = op.lower()
+        if op not in SCRIPT_OPS:
+            raise ValueError('Unknown script op %d: %r' % (i, op))
+        if op == 'read':
+            try:
+                arg = long(arg) if arg.strip() else 0
+            except ValueError:
+                raise ValueError('Bad byte count for script op %d: %r'
+                                 % (i, arg))
+        parsed.append((op, arg, min(t['s'], 300)))
+    return parsed
+
+
 SerialDevice = collections.namedtuple('SerialDevice', ['name', 'devicepath'])
 
 
+class RingBuffer(object):
+    """A preallocated byte buffer, filled at the end and read from the start.
+
+    When it is full, the oldest bytes are dropped to make room for new ones,
+    and counted in overruns.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.length = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, data):
+        n = len(data)
+        if n > self.size:
+            self.overruns += self.length + n - self.size
+            self.drop(self.length)
+            data = data[n - self.size:]
+            n = self.size
+        elif self.length + n > self.size:
+            self.overruns += self.length + n - self.size
+            self.drop(self.length + n - self.size)
+        end = (self.start + self.length) % self.size
+        first = min(n, self.size - end)
+        self.data[end:end + first] = data[:first]
+        if first < n:
+            self.data[:n - first] = data[first:]
+        self.length += n
+
+    def drop(self, n):
+        """Remove the first n bytes."""
+        self.start = (self.start + n) % self.size
+        self.length -= n
+        if not self.length:
+            # start over, so that the next bytes are contiguous
+            self.start = 0
+
+    def take(self, n):
+        """Remove and return up to n bytes from the start, as a memoryview.
+
+        Unless the bytes wrap around the end of the buffer, this is a view
+        of the buffer itself, only valid until more bytes are added.
+        """
+        n = min(n, self.length)
+        end = self.start + n
+        if end <= self.size:
+            data = self.view[self.start:end]
+        else:
+            data = memoryview(self.data[self.start:] +
+                              self.data[:end - self.size])
+        self.drop(n)
+        return data
+
+    def find(self, sub, start=0):
+        """Return the index of the first sub at or after start, or -1."""
+        pos = self.start + start
+        end = self.start + self.length
+        if end <= self.size:
+            i = self.data.find(sub, pos, end)
+            return i - self.start if i >= 0 else -1
+        if pos < self.size:
+            i = self.data.find(sub, pos)
+            if i >= 0:
+                return i - self.start
+            # sub may span the end of the buffer
+            seamStart = max(pos, self.size - len(sub) + 1)
+            seam = self.data[seamStart:] + \
+                self.data[:min(len(sub) - 1, end - self.size)]
+            i = seam.find(sub)
+            if i >= 0:
+                return seamStart + i - self.start
+            pos = self.size
+        i = self.data.find(sub, pos - self.size, end - self.size)
+        return i + self.size - self.start if i >= 0 else -1
+
+
+class PortReader(object):
+    """Reads a serial port in a thread of its own, buffering what arrives.
+
+    The thread blocks in the read of the port, so received bytes are
+    passed to the reactor as soon as they arrive. Reads are satisfied from
+    the buffer, in the reactor thread. A read that has to wait gives up
+    when no bytes have arrived for its timeout, returning what it has.
+
+    Reads give memoryviews of the buffer, which are only valid until more
+    bytes arrive.
+    """
+
+    # how often the reader thread checks whether it should stop, in s
+    pollInterval = 0.1
+    # bytes kept for reads, beyond which the oldest are dropped
+    bufferSize = 1 << 20
+
+    def __init__(self, ser, reactor=reactor):
+        self.ser = ser
+        self.reactor = reactor
+        self.buffer = RingBuffer(self.bufferSize)
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.waiters = []
+        self.error = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.ser.timeout = self.pollInterval
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name='read %s' % self.ser.port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop reading, returning what was received to waiting reads."""
+        self.running = False
+        if hasattr(self.ser, 'cancel_read'):
+            try:
+                self.ser.cancel_read()
+            except Exception:
+                pass
+        if self.thread is not None and \
+                self.thread is not threading.current_thread():
+            self.thread.join(2 * self.pollInterval + 1)
+        while self.waiters:
+            self._finish(self.waiters[0], self.waiters[0]['partial']())
+
+    def _run(self):
+        ser = self.ser
+        while self.running:
+            try:
+                data = ser.read(1)
+                if data:
+                    waiting = ser.in_waiting
+                    if waiting:
+                        data += ser.read(waiting)
+            except Exception, e:
+                if self.running:
+                    self.reactor.callFromThread(self._failed, e)
+                return
+            if data:
+                self.reactor.callFromThread(self._received, data)
+
+    def _received(self, data):
+        self.bytesIn += len(data)
+        self.buffer.extend(data)
+        if self.waiters and self.waiters[0]['timer'] is not None:
+            # the timeout counts from the last bytes received
+            self.waiters[0]['timer'].reset(self.waiters[0]['timeout'])
+        self._serve()
+
+    def _serve(self):
+        """Complete waiting reads in order, as far as the buffer allows."""
+        while self.waiters:
+            waiter = self.waiters[0]
+            ans = waiter['check']()
+            if ans is None:
+                if waiter['timeout'] > 0:
+                    break
+                ans = waiter['partial']()
+            self._finish(waiter, ans)
+
+    def _failed(self, e):
+        self.error = e
+        while self.waiters:
+            waiter = self.waiters.pop(0)
+            if waiter['timer'] is not None and waiter['timer'].active():
+                waiter['timer'].cancel()
+            waiter['d'].errback(e)
+
+    def _take(self, n):
+        return self.buffer.take(n)
+
+    def _finish(self, waiter, ans):
+        self.waiters.remove(waiter)
+        if waiter['timer'] is not None and waiter['timer'].active():
+            waiter['timer'].cancel()
+        waiter['d'].callback(ans)
+
+    def _wait(self, check, timeout, partial):
+        """Call check() until it gives a result, as bytes arrive.
+
+        If no bytes arrive for timeout seconds, gives partial() instead.
+        Returns a Deferred with the result.
+        """
+        if self.error is not None:
+            raise self.error
+        if not self.waiters:
+            ans = check()
+            if ans is not None:
+                return succeed(ans)
+            if timeout <= 0:
+                return succeed(partial())
+        waiter = {'d': Deferred(), 'check': check, 'partial': partial,
+                  'timeout': timeout, 'timer': None}
+        self.waiters.append(waiter)
+
+        def expire():
+            waiter['timer'] = None
+            if waiter in self.waiters:
+                # still waiting for earlier reads, so don't give up yet
+                if self.waiters[0] is not waiter:
+                    waiter['timer'] = self.reactor.callLater(timeout, expire)
+                else:
+                    self._finish(waiter, partial())
+                    self._serve()
+        if timeout > 0:
+            waiter['timer'] = self.reactor.callLater(timeout, expire)
+        return waiter['d']
+
+    def read(self, count=0, timeout=0):
+        """Read count bytes, or all buffered bytes if count is 0.
+
+        Waits for the bytes if timeout is not 0. At most the size of the
+        buffer is read at once.
+        """
+        count = min(count, self.buffer.size)
+        if count == 0:
+            takeAll = lambda: self._take(len(self.buffer))
+            return self._wait(takeAll, 0, takeAll)
+
+        def check():
+            if len(self.buffer) >= count:
+                return self._take(count)
+        return self._wait(check, timeout,
+                          lambda: self._take(min(count, len(self.buffer))))
+
+    def readLine(self, delim, timeout=0, partial=True):
+        """Read up to delim, which is removed. Returns what was received if
+        the delimiter doesn't arrive, or None, leaving it in the buffer, if
+        partial is False."""
+        # where to continue looking for delim as bytes arrive
+        searched = [0]
+
+        def check():
+            i = self.buffer.find(delim, searched[0])
+            if i < 0:
+                searched[0] = max(0, len(self.buffer) - len(delim) + 1)
+                return None
+            line = self._take(i)
+            self.buffer.drop(len(delim))
+            return line
+        if partial:
+            rest = lambda: self._take(len(self.buffer))
+        else:
+            rest = lambda: None
+        return self._wait(check, timeout, rest)
+
+
 class SerialServer(LabradServer):
     """Provides access to a computer's serial (COM) ports."""
     name = '%LABRADNODE% Serial Server'
+    # delivers the data read from the ports, e.g. a fake one for testing
+    reactor = reactor
 
     def initServer(self):
+        self.metrics = Metrics()
         if sys.platform.startswith('win32'):
             self.enumerate_serial_windows()
         else:
@@ -124,8 +412,24 @@ class SerialServer(LabradServer):
                 self.SerialPorts.append(SerialDevice(dev_name, dev_path))
 
     def expireContext(self, c):
+        self.closePort(c)
+
+    def openPort(self, c, devicepath):
+        """Open a serial port for this context and start reading it."""
+        ser = Serial(devicepath, timeout=0)
+        c['PortObject'] = ser
+        c['PortReader'] = PortReader(ser, self.reactor)
+        c['PortReader'].start()
+        c['PortTransport'] = SerialTransport(ser, c['PortReader'],
+                                             self.metrics, self.reactor)
+
+    def closePort(self, c):
         if 'PortObject' in c:
+            c['PortReader'].stop()
             c['PortObject'].close()
+            del c['PortObject']
+            del c['PortReader']
+            del c['PortTransport']
 
     def getPort(self, c):
         try:
@@ -133,6 +437,18 @@ class SerialServer(LabradServer):
         except:
             raise NoPortSelectedError()
 
+    def getTransport(self, c):
+        try:
+            return c['PortTransport']
+        except:
+            raise NoPortSelectedError()
+
+    def getReader(self, c):
+        try:
+            return c['PortReader']
+        except:
+            raise NoPortSelectedError()
+
     @setting(1, 'List Serial Ports',
              returns=['*s: List of serial ports'])
     def list_serial_ports(self, c):
@@ -163,14 +479,11 @@ class SerialServer(LabradServer):
         on Linux.  For compatibility, always use the same case.
         """
         c['Timeout'] = 0
-        if 'PortObject' in c:
-            c['PortObject'].close()
-            del c['PortObject']
+        self.closePort(c)
         if not port:
             for i in range(len(self.SerialPorts)):
                 try:
-                    c['PortObject'] = Serial(self.SerialPorts[i].devicepath,
-                                             timeout=0)
+                    self.openPort(c, self.SerialPorts[i].devicepath)
                     break
                 except SerialException:
                     pass
@@ -180,7 +493,7 @@ class SerialServer(LabradServer):
             for x in self.SerialPorts:
                 if os.path.normcase(x.name) == os.path.normcase(port):
                     try:
-                        c['PortObject'] = Serial(x.devicepath, timeout=0)
+                        self.openPort(c, x.devicepath)
                         return x.name
                     except SerialException, e:
                         if e.message.find('cannot find') >= 0:
@@ -192,9 +505,7 @@ class SerialServer(LabradServer):
     @setting(11, 'Close', returns=[''])
     def close(self, c):
         """Closes the current serial port."""
-        if 'PortObject' in c:
-            c['PortObject'].close()
-            del c['PortObject']
+        self.closePort(c)
 
     @setting(20, 'Baudrate',
              data=[': List baudrates',
@@ -289,91 +600,32 @@ class SerialServer(LabradServer):
              returns=['w: Bytes sent'])
     def write(self, c, data):
         """Sends data over the port."""
-        ser = self.getPort(c)
         if not isinstance(data, str):
             data = ''.join(chr(x & 255) for x in data)
-        ser.write(data)
-        return long(len(data))
+        yield self.getTransport(c).write(data)
+        returnValue(long(len(data)))
 
     @setting(41, 'Write Line', data=['s: Data to send'],
              returns=['w: Bytes sent'])
     def write_line(self, c, data):
         """Sends data over the port appending CR LF."""
-        ser = self.getPort(c)
-        ser.write(data + '\r\n')
-        return long(len(data) + 2)
+        yield self.getTransport(c).write(data + '\r\n')
+        returnValue(long(len(data) + 2))
 
     @setting(42, 'Pause', duration='v[s]: Time to pause', returns=[])
     def pause(self, c, duration):
         _ = yield deferLater(reactor, duration['s'], lambda: None)
         return
 
-    @inlineCallbacks
-    def _deferredRead(self, ser, timeout, count=1):
-        stop_time = time.time() + timeout
-
-        def doRead(count):
-            while True:
-                d = ser.read(count)
-                if d:
-                    return d
-                sleep(0.01)
-                if time.time() > stop_time:
-                    return ''
-
-        data = yield threads.deferToThread(doRead, count)
-        returnValue(data)
-
-    @inlineCallbacks
-    def deferredRead(self, ser, timeout, count=1):
-        killit = False
-
-        def doRead(count):
-            d = ''
-            while not killit:
-                d = ser.read(count)
-                if d:
-                    break
-                sleep(0.010)
-            return d
-
-        data = threads.deferToThread(doRead, count)
-        timeout_object = []
-        start_time = time.time()
-        r = yield util.maybeTimeout(data, min(timeout, 300), timeout_object)
-        killit = True
-
-        if r == timeout_object:
-            elapsed = time.time() - start_time
-            print "deferredRead timed out after {} seconds".format(elapsed)
-            r = ''
-        if r == '':
-            r = ser.read(count)
-
-        returnValue(r)
-
-    @inlineCallbacks
     def readSome(self, c, count=0):
-        ser = self.getPort(c)
+        """Read from the port, with the context timeout.
 
-        if count == 0:
-            returnValue(ser.read(10000))
-
-        timeout = c['Timeout']
-        if timeout == 0:
-            returnValue(ser.read(count))
-
-        recd = ''
-        while len(recd) < count:
-            r = ser.read(count - len(recd))
-            if r == '':
-                r = yield self.deferredRead(ser, timeout, count - len(recd))
-                if r == '':
-                    ser.close()
-                    ser.open()
-                    break
-            recd += r
-        returnValue(recd)
+        Gives a memoryview of the data, only valid until more bytes arrive.
+        """
+        transport = self.getTransport(c)
+        timeout = c['Timeout'] if count else 0
+        return transport.run('read', transport.reader.read, count,
+                             timeout=timeout)
 
     @setting(50, 'Read', count=[': Read all bytes in buffer',
                                 'w: Read this many bytes'],
@@ -385,9 +637,10 @@ class SerialServer(LabradServer):
             count:   bytes to read.
 
         If count=0, reads the contents of the buffer (non-blocking).  Otherwise
-        reads for up to <count> characters or the timeout, whichever is first
+        reads for up to <count> characters or the timeout, whichever is first.
+        The timeout counts from the last byte received.
         """
-        return self.readSome(c, count)
+        return self.readSome(c, count).addCallback(lambda data: data.tobytes())
 
     @setting(51, 'Read as Words',
              data=[': Read all bytes in buffer',
@@ -395,8 +648,8 @@ class SerialServer(LabradServer):
              returns=['*w: Received data'])
     def read_as_words(self, c, data=0):
         """Read data from the port."""
-        ans = yield self.readSome(c, data)
-        returnValue([long(ord(x)) for x in ans])
+        d = self.readSome(c, data)
+        return d.addCallback(lambda data: np.asarray(data).astype(np.uint32))
 
     @setting(52, 'Read Line',
              data=[': Read until LF, ignoring CRs',
@@ -404,26 +657,86 @@ class SerialServer(LabradServer):
              returns=['s: Received data'])
     def read_line(self, c, data=''):
         """Read data from the port, up to but not including the specified
-        delimiter."""
-        ser = self.getPort(c)
-        timeout = c['Timeout']
+        delimiter.
 
+        Returns what has been received if the delimiter hasn't arrived
+        within the timeout, counting from the last byte received.
+        """
+        transport = self.getTransport(c)
         if data:
-            delim, skip = data, ''
-        else:
-            delim, skip = '\n', '\r'
-
-        recd = ''
-        while True:
-            r = ser.read(1)
-            if r == '' and timeout > 0:
-                # only try a deferred read if there is a timeout
-                r = yield self.deferredRead(ser, timeout)
-            if r in ('', delim):
-                break
-            if r != skip:
-                recd += r
-        returnValue(recd)
+            return transport.readUntil(data, c['Timeout'], partial=True)
+        d = transport.readUntil('\n', c['Timeout'], partial=True)
+        return d.addCallback(lambda line: line.replace('\r', ''))
+
+    @setting(60, 'Run Script',
+             steps='*(ssv[s]): Steps to run, as (op, arg, time)',
+             returns='*s: Data read')
+    def run_script(self, c, steps):
+        """Run a list of steps on the port in one request.
+
+        Each step is an (op, arg, time) triple. The ops are:
+
+            write:      send arg.
+            write_line: send arg, appending CR LF.
+            pause:      wait for time.
+            read:       read arg bytes, or all bytes in the buffer if arg
+                        is empty, waiting up to time.
+            read_line:  read up to the delimiter arg (LF, ignoring CRs, if
+                        arg is empty), waiting up to time.
+            expect:     like read_line, but fails if the delimiter doesn't
+                        arrive within time.
+
+        The time of writes is ignored. As with the Timeout setting, the
+        time of a read counts from the last byte received. Returns the data
+        read by each read, read_line and expect step. If any step is
+        invalid, none of them are run.
+        """
+        steps = parseScript(steps)
+        transport = self.getTransport(c)
+        ops = []
+        # whether each op's result is returned, and with CRs removed
+        reads = []
+        for op, arg, t in steps:
+            if op == 'write_line':
+                op, arg = 'write', arg + '\r\n'
+            elif op == 'expect':
+                op = 'read_until'
+            skipCR = op in ('read_line', 'read_until') and not arg
+            if skipCR:
+                arg = '\n'
+            ops.append((op, arg, t))
+            reads.append((op.startswith('read'), skipCR))
+        try:
+            ans = yield transport.transaction(ops)
+        except TransportTimeoutError, e:
+            raise ExpectTimeoutError(str(e))
+        results = []
+        for (isRead, skipCR), data in zip(reads, ans):
+            if isRead:
+                results.append(data.replace('\r', '') if skipCR else data)
+        returnValue(results)
+
+    @setting(62, 'Transport Metrics', port='s',
+             returns='*(sswwwv[s]): (port, op, count, bytes, errors, time)')
+    def transport_metrics(self, c, port=None):
+        """Get I/O counters by port device path and operation, for the
+        given port or all ports opened by this server."""
+        return self.metrics.rows(port)
+
+    @setting(61, 'Port Statistics',
+             returns='*(sw): Counters for the current port')
+    def port_statistics(self, c):
+        """Count the bytes that went through the port since it was opened.
+
+        The counters are the bytes received and sent, the bytes received
+        but dropped because the buffer was full (overruns), and the bytes
+        in the buffer, waiting to be read.
+        """
+        reader = self.getReader(c)
+        return [('bytes in', long(reader.bytesIn)),
+                ('bytes out', long(reader.bytesOut)),
+                ('overruns', long(reader.buffer.overruns)),
+                ('buffered', long(len(reader.buffer)))]
 
 __server__ = SerialServer()
 
@@ -33,10 +33,10 @@ timeout = 20
 ### END NODE INFO
 """
 
-from labrad import types as T, errors
+from labrad import types as T
 from labrad.server import setting
-from labrad.gpib import GPIBManagedServer, GPIBDeviceWrapper
-from struct import unpack
+from labrad.gpib import GPIBManagedServer
+from gpib_wrapper import GPIBTransactionWrapper, parseBlock
 from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad import util
 from labrad.units import MHz
@@ -53,7 +53,7 @@ class SpectrumAnalyzer(GPIBManagedServer):
                   'Keysight Technologies N9010A',
                   'Agilent Technologies N9020A',
                   'Keysight Technologies N9020A']
-    deviceWrapper = GPIBDeviceWrapper
+    deviceWrapper = GPIBTransactionWrapper
 
     @setting(10, 'Get Trace',
                  data=['{Query TRACE1}',
@@ -65,13 +65,12 @@ class SpectrumAnalyzer(GPIBManagedServer):
         if data < 1 or data > 3:
             raise Exception('data out of range')
         trace = data
-        start = float((yield dev.query(':FREQ:STAR?')))
-        span = float((yield dev.query(':FREQ:SPAN?')))
+        start, span = yield dev.queries(':FREQ:STAR?', ':FREQ:SPAN?')
+        start, span = float(start), float(span)
         maxRetries = 10
         for i in range(maxRetries):
             try:
-                yield dev.write(__QUERY__ % trace)
-                resp = yield dev.read_raw()
+                resp = yield dev.write_read_raw(__QUERY__ % trace)
                 vals = _parseBinaryData(resp)
                 break
             except Exception:
@@ -287,18 +286,8 @@ class SpectrumAnalyzer(GPIBManagedServer):
 
     
 def _parseBinaryData(data):
-    """Parse binary trace data."""
-    h = int(data[1]) #length of header
-    d = int(data[2:2+h]) #header, tells us how many bytes of data
-    s = data[2+h:2+h+d]
-    if len(s) != d:
-        raise errors.HandlerError('Could not decode binary response.')
-    n = d/4 # 4 bytes per data point
-
-    data = unpack('>'+'l'*n, s)
-    data = [d/1000.0 for d in data]
-
-    return data
+    """Parse binary trace data, 32 bit integers in thousandths of dBm."""
+    return parseBlock(data, '>i4') / 1000.0
 
 __server__ = SpectrumAnalyzer()
 
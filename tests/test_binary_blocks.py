@@ -0,0 +1,82 @@
+"""
+Decode binary traces: IEEE 488.2 blocks with gpib_wrapper.parseBlock, and
+the waveforms of the sampling scope.
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+import gpib_wrapper
+import sampling_scope
+
+
+def block(payload, digits=None):
+    length = str(len(payload))
+    if digits is None:
+        digits = len(length)
+    return '#%d%s%s' % (digits, length.zfill(digits), payload)
+
+
+@pytest.mark.parametrize('dtype', ['>i4', '<i2', '>f8', '<f4', '>c16'])
+def test_parse_block_dtypes(dtype):
+    expected = (np.arange(100) - 50).astype(dtype)
+    data = block(expected.tostring()) + '\n'
+    vals = gpib_wrapper.parseBlock(data, dtype)
+    assert vals.dtype == np.dtype(dtype)
+    assert np.all(vals == expected)
+
+
+def test_parse_block_headers():
+    payload = np.arange(5, dtype='>i4').tostring()
+    for data in [block(payload), ' \n' + block(payload, 9) + '\n',
+                 '#0' + payload + '\n', '#0' + payload]:
+        assert list(gpib_wrapper.parseBlock(data, '>i4')) == range(5)
+    # the payload may contain anything, including newlines
+    payload = '\n' * 8
+    assert len(gpib_wrapper.parseBlock(block(payload), '>i4')) == 2
+    assert len(gpib_wrapper.parseBlock(block(''), '>i4')) == 0
+
+
+@pytest.mark.parametrize('data', [
+    '', '1,2,3\n', '#', '#x12', '#3 121234', '#220123',
+    '#15123456789\n',
+])
+def test_parse_block_errors(data):
+    with pytest.raises(gpib_wrapper.BinaryBlockError):
+        gpib_wrapper.parseBlock(data, '>i4')
+
+
+def waveform(samples, xzero=-1.5e-9, xincr=1e-11, yzero=0.25, ymult=1e-3):
+    hdr = ('WFMPRE ENC:BIN,BYT.OR:LSB,XZERO:%.6E,XINCR:%.6E,YZERO:%.6E,'
+           'YMULT:%.6E,NR.PT:%d' % (xzero, xincr, yzero, ymult, len(samples)))
+    dat = np.asarray(samples, '<i2').tostring()
+    checksum = chr(sum(map(ord, dat)) % 256)
+    return hdr + ';CURVE %' + struct.pack('>H', len(dat) + 1) + dat + checksum
+
+
+def test_scope_waveforms():
+    a = np.arange(-300, 300, 3)
+    b = np.array([2560, 10, -2560, 32767, -32768] * 40)
+    xzero, xincr, vals = sampling_scope._parseBinaryData(waveform(a) + '\n')
+    assert (xzero, xincr) == (-1.5e-9, 1e-11)
+    assert np.allclose(vals, a * 1e-3 + 0.25)
+    # samples that look like separators or whitespace do not confuse it
+    resp = waveform(a, ymult=2e-3) + ';' + waveform(b, xzero=0.0) + '\n'
+    waveforms = sampling_scope._parseWaveforms(resp)
+    assert len(waveforms) == 2
+    assert np.allclose(waveforms[0][2], a * 2e-3 + 0.25)
+    assert waveforms[1][:2] == (0.0, 1e-11)
+    assert np.allclose(waveforms[1][2], b * 1e-3 + 0.25)
+
+
+def test_scope_bad_response():
+    with pytest.raises(sampling_scope.MeasurementError):
+        sampling_scope._parseBinaryData('WFMPRE ENC:BIN\n')
+    with pytest.raises(sampling_scope.MeasurementError):
+        sampling_scope._parseBinaryData(waveform(range(100))[:-10])
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
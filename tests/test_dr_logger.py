@@ -0,0 +1,143 @@
+"""
+Poll fake Diodes and MKS servers with the DR Logger on a fake clock, and
+check the rows it sends to a fake data vault.
+"""
+
+import pytest
+
+from twisted.internet import defer, task
+
+from labrad.units import Value
+import dr_logger
+
+
+class FakeServer(object):
+    """Answers setting calls after delay seconds of the clock."""
+
+    def __init__(self, clock, delay, answers):
+        self.clock = clock
+        self.delay = delay
+        self.answers = answers
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name not in self.answers:
+            raise AttributeError(name)
+
+        def call(*args, **kw):
+            self.calls.append((name, args))
+            if self.delay is None:
+                return defer.Deferred()
+            return task.deferLater(self.clock, self.delay, lambda: self.answers[name])
+        return call
+
+
+class FakeConnection(dict):
+    def context(self):
+        return (0, 1)
+
+
+@pytest.fixture
+def logger():
+    clock = task.Clock()
+    cxn = FakeConnection()
+    cxn['lakeshore_diodes'] = FakeServer(
+        clock, 2.0, {'temperatures': [Value(4.0 + i, 'K') for i in range(8)]})
+    cxn['mks_gauge_server'] = FakeServer(
+        clock, 3.0, {'get_readings': [Value(1e-3, 'torr'), Value(2e-3, 'torr')],
+                     'get_gauge_list': ['IVC', 'Still']})
+    cxn['data_vault'] = FakeServer(clock, 0.5, {'cd': None, 'new': None,
+                                                'add': None})
+    dev = dr_logger.DRLogger(1, 'Test')
+    dev.reactor = clock
+    dev.connect(cxn, timeInterval=5.0, batchSize=3, flushDelay=12.0,
+                diodes=('lakeshore_diodes', 'node', (('timeout', 4.0),)),
+                mks=('mks_gauge_server', 'node'))
+    return dev, clock, cxn
+
+
+def advance(clock, seconds, step=0.25):
+    for i in range(int(round(seconds / step))):
+        clock.advance(step)
+
+
+def added(cxn):
+    return [args[0] for name, args in cxn['data_vault'].calls if name == 'add']
+
+
+def test_watchers_are_polled_concurrently(logger):
+    dev, clock, cxn = logger
+    advance(clock, 3.0)
+    row, = dev.pending
+    assert row[0] == 0.0
+    assert sorted(row[1:]) == [1e-3, 2e-3] + [4.0 + i for i in range(8)]
+    assert dev.errors == []
+    stats = dict((row[0], row[1:]) for row in
+                 [dev.latency[name].row(name) for name in dev.latency])
+    assert stats['diodes'][:3] == (1, 0, 0)
+    assert stats['diodes'][3] == Value(2.0, 's')
+    assert stats['diodes'][6] == Value(1.0, 's')
+    assert stats['mks'][3] == Value(3.0, 's')
+
+
+def test_watchers_of_one_server_have_their_own_latency():
+    clock = task.Clock()
+    cxn = FakeConnection()
+    cxn['lakeshore_diodes'] = FakeServer(
+        clock, 2.0, {'temperatures': [Value(4.0 + i, 'K') for i in range(8)]})
+    cxn['data_vault'] = FakeServer(clock, 0.5, {'cd': None, 'new': None,
+                                                'add': None})
+    dev = dr_logger.DRLogger(1, 'Test')
+    dev.reactor = clock
+    dev.connect(cxn, timeInterval=5.0,
+                diodes=('lakeshore_diodes', 'node'),
+                diodes2=('lakeshore_diodes', 'other node'))
+    advance(clock, 3.0)
+    rows = [dev.latency[name].row(name) for name in sorted(dev.latency)]
+    assert [row[:2] for row in rows] == [('diodes', 1), ('diodes2', 1)]
+
+
+def test_rows_are_added_in_batches(logger):
+    dev, clock, cxn = logger
+    advance(clock, 25.0)
+    # the points taken at 0, 5 and 10 s are added in one request, after
+    # making the dataset
+    rows = added(cxn)
+    assert len(rows) == 1
+    assert [row[0] for row in rows[0]] == [0.0, 5.0, 10.0]
+    assert [name for name, args in cxn['data_vault'].calls] == \
+        ['cd', 'new', 'add']
+    assert [row[0] for row in dev.pending] == [15.0, 20.0]
+    # the rest are added flushDelay after the first of them was taken
+    dev.batchSize = 10
+    advance(clock, 6.0)
+    assert [row[0] for row in added(cxn)[1]] == [15.0, 20.0, 25.0]
+    assert dev.latency['Data Vault'].count == 2
+
+
+def test_slow_watcher_times_out(logger):
+    dev, clock, cxn = logger
+    advance(clock, 3.0)
+    cxn['lakeshore_diodes'].delay = None
+    # the point taken at 5 s times out at 9 s
+    advance(clock, 6.0)
+    assert len(dev.pending) == 1
+    assert dev.errors == [('lakeshore_diodes',
+                           "no point from 'lakeshore_diodes' in 4.0 s")]
+    assert dev.latency['diodes'].timeouts == 1
+    cxn['lakeshore_diodes'].delay = 1.0
+    advance(clock, 4.0)
+    assert len(dev.pending) == 2 and dev.errors == []
+
+
+def test_stopping_adds_pending_rows(logger):
+    dev, clock, cxn = logger
+    advance(clock, 3.0)
+    d = dev.logging(False)
+    advance(clock, 10.0)
+    assert d.called
+    assert [row[0] for row in added(cxn)[0]] == [0.0]
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
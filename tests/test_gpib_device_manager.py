@@ -0,0 +1,350 @@
+"""
+Identify devices on fake GPIB bus servers with the GPIB Device Manager,
+without a labrad manager. Bus and ident servers answer after a delay on a
+fake clock.
+"""
+
+import pytest
+
+from twisted.internet import defer, task
+
+import gpib_device_manager
+from gpib_device_manager import UNKNOWN
+
+
+class FakeRegistry(object):
+    def __init__(self):
+        self.dirs = {}
+
+    def cd(self, path, create=False):
+        self.path = tuple(path)
+        self.dirs.setdefault(self.path, {})
+        return defer.succeed(path)
+
+    def dir(self):
+        return defer.succeed(([], sorted(self.dirs[self.path])))
+
+    def get(self, key):
+        return defer.succeed(self.dirs[self.path][key])
+
+    def set(self, key, value):
+        self.dirs[self.path][key] = value
+        return defer.succeed(None)
+
+
+class FakeResponse(object):
+    def __init__(self, read):
+        self.read = read
+
+
+class FakeBusPacket(object):
+    def __init__(self, bus):
+        self.bus = bus
+
+    def address(self, addr):
+        self.addr = addr
+        return self
+
+    def timeout(self, t):
+        self.timeout = t['s']
+        return self
+
+    def write(self, data):
+        return self
+
+    def read(self):
+        return self
+
+    @defer.inlineCallbacks
+    def send(self):
+        bus = self.bus
+        bus.queries.append(self.addr)
+        bus.active += 1
+        bus.maxActive = max(bus.maxActive, bus.active)
+        idn = bus.devices[self.addr]
+        try:
+            if idn is None:
+                yield task.deferLater(bus.clock, self.timeout, lambda: None)
+                raise Exception('timeout')
+            yield task.deferLater(bus.clock, bus.delay, lambda: None)
+        finally:
+            bus.active -= 1
+        defer.returnValue(FakeResponse(idn))
+
+
+class FakeBus(object):
+    """A GPIB bus server. devices maps address to *IDN? response, or None
+    for devices that don't answer."""
+
+    settings = ['list_devices']
+
+    def __init__(self, name, devices, clock, delay=0.1):
+        self.name = name
+        self.devices = devices
+        self.clock = clock
+        self.delay = delay
+        self.queries = []
+        self.active = 0
+        self.maxActive = 0
+
+    def list_devices(self):
+        return defer.succeed(sorted(self.devices))
+
+    def packet(self):
+        return FakeBusPacket(self)
+
+
+class FakeIdentServer(object):
+    """A device server with an ident function, which knows the names of
+    devices by (bus, address)."""
+
+    def __init__(self, name, ID, names, clock, delay=0.1):
+        self.name = name
+        self.ID = ID
+        self.names = names
+        self.clock = clock
+        self.delay = delay
+        self.calls = []
+
+    def __getitem__(self, setting):
+        return self.identify
+
+    def identify(self, server, channel, idn=None, context=None):
+        self.calls.append((server, channel, idn))
+        return task.deferLater(self.clock, self.delay,
+                               lambda: self.names.get((server, channel)))
+
+
+class FakeManager(object):
+    ID = 1
+
+    def subscribe_to_named_message(self, name, ID, active):
+        return defer.succeed(None)
+
+
+class FakeClient(object):
+    def __init__(self, buses, registry):
+        self.servers = dict((bus.name, bus) for bus in buses)
+        self.identServers = {}
+        self.registry = lambda: registry
+        self.manager = FakeManager()
+        self.messages = []
+
+    def __getitem__(self, ID):
+        return self.identServers[ID]
+
+    def _sendMessage(self, target, records, context):
+        self.messages.append((target, records))
+
+
+class FakeConnection(object):
+    def addListener(self, f, source, ID):
+        pass
+
+
+class FakeContext(object):
+    def __init__(self, source):
+        self.source = source
+        self.ID = (source, 1)
+
+
+class Node(object):
+    """Buses, ident servers and a registry that outlive the manager."""
+
+    def __init__(self):
+        self.clock = task.Clock()
+        self.registry = FakeRegistry()
+        self.buses = [
+            FakeBus('a GPIB Bus', {
+                'GPIB0::1::INSTR': 'HEWLETT-PACKARD,E4407B,0,1',
+                'GPIB0::2::INSTR': 'Stanford_Research_Systems,SR780,0,1',
+                'GPIB0::3::INSTR': None,
+            }, self.clock),
+            FakeBus('b GPIB Bus', {
+                'GPIB0::1::INSTR': 'Agilent Technologies,N5242A,0,1',
+                'GPIB0::4::INSTR': None,
+            }, self.clock),
+        ]
+        self.scope = FakeIdentServer('Sampling Scope', 101, {
+            ('a GPIB Bus', 'GPIB0::3::INSTR'): 'Tektronix 11801C',
+            ('b GPIB Bus', 'GPIB0::4::INSTR'): 'Tektronix 11801C',
+        }, self.clock)
+        self.other = FakeIdentServer('Other Server', 102, {}, self.clock)
+
+    def manager(self, identServers=()):
+        mgr = gpib_device_manager.GPIBDeviceManager()
+        mgr.client = FakeClient(self.buses, self.registry)
+        mgr._cxn = FakeConnection()
+        self.start(mgr)
+        for s in identServers:
+            self.register(mgr, s)
+            self.run(mgr.identifyDevicesWithServer(s.ID))
+        return mgr
+
+    def start(self, mgr):
+        for bus in self.buses:
+            bus.queries = []
+        self.run(mgr.initServer())
+        self.run(mgr.scanning)
+
+    def register(self, mgr, s):
+        mgr.client.identServers[s.ID] = s
+        mgr.register_ident_function(FakeContext(s.ID), 'identify_device')
+
+    def run(self, d):
+        result = []
+        d.addBoth(result.append)
+        while not result:
+            self.clock.advance(0.05)
+        if hasattr(result[0], 'raiseException'):
+            result[0].raiseException()
+        return result[0]
+
+    def queries(self):
+        return sum(len(bus.queries) for bus in self.buses)
+
+
+@pytest.fixture
+def node():
+    return Node()
+
+
+def names(mgr):
+    return dict((key, name) for key, (name, idn) in mgr.knownDevices.items())
+
+
+def test_identifies_concurrently_across_buses(node):
+    start = node.clock.seconds()
+    mgr = node.manager()
+    assert names(mgr) == {
+        ('a GPIB Bus', 'GPIB0::1::INSTR'): 'HEWLETT-PACKARD E4407B',
+        ('a GPIB Bus', 'GPIB0::2::INSTR'): 'Stanford_Research_Systems SR780',
+        ('a GPIB Bus', 'GPIB0::3::INSTR'): UNKNOWN,
+        ('b GPIB Bus', 'GPIB0::1::INSTR'): 'Agilent Technologies N5242A',
+        ('b GPIB Bus', 'GPIB0::4::INSTR'): UNKNOWN,
+    }
+    # one query at a time per bus, buses in parallel
+    assert [bus.maxActive for bus in node.buses] == [1, 1]
+    assert node.clock.seconds() - start < 1.5
+    assert mgr.stats.counts['*IDN? queries'] == 5
+    assert 'Identified 5 devices' in mgr.startup_report(None)
+
+
+def test_new_ident_server_identifies_unknown_devices(node):
+    mgr = node.manager()
+    node.register(mgr, node.other)
+    node.register(mgr, node.scope)
+    node.run(mgr.identifyDevicesWithServer(node.scope.ID))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == 'Tektronix 11801C'
+    assert names(mgr)['b GPIB Bus', 'GPIB0::4::INSTR'] == 'Tektronix 11801C'
+    entries = node.registry.dirs[tuple(gpib_device_manager.CACHE_PATH)]
+    assert sorted(entries[gpib_device_manager.CACHE_KEY]) == [
+        ('a GPIB Bus', 'GPIB0::3::INSTR', False, '', 'Tektronix 11801C',
+         'Sampling Scope'),
+        ('b GPIB Bus', 'GPIB0::4::INSTR', False, '', 'Tektronix 11801C',
+         'Sampling Scope'),
+    ]
+
+
+def test_cache_skips_idn_query_and_other_identifiers(node):
+    mgr = node.manager([node.other, node.scope])
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == 'Tektronix 11801C'
+    assert node.queries() == 5
+    # restart, with the ident servers already registered
+    node.scope.calls = []
+    node.other.calls = []
+    mgr = node.manager()
+    node.register(mgr, node.other)
+    node.register(mgr, node.scope)
+    for bus in node.buses:
+        bus.queries = []
+    del mgr.knownDevices['a GPIB Bus', 'GPIB0::3::INSTR']
+    node.run(mgr.gpib_device_connect('a GPIB Bus', 'GPIB0::3::INSTR'))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == 'Tektronix 11801C'
+    assert node.queries() == 0
+    assert node.scope.calls == [('a GPIB Bus', 'GPIB0::3::INSTR', None)]
+    assert node.other.calls == []
+    assert mgr.stats.counts['cache hits'] == 1
+
+
+def test_cache_waits_for_identifier_to_register(node):
+    node.manager([node.scope])
+    mgr = node.manager()
+    # devices that didn't answer *IDN? before are not queried
+    assert node.queries() == 3
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == UNKNOWN
+    node.register(mgr, node.scope)
+    node.run(mgr.identifyDevicesWithServer(node.scope.ID))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == 'Tektronix 11801C'
+    assert names(mgr)['b GPIB Bus', 'GPIB0::4::INSTR'] == 'Tektronix 11801C'
+    assert not mgr.unconfirmed
+
+
+def test_changed_device_is_identified_again(node):
+    node.manager([node.scope])
+    # a device that answers *IDN? replaces the scope
+    node.buses[0].devices['GPIB0::3::INSTR'] = 'Keysight Technologies,N9010A,0,1'
+    del node.scope.names['a GPIB Bus', 'GPIB0::3::INSTR']
+    mgr = node.manager()
+    node.register(mgr, node.scope)
+    node.run(mgr.identifyDevicesWithServer(node.scope.ID))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == \
+        'Keysight Technologies N9010A'
+    assert ('a GPIB Bus', 'GPIB0::3::INSTR') not in mgr.cache.entries
+    assert ('b GPIB Bus', 'GPIB0::4::INSTR') in mgr.cache.entries
+
+
+def test_rejected_cache_entry_is_dropped(node):
+    node.manager([node.scope])
+    # the scope that didn't answer *IDN? is replaced by another such device
+    del node.scope.names['a GPIB Bus', 'GPIB0::3::INSTR']
+    mgr = node.manager()
+    node.register(mgr, node.other)
+    node.register(mgr, node.scope)
+    node.scope.calls = []
+    del mgr.knownDevices['a GPIB Bus', 'GPIB0::3::INSTR']
+    node.run(mgr.gpib_device_connect('a GPIB Bus', 'GPIB0::3::INSTR'))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == UNKNOWN
+    # the scope is asked once, and the other server too
+    assert node.scope.calls == [('a GPIB Bus', 'GPIB0::3::INSTR', None)]
+    assert node.other.calls == [('a GPIB Bus', 'GPIB0::3::INSTR', None)]
+    assert ('a GPIB Bus', 'GPIB0::3::INSTR') not in mgr.cache.entries
+    entries = node.registry.dirs[tuple(gpib_device_manager.CACHE_PATH)]
+    assert [e[:2] for e in entries[gpib_device_manager.CACHE_KEY]] == \
+        [('b GPIB Bus', 'GPIB0::4::INSTR')]
+    # after a restart, the device is queried like a new one
+    node.manager()
+    assert 'GPIB0::3::INSTR' in node.buses[0].queries
+
+
+def test_other_identifier_is_not_a_cache_hit(node):
+    node.manager([node.scope])
+    mgr = node.manager()
+    # another server recognizes the device before the cached one registers
+    node.other.names['a GPIB Bus', 'GPIB0::3::INSTR'] = 'Other Device'
+    node.register(mgr, node.other)
+    node.run(mgr.identifyDevicesWithServer(node.other.ID))
+    assert names(mgr)['a GPIB Bus', 'GPIB0::3::INSTR'] == 'Other Device'
+    assert 'cache hits' not in mgr.stats.counts
+    node.register(mgr, node.scope)
+    node.run(mgr.identifyDevicesWithServer(node.scope.ID))
+    assert names(mgr)['b GPIB Bus', 'GPIB0::4::INSTR'] == 'Tektronix 11801C'
+    assert mgr.stats.counts['cache hits'] == 1
+
+
+def test_failed_identify_is_in_startup_report(node, monkeypatch):
+    identify = gpib_device_manager.GPIBDeviceManager.identify
+
+    def failing(self, server, channel):
+        if channel == 'GPIB0::2::INSTR':
+            raise ValueError('bus error')
+        return identify(self, server, channel)
+    monkeypatch.setattr(gpib_device_manager.GPIBDeviceManager, 'identify',
+                        failing)
+    mgr = node.manager()
+    assert len(mgr.knownDevices) == 4
+    assert '  errors: 1' in mgr.startup_report(None).splitlines()
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,209 @@
+"""
+Talk to fake instruments through the GPIB Bus server, without a labrad
+manager: settings are called directly and worker results are delivered by
+a fake reactor.
+"""
+
+import Queue
+import time
+
+import pytest
+
+from twisted.internet.defer import gatherResults
+from twisted.python import failure
+
+pytest.importorskip('visa')
+
+import fake_visa
+import gpib_server
+import labrad.units as units
+
+
+class FakeReactor(object):
+    """Collects calls from worker threads, to run them in the test thread."""
+
+    def __init__(self):
+        self.calls = Queue.Queue()
+
+    def callFromThread(self, f, *args, **kw):
+        self.calls.put((f, args, kw))
+
+    def wait(self, d, timeout=10.0):
+        result = []
+        d.addBoth(result.append)
+        end = time.time() + timeout
+        while not result:
+            f, args, kw = self.calls.get(timeout=end - time.time())
+            f(*args, **kw)
+        if isinstance(result[0], failure.Failure):
+            result[0].raiseException()
+        return result[0]
+
+
+@pytest.fixture
+def bus():
+    reactor = FakeReactor()
+    server = gpib_server.GPIBBusServer()
+    server.resourceManager = fake_visa.FakeResourceManager([
+        fake_visa.FakeInstrument('GPIB0::1::INSTR', delay=0.2),
+        fake_visa.FakeInstrument('GPIB0::2::INSTR', delay=0.2),
+        fake_visa.FakeInstrument('ASRL1::INSTR'),
+    ])
+    server.sendDeviceMessage = lambda msg, addr: None
+    server.devices = {}
+    server.transports = {}
+    server.metrics = gpib_server.Metrics()
+    server.workers = gpib_server.AddressWorkers(4, reactor=reactor)
+    server.workers.start()
+    reactor.wait(server.refreshDevices())
+    yield server, reactor
+    server.workers.stop()
+
+
+def context(server, addr):
+    c = server.newContext(addr)
+    server.initContext(c)
+    server.address(c, addr)
+    return c
+
+
+def test_refresh_opens_known_device_types(bus):
+    server, reactor = bus
+    assert server.list_devices(None) == ['GPIB0::1::INSTR', 'GPIB0::2::INSTR']
+    instr = server.devices['GPIB0::1::INSTR']
+    assert instr.log == [('clear',)]
+    assert instr.write_termination == ''
+
+
+def test_addresses_run_in_parallel(bus):
+    server, reactor = bus
+    c1 = context(server, 'GPIB0::1::INSTR')
+    c2 = context(server, 'GPIB0::2::INSTR')
+    start = time.time()
+    ans = reactor.wait(gatherResults([server.query(c1, 'A?'),
+                                      server.query(c2, 'B?')]))
+    assert ans == ['A?', 'B?']
+    assert time.time() - start < 0.35
+
+
+def test_queries_to_one_address_are_atomic(bus):
+    server, reactor = bus
+    instr = server.devices['GPIB0::1::INSTR']
+    contexts = [context(server, 'GPIB0::1::INSTR') for i in range(3)]
+    start = time.time()
+    ds = [server.query(c, 'Q%d?' % i) for i, c in enumerate(contexts)]
+    ds.append(server.write(contexts[0], 'W'))
+    ans = reactor.wait(gatherResults(ds))
+    assert ans == ['Q0?', 'Q1?', 'Q2?', None]
+    assert time.time() - start >= 0.6
+    assert instr.overlaps == 0
+    assert instr.log[1:] == [('write', 'Q0?'), ('read', None),
+                             ('write', 'Q1?'), ('read', None),
+                             ('write', 'Q2?'), ('read', None),
+                             ('write', 'W')]
+
+
+def test_context_timeout_is_applied(bus):
+    server, reactor = bus
+    instr = server.devices['GPIB0::1::INSTR']
+    slow = context(server, 'GPIB0::1::INSTR')
+    server.timeout(slow, 0.05 * units.s)
+    start = time.time()
+    with pytest.raises(fake_visa.FakeVisaTimeout):
+        reactor.wait(server.query(slow, 'A?'))
+    assert time.time() - start < 0.15
+    assert instr.timeout == 50
+    # other contexts keep their own timeout
+    c = context(server, 'GPIB0::1::INSTR')
+    assert reactor.wait(server.query(c, 'B?')) == 'B?'
+    assert instr.timeout == 1000
+
+
+def test_read_and_read_raw(bus):
+    server, reactor = bus
+    c = context(server, 'GPIB0::2::INSTR')
+    server.devices['GPIB0::2::INSTR'].delay = 0.0
+    reactor.wait(server.write(c, ' 12345 '))
+    assert reactor.wait(server.read_raw(c, 3)) == ' 12'
+    assert reactor.wait(server.read(c)) == '345'
+
+
+def test_no_device_selected(bus):
+    server, reactor = bus
+    c = server.newContext(1)
+    server.initContext(c)
+    with pytest.raises(Exception):
+        reactor.wait(server.query(c, '*IDN?'))
+
+
+def queriesOnly(instr, command):
+    if command.endswith('?'):
+        return ' %s ' % command
+
+
+def test_transaction_runs_ops_in_order(bus):
+    server, reactor = bus
+    instr = server.devices['GPIB0::2::INSTR']
+    instr.delay = 0.0
+    instr.respond = queriesOnly
+    c = context(server, 'GPIB0::2::INSTR')
+    ops = [('write', ':FREQ 5'), ('query', 'A?'), ('write', 'DATA?'),
+           ('read_raw', '2'), ('read', ''), ('write_raw', 'B?\n'),
+           ('READ_RAW', '')]
+    ans = reactor.wait(server.transaction(c, ops))
+    assert ans == ['', 'A?', '', ' D', 'ATA?', '', ' B? ']
+    assert instr.log[1:] == [('write', ':FREQ 5'), ('write', 'A?'),
+                             ('read', None), ('write', 'DATA?'),
+                             ('read', 2), ('read', None),
+                             ('write', 'B?\n'), ('read', None)]
+
+
+def test_transaction_is_atomic(bus):
+    server, reactor = bus
+    instr = server.devices['GPIB0::1::INSTR']
+    instr.delay = 0.05
+    c1 = context(server, 'GPIB0::1::INSTR')
+    c2 = context(server, 'GPIB0::1::INSTR')
+    ds = [server.transaction(c1, [('query', 'A?'), ('query', 'B?')]),
+          server.query(c2, 'C?'),
+          server.transaction(c1, [('write', 'D?'), ('read_raw', '')])]
+    ans = reactor.wait(gatherResults(ds))
+    assert ans == [['A?', 'B?'], 'C?', ['', 'D?']]
+    assert instr.overlaps == 0
+    assert [entry[1] for entry in instr.log[1:] if entry[0] == 'write'] == \
+        ['A?', 'B?', 'C?', 'D?']
+
+
+def test_invalid_transaction_does_nothing(bus):
+    server, reactor = bus
+    instr = server.devices['GPIB0::2::INSTR']
+    c = context(server, 'GPIB0::2::INSTR')
+    with pytest.raises(ValueError):
+        reactor.wait(server.transaction(c, [('write', 'A'), ('poke', '')]))
+    with pytest.raises(ValueError):
+        reactor.wait(server.transaction(c, [('write', 'A'), ('read', 'x')]))
+    assert instr.log == [('clear',)]
+
+
+def test_transport_metrics(bus):
+    server, reactor = bus
+    c = context(server, 'GPIB0::2::INSTR')
+    instr = server.devices['GPIB0::2::INSTR']
+    instr.delay = 0.0
+    instr.respond = queriesOnly
+    reactor.wait(server.write(c, 'A'))
+    reactor.wait(server.query(c, 'BC?'))
+    server.timeout(c, 0.05 * units.s)
+    with pytest.raises(fake_visa.FakeVisaTimeout):
+        reactor.wait(server.read(c))
+    rows = dict(((addr, op), (count, nbytes, errors))
+                for addr, op, count, nbytes, errors, t
+                in server.transport_metrics(c))
+    assert rows == {('GPIB0::2::INSTR', 'write'): (1, 1, 0),
+                    ('GPIB0::2::INSTR', 'query'): (1, 8, 0),
+                    ('GPIB0::2::INSTR', 'read'): (1, 0, 1)}
+    assert server.transport_metrics(c, 'GPIB0::1::INSTR') == []
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,147 @@
+"""
+Calibrations and the channel scan of the Lakeshore RuOx server, without
+an instrument.
+"""
+
+import math
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from labrad.units import Value
+import lakeshore370
+from lakeshore370 import (FunctionCalibration, InterpolationCalibration,
+                          ScanScheduler, VRHCalibration)
+
+JULES = '((math.log(r) - 6.02) / 1.76) ** (-1/.345)'
+JULES_INVERSE = 'math.exp(1.76*(t**(-0.345)) + 6.02)'
+
+RES = [1000.0, 1500.0, 3000.0, 10000.0, 60000.0]
+TEMPS = [4.0, 1.0, 0.3, 0.05, 0.01]
+
+
+def test_interpolation():
+    # not sorted in the registry
+    cal = InterpolationCalibration(RES[::-1], TEMPS[::-1])
+    r = np.array([1000.0, 2000.0, 20000.0, 1e5, -1.0])
+    expected = np.exp(np.interp(np.log(r[:4]), np.log(RES), np.log(TEMPS)))
+    assert np.allclose(cal.temperatures(r)[:4], expected)
+    # a failed conversion gives 0
+    assert cal.temperatures(r)[4] == 0.0
+    assert np.allclose(cal.resistances(cal.temperatures(r[:3])), r[:3])
+
+
+def test_vrh():
+    cal = VRHCalibration(Value(100.0, 'Ohm'), Value(20.0, 'K'))
+    r = np.array([1e3, 1e4])
+    assert np.allclose(cal.temperatures(r), 20.0 / np.log(100.0 / r)**4)
+    assert np.allclose(cal.resistances(cal.temperatures(r)), r)
+
+
+def test_function_is_evaluated_on_arrays():
+    cal = FunctionCalibration(JULES, JULES_INVERSE)
+    r = np.array([1500.0, 3000.0, 20000.0])
+    expected = [eval(JULES, {'math': math}, {'r': x}) for x in r]
+    assert np.allclose(cal.temperatures(r), expected)
+    assert np.allclose(cal.resistances(cal.temperatures(r)), r)
+    # math functions that numpy doesn't have, and conditions, are evaluated
+    # one value at a time
+    cal = FunctionCalibration('math.pow(r, 2) if r > 2 else 1 / 0', 't')
+    assert list(cal.temperatures([1.0, 3.0])) == [0.0, 9.0]
+    assert len(cal.warned) == 2
+    cal.temperatures([1.0, 3.0])
+    assert len(cal.warned) == 2
+    # numpy is available one value at a time too
+    cal = FunctionCalibration('np.log(r) if r > 2 else 1.0', 't')
+    assert list(cal.temperatures([1.0, 3.0])) == [1.0, math.log(3.0)]
+
+
+def wrapper(calibrations, resistances):
+    dev = lakeshore370.RuOxWrapper(1, 'DR GPIB Bus - GPIB0::12')
+    dev.calibrations = calibrations
+    dev.readings = lakeshore370.ReadingCache()
+    dev.channelNames = ['ch%d' % (i + 1) for i in range(len(resistances))]
+    for i, r in enumerate(resistances):
+        dev.readings[i + 1] = Value(r, 'Ohm'), datetime(2020, 1, 1)
+    return dev
+
+
+def test_temperatures_of_all_channels():
+    interp = InterpolationCalibration(RES, TEMPS)
+    function = FunctionCalibration(JULES, JULES_INVERSE)
+    default = lakeshore370.DEFAULT_CALIBRATION
+    # channels 2 and 4 use the device calibration, 5 has none
+    dev = wrapper([function, interp, default, interp, default],
+                  [2000.0, 3000.0, 4000.0, 5000.0, 6000.0])
+    temps = dev.getTemperatures()
+    for ch, (t, time) in zip(range(1, 6), temps):
+        assert t['K'] == pytest.approx(dev.getSingleTemp(ch)['K'])
+    assert temps[0][0]['K'] == pytest.approx(interp.temperatures(2000.0))
+    assert temps[1][0]['K'] == pytest.approx(function.temperatures(3000.0))
+    assert temps[4][0]['K'] == \
+        pytest.approx(lakeshore370.res2temp(6000.0)['K'])
+    assert dev.getNamedTemperatures()[2] == ('ch3', temps[2])
+    assert dev.singleTempToRes(temps[1][0]['K'], 2) == pytest.approx(3000.0)
+
+
+def test_only_requests_count_as_saved_queries():
+    dev = wrapper([lakeshore370.DEFAULT_CALIBRATION] * 2, [2000.0, 3000.0])
+    server = lakeshore370.LakeshoreRuOxServer()
+    server.selectedDevice = lambda c: dev
+    server.temperatures(None)
+    server.named_resistances(None)
+    # as when notifying subscribers
+    dev.getTemperatures()
+    assert dict(dev.readings.statistics())['saved'] == 2
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def scan(scheduler, clock, n, resistance=lambda ch, t: 1000.0):
+    channels = []
+    for i in range(n):
+        ch = scheduler.next()
+        clock.now += 1.0
+        scheduler.record(ch, resistance(ch, clock.now))
+        channels.append(ch)
+    return channels
+
+
+def test_scan_follows_read_order_priorities():
+    clock = Clock()
+    scheduler = ScanScheduler(lakeshore370.READ_ORDER, clock)
+    upcoming = scheduler.schedule(16)
+    channels = scan(scheduler, clock, 40)
+    assert channels[:16] == upcoming
+    # interleaved, and in proportion to the read order
+    assert channels[:8] == channels[8:16]
+    assert sorted(channels[:8]) == sorted(lakeshore370.READ_ORDER)
+    assert all(1 in channels[i:i + 3] for i in range(len(channels) - 2))
+
+
+def test_scan_reads_changing_channels_more_often():
+    clock = Clock()
+    scheduler = ScanScheduler([1, 2, 3, 4], clock)
+    # channel 4, e.g. the mixing chamber, is warming up by 1% per s
+    channels = scan(scheduler, clock, 100, lambda ch, t:
+                    1000.0 * (0.99 ** t if ch == 4 else 1))
+    assert channels[-50:].count(4) > 2 * channels[-50:].count(1)
+    assert scheduler.rates[4] == pytest.approx(math.log(1 / 0.99), rel=0.01)
+    clock.now += 1.0
+    rows = dict((row[0], row[1:]) for row in scheduler.rows())
+    assert rows[4][2] == Value(1.0, 's')
+    assert rows[4][3] == channels.count(4)
+    scheduler.setPriority(4, 0)
+    assert 4 not in scan(scheduler, clock, 10)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,183 @@
+"""
+Log to and read back from the Logger's storage in a temporary directory,
+calling the settings directly, with a fake clock for notifications.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from twisted.internet import task
+
+import labrad.units as units
+import log_server
+from log_server import DAY, toMicros
+
+
+class Context(dict):
+    def __init__(self, ID):
+        dict.__init__(self)
+        self.ID = ID
+
+
+class Messages(object):
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, data, contexts=None):
+        self.sent.append((data, contexts if contexts is None
+                          else sorted(contexts)))
+
+
+@pytest.fixture
+def server(tmpdir):
+    server = log_server.Logger(str(tmpdir))
+    server.reactor = task.Clock()
+    server.onNewLog = Messages()
+    server.onNewVar = Messages()
+    server.onNewData = Messages()
+    return server
+
+
+def test_log_and_get(server):
+    c = Context(1)
+    server.open_log(c, ['fridge', 'dr'], True)
+    assert server.onNewLog.sent == [(['fridge', 'dr'], None)]
+    start = datetime.now()
+    server.log_data(c, [('T', 4.2 * units.K), ('P', 1e-6), ('valve', True)])
+    server.log_data(c, [('T', 3.9 * units.K), ('note', 'cooling')])
+    assert server.onNewVar.sent == [(('fridge/dr', name), None)
+                                    for name in ['T', 'P', 'valve', 'note']]
+    T, note = server.get_data(c, ['T', 'note'], (start, datetime.now()))
+    assert [v for t, v in T] == [4.2 * units.K, 3.9 * units.K]
+    assert T[0][0] < T[1][0]
+    assert [v for t, v in note] == ['cooling']
+    first, last, channels = server.describe(c, 'fridge/dr')
+    assert [ch[:2] for ch in channels] == \
+        [('T', 'v[K]'), ('P', 'v'), ('valve', 'b'), ('note', 's')]
+    assert first == T[0][0] and last == T[1][0]
+
+
+def test_channel_type_is_kept(server):
+    c = Context(1)
+    server.open_log(c, 'x', True)
+    server.log_data(c, [('T', 4.2 * units.K), ('n', 3)])
+    server.log_data(c, [('T', 100 * units.mK)])
+    for data in [[('T', 1.0)], [('T', 2 * units.V)], [('n', 'three')]]:
+        with pytest.raises(log_server.ChannelTypeError):
+            server.log_data(c, data)
+    T, = server.get_data(c, 'T', datetime(2000, 1, 1))
+    assert [v['K'] for t, v in T] == [4.2, 0.1]
+
+
+def test_reopen_from_disk(server, tmpdir):
+    c = Context(1)
+    server.open_log(c, 'a/b', True)
+    channel = c['log']['T']
+    base = toMicros(datetime(2020, 5, 31, 23, 0))
+    times = base + np.arange(0, 7200) * 10**6
+    channel.addEntries(times, np.arange(7200.0))
+    c['log']['msg'].addEntries(times[:3], ['x', '', 'yz'])
+    server.stopServer()
+
+    other = log_server.Logger(str(tmpdir))
+    c = Context(2)
+    first, last, channels = other.open_log(c, ['a', 'b'])
+    assert channels[0] == ('T', 'v', datetime(2020, 5, 31, 23, 0),
+                           datetime(2020, 6, 1, 0, 59, 59))
+    assert os.path.exists(str(tmpdir.join('a', 'b', '2020', '06', '01', 'T.t')))
+    T, msg = other.get_data(c, ['T', 'msg'], (datetime(2020, 5, 31, 23, 59, 58),
+                                              datetime(2020, 6, 1, 0, 0, 2)))
+    assert [v for t, v in T] == [3598.0, 3599.0, 3600.0, 3601.0]
+    assert msg == []
+    msg, = other.get_data(c, 'msg', datetime(2020, 1, 1))
+    assert [v for t, v in msg] == ['x', '', 'yz']
+    assert other.get_log_list(c) == ['a/b']
+    assert other.get_log_list(c, ['a', 'c']) == []
+    with pytest.raises(log_server.NoSuchLogError):
+        other.open_log(c, 'c')
+
+
+def test_times_only_increase(server):
+    c = Context(1)
+    server.open_log(c, 'x', True)
+    channel = c['log']['T']
+    channel.addEntries([10, 10, 5, 20], [1, 2, 3, 4])
+    channel.addEntries([15], [5])
+    assert list(channel.get(0)[0]) == [10, 11, 12, 20, 21]
+
+
+def test_range_queries(server):
+    c = Context(1)
+    server.open_log(c, 'x', True)
+    channel = c['log']['T']
+    base = toMicros(datetime(2021, 1, 1))
+    # 5 days of data, every 10 minutes, with a missing day
+    times = base + np.arange(0, 5 * DAY, 600 * 10**6)
+    times = times[(times - base) // DAY != 2]
+    channel.addEntries(times, np.arange(len(times)))
+    assert len(channel.days) == 4
+    for start, end in [(0, 10**20), (base + DAY // 2, base + 4 * DAY + 1),
+                       (base + 2 * DAY, base + 3 * DAY),
+                       (base + 3 * DAY - 1, base + 3 * DAY + 1)]:
+        t, v = channel.get(start, end)
+        expected = (times >= start) & (times < end)
+        assert list(t) == list(times[expected])
+        assert list(v) == list(np.flatnonzero(expected))
+    t, v = channel.get(base + DAY // 2, base + 4 * DAY, limit=300)
+    assert len(t) == 300 and t[0] == base + DAY // 2
+    assert list(v) == range(72, 372)
+
+
+def test_get_continues_in_pages(server):
+    c = Context(1)
+    server.open_log(c, 'x', True)
+    start = datetime(2021, 1, 1)
+    c['log']['T'].addEntries(toMicros(start) + np.arange(5), range(5))
+    pages = []
+    for i in range(3):
+        T, = server.get_data(c, 'T', (start, start + timedelta(1)), 2)
+        pages.append([v for t, v in T])
+    assert pages == [[0, 1], [2, 3], [4]]
+    # each page but the last announces more data
+    assert server.onNewData.sent == [(None, [1])] * 2
+    assert c['log'].listeners == {}
+
+
+def test_streaming_notifications_are_coalesced(server):
+    c, other = Context(1), Context(2)
+    server.open_log(c, 'x', True)
+    server.open_log(other, 'x')
+    server.log_data(c, [('T', 1.0), ('P', 2.0)])
+    start = datetime.now() - timedelta(1)
+    T, P = server.get_data(c, ['T', 'P'], start)
+    assert len(T) == 1 and len(P) == 1
+    server.get_data(other, 'P', start)
+    assert server.onNewData.sent == []
+    server.log_data(c, [('T', 1.5)])
+    server.log_data(c, [('T', 1.6), ('P', 2.1)])
+    server.log_data(c, [('T', 1.7)])
+    assert server.onNewData.sent == []
+    server.reactor.advance(server.notifyDelay)
+    assert server.onNewData.sent == [(None, [1, 2])]
+    # no more messages until the data is read
+    server.log_data(c, [('P', 2.2)])
+    server.reactor.advance(server.notifyDelay)
+    assert len(server.onNewData.sent) == 1
+    T, P = server.get_data(c, ['T', 'P'], start, 2)
+    assert [v for t, v in T] == [1.5, 1.6]
+    assert [v for t, v in P] == [2.1, 2.2]
+    # T has one more
+    assert server.onNewData.sent[1:] == [(None, [1])]
+    T, P = server.get_data(c, ['T', 'P'], start, 2)
+    assert [v for t, v in T] == [1.7] and P == []
+    server.expireContext(other)
+    server.log_data(c, [('P', 2.3)])
+    server.reactor.advance(server.notifyDelay)
+    assert server.onNewData.sent[2:] == [(None, [1])]
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,62 @@
+"""
+The row buffer and decimation behind the live plots of LabRADPlotWidget3.
+"""
+
+import numpy as np
+import pytest
+
+from GUIs.plot_buffer import DataBuffer, decimate
+
+
+def rows(start, stop):
+    t = np.arange(start, stop, dtype=float)
+    return np.column_stack((t, 2 * t))
+
+
+def test_buffer_grows():
+    buf = DataBuffer(2, capacity=4)
+    for start in range(0, 100, 7):
+        buf.append(rows(start, start + 7))
+    buf.append(np.zeros((0, 2)))
+    assert len(buf) == 105
+    assert np.array_equal(buf.data, rows(0, 105))
+    assert len(buf.array) == 128
+    # the data can be changed in place, e.g. to convert units
+    buf.data[:, 0] *= 1e3
+    assert buf.data[-1, 0] == 104e3
+    with pytest.raises(ValueError):
+        buf.append(np.zeros((1, 3)))
+    buf.clear(3)
+    assert len(buf) == 0 and buf.data.shape == (0, 3)
+
+
+def test_buffer_keeps_the_latest_rows():
+    buf = DataBuffer(2, capacity=1, maxRows=10)
+    for start in range(0, 95, 5):
+        buf.append(rows(start, start + 5))
+        assert 10 <= len(buf) <= 20 or start < 10
+        assert np.array_equal(buf.data, rows(start + 5 - len(buf), start + 5))
+    assert len(buf.array) == 20
+    buf.append(rows(100, 150))
+    assert np.array_equal(buf.data, rows(140, 150))
+
+
+def test_decimate_keeps_extremes():
+    x = np.arange(10000.0)
+    y = np.sin(x / 500.0)
+    y[1234] = 5.0
+    y[7777] = -5.0
+    xd, yd = decimate(x, y, 100)
+    assert len(xd) <= 200 + 100
+    assert np.all(np.diff(xd) > 0)
+    assert np.array_equal(y[xd.astype(int)], yd)
+    assert yd.max() == 5.0 and yd.min() == -5.0
+    assert xd[-1] == x[-1]
+    # short curves are drawn as they are
+    xs, ys = decimate(x[:150], y[:150], 100)
+    assert len(xs) == 150
+    assert decimate(x, y, 0)[0] is x
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,142 @@
+"""
+Share the readings of a fake instrument between requests and subscribers,
+on a fake clock.
+"""
+
+import pytest
+
+from twisted.internet import task
+
+from reading_cache import ReadingCache
+
+
+class Instrument(object):
+    """Takes delay seconds to read its channels."""
+
+    def __init__(self, clock, delay=0.5):
+        self.clock = clock
+        self.delay = delay
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        value = self.reads
+        return task.deferLater(self.clock, self.delay,
+                               lambda: {1: value, 2: -value})
+
+
+def result(d):
+    ans = []
+    d.addBoth(ans.append)
+    assert ans, 'not finished'
+    return ans[0]
+
+
+def values(readings):
+    return dict((ch, value) for ch, (value, t) in readings.items())
+
+
+def test_fresh_readings_are_shared():
+    clock = task.Clock()
+    inst = Instrument(clock)
+    cache = ReadingCache(inst.read, maxAge=2.0, reactor=clock)
+    # requests during a read wait for it
+    ds = [cache.latest() for i in range(3)]
+    clock.advance(0.5)
+    assert [values(result(d)) for d in ds] == [{1: 1, 2: -1}] * 3
+    clock.advance(1.5)
+    assert values(result(cache.latest())) == {1: 1, 2: -1}
+    # too old
+    clock.advance(0.6)
+    d = cache.latest()
+    clock.advance(0.5)
+    assert values(result(d)) == {1: 2, 2: -2}
+    assert values(result(cache.latest(maxAge=0.5))) == {1: 2, 2: -2}
+    assert inst.reads == 2
+    assert dict(cache.statistics()) == {
+        'queries': 2, 'saved': 4, 'notifications': 0, 'subscribers': 0}
+
+
+def test_read_errors_reach_all_waiting_requests():
+    clock = task.Clock()
+    cache = ReadingCache(lambda: task.deferLater(clock, 0.5, lambda: 1 / 0),
+                         reactor=clock)
+    ds = [cache.latest(), cache.latest()]
+    clock.advance(0.5)
+    for d in ds:
+        with pytest.raises(ZeroDivisionError):
+            result(d).raiseException()
+    assert cache.waiting is None
+
+
+def test_subscribers_get_at_most_one_message_per_period():
+    clock = task.Clock()
+    cache = ReadingCache(reactor=clock)
+    sent = []
+    cache.subscribe('a', 1.0, lambda key: sent.append((clock.seconds(), key)))
+    cache.subscribe('b', 0.0, lambda key: sent.append((clock.seconds(), key)))
+    for i in range(10):
+        cache[i % 3] = (i, None)
+        clock.advance(0.25)
+    assert [t for t, key in sent if key == 'a'] == [0.25, 1.25, 2.25]
+    assert [t for t, key in sent if key == 'b'] == \
+        [0.25 * i for i in range(1, 11)]
+    cache.unsubscribe('a')
+    cache.unsubscribe('b')
+    cache[0] = (0, None)
+    clock.advance(1.0)
+    assert len(sent) == 13
+    assert cache[2] == (8, None)
+    # channel 1 was last read at 1.75 s
+    assert cache.age() == 1.75
+    assert cache.isFresh([0], maxAge=1.0) and not cache.isFresh(maxAge=1.0)
+
+
+def test_subscribers_make_the_cache_poll():
+    clock = task.Clock()
+    inst = Instrument(clock, delay=0.1)
+    cache = ReadingCache(inst.read, maxAge=1.0, reactor=clock)
+    sent = []
+    cache.subscribe('a', 5.0, lambda key: sent.append(values(cache)))
+    cache.subscribe('b', 2.0, lambda key: sent.append(values(cache)))
+    clock.pump([0.1] * 50)
+    # polled every 2 s, for 'b', and 'a' hasn't had its second message
+    assert inst.reads == 3
+    assert sent == [{1: 1, 2: -1}] * 2 + [{1: 2, 2: -2}, {1: 3, 2: -3}]
+    # not polled more often than maxAge
+    cache.subscribe('b', 0.1, lambda key: None)
+    assert cache.loop.interval == 1.0
+    cache.stop()
+    assert cache.loop is None and cache.subscribers == {}
+    clock.advance(10)
+    assert inst.reads == 4
+
+
+
+def test_lakeshore218_temperatures_are_shared():
+    import lakeshore218
+    from labrad.units import K
+    clock = task.Clock()
+    dev = lakeshore218.DiodeWrapper(1, 'GPIB Bus - GPIB0::5')
+    dev.initialize()
+    dev.readings.reactor = clock
+    queries = []
+
+    def query(q):
+        queries.append(q)
+        return task.deferLater(clock, 0.2, lambda: '+4.2,x77.1,+300.0')
+    dev.query = query
+    ds = [dev.getTemperatures() for i in range(2)]
+    clock.advance(0.2)
+    assert [result(d) for d in ds] == [[4.2 * K, 77.1 * K, 300.0 * K]] * 2
+    clock.advance(0.5)
+    result(dev.getTemperatures())
+    assert queries == ['KRDG? 0']
+    d = dev.getTemperatures(maxAge=0.1)
+    clock.advance(0.2)
+    assert len(result(d)) == 3 and len(queries) == 2
+    assert dict(dev.readings.statistics())['saved'] == 2
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
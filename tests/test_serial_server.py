@@ -0,0 +1,247 @@
+"""
+Read from a pty stand-in serial device through the Serial Server, without a
+labrad manager: settings are called directly and the bytes read by the
+port's reader thread are delivered by a fake reactor.
+"""
+
+import os
+import Queue
+import time
+
+import pytest
+
+from twisted.internet import task
+from twisted.python import failure
+
+pytest.importorskip('serial')
+if os.name != 'posix':
+    pytest.skip('pty devices need a posix system', allow_module_level=True)
+
+import fake_serial
+import labrad.units as units
+import serial_server
+
+
+class FakeReactor(task.Clock):
+    """Collects calls from the reader threads, to run them in the test
+    thread, with a clock that follows the time spent waiting for them."""
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.threadCalls = Queue.Queue()
+
+    def callFromThread(self, f, *args, **kw):
+        self.threadCalls.put((f, args, kw))
+
+    def settle(self, duration=0.05):
+        """Deliver what the reader threads get for duration seconds."""
+        self.wait(task.deferLater(self, duration, lambda: None))
+
+    def wait(self, d, timeout=5.0):
+        result = []
+        d.addBoth(result.append)
+        end = time.time() + timeout
+        last = time.time()
+        while not result:
+            assert time.time() < end, 'timed out'
+            try:
+                f, args, kw = self.threadCalls.get(timeout=0.01)
+                f(*args, **kw)
+            except Queue.Empty:
+                pass
+            now = time.time()
+            self.advance(now - last)
+            last = now
+        if isinstance(result[0], failure.Failure):
+            result[0].raiseException()
+        return result[0]
+
+
+@pytest.fixture
+def port():
+    device = fake_serial.PtyDevice()
+    server = serial_server.SerialServer()
+    server.reactor = FakeReactor()
+    server.metrics = serial_server.Metrics()
+    server.SerialPorts = [serial_server.SerialDevice('pty', device.port)]
+    c = {}
+    server.open(c, 'pty')
+    yield server, device, c
+    server.close(c)
+    device.close()
+
+
+def test_read_line_waits_for_response(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    server.write_line(c, 'MEAS?')
+    assert server.reactor.wait(server.read_line(c)) == 'MEAS?'
+    assert device.received == ['MEAS?']
+
+
+def test_read_line_with_delimiter(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    device.send('12;34;\r\n')
+    assert server.reactor.wait(server.read_line(c, ';')) == '12'
+    assert server.reactor.wait(server.read_line(c, ';')) == '34'
+    assert server.reactor.wait(server.read_line(c)) == ''
+
+
+def test_read_count_across_chunks(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    d = server.read(c, 6)
+    device.send('abc')
+    time.sleep(0.05)
+    device.send('defgh')
+    assert server.reactor.wait(d) == 'abcdef'
+    assert server.reactor.wait(server.read(c, 2)) == 'gh'
+
+
+def test_read_times_out_with_partial_data(port):
+    server, device, c = port
+    server.timeout(c, 0.2 * units.s)
+    device.send('abc')
+    start = time.time()
+    assert server.reactor.wait(server.read(c, 10)) == 'abc'
+    assert 0.15 < time.time() - start < 1.0
+    device.send('xy')
+    assert server.reactor.wait(server.read_line(c)) == 'xy'
+
+
+def test_read_without_timeout_does_not_wait(port):
+    server, device, c = port
+    assert server.reactor.wait(server.read(c, 10)) == ''
+    device.send('abc')
+    server.reactor.settle()
+    assert server.reactor.wait(server.read_line(c, 'z')) == 'abc'
+    device.send('abc')
+    server.reactor.settle()
+    # read(0) returns everything in the buffer
+    assert server.reactor.wait(server.read(c)) == 'abc'
+
+
+def test_read_as_words(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    device.send('\x00\x01\xff')
+    words = server.reactor.wait(server.read_as_words(c, 3))
+    assert list(words) == [0, 1, 255]
+    assert words.dtype == 'uint32'
+
+
+def test_reads_are_served_in_order(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    first = server.read_line(c)
+    second = server.read(c, 2)
+    device.send('one\r\nxyz')
+    assert server.reactor.wait(first) == 'one'
+    assert server.reactor.wait(second) == 'xy'
+
+
+def test_run_script(port):
+    server, device, c = port
+    device.delay = 0.02
+    steps = [('write_line', 'p', 0 * units.s),
+             ('pause', '', 0.05 * units.s),
+             ('read_line', '', 1 * units.s),
+             ('WRITE', 'f\n', 0 * units.s),
+             ('expect', '\r\n', 1 * units.s),
+             ('write_line', 'abc', 0 * units.s),
+             ('read', '2', 1 * units.s),
+             ('read', '', 0 * units.s)]
+    start = time.time()
+    ans = server.reactor.wait(server.run_script(c, steps))
+    assert ans == ['p', 'f', 'ab', 'c\r\n']
+    assert time.time() - start >= 0.05
+    assert device.received == ['p', 'f', 'abc']
+
+
+def test_run_script_expect_fails_on_timeout(port):
+    server, device, c = port
+    device.send('no delimiter')
+    steps = [('read', '3', 1 * units.s),
+             ('expect', ';', 0.1 * units.s)]
+    with pytest.raises(serial_server.ExpectTimeoutError):
+        server.reactor.wait(server.run_script(c, steps))
+    # the data is left for later reads
+    assert server.reactor.wait(server.read(c)) == 'delimiter'
+
+
+def test_invalid_script_does_nothing(port):
+    server, device, c = port
+    for steps in [[('write_line', 'A', 0 * units.s), ('poke', '', 0 * units.s)],
+                  [('write_line', 'A', 0 * units.s), ('read', 'x', 0 * units.s)]]:
+        with pytest.raises(ValueError):
+            server.reactor.wait(server.run_script(c, steps))
+    server.reactor.settle()
+    assert device.received == []
+
+
+def test_port_statistics(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    server.write_line(c, 'abc')
+    server.write(c, [100, 101, 102])
+    assert server.reactor.wait(server.read_line(c)) == 'abc'
+    server.reactor.settle()
+    assert dict(server.port_statistics(c)) == {
+        'bytes in': 5, 'bytes out': 8, 'overruns': 0, 'buffered': 0}
+
+
+def test_overrun_drops_oldest_bytes(port):
+    server, device, c = port
+    server.timeout(c, 1 * units.s)
+    c['PortReader'].buffer = serial_server.RingBuffer(16)
+    device.send('0123456789' * 3)
+    server.reactor.settle(0.1)
+    stats = dict(server.port_statistics(c))
+    assert stats['overruns'] == 14
+    assert stats['buffered'] == 16
+    assert server.reactor.wait(server.read(c)) == '4567890123456789'
+
+
+def test_ring_buffer_wraps_around():
+    buf = serial_server.RingBuffer(8)
+    buf.extend('abcdef')
+    assert buf.take(4).tobytes() == 'abcd'
+    buf.extend('\r\nxyz')
+    # 'ef\r\nxyz' now spans the end of the buffer
+    assert buf.start == 4
+    assert buf.find('\r\n') == 2
+    assert buf.find('z') == 6
+    assert buf.find('z', 7) == -1
+    assert buf.find('e') == 0
+    assert buf.find('q') == -1
+    assert buf.take(7).tobytes() == 'ef\r\nxyz'
+    assert len(buf) == 0 and buf.overruns == 0
+    buf.extend('0123456789')
+    assert buf.overruns == 2
+    assert buf.take(100).tobytes() == '23456789'
+
+
+def test_ring_buffer_finds_delimiter_across_the_end():
+    buf = serial_server.RingBuffer(8)
+    buf.extend('abcdefg')
+    buf.drop(6)
+    buf.extend('\r\nxy')
+    assert buf.find('\r\n') == 1
+    assert buf.find('g\r') == 0
+    buf.drop(2)
+    assert buf.find('\nx') == 0
+
+
+def test_close_stops_reader(port):
+    server, device, c = port
+    reader = c['PortReader']
+    server.close(c)
+    assert not reader.thread.is_alive()
+    assert 'PortObject' not in c
+    with pytest.raises(serial_server.NoPortSelectedError):
+        server.read(c)
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,205 @@
+"""
+Queueing, timeouts and operations of transports, on loopback instruments
+and a fake IBCL server, with a fake clock.
+"""
+
+import numpy as np
+import pytest
+
+from twisted.internet import defer, task
+
+import transport
+from transport import LoopbackTransport, TransportTimeoutError
+
+
+def run(clock, d, step=0.01, limit=10.0):
+    result = []
+    d.addBoth(result.append)
+    while not result and limit > 0:
+        clock.advance(step)
+        limit -= step
+    assert result, 'not finished'
+    if hasattr(result[0], 'raiseException'):
+        result[0].raiseException()
+    return result[0]
+
+
+def loopback(clock, **kw):
+    kw.setdefault('delay', 0.1)
+    return LoopbackTransport(reactor=clock, metrics=transport.Metrics(), **kw)
+
+
+def block(values):
+    payload = values.tostring()
+    length = str(len(payload))
+    return '#%d%s%s\n' % (len(length), length, payload)
+
+
+def test_queries_are_queued_in_order():
+    clock = task.Clock()
+    t = loopback(clock)
+    ds = [t.query('Q%d?' % i) for i in range(3)]
+    ds.append(t.write('W'))
+    ans = run(clock, defer.gatherResults(ds))
+    assert ans == ['Q0?', 'Q1?', 'Q2?', None]
+    assert t.written == ['Q0?', 'Q1?', 'Q2?', 'W']
+    assert clock.seconds() == pytest.approx(0.3, abs=0.02)
+
+
+def test_transports_run_independently():
+    clock = task.Clock()
+    ts = [loopback(clock, name='t%d' % i) for i in range(3)]
+    ans = run(clock, defer.gatherResults([t.query('A?') for t in ts]))
+    assert ans == ['A?'] * 3
+    assert clock.seconds() == pytest.approx(0.1, abs=0.02)
+
+
+def test_read_timeout():
+    clock = task.Clock()
+    t = loopback(clock, respond=lambda data: None)
+    with pytest.raises(TransportTimeoutError):
+        run(clock, t.query('A?', timeout=0.2))
+    assert clock.seconds() == pytest.approx(0.2, abs=0.02)
+    # the queue goes on
+    t.respond = transport.echo
+    assert run(clock, t.query('B?')) == 'B?'
+    # two queries, 6 bytes sent and received, one error
+    assert t.metrics.ops['loopback', 'query'][:3] == [2, 6, 1]
+
+
+def test_hung_operation_is_cancelled():
+    clock = task.Clock()
+    t = loopback(clock)
+    t.grace = 0.5
+    d = t.run('poke', lambda timeout: defer.Deferred(), timeout=1.0)
+    after = t.query('A?')
+    with pytest.raises(TransportTimeoutError):
+        run(clock, d)
+    assert clock.seconds() == pytest.approx(1.5, abs=0.02)
+    assert run(clock, after) == 'A?'
+
+
+def test_queued_operation_can_be_cancelled():
+    clock = task.Clock()
+    t = loopback(clock)
+    first = t.query('A?')
+    second = t.query('B?')
+    third = t.query('C?')
+    second.cancel()
+    assert run(clock, first) == 'A?'
+    assert run(clock, third) == 'C?'
+    assert t.written == ['A?', 'C?']
+    with pytest.raises(defer.CancelledError):
+        run(clock, second)
+
+
+def test_read_until_keeps_leftover():
+    clock = task.Clock()
+    t = loopback(clock, respond=lambda data: None)
+    t.send('1,2;3')
+    t.send(',4;')
+    assert run(clock, t.readUntil(';')) == '1,2'
+    assert run(clock, t.readUntil(';')) == '3,4'
+    t.send('5,6')
+    with pytest.raises(TransportTimeoutError):
+        run(clock, t.readUntil(';', timeout=0.1))
+    assert run(clock, t.readUntil(';', timeout=0.1, partial=True)) == '5,6'
+
+
+def test_read_count():
+    clock = task.Clock()
+    t = loopback(clock, respond=lambda data: None)
+    t.send('abcdef')
+    assert run(clock, t.read(4)) == 'abcd'
+    assert run(clock, t.read()) == 'ef'
+
+
+def test_read_block_across_messages():
+    clock = task.Clock()
+    t = loopback(clock, respond=lambda data: None)
+    values = np.arange(10, dtype='>i4')
+    data = block(values)
+    t.send(data[:5])
+    t.send(data[5:20])
+    t.send(data[20:])
+    ans = run(clock, t.readBlock('>i4'))
+    assert list(ans) == range(10)
+
+
+def test_query_block():
+    clock = task.Clock()
+    values = np.linspace(0, 1, 5)
+    t = loopback(clock, respond=lambda data: ' ' + block(values))
+    ans = run(clock, t.queryBlock('TRACE?', '<f8'))
+    assert np.all(ans == values)
+    assert t.metrics.ops['loopback', 'query_block'][1] == 6 + 40
+
+
+def test_transaction():
+    clock = task.Clock()
+    t = loopback(clock, respond=lambda data: data if '?' in data else None)
+    ops = [('write', 'FREQ 5'), ('pause', '', 0.5), ('query', 'A?'),
+           ('write', 'B?;C?'), ('read_until', ';'), ('read', None)]
+    d = t.transaction(ops)
+    # other traffic waits for the transaction
+    other = t.query('D?')
+    ans = run(clock, defer.gatherResults([d, other]))
+    assert ans == [['', '', 'A?', '', 'B?', 'C?'], 'D?']
+    assert t.written == ['FREQ 5', 'A?', 'B?;C?', 'D?']
+
+
+class FakeIBCLPacket(object):
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def select(self, name):
+        self.controller = name
+
+    def command(self, cmd, timeout, key):
+        self.commands.append(cmd)
+
+    def send(self):
+        cmd, = self.commands
+        self.server.commands.append((self.controller, cmd))
+        return defer.succeed({'ans': self.server.respond(cmd)})
+
+
+class FakeIBCL(object):
+    """The IBCL server, with a device that sends data."""
+
+    def __init__(self, data):
+        self.data = data
+        self.commands = []
+
+    def packet(self, context=None):
+        return FakeIBCLPacket(self)
+
+    def respond(self, cmd):
+        words = cmd.split()
+        if words[-1] == 'write':
+            return [['2000', '']]
+        n = int(words[2], 16)
+        data, self.data = self.data[:n], self.data[n:]
+        escaped = ''.join(c if 32 <= ord(c) < 127 else '%%%02X' % ord(c)
+                          for c in data.replace('%', '%%'))
+        return [['0', escaped]]
+
+
+def test_ibcl_transport():
+    clock = task.Clock()
+    ibcl = FakeIBCL('5%\x00\n' * 3000)
+    t = transport.IBCLTransport(ibcl, 'GPIB-422CT', 12, 1000, reactor=clock)
+    status = run(clock, t.write('*IDN?', timeout=0.3))
+    assert status[13] and not status[15]
+    assert ibcl.commands == [('GPIB-422CT', 'C " *IDN?" A write')]
+    ans = run(clock, t.read(11000, timeout=0.3))
+    assert ans == ('5%\x00\n' * 3000)[:11000]
+    assert [cmd for ctrl, cmd in ibcl.commands[1:]] == \
+        ['C 3E8 2710 A read', 'C 3E8 3E8 A read']
+    assert transport.ibclTimeoutIndex(0.3) == 10
+    assert transport.ibclTimeoutIndex(2000) == 0
+
+
+if __name__ == '__main__':
+    pytest.main(['-v', __file__])
@@ -0,0 +1,645 @@
+"""
+Asynchronous transports for instrument I/O, shared by the GPIB Bus, Serial
+and IBCL GPIB servers.
+
+A Transport is one resource, e.g. a GPIB address or a serial port, with
+the operations that device servers need: write, read, readUntil, query,
+transaction and readBlock. Operations on one transport are queued and run
+in order, without other traffic in between, while operations on different
+transports run independently. So a client can send several requests
+without waiting for each answer, and a slow instrument only holds up its
+own queue.
+
+Every operation takes a timeout in seconds, defaulting to the timeout of
+the transport. Adapters pass it on to the resource. If the resource doesn't
+give up by itself, the operation is cancelled grace seconds later, failing
+with TransportTimeoutError. Callers can also cancel the Deferred of an
+operation, e.g. one still waiting in the queue.
+
+Adapters implement _write and _readChunk, or _read and _readUntil for
+streams:
+
+    VisaTransport:     a pyvisa instrument, in a worker thread per address
+    SerialTransport:   a pyserial port, read by a serial_server.PortReader
+    IBCLTransport:     a GPIB device behind a GPIB-422CT controller, through
+                       the IBCL server
+    LoopbackTransport: an instrument in memory, for tests and benchmarks
+
+A metrics hook, e.g. Metrics, is told the time, bytes and outcome of every
+operation. Run this module to benchmark transports on loopback instruments.
+"""
+
+import argparse
+import time
+
+from labrad import errors
+import labrad.units as units
+from twisted.internet import reactor
+from twisted.internet.defer import (CancelledError, Deferred, DeferredList,
+                                    DeferredLock, inlineCallbacks,
+                                    maybeDeferred, returnValue, succeed)
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from gpib_wrapper import BinaryBlockError, parseBlock
+
+
+class TransportError(errors.Error):
+    """Instrument I/O failed."""
+
+
+class TransportTimeoutError(TransportError):
+    """Instrument I/O timed out."""
+
+
+class Metrics(object):
+    """Counts the operations of transports, by resource name and op."""
+
+    def __init__(self):
+        # (name, op) -> [count, bytes, errors, seconds]
+        self.ops = {}
+
+    def record(self, name, op, elapsed, nbytes, failed):
+        entry = self.ops.setdefault((name, op), [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += nbytes
+        entry[2] += bool(failed)
+        entry[3] += elapsed
+
+    def rows(self, name=None):
+        """Return (name, op, count, bytes, errors, time) for each op, of
+        the named resource or all of them."""
+        return [(n, op, long(count), long(nbytes), long(failed),
+                 units.Value(elapsed, 's'))
+                for (n, op), (count, nbytes, failed, elapsed)
+                in sorted(self.ops.items()) if name in (None, n)]
+
+    def report(self):
+        lines = []
+        for n, op, count, nbytes, failed, elapsed in self.rows():
+            lines.append('%-20s %-12s %6d ops %10d bytes %4d errors '
+                         '%8.3f ms/op' % (n, op, count, nbytes, failed,
+                                          elapsed['ms'] / count))
+        return '\n'.join(lines)
+
+
+def resultBytes(ans):
+    if isinstance(ans, (str, memoryview)):
+        return len(ans)
+    if isinstance(ans, list):
+        return sum(resultBytes(x) for x in ans)
+    return getattr(ans, 'nbytes', 0)
+
+
+class Transport(object):
+    """A resource with queued, asynchronous I/O operations."""
+
+    # default timeout of operations, in s
+    timeout = 1.0
+    # time after the timeout before an operation is cancelled, or None if
+    # it can't be, e.g. a call in a thread
+    grace = 1.0
+    # terminates the responses to queries, or None to read one message
+    readTermination = None
+
+    def __init__(self, name, metrics=None, reactor=reactor):
+        self.name = name
+        self.metrics = metrics
+        self.reactor = reactor
+        self.lock = DeferredLock()
+        self.leftover = ''
+
+    @inlineCallbacks
+    def run(self, op, f, *args, **kw):
+        """Call f(*args, timeout=timeout) after earlier ops have finished.
+
+        kw may give the timeout, in s, and the number of bytes sent, for
+        the metrics. Returns a Deferred with the result.
+        """
+        timeout = kw.get('timeout')
+        if timeout is None:
+            timeout = self.timeout
+        sent = kw.get('sent', 0)
+        yield self.lock.acquire()
+        start = time.time()
+        ans = None
+        failed = True
+        try:
+            d = maybeDeferred(f, *args, timeout=timeout)
+            if timeout > 0 and self.grace is not None:
+                d.addTimeout(timeout + self.grace, self.reactor,
+                             onTimeoutCancel=self._timedOut)
+            ans = yield d
+            failed = False
+        finally:
+            self.lock.release()
+            if self.metrics is not None:
+                self.metrics.record(self.name, op, time.time() - start,
+                                    sent + resultBytes(ans), failed)
+        returnValue(ans)
+
+    def _timedOut(self, result, timeout):
+        if hasattr(result, 'check') and result.check(CancelledError):
+            raise TransportTimeoutError('%s: no response within %g s'
+                                        % (self.name, timeout))
+        return result
+
+    # operations
+
+    def write(self, data, timeout=None):
+        """Send data."""
+        return self.run('write', self._write, data, timeout=timeout,
+                        sent=len(data))
+
+    def read(self, count=None, timeout=None):
+        """Read up to count bytes, or one message if count is None."""
+        return self.run('read', self._read, count, timeout=timeout)
+
+    def readUntil(self, delim, timeout=None, partial=False):
+        """Read up to delim, which is removed.
+
+        If delim doesn't arrive in time, fails with TransportTimeoutError,
+        leaving what was received to be read, or returns it if partial.
+        """
+        return self.run('read_until', self._readUntil, delim, partial,
+                        timeout=timeout)
+
+    def query(self, data, timeout=None):
+        """Send data and read the response."""
+        return self.run('query', self._query, data, timeout=timeout,
+                        sent=len(data))
+
+    def readBlock(self, dtype, timeout=None):
+        """Read an IEEE 488.2 binary block as an array of dtype."""
+        return self.run('read_block', self._readBlock, dtype,
+                        timeout=timeout)
+
+    def queryBlock(self, data, dtype, timeout=None):
+        """Send data and read the binary block response."""
+        @inlineCallbacks
+        def queryBlock(timeout):
+            yield self._write(data, timeout=timeout)
+            ans = yield self._readBlock(dtype, timeout=timeout)
+            returnValue(ans)
+        return self.run('query_block', queryBlock, timeout=timeout,
+                        sent=len(data))
+
+    def transaction(self, ops, timeout=None):
+        """Run a list of ops in one go, without other traffic in between.
+
+        Each op is (op, arg) or (op, arg, timeout). The ops are write,
+        query, read (arg is the byte count, or None), read_line (read
+        until the delimiter arg, returning what arrived on timeout),
+        read_until (likewise, but failing on timeout) and pause (wait for
+        the op's timeout). Returns one result per op, '' for writes and
+        pauses.
+        """
+        sent = sum(len(op[1]) for op in ops
+                   if op[0] in ('write', 'query'))
+        return self.run('transaction', self._transaction, ops,
+                        timeout=timeout, sent=sent)
+
+    # implementation, called while holding the lock
+
+    def _write(self, data, timeout):
+        raise NotImplementedError
+
+    def _readChunk(self, count, timeout):
+        """Read one message, or up to count bytes of it."""
+        raise NotImplementedError
+
+    @inlineCallbacks
+    def _read(self, count, timeout):
+        if not self.leftover:
+            self.leftover = yield self._readChunk(count, timeout=timeout)
+        if count is None:
+            count = len(self.leftover)
+        ans, self.leftover = self.leftover[:count], self.leftover[count:]
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _readExactly(self, count, timeout):
+        ans = ''
+        while len(ans) < count:
+            data = yield self._read(count - len(ans), timeout=timeout)
+            if not data:
+                raise TransportTimeoutError('%s: got %d of %d bytes'
+                                            % (self.name, len(ans), count))
+            ans += data
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _readUntil(self, delim, partial, timeout):
+        while delim not in self.leftover:
+            try:
+                data = yield self._readChunk(None, timeout=timeout)
+            except TransportTimeoutError:
+                data = ''
+            if not data:
+                if not partial:
+                    raise TransportTimeoutError('%s: %r not received'
+                                                % (self.name, delim))
+                ans, self.leftover = self.leftover, ''
+                returnValue(ans)
+            self.leftover += data
+        ans, self.leftover = self.leftover.split(delim, 1)
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _query(self, data, timeout):
+        yield self._write(data, timeout=timeout)
+        if self.readTermination:
+            ans = yield self._readUntil(self.readTermination, False,
+                                        timeout=timeout)
+        else:
+            ans = yield self._read(None, timeout=timeout)
+        returnValue(ans)
+
+    @inlineCallbacks
+    def _readBlock(self, dtype, timeout):
+        head = yield self._readExactly(2, timeout=timeout)
+        while head[:1].isspace():
+            more = yield self._readExactly(1, timeout=timeout)
+            head = head[1:] + more
+        if head[0] != '#' or not head[1].isdigit():
+            raise BinaryBlockError('Could not decode binary response: '
+                                   'no block header.')
+        n = int(head[1])
+        if n == 0:
+            payload = yield self._readUntil('\n', False, timeout=timeout)
+            returnValue(parseBlock(head + payload, dtype))
+        digits = yield self._readExactly(n, timeout=timeout)
+        if not digits.isdigit():
+            raise BinaryBlockError('Could not decode binary response: '
+                                   'bad block header.')
+        payload = yield self._readExactly(int(digits), timeout=timeout)
+        returnValue(parseBlock(head + digits + payload, dtype))
+
+    @inlineCallbacks
+    def _transaction(self, ops, timeout):
+        results = []
+        for op in ops:
+            op, arg, t = (op + (timeout,))[:3]
+            if t is None:
+                t = timeout
+            if op == 'write':
+                yield self._write(arg, timeout=t)
+                ans = ''
+            elif op == 'query':
+                ans = yield self._query(arg, timeout=t)
+            elif op == 'read':
+                ans = yield self._read(arg, timeout=t)
+            elif op == 'read_line':
+                ans = yield self._readUntil(arg, True, timeout=t)
+            elif op == 'read_until':
+                ans = yield self._readUntil(arg, False, timeout=t)
+            elif op == 'pause':
+                yield deferLater(self.reactor, t, lambda: None)
+                ans = ''
+            else:
+                raise ValueError('Unknown transaction op: %r' % (op,))
+            results.append(ans)
+        returnValue(results)
+
+
+class AddressWorkers(object):
+    """Runs blocking VISA calls in a thread pool, one at a time per address.
+
+    Calls for the same address run in the order they were made and never
+    overlap, so that e.g. the write and read of a query are not interleaved
+    with other traffic to the instrument. Calls for different addresses run
+    in parallel, so a slow instrument only holds up its own requests.
+    """
+
+    def __init__(self, maxThreads=10, reactor=reactor):
+        self.reactor = reactor
+        self.pool = ThreadPool(minthreads=0, maxthreads=maxThreads,
+                               name='GPIB Bus')
+        self.locks = {}
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    @inlineCallbacks
+    def run(self, addr, f, *args, **kw):
+        """Call f(*args, **kw) in a worker thread, after all earlier calls
+        for addr have finished. Returns a Deferred with the result."""
+        lock = self.locks.setdefault(addr, DeferredLock())
+        yield lock.acquire()
+        try:
+            ans = yield deferToThreadPool(self.reactor, self.pool,
+                                          f, *args, **kw)
+        finally:
+            lock.release()
+        returnValue(ans)
+
+
+class VisaTransport(Transport):
+    """A pyvisa instrument, called in the worker thread of its address."""
+
+    # VISA times out by itself, and a call in a thread can't be stopped
+    grace = None
+
+    def __init__(self, instr, addr, workers, metrics=None, reactor=reactor):
+        Transport.__init__(self, addr, metrics, reactor)
+        self.instr = instr
+        self.workers = workers
+
+    def _call(self, f, args, timeout):
+        instr = self.instr
+
+        def call():
+            instr.timeout = timeout * 1000.0
+            return f(instr, *args)
+        return self.workers.run(self.name, call)
+
+    def call(self, op, f, *args, **kw):
+        """Call f(instr, *args) in the worker thread, as operation op.
+
+        kw may give the timeout, in s, and the number of bytes sent.
+        """
+        return self.run(op, lambda timeout: self._call(f, args, timeout),
+                        **kw)
+
+    def _write(self, data, timeout):
+        return self._call(lambda instr: instr.write(data), (), timeout)
+
+    def _readChunk(self, count, timeout):
+        def read(instr):
+            if count is None:
+                return bytes(instr.read_raw())
+            return bytes(instr.read_raw(count))
+        return self._call(read, (), timeout)
+
+
+class SerialTransport(Transport):
+    """A serial port, read in the background by a PortReader.
+
+    Reads are served from the reader's buffer. Timeouts count from the
+    last byte received, and a read of count bytes without a timeout
+    returns what has arrived already.
+    """
+
+    grace = None
+    readTermination = '\r\n'
+
+    def __init__(self, ser, reader, metrics=None, reactor=reactor):
+        Transport.__init__(self, ser.port, metrics, reactor)
+        self.ser = ser
+        self.reader = reader
+
+    def _write(self, data, timeout):
+        self.ser.write(data)
+        self.reader.bytesOut += len(data)
+
+    def _read(self, count, timeout):
+        d = self.reader.read(count or 0, timeout if count else 0)
+        return d.addCallback(lambda data: data.tobytes())
+
+    def _readExactly(self, count, timeout):
+        def check(data):
+            if len(data) < count:
+                raise TransportTimeoutError('%s: got %d of %d bytes'
+                                            % (self.name, len(data), count))
+            return data
+        return self._read(count, timeout).addCallback(check)
+
+    def _readUntil(self, delim, partial, timeout):
+        def check(line):
+            if line is None:
+                raise TransportTimeoutError('%s: %r not received'
+                                            % (self.name, delim))
+            return line.tobytes()
+        d = self.reader.readLine(delim, timeout, partial)
+        return d.addCallback(check)
+
+
+# IBCL timeout codes: the index in this list, plus one, of the first time
+# not shorter than the timeout, in s
+IBCL_TIMEOUTS = [.00001, .00003, .0001, .0003, .001, .003, .01, .03,
+                 .1, .3, 1, 3, 10, 30, 100, 300, 1000]
+
+IBCL_ESCAPES = [('%%%02X' % i, chr(i)) for i in range(32) + range(127, 256)] \
+    + [('%%', '%')]
+
+
+def ibclTimeoutIndex(timeout):
+    """IBCL timeout code for a timeout in s, 0 for no timeout."""
+    for i, t in enumerate(IBCL_TIMEOUTS):
+        if timeout <= t:
+            return i + 1
+    return 0
+
+
+def ibclStatus(word):
+    """Decode a GPIB status word, in hex, into a list of 16 bits."""
+    state = int(word, 16)
+    return [(state & 2**b) > 0 for b in range(16)]
+
+
+def ibclDecode(data):
+    """Decode data sent by the IBCL bindl word, which escapes
+    nonprintable characters as %HEX and % as %%."""
+    if '%' in data:
+        for old, new in IBCL_ESCAPES:
+            data = data.replace(old, new)
+    return data
+
+
+class IBCLTransport(Transport):
+    """A GPIB device on a GPIB-422CT controller, through the IBCL server.
+
+    Uses the read and write words loaded into the controller by the IBCL
+    GPIB server. Writes give the GPIB status bits, and status is the GPIB
+    status of the last operation.
+    """
+
+    # bytes read at a time, the size of the controller's read buffer
+    maxChunk = 10000
+
+    def __init__(self, ibcl, controller, gpibAddr, buffer, context=None,
+                 metrics=None, reactor=reactor):
+        Transport.__init__(self, '%s::%d' % (controller, gpibAddr), metrics,
+                           reactor)
+        self.ibcl = ibcl
+        self.controller = controller
+        self.gpibAddr = gpibAddr
+        self.buffer = buffer
+        self.context = context
+        self.status = [False] * 16
+
+    @inlineCallbacks
+    def _command(self, cmd, timeout):
+        p = self.ibcl.packet(context=self.context)
+        p.select(self.controller)
+        p.command(cmd, units.Value(timeout + 0.1, 's'), key='ans')
+        ans = yield p.send()
+        returnValue(ans['ans'])
+
+    @inlineCallbacks
+    def _write(self, data, timeout):
+        """Returns the GPIB status."""
+        res = yield self._command('%X " %s" %X write' % (
+            self.gpibAddr, data, ibclTimeoutIndex(timeout)), timeout)
+        self.status = ibclStatus(res[0][0])
+        returnValue(self.status)
+
+    @inlineCallbacks
+    def _readChunk(self, count, timeout):
+        ans = ''
+        while True:
+            n = self.maxChunk if count is None \
+                else min(count - len(ans), self.maxChunk)
+            res = yield self._command('%X %X %X %X read' % (
+                self.gpibAddr, self.buffer, n, ibclTimeoutIndex(timeout)),
+                timeout)
+            self.status = ibclStatus(res[0][0])
+            data = ibclDecode(res[0][1])
+            ans += data
+            if count is None or len(data) < n or len(ans) >= count:
+                returnValue(ans)
+
+
+def echo(data):
+    """Default loopback response: everything is echoed back."""
+    return data
+
+
+class LoopbackTransport(Transport):
+    """An instrument in memory, for tests and benchmarks.
+
+    respond(data) gives the response to data written, or None. Responses
+    can be read delay seconds after the write. Each response is one
+    message. written lists what was written.
+    """
+
+    def __init__(self, name='loopback', respond=echo, delay=0.0,
+                 metrics=None, reactor=reactor):
+        Transport.__init__(self, name, metrics, reactor)
+        self.respond = respond
+        self.delay = delay
+        self.written = []
+        self.output = []
+        self.waiting = None
+
+    def _write(self, data, timeout):
+        self.written.append(data)
+        ans = self.respond(data)
+        if ans is not None:
+            if self.delay:
+                self.reactor.callLater(self.delay, self.send, ans)
+            else:
+                self.send(ans)
+
+    def send(self, data):
+        """Make data available to read, as a message."""
+        self.output.append(data)
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            d.callback(None)
+
+    @inlineCallbacks
+    def _readChunk(self, count, timeout):
+        if not self.output:
+            if timeout <= 0:
+                raise TransportTimeoutError('%s: nothing to read'
+                                            % self.name)
+            d = self.waiting = Deferred()
+
+            def expire():
+                if self.waiting is d:
+                    self.waiting = None
+                    d.errback(TransportTimeoutError(
+                        '%s: no response within %g s' % (self.name, timeout)))
+            timer = self.reactor.callLater(timeout, expire)
+            try:
+                yield d
+            finally:
+                if timer.active():
+                    timer.cancel()
+        data = self.output[0]
+        if count is None or count >= len(data):
+            self.output.pop(0)
+            returnValue(data)
+        self.output[0] = data[count:]
+        returnValue(data[:count])
+
+
+def benchmark(nResources, nQueries, delay):
+    """Time queries to loopback instruments that answer after delay s."""
+    metrics = Metrics()
+    transports = [LoopbackTransport('loopback %d' % i, delay=delay,
+                                    metrics=metrics)
+                  for i in range(nResources)]
+
+    @inlineCallbacks
+    def oneByOne(t):
+        for i in range(nQueries):
+            ans = yield t.query('MEAS%d?' % i)
+            assert ans == 'MEAS%d?' % i
+
+    def inTurn():
+        d = succeed(None)
+        for t in transports:
+            d.addCallback(lambda _, t=t: oneByOne(t))
+        return d
+
+    def concurrent():
+        return DeferredList([oneByOne(t) for t in transports],
+                            fireOnOneErrback=True)
+
+    def pipelined():
+        return DeferredList([pipeline(t) for t in transports],
+                            fireOnOneErrback=True)
+
+    @inlineCallbacks
+    def pipeline(t):
+        ds = [t.query('MEAS%d?' % i) for i in range(nQueries)]
+        ans = yield DeferredList(ds, fireOnOneErrback=True)
+        assert [a for ok, a in ans] == ['MEAS%d?' % i for i in range(nQueries)]
+
+    @inlineCallbacks
+    def run():
+        try:
+            print '%d instruments x %d queries, %g s per query:' % (
+                nResources, nQueries, delay)
+            for name, f in [('in turn', inTurn), ('concurrent', concurrent),
+                            ('pipelined', pipelined)]:
+                start = time.time()
+                yield f()
+                print '  %-12s %8.3f s' % (name, time.time() - start)
+            transports[0].delay = 0.0
+            start = time.time()
+            for i in range(nQueries):
+                yield transports[0].query('x')
+            t0 = time.time()
+            for i in range(nQueries):
+                yield transports[0].transaction([('query', 'x')])
+            t1 = time.time()
+            print 'overhead per query, no delay: %.3f ms' % (
+                (t0 - start) / nQueries * 1e3)
+            print 'overhead per transaction of one query: %.3f ms' % (
+                (t1 - t0) / nQueries * 1e3)
+            print metrics.report()
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark transports with loopback instruments.')
+    parser.add_argument('--resources', type=int, default=4,
+                        help='number of instruments')
+    parser.add_argument('--queries', type=int, default=50,
+                        help='queries per instrument')
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='time each query takes, in s')
+    args = parser.parse_args()
+    benchmark(args.resources, args.queries, args.delay)